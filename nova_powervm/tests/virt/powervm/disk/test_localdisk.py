@@ -126,6 +126,15 @@ class TestLocalDisk(test.TestCase):
                                             disk_prefixes=None)
         self.assertEqual(1, mock_remove.call_count)
 
+        # The partition ID is not looked up when the caller has it.
+        mock_get_vm_id.reset_mock()
+        mock_remove.reset_mock()
+        local.disconnect_image_disk(mock.MagicMock(), mock.MagicMock(), '2',
+                                    lpar_id=3)
+        mock_remove.assert_called_once_with(mock.ANY, mock.ANY, 3,
+                                            disk_prefixes=None)
+        self.assertFalse(mock_get_vm_id.called)
+
     @mock.patch('pypowervm.tasks.scsi_mapper.remove_vdisk_mapping')
     @mock.patch('nova_powervm.virt.powervm.vm.get_vm_id')
     def test_disconnect_image_disk_disktype(self, mock_get_vm_id, mock_remove):
@@ -158,6 +167,15 @@ class TestLocalDisk(test.TestCase):
                         mock_vdisk, 'lpar_UUID')
         self.assertEqual(1, mock_add_mapping.call_count)
 
+        # With an accumulator, the mapping is queued instead.
+        mock_add_mapping.reset_mock()
+        mapping_acc = mock.Mock()
+        ls.connect_disk(mock.MagicMock(), mock.MagicMock(),
+                        mock_vdisk, 'lpar_UUID', mapping_acc=mapping_acc)
+        mapping_acc.add_storage_mapping.assert_called_once_with(
+            ls.vios_uuid, 'lpar_UUID', mock_vdisk)
+        self.assertFalse(mock_add_mapping.called)
+
     @mock.patch('pypowervm.wrappers.storage.VG.update')
     @mock.patch('nova_powervm.virt.powervm.disk.localdisk.LocalStorage.'
                 '_get_vg_wrap')
@@ -18,10 +18,12 @@ import fixtures
 import mock
 from oslo_config import cfg
 
+from nova import exception as nova_exc
 from nova import test
 import os
 import pypowervm.adapter as pvm_adp
 import pypowervm.entities as pvm_ent
+import pypowervm.exceptions as pvm_exc
 from pypowervm.tests.wrappers.util import pvmhttp
 from pypowervm.wrappers import cluster as pvm_clust
 from pypowervm.wrappers import storage as pvm_stg
@@ -361,6 +363,17 @@ class TestSSPDiskAdapter(test.TestCase):
         ssp_stor.connect_disk(None, self.instance, lu, 'lpar_uuid')
         self.assertEqual(1, mock_add_map.call_count)
 
+        # With an accumulator, the mapping is queued instead.
+        mock_add_map.reset_mock()
+        mapping_acc = mock.Mock()
+        ssp_stor.connect_disk(None, self.instance, lu, 'lpar_uuid',
+                              mapping_acc=mapping_acc)
+        mapping_acc.add_storage_mapping.assert_called_once_with(
+            '6424120D-CA95-437D-9C18-10B06F4B3400', 'lpar_uuid', mock.ANY)
+        self.assertEqual(
+            lu.name, mapping_acc.add_storage_mapping.call_args[0][2].name)
+        self.assertFalse(mock_add_map.called)
+
     def test_delete_disks(self):
         def _mk_img_lu(idx):
             lu = pvm_stg.LU.bld(None, 'img_lu%d' % idx, 123,
@@ -427,6 +440,61 @@ class TestSSPDiskAdapter(test.TestCase):
         lu_list = ssp_stor.disconnect_image_disk(None, None, None)
         self.assertEqual({lu1, lu2}, set(lu_list))
 
+        # With the partition ID from the caller, the VM is not read and the
+        # VIOSes on the driver's host are used.
+        mock_vm_qp.reset_mock()
+        ssp_stor.host_uuid = '67dca605-3923-34da-bd8f-26a378fc817f'
+        lu_list = ssp_stor.disconnect_image_disk(None, None, None,
+                                                 lpar_id='lpar_id')
+        self.assertEqual({lu1, lu2}, set(lu_list))
+        self.assertFalse(mock_vm_qp.called)
+
+    def test_extend_disk(self):
+        ssp_stor = self._get_ssp_stor()
+        ssp1 = ssp_stor._ssp_wrap
+        dsk_lu = pvm_stg.LU.bld(None, 'boot_instance_name', 10,
+                                typ=pvm_stg.LUType.DISK)
+        ssp1.logical_units = [dsk_lu]
+        self.apt.update_by_path.return_value = ssp1.entry
+
+        # Disk not found in the SSP
+        self.assertRaises(nova_exc.DiskNotFound, ssp_stor.extend_disk,
+                          'context', self.instance, dict(type='rescue'), 20)
+        self.assertEqual(0, self.apt.update_by_path.call_count)
+
+        # Extend the boot disk
+        ssp_stor.extend_disk('context', self.instance, dict(type='boot'), 20)
+        self.assertEqual(20, dsk_lu.capacity)
+        self.assertEqual(1, self.apt.update_by_path.call_count)
+
+        # Already at (or above) the requested size, no update
+        ssp_stor.extend_disk('context', self.instance, dict(type='boot'), 15)
+        self.assertEqual(1, self.apt.update_by_path.call_count)
+
+    def test_get_disk(self):
+        ssp_stor = self._get_ssp_stor()
+        dsk_lu = pvm_stg.LU.bld(None, 'boot_instance_name', 10,
+                                typ=pvm_stg.LUType.DISK)
+        ssp_stor._ssp_wrap.logical_units = [dsk_lu]
+
+        self.assertEqual(dsk_lu, ssp_stor.get_disk('context', self.instance))
+        self.assertRaises(nova_exc.DiskNotFound, ssp_stor.get_disk,
+                          'context', self.instance, disk_type='rescue')
+
+    def test_extend_disk_etag_retry(self):
+        ssp_stor = self._get_ssp_stor()
+        ssp1 = ssp_stor._ssp_wrap
+        dsk_lu = pvm_stg.LU.bld(None, 'boot_instance_name', 10,
+                                typ=pvm_stg.LUType.DISK)
+        ssp1.logical_units = [dsk_lu]
+
+        # First update fails on an etag mismatch, the second works.
+        resp = mock.Mock(status=412)
+        self.apt.update_by_path.side_effect = [
+            pvm_exc.HttpError('etag mismatch', response=resp), ssp1.entry]
+        ssp_stor.extend_disk('context', self.instance, dict(type='boot'), 20)
+        self.assertEqual(2, self.apt.update_by_path.call_count)
+
     def test_shared_stg_calls(self):
 
         # Check the good paths
@@ -21,6 +21,7 @@ import fixtures
 import mock
 
 from nova_powervm.virt.powervm import driver
+from nova_powervm.virt.powervm import vios
 
 from nova.virt import fake
 from pypowervm.tests.wrappers.util import pvmhttp
@@ -44,6 +45,9 @@ class PyPowerVM(fixtures.Fixture):
         self.addCleanup(self._sess_patcher.stop)
         self.addCleanup(self._apt_patcher.stop)
 
+        # Feeds cached by an earlier test came from a different adapter.
+        vios.invalidate_vios_feed()
+
 
 class ImageAPI(fixtures.Fixture):
     """Mock out the Glance API."""
@@ -15,11 +15,14 @@
 #    under the License.
 #
 
+import eventlet
+import fixtures
 import logging
 
 import mock
 from oslo_config import cfg
 
+from nova.compute import task_states
 from nova import exception as exc
 from nova import objects
 from nova import test
@@ -34,6 +37,7 @@ import pypowervm.wrappers.managed_system as pvm_ms
 from nova_powervm.tests.virt import powervm
 from nova_powervm.tests.virt.powervm import fixtures as fx
 from nova_powervm.virt.powervm import driver
+from nova_powervm.virt.powervm.volume import vscsi
 
 MS_HTTPRESP_FILE = "managedsystem.txt"
 MS_NAME = 'HV4'
@@ -119,10 +123,14 @@ class TestPowerVMDriver(test.TestCase):
             inst_list = self.drv.list_instances()
             self.assertEqual(fake_lpar_list, inst_list)
 
+            # The warm pool LPARs are not instances.
+            mock_get_list.return_value = ['1', 'pvm-warm-0123abcd-00ff', '2']
+            self.assertEqual(['1', '2'], self.drv.list_instances())
+
     @mock.patch('nova_powervm.virt.powervm.driver.PowerVMDriver._plug_vifs')
     @mock.patch('nova.virt.configdrive.required_by')
     @mock.patch('nova.objects.flavor.Flavor.get_by_id')
-    @mock.patch('pypowervm.tasks.power.power_on')
+    @mock.patch('nova_powervm.virt.powervm.vm.start_lpar')
     def test_spawn_ops(self, mock_pwron, mock_get_flv, mock_cfg_drv,
                        mock_plug_vifs):
 
@@ -150,7 +158,7 @@ class TestPowerVMDriver(test.TestCase):
                 '_validate_vopt_vg')
     @mock.patch('nova.virt.configdrive.required_by')
     @mock.patch('nova.objects.flavor.Flavor.get_by_id')
-    @mock.patch('pypowervm.tasks.power.power_on')
+    @mock.patch('nova_powervm.virt.powervm.vm.start_lpar')
     def test_spawn_with_cfg(self, mock_pwron, mock_get_flv, mock_cfg_drv,
                             mock_val_vopt, mock_cfg_vopt, mock_plug_vifs):
 
@@ -178,7 +186,7 @@ class TestPowerVMDriver(test.TestCase):
                 '_validate_vopt_vg')
     @mock.patch('nova.virt.configdrive.required_by')
     @mock.patch('nova.objects.flavor.Flavor.get_by_id')
-    @mock.patch('pypowervm.tasks.power.power_on')
+    @mock.patch('nova_powervm.virt.powervm.vm.start_lpar')
     def test_spawn_with_bdms(self, mock_pwron, mock_get_flv, mock_cfg_drv,
                              mock_val_vopt, mock_cfg_vopt, mock_plug_vifs):
 
@@ -206,12 +214,22 @@ class TestPowerVMDriver(test.TestCase):
         # Check that the connect volume was called
         self.assertEqual(2, self.fc_vol_drv.connect_volume.call_count)
 
+        # Both volumes, the boot disk and the config drive queued their
+        # mappings on the same accumulator.
+        accs = set(call[1]['mapping_acc'] for call in
+                   self.fc_vol_drv.connect_volume.call_args_list)
+        accs.add(self.drv.disk_dvr.connect_disk.call_args[1]['mapping_acc'])
+        accs.add(mock_cfg_vopt.call_args[1]['mapping_acc'])
+        self.assertEqual(1, len(accs))
+        self.assertIsInstance(accs.pop(), vscsi.VscsiMappingAccumulator)
+        self.assertEqual({}, vscsi.VscsiMappingAccumulator._spawns)
+
     @mock.patch('nova_powervm.virt.powervm.driver.PowerVMDriver._plug_vifs')
     @mock.patch('nova_powervm.virt.powervm.vm.dlt_lpar')
     @mock.patch('nova.virt.configdrive.required_by')
     @mock.patch('nova.objects.flavor.Flavor.get_by_id')
-    @mock.patch('pypowervm.tasks.power.power_on')
-    @mock.patch('pypowervm.tasks.power.power_off')
+    @mock.patch('nova_powervm.virt.powervm.vm.start_lpar')
+    @mock.patch('nova_powervm.virt.powervm.vm.stop_lpar_immediate')
     def test_spawn_ops_rollback(self, mock_pwroff, mock_pwron, mock_get_flv,
                                 mock_cfg_drv, mock_dlt, mock_plug_vifs):
         """Validates the PowerVM driver operations.  Will do a rollback."""
@@ -243,6 +261,51 @@ class TestPowerVMDriver(test.TestCase):
         self.assertTrue(mock_dlt.called)
         self.assertEqual(2, self.fc_vol_drv.disconnect_volume.call_count)
 
+    @mock.patch('nova_powervm.virt.powervm.driver.PowerVMDriver._plug_vifs')
+    @mock.patch('nova_powervm.virt.powervm.volume.vscsi.'
+                'VscsiMappingAccumulator.apply_batched')
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
+                '_rm_media')
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
+                'dlt_vopt')
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
+                '_upload_vopt_stream')
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
+                '_create_cfg_dr_iso_mem')
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
+                '_validate_vopt_vg')
+    @mock.patch('nova_powervm.virt.powervm.vm.dlt_lpar')
+    @mock.patch('nova.virt.configdrive.required_by')
+    @mock.patch('nova.objects.flavor.Flavor.get_by_id')
+    @mock.patch('nova_powervm.virt.powervm.vm.start_lpar')
+    @mock.patch('nova_powervm.virt.powervm.vm.stop_lpar_immediate')
+    def test_spawn_cfg_rollback(self, mock_pwroff, mock_pwron, mock_get_flv,
+                                mock_cfg_drv, mock_dlt, mock_val_vopt,
+                                mock_iso, mock_upload, mock_dlt_vopt,
+                                mock_rm_media, mock_apply, mock_plug_vifs):
+        """A failed spawn removes the config drive media it uploaded."""
+        tmp_dir = self.useFixture(fixtures.TempDir()).path
+        self.flags(image_meta_in_memory=True, image_meta_local_path=tmp_dir)
+        inst = objects.Instance(**powervm.TEST_INSTANCE)
+        mock_get_flv.return_value = inst.get_flavor()
+        mock_cfg_drv.return_value = True
+        mock_iso.return_value = (mock.MagicMock(), 'config_inst.iso', 10)
+        mock_upload.return_value = (mock.Mock(), 'f_uuid')
+
+        # The mappings, the config drive's among them, are never added.
+        mock_apply.side_effect = pvm_exc.Error('apply failed')
+        self.assertRaises(pvm_exc.Error, self.drv.spawn, 'context', inst,
+                          mock.Mock(), 'injected_files', 'admin_password')
+        self.assertFalse(mock_pwron.called)
+
+        # So the media is not found from the mappings, and is removed by
+        # name.
+        self.assertTrue(mock_dlt_vopt.called)
+        mock_rm_media.assert_called_once_with(mock.ANY, mock.ANY,
+                                              {'config_inst.iso'})
+        self.assertTrue(mock_dlt.called)
+
+    @mock.patch('nova_powervm.virt.powervm.vm.get_vm_id')
     @mock.patch('nova_powervm.virt.powervm.vm.dlt_lpar')
     @mock.patch('nova_powervm.virt.powervm.vm.power_off')
     @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
@@ -255,7 +318,7 @@ class TestPowerVMDriver(test.TestCase):
     @mock.patch('nova.objects.flavor.Flavor.get_by_id')
     def test_destroy(
         self, mock_get_flv, mock_cache, mock_pvmuuid, mock_inst_wrap,
-        mock_val_vopt, mock_dlt_vopt, mock_pwroff, mock_dlt):
+        mock_val_vopt, mock_dlt_vopt, mock_pwroff, mock_dlt, mock_vm_id):
 
         """Validates the basic PowerVM destroy."""
         # Set up the mocks to the tasks.
@@ -267,6 +330,7 @@ class TestPowerVMDriver(test.TestCase):
         mock_cache.get_cache.return_value = singleton
         # BDMs
         mock_bdms = self._fake_bdms()
+        mock_vm_id.return_value = 2
 
         # Invoke the method.
         self.drv.destroy('context', inst, mock.Mock(),
@@ -275,11 +339,16 @@ class TestPowerVMDriver(test.TestCase):
         # Power off was called
         self.assertTrue(mock_pwroff.called)
 
-        # Validate that the vopt delete was called
-        self.assertTrue(mock_dlt_vopt.called)
+        # The partition ID was looked up once and given to the storage tasks
+        self.assertEqual(1, mock_vm_id.call_count)
+        mock_dlt_vopt.assert_called_once_with(mock.ANY, lpar_id=2)
+        self.drv.disk_dvr.disconnect_image_disk.assert_called_once_with(
+            'context', inst, mock.ANY, disk_type=None, lpar_id=2)
 
         # Validate that the volume detach was called
         self.assertEqual(2, self.fc_vol_drv.disconnect_volume.call_count)
+        for call in self.fc_vol_drv.disconnect_volume.call_args_list:
+            self.assertEqual(2, call[1]['lpar_id'])
 
         # Delete LPAR was called, and removed from the cache
         mock_dlt.assert_called_with(self.apt, mock.ANY)
@@ -359,10 +428,12 @@ class TestPowerVMDriver(test.TestCase):
         # Verify the connect volume was invoked
         self.assertEqual(1, mock_conn_volume.call_count)
 
+    @mock.patch('nova_powervm.virt.powervm.vm.get_vm_id')
     @mock.patch('nova_powervm.virt.powervm.volume.vscsi.VscsiVolumeAdapter.'
                 'disconnect_volume')
     @mock.patch('nova_powervm.virt.powervm.vm.get_pvm_uuid')
-    def test_detach_volume(self, mock_pvmuuid, mock_disconn_volume):
+    def test_detach_volume(self, mock_pvmuuid, mock_disconn_volume,
+                           mock_vm_id):
 
         """Validates the basic PowerVM destroy."""
         # Set up the mocks to the tasks.
@@ -375,9 +446,103 @@ class TestPowerVMDriver(test.TestCase):
         # Invoke the method.
         self.drv.detach_volume(mock_bdm['connection_info'], inst, mock.Mock())
 
-        # Verify the connect volume was invoked
+        # Verify the disconnect volume was invoked
         self.assertEqual(1, mock_disconn_volume.call_count)
+        self.assertEqual(mock_vm_id.return_value,
+                         mock_disconn_volume.call_args[1]['lpar_id'])
+
+    @mock.patch('nova_powervm.virt.powervm.vm.get_vm_id')
+    @mock.patch('nova_powervm.virt.powervm.volume.vscsi.'
+                'VscsiMappingAccumulator')
+    @mock.patch('nova_powervm.virt.powervm.vm.get_pvm_uuid')
+    def test_attach_volumes(self, mock_pvmuuid, mock_acc, mock_vm_id):
+        """Validates the bulk volume attach."""
+        inst = objects.Instance(**powervm.TEST_INSTANCE)
+        mock_pvmuuid.return_value = 'pvm_uuid'
+        mock_vm_id.return_value = 2
+        conn_infos = [dict(bdm['connection_info'], serial=str(i))
+                      for i, bdm in enumerate(
+                          self._fake_bdms()['block_device_mapping'])]
+
+        # The second volume fails, the first is still attached.
+        def connect(adpt, host_uuid, vm_uuid, instance, conn_info,
+                    mapping_acc=None, lpar_id=None):
+            if conn_info['serial'] == '1':
+                raise pvm_exc.Error('no hdisk')
+        self.fc_vol_drv.connect_volume.side_effect = connect
+        results = self.drv.attach_volumes('context', inst, conn_infos)
+
+        self.assertEqual(2, len(results))
+        self.assertEqual((conn_infos[0], None), results[0])
+        self.assertIs(conn_infos[1], results[1][0])
+        self.assertIsInstance(results[1][1], pvm_exc.Error)
+        # The mappings went through one accumulator, applied once.
+        acc = mock_acc.return_value
+        self.fc_vol_drv.connect_volume.assert_any_call(
+            self.apt, self.drv.host_uuid, 'pvm_uuid', inst, conn_infos[0],
+            mapping_acc=acc, lpar_id=2)
+        acc.apply.assert_called_once_with()
+        self.assertFalse(acc.rollback.called)
+
+        # If the mappings cannot be sent, none of the volumes is attached.
+        acc.apply.side_effect = exc.Forbidden()
+        results = self.drv.attach_volumes('context', inst, conn_infos)
+        self.assertIsInstance(results[0][1], exc.Forbidden)
+        self.assertIsInstance(results[1][1], pvm_exc.Error)
+        acc.rollback.assert_called_once_with()
+
+    @mock.patch('nova_powervm.virt.powervm.vm.get_vm_id')
+    @mock.patch('nova_powervm.virt.powervm.volume.vscsi.'
+                'VscsiMappingAccumulator')
+    @mock.patch('nova_powervm.virt.powervm.vm.get_pvm_uuid')
+    def test_detach_volumes(self, mock_pvmuuid, mock_acc, mock_vm_id):
+        """Validates the bulk volume detach."""
+        inst = objects.Instance(**powervm.TEST_INSTANCE)
+        mock_pvmuuid.return_value = 'pvm_uuid'
+        mock_vm_id.return_value = 2
+        conn_infos = [bdm['connection_info'] for bdm in
+                      self._fake_bdms()['block_device_mapping']]
+
+        results = self.drv.detach_volumes(inst, conn_infos)
+        self.assertEqual([(conn_infos[0], None), (conn_infos[1], None)],
+                         results)
+        self.assertEqual(2, self.fc_vol_drv.disconnect_volume.call_count)
+        self.fc_vol_drv.disconnect_volume.assert_any_call(
+            self.apt, self.drv.host_uuid, 'pvm_uuid', inst, conn_infos[1],
+            mapping_acc=mock_acc.return_value, lpar_id=2)
+        mock_acc.return_value.apply.assert_called_once_with()
+
+    @mock.patch('nova_powervm.virt.powervm.vm.get_vm_id')
+    @mock.patch('nova_powervm.virt.powervm.volume.vscsi.'
+                'VscsiMappingAccumulator')
+    @mock.patch('nova_powervm.virt.powervm.vm.get_pvm_uuid')
+    def test_attach_volumes_unqueued(self, mock_pvmuuid, mock_acc,
+                                     mock_vm_id):
+        """Validates that adapters without an accumulator run serially."""
+        inst = objects.Instance(**powervm.TEST_INSTANCE)
+        mock_pvmuuid.return_value = 'pvm_uuid'
+        mock_vm_id.return_value = 2
+        conn_infos = [bdm['connection_info'] for bdm in
+                      self._fake_bdms()['block_device_mapping']]
+        self.fc_vol_drv.queues_mappings = False
+
+        running = []
+
+        def connect(*args, **kwargs):
+            running.append(kwargs)
+            self.assertEqual(1, len(running))
+            eventlet.sleep(0)
+            running.pop()
+        self.fc_vol_drv.connect_volume.side_effect = connect
+
+        # The mappings they made are not undone by a failed apply.
+        mock_acc.return_value.apply.side_effect = exc.Forbidden()
+        results = self.drv.attach_volumes('context', inst, conn_infos)
+        self.assertEqual([(conn_infos[0], None), (conn_infos[1], None)],
+                         results)
+        self.assertEqual(2, self.fc_vol_drv.connect_volume.call_count)
 
+    @mock.patch('nova_powervm.virt.powervm.vm.get_vm_id')
     @mock.patch('nova_powervm.virt.powervm.vm.dlt_lpar')
     @mock.patch('nova_powervm.virt.powervm.vm.power_off')
     @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
@@ -389,7 +554,7 @@ class TestPowerVMDriver(test.TestCase):
     @mock.patch('nova.objects.flavor.Flavor.get_by_id')
     def test_destroy_rollback(self, mock_get_flv, mock_pvmuuid, mock_inst_wrap,
                               mock_val_vopt, mock_dlt_vopt, mock_pwroff,
-                              mock_dlt):
+                              mock_dlt, mock_vm_id):
 
         """Validates the basic PowerVM destroy rollback mechanism works."""
         # Set up the mocks to the tasks.
@@ -419,11 +584,51 @@ class TestPowerVMDriver(test.TestCase):
         # Validate the rollbacks were called.
         self.assertEqual(2, self.fc_vol_drv.connect_volume.call_count)
 
+    @mock.patch('nova_powervm.virt.powervm.vm.power_on_many')
+    @mock.patch('nova_powervm.virt.powervm.vm.power_off_many')
+    def test_power_instances(self, mock_off_many, mock_on_many):
+        """Validates the bulk power operations of the driver."""
+        insts = [objects.Instance(**powervm.TEST_INSTANCE)]
+        self.assertEqual(mock_off_many.return_value,
+                         self.drv.power_off_instances(insts))
+        mock_off_many.assert_called_once_with(self.apt, insts,
+                                              self.drv.host_uuid)
+        self.assertEqual(mock_on_many.return_value,
+                         self.drv.power_on_instances(insts))
+        mock_on_many.assert_called_once_with(self.apt, insts,
+                                             self.drv.host_uuid)
+
+    @mock.patch('nova_powervm.virt.powervm.vm.get_vm_id')
+    @mock.patch('nova_powervm.virt.powervm.vm.dlt_lpar')
+    @mock.patch('nova_powervm.virt.powervm.vm.power_off')
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
+                'dlt_vopt')
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
+                '_validate_vopt_vg')
+    @mock.patch('nova_powervm.virt.powervm.vm.get_pvm_uuid')
+    @mock.patch('nova_powervm.virt.powervm.vm.UUIDCache')
+    def test_destroy_resize_revert(self, mock_cache, mock_pvmuuid,
+                                   mock_val_vopt, mock_dlt_vopt, mock_pwroff,
+                                   mock_dlt, mock_vm_id):
+        inst = objects.Instance(**powervm.TEST_INSTANCE)
+        inst.task_state = task_states.RESIZE_REVERTING
+        inst.system_metadata = {}
+
+        # The LPAR of a resize on this host is kept.
+        self.drv.destroy('context', inst, 'network_info')
+        self.assertFalse(mock_dlt.called)
+
+        # The LPAR of a migration from another host goes, but not its disks.
+        inst.system_metadata = {driver.SHARED_STG_MIGRATION_KEY: 'src_host'}
+        self.drv.destroy('context', inst, 'network_info')
+        mock_dlt.assert_called_once_with(self.apt, mock_pvmuuid.return_value)
+        self.assertFalse(self.drv.disk_dvr.delete_disks.called)
+
     @mock.patch('nova_powervm.virt.powervm.vm.get_pvm_uuid')
     @mock.patch('nova_powervm.virt.powervm.vm.power_off')
-    @mock.patch('nova_powervm.virt.powervm.vm.update')
+    @mock.patch('nova_powervm.virt.powervm.vm.resize')
     @mock.patch('nova.objects.flavor.Flavor.get_by_id')
-    def test_resize(self, mock_get_flv, mock_update, mock_pwr_off,
+    def test_resize(self, mock_get_flv, mock_resize, mock_pwr_off,
                     mock_get_uuid):
         """Validates the PowerVM driver resize operation."""
         # Set up the mocks to the resize operation.
@@ -441,18 +646,20 @@ class TestPowerVMDriver(test.TestCase):
 
         new_flav = objects.Flavor(vcpus=1, memory_mb=2048, root_gb=10)
 
-        # We don't support resize to different host.
+        # A migration to a different host needs shared storage.
+        self.drv.disk_dvr.check_instance_shared_storage_local.side_effect = (
+            NotImplementedError())
         self.assertRaises(
-            NotImplementedError, self.drv.migrate_disk_and_power_off,
+            exc.InstanceFaultRollback, self.drv.migrate_disk_and_power_off,
             'context', inst, 'bogus host', new_flav, 'network_info')
+        self.assertFalse(mock_pwr_off.called)
 
+        # The resize itself decides whether to power off.
         self.drv.migrate_disk_and_power_off(
             'context', inst, host, new_flav, 'network_info')
-        mock_pwr_off.assert_called_with(
-            self.drv.adapter, inst, self.drv.host_uuid, entry=mock.ANY)
-        mock_update.assert_called_with(
-            self.drv.adapter, self.drv.host_wrapper, inst, new_flav,
-            entry=mock.ANY)
+        self.assertFalse(mock_pwr_off.called)
+        mock_resize.assert_called_with(
+            self.drv.adapter, self.drv.host_wrapper, inst, new_flav)
 
         # Boot disk resize
         boot_flav = objects.Flavor(vcpus=1, memory_mb=2048, root_gb=12)
@@ -460,13 +667,151 @@ class TestPowerVMDriver(test.TestCase):
             'context', inst, host, boot_flav, 'network_info')
         self.drv.disk_dvr.extend_disk.assert_called_with(
             'context', inst, dict(type='boot'), 12)
+        mock_pwr_off.assert_called_once_with(self.drv.adapter, inst,
+                                             self.drv.host_uuid)
+
+    @mock.patch('nova_powervm.virt.powervm.vm.get_vm_id')
+    @mock.patch('nova_powervm.virt.powervm.vm.power_off')
+    @mock.patch('nova_powervm.virt.powervm.vm.get_pvm_uuid')
+    def test_migrate_shared_stg(self, mock_get_uuid, mock_pwr_off,
+                                mock_vm_id):
+        inst = objects.Instance(**powervm.TEST_INSTANCE)
+        inst.system_metadata = {}
+        mock_vm_id.return_value = 2
+        self.drv.disk_dvr.check_instance_shared_storage_local.return_value = {
+            'ssp_uuid': 'ssp'}
+        flav = objects.Flavor(vcpus=1, memory_mb=2048, root_gb=12)
+
+        disk_info = self.drv.migrate_disk_and_power_off(
+            'context', inst, 'dest', flav, 'network_info',
+            block_device_info=self._fake_bdms())
+        self.assertEqual({'shared_storage': {'ssp_uuid': 'ssp'}}, disk_info)
+        mock_pwr_off.assert_called_once_with(
+            self.drv.adapter, inst, self.drv.host_uuid,
+            force_immediate=True)
+        # The volumes are unmapped.  The boot disk stays mapped until the
+        # migration is confirmed, and is grown in place.
+        self.assertEqual(2, self.fc_vol_drv.disconnect_volume.call_count)
+        self.assertFalse(self.drv.disk_dvr.disconnect_image_disk.called)
+        self.assertFalse(self.drv.disk_dvr.delete_disks.called)
+        self.drv.disk_dvr.extend_disk.assert_called_once_with(
+            'context', inst, dict(type='boot'), 12)
+        self.assertEqual(self.drv.host_uuid, inst.system_metadata[
+            driver.SHARED_STG_MIGRATION_KEY])
+
+        # A disk that can not grow fails before the LPAR is powered off.
+        mock_pwr_off.reset_mock()
+        self.drv.disk_dvr.extend_disk.side_effect = ValueError()
+        inst.system_metadata = {}
+        self.assertRaises(ValueError, self.drv.migrate_disk_and_power_off,
+                          'context', inst, 'dest', flav, 'network_info')
+        self.assertFalse(mock_pwr_off.called)
+        self.assertEqual({}, inst.system_metadata)
+
+    @mock.patch('nova.virt.configdrive.required_by')
+    @mock.patch('nova_powervm.virt.powervm.driver.PowerVMDriver._plug_vifs')
+    @mock.patch('nova_powervm.virt.powervm.vm.power_on')
+    def test_finish_migration(self, mock_pwr_on, mock_plug_vifs,
+                              mock_cfg_drv):
+        inst = objects.Instance(**powervm.TEST_INSTANCE)
+        mock_cfg_drv.return_value = False
+
+        # A resize on this host only powers on the LPAR.
+        self.drv.finish_migration('context', 'migration', inst, {},
+                                  'network_info', 'image_meta', True)
+        mock_pwr_on.assert_called_once_with(self.drv.adapter, inst,
+                                            self.drv.host_uuid)
+        self.assertFalse(self.crt_lpar.called)
+
+        # A migration creates the LPAR and maps the shared disk to it.
+        disk_info = {'shared_storage': {'ssp_uuid': 'ssp'}}
+        mock_pwr_on.reset_mock()
+        self.drv.finish_migration('context', 'migration', inst, disk_info,
+                                  'network_info', 'image_meta', True,
+                                  power_on=False)
+        mock_remote = self.drv.disk_dvr.check_instance_shared_storage_remote
+        mock_remote.assert_called_once_with('context', {'ssp_uuid': 'ssp'})
+        self.crt_lpar.assert_called_once_with(
+            self.apt, self.drv.host_wrapper, inst, inst.get_flavor())
+        self.drv.disk_dvr.get_disk.assert_called_once_with(
+            'context', inst, disk_type='boot')
+        self.drv.disk_dvr.connect_disk.assert_called_once_with(
+            'context', inst, self.drv.disk_dvr.get_disk.return_value,
+            self.crt_lpar.return_value.uuid, mapping_acc=mock.ANY)
+        self.assertFalse(mock_pwr_on.called)
+
+        # A failed flow fails the migration.
+        self.drv.disk_dvr.connect_disk.side_effect = ValueError()
+        self.assertRaises(exc.MigrationError, self.drv.finish_migration,
+                          'context', 'migration', inst, disk_info,
+                          'network_info', 'image_meta', True)
+
+        # Storage that is not shared with the source fails the migration.
+        self.crt_lpar.reset_mock()
+        mock_remote.return_value = False
+        self.assertRaises(exc.MigrationError, self.drv.finish_migration,
+                          'context', 'migration', inst, disk_info,
+                          'network_info', 'image_meta', True)
+        self.assertFalse(self.crt_lpar.called)
+
+    @mock.patch('nova_powervm.virt.powervm.driver.PowerVMDriver.destroy')
+    def test_confirm_migration(self, mock_destroy):
+        inst = objects.Instance(**powervm.TEST_INSTANCE)
+        inst.system_metadata = {}
+
+        # Nothing to do for a resize on this host.
+        self.drv.confirm_migration('migration', inst, 'network_info')
+        self.assertFalse(mock_destroy.called)
+
+        # The LPAR left by a migration is deleted, but not its disks.
+        inst.system_metadata = {
+            driver.SHARED_STG_MIGRATION_KEY: self.drv.host_uuid}
+        self.drv.confirm_migration('migration', inst, 'network_info')
+        mock_destroy.assert_called_once_with(mock.ANY, inst, 'network_info',
+                                             destroy_disks=False)
+        self.assertEqual({}, inst.system_metadata)
+
+    @mock.patch('nova_powervm.virt.powervm.vm.get_instance_wrapper')
+    @mock.patch('nova_powervm.virt.powervm.vm.power_on')
+    @mock.patch('nova_powervm.virt.powervm.vm.resize')
+    @mock.patch('nova.objects.flavor.Flavor.get_by_id')
+    def test_finish_revert_migration_shared_stg(self, mock_get_flv,
+                                                mock_resize, mock_pwr_on,
+                                                mock_get_wrap):
+        inst = objects.Instance(**powervm.TEST_INSTANCE)
+        inst.system_metadata = {
+            driver.SHARED_STG_MIGRATION_KEY: self.drv.host_uuid}
+        self.drv.finish_revert_migration(
+            'context', inst, 'network_info',
+            block_device_info=self._fake_bdms())
+
+        # The volumes go back to the LPAR kept on this host.  The boot disk
+        # never left it.
+        self.assertEqual(2, self.fc_vol_drv.connect_volume.call_count)
+        self.assertFalse(self.drv.disk_dvr.connect_disk.called)
+        self.assertEqual({}, inst.system_metadata)
+        self.assertTrue(mock_pwr_on.called)
+
+    @mock.patch('nova_powervm.virt.powervm.vm.power_on')
+    @mock.patch('nova_powervm.virt.powervm.vm.resize')
+    @mock.patch('nova.objects.flavor.Flavor.get_by_id')
+    def test_finish_revert_migration(self, mock_get_flv, mock_resize,
+                                     mock_pwr_on):
+        inst = objects.Instance(**powervm.TEST_INSTANCE)
+        inst.system_metadata = {}
+        self.drv.finish_revert_migration('context', inst, 'network_info')
+        # The LPAR goes back to the instance's flavor, using the host
+        # wrapper.
+        mock_resize.assert_called_once_with(
+            self.drv.adapter, self.drv.host_wrapper, inst,
+            mock_get_flv.return_value)
+        mock_pwr_on.assert_called_once_with(self.drv.adapter, inst,
+                                            self.drv.host_uuid)
 
     @mock.patch('nova.objects.flavor.Flavor.get_by_id')
     @mock.patch('nova_powervm.virt.powervm.driver.vm')
     @mock.patch('nova_powervm.virt.powervm.tasks.vm.vm')
-    @mock.patch('nova_powervm.virt.powervm.tasks.vm.power')
-    def test_rescue(self, mock_task_pwr, mock_task_vm,
-                    mock_dvr_vm, mock_get_flv):
+    def test_rescue(self, mock_task_vm, mock_dvr_vm, mock_get_flv):
 
         """Validates the PowerVM driver rescue operation."""
         # Set up the mocks to the tasks.
@@ -481,14 +826,12 @@ class TestPowerVMDriver(test.TestCase):
         self.assertTrue(self.drv.disk_dvr.create_disk_from_image.called)
         self.assertTrue(self.drv.disk_dvr.connect_disk.called)
         # TODO(IBM): Power on not called until bootmode=sms is supported
-        # self.assertTrue(mock_task_pwr.power_on.called)
+        # self.assertTrue(mock_task_vm.start_lpar.called)
 
     @mock.patch('nova.objects.flavor.Flavor.get_by_id')
     @mock.patch('nova_powervm.virt.powervm.driver.vm')
     @mock.patch('nova_powervm.virt.powervm.tasks.vm.vm')
-    @mock.patch('nova_powervm.virt.powervm.tasks.vm.power')
-    def test_unrescue(self, mock_task_pwr, mock_task_vm,
-                      mock_dvr_vm, mock_get_flv):
+    def test_unrescue(self, mock_task_vm, mock_dvr_vm, mock_get_flv):
 
         """Validates the PowerVM driver rescue operation."""
         # Set up the mocks to the tasks.
@@ -501,7 +844,7 @@ class TestPowerVMDriver(test.TestCase):
         self.assertTrue(mock_task_vm.power_off.called)
         self.assertTrue(self.drv.disk_dvr.disconnect_image_disk.called)
         self.assertTrue(self.drv.disk_dvr.delete_disks.called)
-        self.assertTrue(mock_task_pwr.power_on.called)
+        self.assertTrue(mock_task_vm.start_lpar.called)
 
     @mock.patch('nova_powervm.virt.powervm.driver.LOG')
     def test_log_op(self, mock_log):
@@ -529,6 +872,7 @@ class TestPowerVMDriver(test.TestCase):
         for fld in fields:
             value = stats.get(fld, None)
             self.assertIsNotNone(value)
+        self.assertEqual(0, stats['stats']['warm_pool_lpars'])
 
     @mock.patch('nova_powervm.virt.powervm.vm.crt_secure_rmc_vif')
     @mock.patch('nova_powervm.virt.powervm.vm.get_secure_rmc_vswitch')
@@ -602,6 +946,33 @@ class TestPowerVMDriver(test.TestCase):
         self.assertEqual(1, mock_vm_crt.call_count)
         self.assertEqual(1, mock_crt_rmc_vif.call_count)
 
+    @mock.patch('nova_powervm.virt.powervm.vm.crt_secure_rmc_vif')
+    @mock.patch('nova_powervm.virt.powervm.vm.get_secure_rmc_vswitch')
+    @mock.patch('nova_powervm.virt.powervm.vm.crt_vif')
+    @mock.patch('nova_powervm.virt.powervm.vm.get_cnas')
+    def test_plug_vifs_fail(self, mock_vm_get, mock_vm_crt,
+                            mock_get_rmc_vswitch, mock_crt_rmc_vif):
+        """Tests that a failed VIF create does not stop the others."""
+        inst = objects.Instance(**powervm.TEST_INSTANCE)
+        mock_vm_get.return_value = []
+        mock_get_rmc_vswitch.return_value = None
+
+        net_info = [
+            {'address': 'aabbccddeeff'},
+            {'address': 'aabbccddee22'},
+            {'address': 'aabbccddee33'}
+        ]
+
+        def crt_vif(adapter, instance, host_uuid, vif):
+            if vif['address'] == 'aabbccddee22':
+                raise exc.Forbidden()
+        mock_vm_crt.side_effect = crt_vif
+
+        # The failure is raised, but every VIF was attempted.
+        self.assertRaises(exc.Forbidden, self.drv.plug_vifs, inst, net_info)
+        self.assertEqual(3, mock_vm_crt.call_count)
+        self.assertEqual(0, mock_crt_rmc_vif.call_count)
+
     def test_extract_bdm(self):
         """Tests the _extract_bdm method."""
         self.assertEqual([], self.drv._extract_bdm(None))
@@ -645,10 +1016,66 @@ class TestPowerVMDriver(test.TestCase):
         self.assertTrue(
             self.drv.disk_dvr.check_instance_shared_storage_cleanup.called)
 
+    @mock.patch('nova_powervm.virt.powervm.live_migration.LiveMigrationSrc')
+    @mock.patch('nova_powervm.virt.powervm.live_migration.LiveMigrationDest')
+    def test_live_migration_checks(self, mock_dest, mock_src):
+        inst = objects.Instance(**powervm.TEST_INSTANCE)
+        dest_data = self.drv.check_can_live_migrate_destination(
+            'context', inst, 'src_info', 'dst_info')
+        mock_dest.assert_called_once_with(self.drv, inst)
+        mock_dest.return_value.check_destination.assert_called_once_with(
+            'context')
+        self.assertEqual(mock_dest.return_value.check_destination.return_value,
+                         dest_data)
+
+        # The source passes the destination data on to the migration.
+        self.assertEqual(dest_data, self.drv.check_can_live_migrate_source(
+            'context', inst, dest_data))
+        mock_src.assert_called_once_with(self.drv, inst, dest_data)
+        mock_src.return_value.check_source.assert_called_once_with('context')
+
+    @mock.patch('nova_powervm.virt.powervm.live_migration.LiveMigrationSrc')
+    def test_live_migration(self, mock_src):
+        inst = objects.Instance(**powervm.TEST_INSTANCE)
+        mig = mock_src.return_value
+        post_method, recover_method = mock.Mock(), mock.Mock()
+
+        def live_migration(context):
+            # The migration can be aborted while it runs.
+            self.drv.live_migration_abort(inst)
+            mig.abort.assert_called_once_with()
+        mig.live_migration.side_effect = live_migration
+
+        self.drv.live_migration('context', inst, 'dest', post_method,
+                                recover_method, migrate_data='data')
+        mock_src.assert_called_once_with(self.drv, inst, 'data')
+        post_method.assert_called_once_with('context', inst, 'dest', False,
+                                            'data')
+        self.assertFalse(recover_method.called)
+        self.assertFalse(mig.rollback_live_migration.called)
+        self.assertEqual({}, self.drv.live_migrations)
+
+        # A failed migration is recovered.
+        post_method.reset_mock()
+        mig.live_migration.side_effect = exc.MigrationError(reason='error')
+        self.assertRaises(exc.MigrationError, self.drv.live_migration,
+                          'context', inst, 'dest', post_method,
+                          recover_method, migrate_data='data')
+        mig.rollback_live_migration.assert_called_once_with()
+        recover_method.assert_called_once_with('context', inst, 'dest',
+                                               False, 'data')
+        self.assertFalse(post_method.called)
+        self.assertEqual({}, self.drv.live_migrations)
+
+        # Nothing to abort once the migration is done.
+        mig.abort.reset_mock()
+        self.drv.live_migration_abort(inst)
+        self.assertFalse(mig.abort.called)
+
     @mock.patch('nova_powervm.virt.powervm.vm.get_instance_wrapper')
-    @mock.patch('pypowervm.tasks.power.power_on')
-    @mock.patch('pypowervm.tasks.power.power_off')
-    def test_reboot(self, mock_pwroff, mock_pwron, mock_instw):
+    @mock.patch('nova_powervm.virt.powervm.vm.stop_lpar')
+    @mock.patch('nova_powervm.virt.powervm.vm.start_lpar')
+    def test_reboot(self, mock_pwron, mock_pwroff, mock_instw):
         entry = mock.Mock()
         # State doesn't matter
         entry.state = "whatever"
@@ -657,14 +1084,15 @@ class TestPowerVMDriver(test.TestCase):
 
         # Validate SOFT vs HARD and power_on called with each.
         self.assertTrue(self.drv.reboot('context', inst, None, 'SOFT'))
-        mock_pwroff.assert_called_with(entry, self.drv.host_uuid,
+        mock_pwroff.assert_called_with(self.apt, entry, self.drv.host_uuid,
                                        force_immediate=False)
-        mock_pwron.assert_called_with(entry, self.drv.host_uuid)
+        mock_pwron.assert_called_with(self.apt, entry, self.drv.host_uuid)
         self.assertTrue(self.drv.reboot('context', inst, None, 'HARD'))
-        mock_pwroff.assert_called_with(entry, self.drv.host_uuid,
+        mock_pwroff.assert_called_with(self.apt, entry, self.drv.host_uuid,
                                        force_immediate=True)
+        self.assertEqual(2, mock_pwroff.call_count)
         self.assertEqual(2, mock_pwron.call_count)
-        mock_pwron.assert_called_with(entry, self.drv.host_uuid)
+        mock_pwron.assert_called_with(self.apt, entry, self.drv.host_uuid)
 
         # If power_on raises an exception, it percolates up.
         mock_pwron.side_effect = pvm_exc.VMPowerOnFailure(lpar_nm='lpar',
@@ -672,7 +1100,7 @@ class TestPowerVMDriver(test.TestCase):
         self.assertRaises(pvm_exc.VMPowerOnFailure, self.drv.reboot, 'context',
                           inst, None, 'SOFT')
         # But power_off was called first.
-        mock_pwroff.assert_called_with(entry, self.drv.host_uuid,
+        mock_pwroff.assert_called_with(self.apt, entry, self.drv.host_uuid,
                                        force_immediate=False)
 
         # If power_off raises an exception, power_on is not called, and the
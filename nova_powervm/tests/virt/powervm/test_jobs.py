@@ -0,0 +1,167 @@
+# Copyright 2015 IBM Corp.
+#
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import eventlet
+import mock
+
+from nova import test
+from pypowervm import exceptions as pvm_exc
+from pypowervm.wrappers import job as pvm_job
+
+from nova_powervm.tests.virt.powervm import fixtures as fx
+from nova_powervm.virt.powervm import jobs
+
+RUNNING = pvm_job.JobStatus.RUNNING
+COMPLETED_OK = pvm_job.JobStatus.COMPLETED_OK
+COMPLETED_WITH_ERROR = pvm_job.JobStatus.COMPLETED_WITH_ERROR
+
+
+class TestJobMonitor(test.TestCase):
+
+    def setUp(self):
+        super(TestJobMonitor, self).setUp()
+        self.adpt = self.useFixture(fx.PyPowerVM()).apt
+        jobs.JobMonitor._monitors = {}
+
+        # Check the jobs without waiting.
+        self._patch_obj('_POLL_INTERVALS', {})
+        self._patch_obj('_DEFAULT_POLL_INTERVAL', 0)
+        self._patch_obj('_MAX_POLL_INTERVAL', 0)
+        patcher = mock.patch('pypowervm.wrappers.job.Job.wrap')
+        self.mock_wrap = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.monitor = jobs.JobMonitor.get(self.adpt, 'host_uuid')
+
+    def _patch_obj(self, name, value):
+        patcher = mock.patch.object(jobs, name, value)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def _job(job_id, status):
+        job_w = mock.Mock()
+        job_w.job_id = job_id
+        job_w.job_status = status
+        job_w.get_job_resp_exception_msg.return_value = 'HSCL3681 error'
+        return job_w
+
+    def test_get(self):
+        self.assertIs(self.monitor,
+                      jobs.JobMonitor.get(self.adpt, 'host_uuid'))
+        self.assertIsNot(self.monitor,
+                         jobs.JobMonitor.get(self.adpt, 'host2'))
+
+    def test_run_job(self):
+        req = mock.Mock()
+        done = self._job('1', COMPLETED_OK)
+        self.mock_wrap.side_effect = [self._job('1', RUNNING),
+                                      self._job('1', RUNNING), done]
+
+        self.assertIs(done, self.monitor.run_job(
+            req, 'uuid', 'LogicalPartition', 'PowerOn', job_parms=['parm']))
+        req.add_job_parameters_to_existing.assert_called_once_with('parm')
+        self.adpt.create_job.assert_called_once_with(
+            req.entry.element, 'LogicalPartition', 'uuid')
+        # A single job is read on its own, until it finishes.
+        self.assertEqual(2, self.adpt.read.call_count)
+        self.adpt.read.assert_called_with('jobs', root_id='1')
+        self.adpt.delete.assert_called_once_with('jobs', root_id='1')
+
+        # A failed job raises.
+        self.mock_wrap.side_effect = [self._job('2', RUNNING),
+                                      self._job('2', COMPLETED_WITH_ERROR)]
+        self.assertRaises(pvm_exc.JobRequestFailed, self.monitor.run_job,
+                          req, 'uuid', 'LogicalPartition', 'PowerOn')
+
+        # So does one that can not be started.
+        self.adpt.create_job.side_effect = pvm_exc.Error('busy')
+        self.assertRaises(pvm_exc.JobRequestFailed, self.monitor.run_job,
+                          req, 'uuid', 'LogicalPartition', 'PowerOn')
+
+    def test_run_job_timeout(self):
+        self.mock_wrap.side_effect = lambda entry: self._job('1', RUNNING)
+        self.assertRaises(pvm_exc.JobRequestTimedOut, self.monitor.run_job,
+                          mock.Mock(), 'uuid', 'LogicalPartition', 'PowerOn',
+                          timeout=0.01)
+        self.assertFalse(self.monitor._waiters)
+
+    def test_wait_batched(self):
+        job1 = self._job('1', COMPLETED_OK)
+        job2 = self._job('2', COMPLETED_WITH_ERROR)
+        self.adpt.read.return_value.feed.entries = [job1, job2]
+        self.mock_wrap.side_effect = lambda entry: entry
+
+        # Both jobs are covered by one read of the job feed.
+        thread1 = eventlet.spawn(self.monitor.wait, '1', 'PowerOn')
+        thread2 = eventlet.spawn(self.monitor.wait, '2', 'PowerOff')
+        self.assertIs(job1, thread1.wait())
+        self.assertIs(job2, thread2.wait())
+        self.adpt.read.assert_called_once_with('jobs')
+
+    def test_wait_feed_error(self):
+        job1 = self._job('1', COMPLETED_OK)
+        job2 = self._job('2', COMPLETED_OK)
+
+        def read(root_type, root_id=None):
+            if root_id is None:
+                raise pvm_exc.Error('no feed')
+            return mock.Mock(entry=job1 if root_id == '1' else job2)
+        self.adpt.read.side_effect = read
+        self.mock_wrap.side_effect = lambda entry: entry
+
+        # Each job is read on its own instead.
+        thread1 = eventlet.spawn(self.monitor.wait, '1', 'PowerOn')
+        thread2 = eventlet.spawn(self.monitor.wait, '2', 'PowerOn')
+        self.assertIs(job1, thread1.wait())
+        self.assertIs(job2, thread2.wait())
+        self.adpt.read.assert_any_call('jobs', root_id='1')
+        self.adpt.read.assert_any_call('jobs', root_id='2')
+
+    def test_wait_wakes_poller(self):
+        job1 = self._job('1', RUNNING)
+        job2 = self._job('2', COMPLETED_OK)
+        self.adpt.read.return_value.feed.entries = [job1, job2]
+        self.adpt.read.return_value.entry = job2
+        self.mock_wrap.side_effect = lambda entry: entry
+
+        # The poller waits a minute for the first job.  A job added in the
+        # meantime is checked right away.
+        with mock.patch.object(jobs, '_POLL_INTERVALS', {'PowerOn': 60}):
+            thread1 = eventlet.spawn(self.monitor.wait, '1', 'PowerOn')
+            eventlet.sleep(0)
+            self.assertIs(job2, self.monitor.wait('2', 'PowerOff'))
+        self.adpt.read.assert_called_once_with('jobs', root_id='2')
+
+        self.monitor._finish(self.monitor._waiters['1'], None)
+        self.assertIsNone(thread1.wait())
+        with self.monitor._lock:
+            self.monitor._added.notify()
+
+    def test_poll_interval(self):
+        waiter = jobs._Waiter('1', 'PowerOn', 0)
+        self.assertEqual(0, waiter.interval)
+        self.assertIsNone(waiter.deadline)
+
+        with mock.patch.object(jobs, '_POLL_INTERVALS', {'PowerOn': 2.0}), \
+                mock.patch.object(jobs, '_MAX_POLL_INTERVAL', 4.0):
+            waiter = jobs._Waiter('1', 'PowerOn', 10)
+            self.assertEqual(2.0, waiter.interval)
+            waiter.backoff(100)
+            self.assertEqual(3.0, waiter.interval)
+            self.assertEqual(103.0, waiter.next_poll)
+            waiter.backoff(100)
+            self.assertEqual(4.0, waiter.interval)
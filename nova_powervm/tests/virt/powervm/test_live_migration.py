@@ -0,0 +1,332 @@
+# Copyright 2015 IBM Corp.
+#
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from nova import exception
+from nova import objects
+from nova import test
+from pypowervm.wrappers import storage as pvm_stor
+
+from nova_powervm.tests.virt import powervm
+from nova_powervm.tests.virt.powervm import fixtures as fx
+from nova_powervm.virt.powervm import live_migration as lpm
+
+
+class TestLiveMigration(test.TestCase):
+
+    def setUp(self):
+        super(TestLiveMigration, self).setUp()
+        self.adpt = self.useFixture(fx.PyPowerVM()).apt
+        self.drvr = mock.Mock(adapter=self.adpt, host_uuid='host')
+        self.drvr._extract_bdm.side_effect = (
+            lambda bdi: bdi['block_device_mapping'] if bdi else [])
+        self.vol_drv = mock.Mock()
+        self.drvr.vol_drvs = {'fibre_channel': self.vol_drv}
+        self.conn_infos = [{'driver_volume_type': 'fibre_channel',
+                            'data': {'volume_id': vol_id}}
+                           for vol_id in ('vol1', 'vol2')]
+        self.bdi = {'block_device_mapping': [
+            {'connection_info': conn_info} for conn_info in self.conn_infos]}
+        self.inst = objects.Instance(image_ref='image',
+                                     **powervm.TEST_INSTANCE)
+        self.dest_data = {'dest_sys_name': 'dest',
+                          'dest_vlans': {'ETHERNET0': [1, 2]},
+                          'dest_shared_storage': {'ssp_uuid': 'ssp'}}
+
+    @staticmethod
+    def _wrap(name, switch_id):
+        wrap = mock.Mock(switch_id=switch_id, vswitch_id=switch_id)
+        wrap.name = name
+        return wrap
+
+    @mock.patch('pypowervm.wrappers.network.NetBridge.wrap')
+    @mock.patch('pypowervm.wrappers.network.VSwitch.wrap')
+    def test_get_bridged_vlans(self, mock_vs_wrap, mock_nb_wrap):
+        mock_vs_wrap.return_value = [self._wrap('ETHERNET0', 0),
+                                     self._wrap('MGMTSWITCH', 1)]
+        nb1, nb2 = self._wrap('nb1', 0), self._wrap('nb2', 0)
+        nb1.list_vlans.return_value = [4, 1]
+        nb2.list_vlans.return_value = [2]
+        mock_nb_wrap.return_value = [nb1, nb2]
+
+        self.assertEqual({'ETHERNET0': [1, 2, 4], 'MGMTSWITCH': []},
+                         lpm._get_bridged_vlans(self.adpt, 'host'))
+
+    @mock.patch('nova_powervm.virt.powervm.live_migration._get_bridged_vlans')
+    @mock.patch('pypowervm.wrappers.managed_system.System.wrap')
+    def test_check_destination(self, mock_wrap, mock_vlans):
+        host_w = mock_wrap.return_value
+        host_w.get_capability.return_value = True
+        host_w.memory_free = 4096
+        host_w.proc_units_avail = '2.00'
+        host_w.system_name = 'dest'
+        self.drvr.check_instance_shared_storage_local.return_value = {
+            'ssp_uuid': 'ssp'}
+        mock_vlans.return_value = {'ETHERNET0': [1, 2]}
+
+        mig = lpm.LiveMigrationDest(self.drvr, self.inst)
+        self.assertEqual(self.dest_data, mig.check_destination('context'))
+        host_w.get_capability.assert_called_once_with(
+            'active_lpar_mobility_capable')
+        mock_vlans.assert_called_once_with(self.adpt, 'host')
+        # The driver's host wrapper is left alone.
+        self.assertIsNot(host_w, self.drvr.host_wrapper)
+
+        # Storage that is never shared has no data.
+        self.drvr.check_instance_shared_storage_local.side_effect = (
+            NotImplementedError())
+        self.assertIsNone(
+            mig.check_destination('context')['dest_shared_storage'])
+
+        # A host without the memory for the instance can not take it.
+        host_w.memory_free = 1024
+        self.assertRaises(exception.MigrationPreCheckError,
+                          mig.check_destination, 'context')
+
+        # Nor can a host that is not capable of the migration.
+        host_w.memory_free = 4096
+        host_w.get_capability.return_value = False
+        self.assertRaises(exception.MigrationPreCheckError,
+                          mig.check_destination, 'context')
+
+    @mock.patch('nova_powervm.virt.powervm.vios.get_vios_feed')
+    @mock.patch('nova_powervm.virt.powervm.vm.get_vm_id')
+    @mock.patch('nova_powervm.virt.powervm.vm.get_cnas')
+    @mock.patch('nova_powervm.virt.powervm.live_migration._get_bridged_vlans')
+    @mock.patch('pypowervm.wrappers.network.VSwitch.wrap')
+    @mock.patch('nova_powervm.virt.powervm.vm.get_instance_wrapper')
+    @mock.patch('pypowervm.tasks.migration.migrate_lpar')
+    def test_check_source(self, mock_migrate, mock_get_wrap, mock_vs_wrap,
+                          mock_vlans, mock_cnas, mock_vm_id, mock_vios):
+        lpar_w = mock_get_wrap.return_value
+        mock_vs_wrap.return_value = [self._wrap('ETHERNET0', 0),
+                                     self._wrap('ETHERNET1', 1)]
+        mock_vlans.return_value = {'ETHERNET0': [1, 2, 3], 'ETHERNET1': []}
+        mock_cnas.return_value = [mock.Mock(vswitch_id=0, pvid=2),
+                                  mock.Mock(vswitch_id=0, pvid=5)]
+        mock_vm_id.return_value = '4'
+        vio = mock.Mock()
+        vio.scsi_mappings = [
+            mock.Mock(backing_storage=mock.Mock(spec=pvm_stor.PV),
+                      server_adapter=mock.Mock(lpar_id=4)),
+            mock.Mock(backing_storage=mock.Mock(spec=pvm_stor.VDisk),
+                      server_adapter=mock.Mock(lpar_id=5)),
+            mock.Mock(backing_storage=mock.Mock(spec=pvm_stor.VOptMedia),
+                      server_adapter=mock.Mock(lpar_id=4))]
+        mock_vios.return_value = [vio]
+        self.drvr.check_instance_shared_storage_remote.return_value = True
+
+        mig = lpm.LiveMigrationSrc(self.drvr, self.inst, self.dest_data)
+        mig.check_source('context')
+        mock_migrate.assert_called_once_with(lpar_w, 'dest',
+                                             validate_only=True)
+        self.drvr.check_instance_shared_storage_remote.assert_called_once_with(
+            'context', {'ssp_uuid': 'ssp'})
+
+        # Each failed check is reported.
+        mock_migrate.side_effect = ValueError('HSCLA27C')
+        mock_cnas.return_value = [mock.Mock(vswitch_id=0, pvid=3)]
+        vio.scsi_mappings[1].server_adapter.lpar_id = 4
+        self.drvr.check_instance_shared_storage_remote.return_value = False
+        e = self.assertRaises(exception.MigrationPreCheckError,
+                              mig.check_source, 'context')
+        for text in ('HSCLA27C', 'VLAN 3', 'Virtual I/O Server',
+                     'not shared'):
+            self.assertIn(text, str(e))
+
+        # So is a vSwitch the destination does not have.
+        mock_migrate.side_effect = None
+        mock_cnas.return_value = [mock.Mock(vswitch_id=1, pvid=1)]
+        vio.scsi_mappings = []
+        self.drvr.check_instance_shared_storage_remote.return_value = True
+        e = self.assertRaises(exception.MigrationPreCheckError,
+                              mig.check_source, 'context')
+        self.assertIn('ETHERNET1', str(e))
+
+        # An instance booted from a volume needs no shared storage.
+        mock_cnas.return_value = []
+        self.drvr.check_instance_shared_storage_remote.reset_mock()
+        self.drvr.check_instance_shared_storage_remote.return_value = False
+        self.inst.image_ref = ''
+        mig.check_source('context')
+        self.assertFalse(self.drvr.check_instance_shared_storage_remote.called)
+
+    @mock.patch('nova.virt.configdrive.required_by')
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM')
+    @mock.patch('eventlet.spawn_n')
+    @mock.patch('nova_powervm.virt.powervm.vm.get_instance_wrapper')
+    @mock.patch('pypowervm.tasks.migration.migrate_lpar')
+    def test_live_migration(self, mock_migrate, mock_get_wrap, mock_spawn,
+                            mock_cfg_dr, mock_cfg_drv):
+        lpar_w = mock_get_wrap.return_value
+        mock_cfg_drv.return_value = False
+        mig = lpm.LiveMigrationSrc(self.drvr, self.inst, self.dest_data)
+        mig.live_migration('context')
+        mock_migrate.assert_called_once_with(lpar_w, 'dest')
+        mock_spawn.assert_called_once_with(mig._report_progress)
+        self.assertTrue(mig._done.is_set())
+        self.assertFalse(mock_cfg_dr.called)
+
+        # The config drive media is removed before the LPAR migrates.
+        mock_cfg_drv.return_value = True
+        mock_migrate.side_effect = (
+            lambda *a: self.assertTrue(mock_cfg_dr.return_value.dlt_vopt.
+                                       called))
+        mig.live_migration('context')
+        mock_cfg_dr.assert_called_once_with(self.adpt, 'host')
+        mock_cfg_dr.return_value.dlt_vopt.assert_called_once_with(
+            lpar_w.uuid, lpar_id=lpar_w.id)
+        self.assertTrue(mig._cfg_drive_removed)
+
+        mock_migrate.side_effect = ValueError('HSCLA27C')
+        self.assertRaises(exception.MigrationError, mig.live_migration,
+                          'context')
+        self.assertTrue(mig._done.is_set())
+
+    @mock.patch('pypowervm.wrappers.logical_partition.LPAR.wrap')
+    def test_report_progress(self, mock_wrap):
+        inst = mock.Mock()
+        mig = lpm.LiveMigrationSrc(self.drvr, inst, self.dest_data)
+        mig.lpar_w = mock.Mock(uuid='lpar')
+        states = ['Migration_Starting', 'Migration_Starting', 'Unknown',
+                  'Migration_Running']
+
+        def wrap(entry):
+            if len(states) == 1:
+                mig._done.set()
+            return mock.Mock(migration_state=states.pop(0))
+        mock_wrap.side_effect = wrap
+
+        with mock.patch.object(lpm, '_PROGRESS_INTERVAL', 0):
+            mig._report_progress()
+        self.assertEqual(50, inst.progress)
+        # Only the changes to a known state are saved.
+        self.assertEqual(2, inst.save.call_count)
+        self.adpt.read.assert_called_with('LogicalPartition', root_id='lpar')
+
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM')
+    @mock.patch('pypowervm.tasks.migration.migrate_recover')
+    @mock.patch('pypowervm.tasks.migration.migrate_abort')
+    def test_abort_rollback(self, mock_abort, mock_recover, mock_cfg_dr):
+        mig = lpm.LiveMigrationSrc(self.drvr, self.inst, self.dest_data)
+
+        # Nothing to do before the migration started.
+        mig.abort()
+        mig.rollback_live_migration()
+        self.assertFalse(mock_abort.called)
+        self.assertFalse(mock_recover.called)
+
+        mig.lpar_w = mock.Mock()
+        mig.abort()
+        mock_abort.assert_called_once_with(mig.lpar_w)
+
+        # A failed recovery is only logged.
+        mock_recover.side_effect = ValueError()
+        mig.rollback_live_migration()
+        mock_recover.assert_called_once_with(mig.lpar_w, force=True)
+        self.assertFalse(mock_cfg_dr.called)
+
+        # The config drive removed for the migration is built again.
+        self.inst.info_cache = mock.Mock()
+        mig._cfg_drive_removed = True
+        mig.rollback_live_migration()
+        mock_cfg_dr.return_value.create_cfg_drv_vopt.assert_called_once_with(
+            self.inst, [], self.inst.info_cache.network_info,
+            mig.lpar_w.uuid)
+        self.assertFalse(mig._cfg_drive_removed)
+
+        # Nothing to abort once the migration is done.
+        mig._done.set()
+        mig.abort()
+        self.assertEqual(1, mock_abort.call_count)
+
+    def test_pre_live_migration(self):
+        mig = lpm.LiveMigrationDest(self.drvr, self.inst)
+        mig.pre_live_migration(self.bdi)
+        self.assertEqual(2, self.vol_drv.pre_live_migration_on_destination.
+                         call_count)
+        for conn_info in self.conn_infos:
+            self.vol_drv.pre_live_migration_on_destination.assert_any_call(
+                self.adpt, 'host', self.inst, conn_info)
+
+        # A volume that can not be prepared fails the migration.
+        self.vol_drv.pre_live_migration_on_destination.side_effect = (
+            ValueError())
+        self.assertRaises(ValueError, mig.pre_live_migration, self.bdi)
+
+        # Nothing to do without volumes.
+        self.vol_drv.reset_mock()
+        mig.pre_live_migration(None)
+        self.assertFalse(
+            self.vol_drv.pre_live_migration_on_destination.called)
+
+    @mock.patch('nova.virt.configdrive.required_by')
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM')
+    @mock.patch('nova_powervm.virt.powervm.vm.get_instance_wrapper')
+    @mock.patch('nova_powervm.virt.powervm.vios.invalidate_vios_feed')
+    @mock.patch('nova_powervm.virt.powervm.vm.UUIDCache.get_cache')
+    def test_live_migration_at_destination_volumes(self, mock_cache,
+                                                   mock_invalidate,
+                                                   mock_get_wrap, mock_cfg_dr,
+                                                   mock_cfg_drv):
+        mock_get_wrap.return_value = mock.Mock(id=7)
+        mock_cfg_drv.return_value = False
+        mig = lpm.LiveMigrationDest(self.drvr, self.inst)
+
+        # The volumes are recorded with the migrated LPAR's partition ID.
+        mig.post_live_migration_at_destination('network_info', self.bdi)
+        for conn_info in self.conn_infos:
+            self.vol_drv.post_live_migration_at_destination.assert_any_call(
+                self.adpt, 'host', self.inst, conn_info, 7)
+        mock_get_wrap.assert_called_once_with(self.adpt, self.inst, 'host')
+        self.assertFalse(mock_cfg_dr.called)
+
+        # The config drive removed on the source host is built again.
+        mock_cfg_drv.return_value = True
+        mig.post_live_migration_at_destination('network_info', None)
+        mock_cfg_dr.assert_called_once_with(self.adpt, 'host')
+        mock_cfg_dr.return_value.create_cfg_drv_vopt.assert_called_once_with(
+            self.inst, [], 'network_info', mock_get_wrap.return_value.uuid)
+
+        # A failed migration undoes their preparation.
+        mock_cache.reset_mock()
+        mig.rollback_live_migration_at_destination(self.bdi)
+        mock_cache.return_value.remove.assert_called_once_with(
+            self.inst.name)
+        self.assertEqual(
+            2, self.vol_drv.rollback_live_migration_at_destination.call_count)
+        self.vol_drv.rollback_live_migration_at_destination.assert_any_call(
+            self.adpt, 'host', self.inst, self.conn_infos[0])
+
+    @mock.patch('nova.virt.configdrive.required_by')
+    @mock.patch('nova_powervm.virt.powervm.vios.invalidate_vios_feed')
+    @mock.patch('nova_powervm.virt.powervm.vm.UUIDCache.get_cache')
+    def test_post_live_migration(self, mock_cache, mock_invalidate,
+                                 mock_cfg_drv):
+        mock_cfg_drv.return_value = False
+        lpm.LiveMigrationDest(
+            self.drvr, self.inst).post_live_migration_at_destination(
+            'network_info', None)
+        mock_cache.return_value.remove.assert_called_once_with(
+            self.inst.name)
+        mock_invalidate.assert_called_once_with('host')
+
+        mock_cache.reset_mock()
+        lpm.LiveMigrationSrc(
+            self.drvr, self.inst, None).post_live_migration_at_source()
+        mock_cache.return_value.remove.assert_called_once_with(
+            self.inst.name)
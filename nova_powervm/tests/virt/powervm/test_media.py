@@ -14,12 +14,15 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import fixtures
 import mock
 
 from nova import test
 import os
+from pypowervm import exceptions as pvm_exc
 from pypowervm.tests.wrappers.util import pvmhttp
 from pypowervm.wrappers import storage as pvm_stor
+from pypowervm.wrappers import virtual_io_server as pvm_vios
 
 from nova_powervm.tests.virt.powervm import fixtures as fx
 from nova_powervm.virt.powervm import media as m
@@ -62,9 +65,33 @@ class TestConfigDrivePowerVM(test.TestCase):
         self.vio_feed = resp(VIOS_FEED)
 
         # Wipe out the static variables, so that the revalidate is called
-        m.ConfigDrivePowerVM._cur_vios_uuid = None
-        m.ConfigDrivePowerVM._cur_vios_name = None
-        m.ConfigDrivePowerVM._cur_vg_uuid = None
+        m.ConfigDrivePowerVM._cur_repos = []
+        m.ConfigDrivePowerVM._next_repo = 0
+        m.ConfigDrivePowerVM._cur_validated = None
+        m.ConfigDrivePowerVM._dlt_batches = {}
+        m.ConfigDrivePowerVM._dlt_pending = 0
+        m.ConfigDrivePowerVM._orphans_reaped = True
+        self.flags(vopt_media_delete_window=0)
+        self.tmp_dir = self.useFixture(fixtures.TempDir()).path
+
+    @staticmethod
+    def _vios(uuid, media):
+        """Builds a mock VIOS wrapper that maps optical media.
+
+        :param uuid: The UUID of the VIOS.
+        :param media: List of (media_name, lpar_id) tuples.
+        """
+        vio = mock.Mock(uuid=uuid)
+        vio.name = uuid + '_name'
+        vio.scsi_mappings = [mock.Mock(
+            backing_storage=mock.Mock(spec=pvm_stor.LU))]
+        for name, lpar_id in media:
+            stg = mock.Mock(spec=pvm_stor.VOptMedia)
+            stg.media_name = name
+            smap = mock.Mock(backing_storage=stg)
+            smap.server_adapter.lpar_id = lpar_id
+            vio.scsi_mappings.append(smap)
+        return vio
 
     @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
                 '_validate_vopt_vg')
@@ -107,6 +134,115 @@ class TestConfigDrivePowerVM(test.TestCase):
         self.assertTrue(mock_upld.called)
         self.assertTrue(mock_add_map.called)
 
+        # With an accumulator, the mapping is queued instead.
+        mock_add_map.reset_mock()
+        mapping_acc = mock.Mock()
+        cfg_dr_builder.create_cfg_drv_vopt(mock.MagicMock(), mock.MagicMock(),
+                                           mock.MagicMock(), 'fake_lpar',
+                                           mapping_acc=mapping_acc)
+        mapping_acc.add_storage_mapping.assert_called_once_with(
+            cfg_dr_builder.vios_uuid, 'fake_lpar',
+            mock_upld.return_value[0])
+        self.assertFalse(mock_add_map.called)
+
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
+                '_validate_vopt_vg')
+    @mock.patch('os.fstat')
+    @mock.patch('tempfile.TemporaryFile')
+    @mock.patch('nova.api.metadata.base.InstanceMetadata')
+    @mock.patch('nova.virt.configdrive.ConfigDriveBuilder.make_drive')
+    def test_crt_cfg_dr_iso_mem(self, mock_mkdrv, mock_meta, mock_tmpf,
+                                mock_fstat, mock_vopt_valid):
+        """Validates that the in memory image creation method works."""
+        self.flags(image_meta_memory_path='/dev/shm')
+        mock_tmpf.return_value.fileno.return_value = 7
+        mock_fstat.return_value.st_size = 4096
+        cfg_dr_builder = m.ConfigDrivePowerVM(self.apt, 'host_uuid')
+        mock_instance = mock.MagicMock()
+        mock_instance.name = 'fake-instance'
+
+        iso_stream, file_name, file_size = (
+            cfg_dr_builder._create_cfg_dr_iso_mem(mock_instance, [],
+                                                  mock.MagicMock()))
+        self.assertEqual(mock_tmpf.return_value, iso_stream)
+        self.assertEqual('config_fake_instance.iso', file_name)
+        self.assertEqual(4096, file_size)
+        mock_tmpf.assert_called_once_with(dir='/dev/shm')
+        mock_mkdrv.assert_called_once_with('/proc/%d/fd/7' % os.getpid())
+        iso_stream.seek.assert_called_once_with(0)
+        self.assertFalse(iso_stream.close.called)
+
+        # A failed build releases the memory
+        mock_mkdrv.side_effect = OSError()
+        self.assertRaises(OSError, cfg_dr_builder._create_cfg_dr_iso_mem,
+                          mock_instance, [], mock.MagicMock())
+        self.assertTrue(mock_tmpf.return_value.close.called)
+
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
+                '_create_cfg_dr_iso_mem')
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
+                '_create_cfg_dr_iso')
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
+                '_validate_vopt_vg')
+    @mock.patch('os.remove')
+    @mock.patch('pypowervm.tasks.storage.upload_vopt')
+    @mock.patch('pypowervm.tasks.scsi_mapper.add_vscsi_mapping')
+    def test_crt_cfg_drv_vopt_mem(self, mock_add_map, mock_upld, mock_rm,
+                                  mock_validate, mock_cfg_iso,
+                                  mock_cfg_iso_mem):
+        self.flags(image_meta_in_memory=True,
+                   image_meta_local_path=self.tmp_dir)
+        iso_stream = mock.MagicMock()
+        mock_cfg_iso_mem.return_value = iso_stream, 'fake.iso', 10000
+        mock_upld.return_value = (mock.Mock(), None)
+
+        # Run
+        cfg_dr_builder = m.ConfigDrivePowerVM(self.apt, 'fake_host')
+        cfg_dr_builder.create_cfg_drv_vopt(mock.MagicMock(), mock.MagicMock(),
+                                           mock.MagicMock(), 'fake_lpar')
+
+        # The stream went straight to the upload; no file on disk.
+        mock_upld.assert_called_once_with(self.apt, mock.ANY, iso_stream,
+                                          'fake.iso', 10000)
+        self.assertTrue(iso_stream.__exit__.called)
+        self.assertFalse(mock_cfg_iso.called)
+        self.assertFalse(mock_rm.called)
+        self.assertTrue(mock_add_map.called)
+
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
+                '_rm_media')
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
+                '_create_cfg_dr_iso_mem')
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
+                '_validate_vopt_vg')
+    @mock.patch('pypowervm.tasks.storage.upload_vopt')
+    def test_dlt_created_vopt(self, mock_upld, mock_validate,
+                              mock_cfg_iso_mem, mock_rm_media):
+        self.flags(image_meta_in_memory=True,
+                   image_meta_local_path=self.tmp_dir)
+        m.ConfigDrivePowerVM._cur_repos = [m._MediaRepo('vios1', 'vios1_name',
+                                                        'vg1')]
+        mock_cfg_iso_mem.return_value = mock.MagicMock(), 'fake.iso', 10000
+        mock_upld.return_value = (mock.Mock(), None)
+        cfg_dr = m.ConfigDrivePowerVM(self.apt, 'fake_host')
+
+        # Nothing uploaded, nothing to delete.
+        cfg_dr.dlt_created_vopt()
+        self.assertFalse(mock_rm_media.called)
+
+        # The media is deleted from the repository it was uploaded to, even
+        # though its mapping was only queued.
+        cfg_dr.create_cfg_drv_vopt(mock.MagicMock(), mock.MagicMock(),
+                                   mock.MagicMock(), 'fake_lpar',
+                                   mapping_acc=mock.Mock())
+        cfg_dr.dlt_created_vopt()
+        mock_rm_media.assert_called_once_with('vios1', 'vg1', {'fake.iso'})
+        self.assertEqual(set(), m._pending_dlts())
+
+        # Only once.
+        cfg_dr.dlt_created_vopt()
+        self.assertEqual(1, mock_rm_media.call_count)
+
     def test_validate_opt_vg(self):
         self.apt.read.side_effect = [self.vio_feed, self.vol_grp_resp]
         vg_update = self.vol_grp_resp.feed.entries[0]
@@ -115,25 +251,106 @@ class TestConfigDrivePowerVM(test.TestCase):
         self.assertEqual('1e46bbfd-73b6-3c2a-aeab-a1d3f065e92f',
                          cfg_dr_builder.vg_uuid)
 
+    @mock.patch('time.time')
+    def test_validate_opt_vg_cached(self, mock_time):
+        # Prime the host level cache
+        mock_time.return_value = 1000
+        self.apt.read.side_effect = [self.vio_feed, self.vol_grp_resp]
+        self.apt.update_by_path.return_value = (
+            self.vol_grp_resp.feed.entries[0])
+        m.ConfigDrivePowerVM(self.apt, 'fake_host')
+        self.assertEqual(2, self.apt.read.call_count)
+
+        # Within the validity window, no REST calls at all.
+        self.apt.reset_mock()
+        mock_time.return_value = 1000 + 599
+        cfg_dr_builder = m.ConfigDrivePowerVM(self.apt, 'fake_host')
+        self.assertEqual(0, self.apt.read.call_count)
+        self.assertEqual('1e46bbfd-73b6-3c2a-aeab-a1d3f065e92f',
+                         cfg_dr_builder.vg_uuid)
+
+        # Once the window passes, a single VG read revalidates it.
+        self.apt.read.side_effect = None
+        self.apt.read.return_value = self.vol_grp_resp
+        mock_time.return_value = 1000 + 600
+        m.ConfigDrivePowerVM(self.apt, 'fake_host')
+        self.assertEqual(1, self.apt.read.call_count)
+
+        # And the window restarts.
+        mock_time.return_value = 1000 + 1199
+        m.ConfigDrivePowerVM(self.apt, 'fake_host')
+        self.assertEqual(1, self.apt.read.call_count)
+
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
+                '_validate_vopt_vg')
+    def test_run_on_repo(self, mock_validate):
+        m.ConfigDrivePowerVM._cur_repos = [
+            m._MediaRepo('vios1', 'vios1_name', 'vg1')]
+        cfg_dr_builder = m.ConfigDrivePowerVM(self.apt, 'fake_host')
+        mock_validate.reset_mock()
+
+        # Success does not revalidate
+        func = mock.Mock(return_value='ok')
+        self.assertEqual('ok', cfg_dr_builder._run_on_repo(func))
+        self.assertFalse(mock_validate.called)
+
+        # A failure revalidates and retries against the new repository.
+        def move_repo(stale_vg_uuid=None):
+            self.assertEqual('vg1', stale_vg_uuid)
+            m.ConfigDrivePowerVM._cur_repos = [
+                m._MediaRepo('vios2', 'vios2_name', 'vg2')]
+        mock_validate.side_effect = move_repo
+
+        def run():
+            if cfg_dr_builder.vios_uuid == 'vios1':
+                raise pvm_exc.Error('vios down')
+            return cfg_dr_builder.vios_uuid
+        self.assertEqual('vios2', cfg_dr_builder._run_on_repo(run))
+        self.assertEqual(1, mock_validate.call_count)
+        self.assertEqual('vg2', cfg_dr_builder.vg_uuid)
+
+    def test_validate_opt_vg_stale(self):
+        # Another caller already moved off of the failed volume group.
+        m.ConfigDrivePowerVM._cur_repos = [
+            m._MediaRepo('vios2', 'vios2_name', 'vg2')]
+        with mock.patch.object(m.ConfigDrivePowerVM, '_validate_vopt_vg'):
+            cfg_dr_builder = m.ConfigDrivePowerVM(self.apt, 'fake_host')
+        cfg_dr_builder._validate_vopt_vg(stale_vg_uuid='vg1')
+        self.assertEqual(0, self.apt.read.call_count)
+
+        # The failed volume group is still cached.  Full rediscovery.
+        self.apt.read.side_effect = [self.vio_feed, self.vol_grp_resp]
+        self.apt.update_by_path.return_value = (
+            self.vol_grp_resp.feed.entries[0])
+        cfg_dr_builder._validate_vopt_vg(stale_vg_uuid='vg2')
+        self.assertEqual(2, self.apt.read.call_count)
+        self.assertEqual('1e46bbfd-73b6-3c2a-aeab-a1d3f065e92f',
+                         m.ConfigDrivePowerVM._cur_repos[0].vg_uuid)
+
     def test_validate_opt_vg_fail(self):
         self.apt.read.side_effect = [self.vio_feed_no_vg,
                                      self.vol_grp_novg_resp]
         self.assertRaises(m.NoMediaRepoVolumeGroupFound,
                           m.ConfigDrivePowerVM, self.apt, 'fake_host')
 
+    @mock.patch('nova_powervm.virt.powervm.vios.get_vios_feed')
     @mock.patch('pypowervm.tasks.scsi_mapper.remove_vopt_mapping')
     @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
                 '_validate_vopt_vg')
-    def test_dlt_vopt(self, mock_vop_valid, mock_remove_map):
+    def test_dlt_vopt(self, mock_vop_valid, mock_remove_map, mock_feed):
+        self.flags(image_meta_local_path=self.tmp_dir)
 
         # Set up the mock data.
         resp = mock.MagicMock(name='resp')
         type(resp).body = mock.PropertyMock(return_value='2')
         self.apt.read.side_effect = [resp, self.vg_to_vio]
 
-        # We tell it to remove all the optical medias.
+        # All of the optical media is mapped to the VM.
         vg = pvm_stor.VG.wrap(self.vg_to_vio)
-        mock_remove_map.return_value = vg.vmedia_repos[0].optical_media
+        names = [media.media_name
+                 for media in vg.vmedia_repos[0].optical_media]
+        mock_feed.return_value = [
+            self._vios('vios_uuid', [(name, 2) for name in names])]
 
         # Make sure that the first update is a VIO and doesn't have the vopt
         # mapping
@@ -145,9 +362,357 @@ class TestConfigDrivePowerVM(test.TestCase):
             return vol_grp.entry
 
         self.apt.update_by_path.side_effect = validate_update
+        m.ConfigDrivePowerVM._cur_repos = [
+            m._MediaRepo('vios_uuid', 'vios_name', 'vg_uuid')]
 
         # Invoke the operation
         cfg_dr = m.ConfigDrivePowerVM(self.apt, 'fake_host')
         cfg_dr.dlt_vopt('fake_lpar_uuid')
 
+        mock_remove_map.assert_called_once_with(self.apt, 'vios_uuid', 2)
         self.assertEqual(1, self.apt.update_by_path.call_count)
+        # The deletes are finished.
+        self.assertEqual(set(), m._pending_dlts())
+        self.assertEqual(0, m.ConfigDrivePowerVM._dlt_pending)
+
+    @mock.patch('nova_powervm.virt.powervm.vios.get_vios_feed')
+    @mock.patch('pypowervm.tasks.scsi_mapper.remove_vopt_mapping')
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
+                '_validate_vopt_vg')
+    def test_dlt_vopt_no_media(self, mock_vop_valid, mock_remove_map,
+                               mock_feed):
+        m.ConfigDrivePowerVM._cur_repos = [
+            m._MediaRepo('vios_uuid', 'vios_name', 'vg_uuid')]
+        resp = mock.MagicMock(name='resp')
+        type(resp).body = mock.PropertyMock(return_value='2')
+        self.apt.read.return_value = resp
+        # Media is only mapped to another VM.
+        mock_feed.return_value = [self._vios('vios_uuid',
+                                             [('config_other.iso', 3)])]
+
+        cfg_dr = m.ConfigDrivePowerVM(self.apt, 'fake_host')
+        cfg_dr.dlt_vopt('fake_lpar_uuid')
+
+        # Only the partition ID was read.  The VIOS was left alone.
+        self.assertEqual(1, self.apt.read.call_count)
+        mock_feed.assert_called_once_with(
+            self.apt, 'fake_host', xag=[pvm_vios.VIOS.xags.SCSI_MAPPING])
+        self.assertFalse(mock_remove_map.called)
+        self.assertFalse(self.apt.update_by_path.called)
+
+        # Nothing is read when the caller has the partition ID.
+        self.apt.read.reset_mock()
+        cfg_dr.dlt_vopt('fake_lpar_uuid', lpar_id=2)
+        self.assertFalse(self.apt.read.called)
+        self.assertEqual(0, m.ConfigDrivePowerVM._dlt_pending)
+
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
+                '_rm_media')
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
+                '_validate_vopt_vg')
+    def test_dlt_media_batched(self, mock_vop_valid, mock_rm):
+        self.flags(vopt_media_delete_window=2)
+        cfg_dr = m.ConfigDrivePowerVM(self.apt, 'fake_host')
+        cond = m.ConfigDrivePowerVM._dlt_cond
+
+        # With no other delete in progress, there is no wait.
+        with mock.patch.object(cond, 'wait') as mock_wait:
+            cfg_dr._dlt_media('vios1', 'vg1', {'config_a.iso'})
+        self.assertFalse(mock_wait.called)
+        mock_rm.assert_called_once_with('vios1', 'vg1', {'config_a.iso'})
+
+        # Another delete joins while the first one waits for it.
+        other = m.ConfigDrivePowerVM(self.apt, 'fake_host')
+        other._dlt_start()
+
+        def join(secs):
+            self.assertTrue(0 < secs <= 2)
+            batch = m.ConfigDrivePowerVM._dlt_batches[('vios1', 'vg1')]
+            batch.media_names.add('config_b.iso')
+            other._dlt_joined_locked()
+
+        mock_rm.reset_mock()
+        with mock.patch.object(cond, 'wait', side_effect=join) as mock_wait:
+            cfg_dr._dlt_media('vios1', 'vg1', {'config_a.iso'})
+        self.assertEqual(1, mock_wait.call_count)
+        mock_rm.assert_called_once_with('vios1', 'vg1',
+                                        {'config_a.iso', 'config_b.iso'})
+
+        # The batch was closed and the joined delete was woken up.
+        self.assertEqual({}, m.ConfigDrivePowerVM._dlt_batches)
+        self.assertEqual(0, m.ConfigDrivePowerVM._dlt_pending)
+
+        # A delete that does not join in the window is not waited for.
+        other._dlt_start()
+        with mock.patch('time.time', side_effect=[100, 101, 103]):
+            with mock.patch.object(cond, 'wait') as mock_wait:
+                cfg_dr._dlt_media('vios1', 'vg1', {'config_a.iso'})
+        mock_wait.assert_called_once_with(1)
+        other._dlt_joined()
+
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
+                '_rm_media')
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
+                '_validate_vopt_vg')
+    def test_dlt_media_join(self, mock_vop_valid, mock_rm):
+        m.ConfigDrivePowerVM._cur_repos = [
+            m._MediaRepo('vios1', 'vios1_name', 'vg1')]
+        cfg_dr = m.ConfigDrivePowerVM(self.apt, 'fake_host')
+
+        # A batch is already open.  Its owner sends the update and reports
+        # the result back.
+        batch = m._MediaDeleteBatch()
+        batch.media_names.add('config_a.iso')
+        batch.error = pvm_exc.Error('update failed')
+        batch.done.set()
+        m.ConfigDrivePowerVM._dlt_batches[('vios1', 'vg1')] = batch
+
+        self.assertRaises(pvm_exc.Error, cfg_dr._dlt_media, 'vios1', 'vg1',
+                          {'config_b.iso'})
+        self.assertEqual({'config_a.iso', 'config_b.iso'}, batch.media_names)
+        self.assertFalse(mock_rm.called)
+
+    @mock.patch('pypowervm.wrappers.storage.VG.wrap')
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
+                '_validate_vopt_vg')
+    def test_rm_media(self, mock_vop_valid, mock_vg_wrap):
+        cfg_dr = m.ConfigDrivePowerVM(self.apt, 'fake_host')
+
+        def media(name):
+            med = mock.Mock()
+            med.media_name = name
+            return med
+
+        # The first update hits an etag mismatch.
+        resp = mock.Mock(status=412, reqmethod='POST', reqpath='/VG')
+        updates = [pvm_exc.HttpError('etag', resp), None]
+
+        # Each read returns a fresh volume group.
+        vgs = []
+
+        def wrap(resp):
+            volgrp = mock.Mock()
+            volgrp.vmedia_repos[0].optical_media = [
+                media('config_a.iso'), media('config_b.iso'),
+                media('other.iso')]
+            volgrp.update.side_effect = updates.pop(0) if updates else None
+            vgs.append(volgrp)
+            return volgrp
+        mock_vg_wrap.side_effect = wrap
+
+        cfg_dr._rm_media('vios1', 'vg1', {'config_a.iso', 'config_b.iso'})
+
+        # Re-read and retried against the new volume group.
+        self.assertEqual(2, len(vgs))
+        self.assertEqual(2, self.apt.read.call_count)
+        self.assertEqual(
+            ['other.iso'],
+            [med.media_name for med in vgs[1].vmedia_repos[0].optical_media])
+
+        # Nothing left to remove means no update.
+        cfg_dr._rm_media('vios1', 'vg1', {'config_c.iso'})
+        self.assertFalse(vgs[-1].update.called)
+
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
+                '_rm_media')
+    @mock.patch('pypowervm.wrappers.storage.VG.wrap')
+    @mock.patch('pypowervm.wrappers.virtual_io_server.VIOS.wrap')
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
+                '_validate_vopt_vg')
+    def test_rm_orphaned_media(self, mock_vop_valid, mock_vios_wrap,
+                               mock_vg_wrap, mock_rm):
+        self.flags(image_meta_local_path=self.tmp_dir)
+        cfg_dr = m.ConfigDrivePowerVM(self.apt, 'fake_host')
+
+        def media(name):
+            med = mock.Mock(spec=pvm_stor.VOptMedia)
+            med.media_name = name
+            return med
+
+        mock_vios_wrap.return_value = self._vios(
+            'vios1', [('config_mapped.iso', 2)])
+        mock_vg_wrap.return_value.vmedia_repos[0].optical_media = [
+            media('config_mapped.iso'), media('config_orphan.iso'),
+            media('config_other.iso'), media('ubuntu.iso')]
+        pending = {'config_mapped.iso', 'config_orphan.iso'}
+        m._mark_pending_dlt(pending)
+
+        cfg_dr._rm_orphaned_media('vios1', 'vg1', pending)
+
+        # Only unmapped media with an unfinished delete is removed.  Other
+        # media in the repository is not ours to remove.
+        mock_rm.assert_called_once_with('vios1', 'vg1',
+                                        {'config_orphan.iso'})
+        self.assertEqual({'config_mapped.iso'}, m._pending_dlts())
+
+        # A failure is not fatal.
+        mock_rm.reset_mock()
+        self.apt.read.side_effect = pvm_exc.Error('vios down')
+        cfg_dr._rm_orphaned_media('vios1', 'vg1', pending)
+        self.assertFalse(mock_rm.called)
+
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
+                '_rm_orphaned_media')
+    def test_validate_opt_vg_reaps_once(self, mock_reap):
+        self.flags(image_meta_local_path=self.tmp_dir)
+        m._mark_pending_dlt({'config_a.iso'})
+        m.ConfigDrivePowerVM._orphans_reaped = False
+        self.apt.read.side_effect = [self.vio_feed, self.vol_grp_resp,
+                                     self.vio_feed, self.vol_grp_resp]
+        self.apt.update_by_path.return_value = (
+            self.vol_grp_resp.feed.entries[0])
+        cfg_dr = m.ConfigDrivePowerVM(self.apt, 'fake_host')
+        mock_reap.assert_called_once_with(cfg_dr.vios_uuid, cfg_dr.vg_uuid,
+                                          {'config_a.iso'})
+
+        # Later rediscovery must not reap, uploads may be in flight.
+        cfg_dr._validate_vopt_vg(stale_vg_uuid=cfg_dr.vg_uuid)
+        self.assertEqual(1, mock_reap.call_count)
+
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
+                '_validate_vopt_vg')
+    def test_load_cur_repo(self, mock_validate):
+        m.ConfigDrivePowerVM._cur_repos = [
+            m._MediaRepo('vios1', 'vios1_name', 'vg1'),
+            m._MediaRepo('vios2', 'vios2_name', 'vg2')]
+
+        # Uploads are spread round robin across the repositories.
+        picked = [m.ConfigDrivePowerVM(self.apt, 'fake_host').vios_uuid
+                  for i in range(3)]
+        self.assertEqual(['vios1', 'vios2', 'vios1'], picked)
+
+    @mock.patch('pypowervm.tasks.storage.upload_vopt')
+    @mock.patch('pypowervm.tasks.scsi_mapper.add_vscsi_mapping')
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
+                '_create_cfg_dr_iso_mem')
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
+                '_validate_vopt_vg')
+    def test_crt_cfg_drv_vopt_colocated(self, mock_validate, mock_cfg_iso,
+                                        mock_add_map, mock_upld):
+        self.flags(image_meta_in_memory=True)
+        mock_cfg_iso.return_value = mock.MagicMock(), 'fake.iso', 10000
+        vopt = mock.Mock()
+        mock_upld.return_value = (vopt, None)
+        m.ConfigDrivePowerVM._cur_repos = [
+            m._MediaRepo('vios1', 'vios1_name', 'vg1'),
+            m._MediaRepo('vios2', 'vios2_name', 'vg2')]
+        m.ConfigDrivePowerVM._next_repo = 1
+
+        cfg_dr_builder = m.ConfigDrivePowerVM(self.apt, 'fake_host')
+        cfg_dr_builder.create_cfg_drv_vopt(mock.MagicMock(), mock.MagicMock(),
+                                           mock.MagicMock(), 'fake_lpar')
+
+        # The media is mapped from the VIOS it was uploaded to.
+        mock_upld.assert_called_once_with(self.apt, 'vios2', mock.ANY,
+                                          'fake.iso', 10000)
+        mock_add_map.assert_called_once_with('fake_host', 'vios2',
+                                             'fake_lpar', vopt)
+
+    @mock.patch('pypowervm.wrappers.storage.VG.wrap')
+    @mock.patch('pypowervm.wrappers.virtual_io_server.VIOS.wrap')
+    def test_validate_opt_vg_multi(self, mock_vios_wrap, mock_vg_wrap):
+        def vios(uuid, rmc_state='active'):
+            vio = mock.Mock(uuid=uuid, rmc_state=rmc_state)
+            vio.name = uuid + '_name'
+            return vio
+
+        def vg(uuid, name='rootvg', repos=1):
+            vol_grp = mock.Mock(uuid=uuid, vmedia_repos=[mock.Mock()] * repos)
+            vol_grp.name = name
+            return vol_grp
+
+        mock_vios_wrap.return_value = [vios('vios1'), vios('vios2'),
+                                       vios('vios3', rmc_state='inactive'),
+                                       vios('vios4')]
+
+        # vios4 needs a repository created, but that fails.
+        vg4 = vg('vg4', repos=0)
+        vg4.update.side_effect = pvm_exc.Error('no space')
+        mock_vg_wrap.side_effect = [[vg('vg1')],
+                                    [vg('other', name='datavg'), vg('vg2')],
+                                    [vg4]]
+
+        cfg_dr_builder = m.ConfigDrivePowerVM(self.apt, 'fake_host')
+
+        # Every eligible VIOS hosts a repository.
+        self.assertEqual(
+            [('vios1', 'vios1_name', 'vg1'), ('vios2', 'vios2_name', 'vg2')],
+            [(repo.vios_uuid, repo.vios_name, repo.vg_uuid)
+             for repo in m.ConfigDrivePowerVM._cur_repos])
+        self.assertEqual('vios1', cfg_dr_builder.vios_uuid)
+
+        # A failure on one repository only drops that repository.
+        mock_vg_wrap.side_effect = [[vg('vg1')], [], [vg('vg4')]]
+        cfg_dr_builder._validate_vopt_vg(stale_vg_uuid='vg2')
+        self.assertEqual(['vg1', 'vg4'], [repo.vg_uuid for repo in
+                                          m.ConfigDrivePowerVM._cur_repos])
+
+    @mock.patch('pypowervm.wrappers.storage.VG.wrap')
+    @mock.patch('nova_powervm.virt.powervm.vios.get_vios_feed')
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
+                '_rm_media')
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
+                '_dlt_media')
+    @mock.patch('pypowervm.tasks.scsi_mapper.remove_vopt_mapping')
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
+                '_validate_vopt_vg')
+    def test_dlt_vopt_multi_repo(self, mock_validate, mock_remove_map,
+                                 mock_dlt_media, mock_rm_media, mock_feed,
+                                 mock_vg_wrap):
+        self.flags(image_meta_local_path=self.tmp_dir)
+        m.ConfigDrivePowerVM._cur_repos = [
+            m._MediaRepo('vios1', 'vios1_name', 'vg1'),
+            m._MediaRepo('vios2', 'vios2_name', 'vg2')]
+        cfg_dr = m.ConfigDrivePowerVM(self.apt, 'fake_host')
+
+        # The VM's media is on vios1 and on vios3, which no longer hosts a
+        # current repository.
+        mock_feed.return_value = [
+            self._vios('vios1', [('config_a.iso', 2)]),
+            self._vios('vios2', [('config_b.iso', 3)]),
+            self._vios('vios3', [('config_c.iso', 2)])]
+
+        def vg(uuid, repos=1):
+            return mock.Mock(uuid=uuid, vmedia_repos=[mock.Mock()] * repos)
+        mock_vg_wrap.side_effect = [[vg('vg1b')],
+                                    [vg('datavg', repos=0), vg('vg3')]]
+
+        # The batched media removal on vios1 fails.
+        def dlt_media(vios_uuid, vg_uuid, media_names):
+            if vios_uuid == 'vios1':
+                raise pvm_exc.Error('etag mismatch')
+        mock_dlt_media.side_effect = dlt_media
+
+        cfg_dr.dlt_vopt('fake_lpar_uuid', lpar_id=2)
+
+        # Only the VIOSes with the VM's media are updated.
+        self.assertEqual([mock.call(self.apt, 'vios1', 2),
+                          mock.call(self.apt, 'vios3', 2)],
+                         mock_remove_map.call_args_list)
+        self.assertEqual(
+            [mock.call('vios1', 'vg1', {'config_a.iso'}),
+             mock.call('vios3', 'vg3', {'config_c.iso'})],
+            mock_dlt_media.call_args_list)
+        # The media removal alone is retried, against the volume group read
+        # fresh from the VIOS.
+        mock_rm_media.assert_called_once_with('vios1', 'vg1b',
+                                              {'config_a.iso'})
+        self.assertEqual(set(), m._pending_dlts())
+        self.assertFalse(mock_validate.called)
+        # The repository this instance uploads to is left alone.
+        self.assertEqual('vios1', cfg_dr.vios_uuid)
+
+        # A VIOS that fails does not stop the others.  Its media stays
+        # recorded as pending.
+        mock_remove_map.reset_mock()
+        mock_vg_wrap.side_effect = [[vg('vg3')]]
+
+        def remove_map(adapter, vios_uuid, partition_id):
+            if vios_uuid == 'vios1':
+                raise pvm_exc.Error('vios down')
+        mock_remove_map.side_effect = remove_map
+        self.assertRaises(pvm_exc.Error, cfg_dr.dlt_vopt, 'fake_lpar_uuid',
+                          lpar_id=2)
+        self.assertEqual(2, mock_remove_map.call_count)
+        self.assertEqual({'config_a.iso'}, m._pending_dlts())
+        self.assertEqual(0, m.ConfigDrivePowerVM._dlt_pending)
\ No newline at end of file
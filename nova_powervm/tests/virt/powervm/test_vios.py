@@ -14,6 +14,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import mock
 
 from nova import test
 import os
@@ -62,3 +63,116 @@ class TestVios(test.TestCase):
         expected = set(['21000024FF649104'])
         result = set(vios.get_physical_wwpns(self.adpt, 'fake_uuid'))
         self.assertSetEqual(expected, result)
+
+    @mock.patch('time.time')
+    def test_get_vios_feed_cached(self, mock_time):
+        mock_time.return_value = 1000
+        self.adpt.read.return_value = self.vios_feed_resp
+        feed = vios.get_vios_feed(self.adpt, 'host_uuid')
+        self.assertEqual(1, len(feed))
+        self.assertEqual(1, self.adpt.read.call_count)
+
+        # Reused within the staleness budget, including by the helpers.
+        mock_time.return_value = 1014
+        self.assertEqual(1, len(vios.get_active_vioses(self.adpt,
+                                                       'host_uuid')))
+        self.assertEqual(1, self.adpt.read.call_count)
+
+        # Other extended attribute groups and hosts are cached separately.
+        xags = [pvm_vios.VIOS.xags.STORAGE]
+        vios.get_vios_feed(self.adpt, 'host_uuid', xag=xags)
+        vios.get_vios_feed(self.adpt, 'host_uuid2')
+        self.assertEqual(3, self.adpt.read.call_count)
+
+        # Once past the budget, the feed etag is checked.  Not modified means
+        # the wrappers are reused.
+        self.adpt.reset_mock()
+        mock_time.return_value = 1015
+        self.adpt.read.return_value = mock.Mock(status=304)
+        self.assertEqual(feed, vios.get_vios_feed(self.adpt, 'host_uuid'))
+        self.adpt.read.assert_called_once_with(
+            pvm_ms.System.schema_type, root_id='host_uuid',
+            child_type=pvm_vios.VIOS.schema_type, xag=None,
+            etag=self.vios_feed_resp.etag)
+
+        # And the budget starts over.
+        mock_time.return_value = 1029
+        vios.get_vios_feed(self.adpt, 'host_uuid')
+        self.assertEqual(1, self.adpt.read.call_count)
+
+    def test_get_vios_feed_invalidate(self):
+        self.adpt.read.return_value = self.vios_feed_resp
+        vio_uuid = vios.get_vios_feed(self.adpt, 'host_uuid')[0].uuid
+
+        # A changed VIOS is reread on its own, checked against its etag.
+        vios.invalidate_vios_feed('host_uuid', vio_uuid)
+        vio_resp = mock.Mock(status=200)
+        self.adpt.read.return_value = vio_resp
+        with mock.patch.object(pvm_vios.VIOS, 'wrap') as mock_wrap:
+            feed = vios.get_vios_feed(self.adpt, 'host_uuid')
+        self.adpt.read.assert_called_with(
+            pvm_vios.VIOS.schema_type, root_id=vio_uuid, xag=None,
+            etag=mock.ANY)
+        mock_wrap.assert_called_once_with(vio_resp)
+        self.assertEqual([mock_wrap.return_value], feed)
+
+        # Only once.
+        self.assertEqual(2, self.adpt.read.call_count)
+        vios.get_vios_feed(self.adpt, 'host_uuid')
+        self.assertEqual(2, self.adpt.read.call_count)
+
+        # Another host's invalidation leaves this one alone.
+        vios.invalidate_vios_feed('host_uuid2')
+        vios.get_vios_feed(self.adpt, 'host_uuid')
+        self.assertEqual(2, self.adpt.read.call_count)
+
+        # Dropping the host's feeds rereads the whole feed.
+        self.adpt.read.return_value = self.vios_feed_resp
+        vios.invalidate_vios_feed('host_uuid')
+        vios.get_vios_feed(self.adpt, 'host_uuid')
+        self.assertEqual(3, self.adpt.read.call_count)
+        self.adpt.read.assert_called_with(
+            pvm_ms.System.schema_type, root_id='host_uuid',
+            child_type=pvm_vios.VIOS.schema_type, xag=None)
+
+    def test_get_vios_feed_no_cache(self):
+        self.flags(vios_feed_cache_time=0)
+        self.adpt.read.return_value = self.vios_feed_resp
+        vios.get_vios_feed(self.adpt, 'host_uuid')
+        vios.get_vios_feed(self.adpt, 'host_uuid')
+        self.assertEqual(2, self.adpt.read.call_count)
+
+    def test_get_vios_feed_invalidated_during_read(self):
+        # The read does not hold the cache lock, so the feed can be
+        # invalidated while it runs.  What it read must not be cached.
+        def _read(*args, **kwargs):
+            self.assertTrue(vios._feed_lock.acquire(False))
+            vios._feed_lock.release()
+            vios.invalidate_vios_feed('host_uuid')
+            return self.vios_feed_resp
+        self.adpt.read.side_effect = _read
+        vios.get_vios_feed(self.adpt, 'host_uuid')
+
+        self.adpt.read.side_effect = None
+        self.adpt.read.return_value = self.vios_feed_resp
+        vio_uuid = vios.get_vios_feed(self.adpt, 'host_uuid')[0].uuid
+        self.assertEqual(2, self.adpt.read.call_count)
+
+        # A single VIOS changed during a read is reread next time.
+        def _read_vios(*args, **kwargs):
+            vios.invalidate_vios_feed('host_uuid', vio_uuid)
+            return mock.Mock(status=304)
+        vios.invalidate_vios_feed('host_uuid', vio_uuid)
+        self.adpt.read.side_effect = _read_vios
+        vios.get_vios_feed(self.adpt, 'host_uuid')
+        self.assertEqual(3, self.adpt.read.call_count)
+
+        self.adpt.read.side_effect = None
+        self.adpt.read.return_value = mock.Mock(status=304)
+        vios.get_vios_feed(self.adpt, 'host_uuid')
+        self.assertEqual(4, self.adpt.read.call_count)
+        self.adpt.read.assert_called_with(
+            pvm_vios.VIOS.schema_type, root_id=vio_uuid, xag=None,
+            etag=mock.ANY)
+        vios.get_vios_feed(self.adpt, 'host_uuid')
+        self.assertEqual(4, self.adpt.read.call_count)
@@ -26,7 +26,9 @@ from nova import test
 from pypowervm import adapter as pvm_adp
 from pypowervm import exceptions as pvm_exc
 from pypowervm.tests.wrappers.util import pvmhttp
+from pypowervm.wrappers import base_partition as pvm_bp
 from pypowervm.wrappers import logical_partition as pvm_lpar
+import six
 
 from nova_powervm.tests.virt import powervm
 from nova_powervm.tests.virt.powervm import fixtures as fx
@@ -155,12 +157,159 @@ class TestVM(test.TestCase):
         self.assertEqual(lpar_list[0], 'z3-9-5-126-127-00000001')
         self.assertEqual(len(lpar_list), 21)
 
+    @mock.patch('nova_powervm.virt.powervm.vm.power_off')
+    @mock.patch('nova_powervm.virt.powervm.vm.power_on')
+    @mock.patch('nova_powervm.virt.powervm.vm.get_lpar_feed')
+    def test_power_many(self, mock_feed, mock_pwr_on, mock_pwr_off):
+        """Validates the bulk power operations."""
+        mock_feed.return_value = self.resp.feed
+        self.flags(power_op_concurrency=2)
+        insts = []
+        for name in ('z3-9-5-126-127-00000001', 'missing',
+                     'z3-9-5-126-127-00000001'):
+            inst = mock.Mock()
+            inst.name = name
+            insts.append(inst)
+        mock_pwr_on.side_effect = [True, pvm_exc.Error('job failed')]
+
+        results = vm.power_on_many(self.apt, insts, 'host_uuid')
+
+        # The states came from the one feed.  The VM not in it is not found.
+        self.assertEqual(1, mock_feed.call_count)
+        self.assertEqual(insts, [inst for inst, e in results])
+        self.assertIsNone(results[0][1])
+        self.assertIsInstance(results[1][1], exception.InstanceNotFound)
+        self.assertIsInstance(results[2][1], pvm_exc.Error)
+        self.assertEqual(2, mock_pwr_on.call_count)
+        entry = mock_pwr_on.call_args[1]['entry']
+        self.assertEqual('z3-9-5-126-127-00000001', entry.name)
+
+        # Without the feed, each VM is read on its own.
+        mock_feed.return_value = None
+        results = vm.power_off_many(self.apt, insts[:1], 'host_uuid',
+                                    force_immediate=True)
+        self.assertEqual([(insts[0], None)], results)
+        mock_pwr_off.assert_called_once_with(
+            self.apt, insts[0], 'host_uuid', entry=None,
+            force_immediate=True)
+
+    @mock.patch('nova_powervm.virt.powervm.jobs.JobMonitor.run_job')
+    @mock.patch('pypowervm.wrappers.job.Job.wrap')
+    def test_start_stop_lpar(self, mock_wrap, mock_run_job):
+        """Validates the power jobs run through the job monitor."""
+        lpar_w = mock.Mock(uuid='lpar_uuid')
+        vm.start_lpar(self.apt, lpar_w, 'host_uuid',
+                      add_parms={'bootmode': 'sms'})
+        self.apt.read.assert_called_once_with(
+            pvm_lpar.LPAR.schema_type, root_id='lpar_uuid', suffix_type='do',
+            suffix_parm='PowerOn')
+        mock_run_job.assert_called_once_with(
+            mock_wrap.return_value, 'lpar_uuid', pvm_lpar.LPAR.schema_type,
+            'PowerOn', job_parms=mock.ANY)
+        self.assertEqual(1, len(mock_run_job.call_args[1]['job_parms']))
+
+        # Already powered on is not a failure, anything else is.
+        mock_run_job.side_effect = pvm_exc.JobRequestFailed(
+            operation_name='PowerOn', error='HSCL3681 already on')
+        vm.start_lpar(self.apt, lpar_w, 'host_uuid')
+        mock_run_job.side_effect = pvm_exc.JobRequestFailed(
+            operation_name='PowerOn', error='HSCL0000 no resources')
+        self.assertRaises(pvm_exc.VMPowerOnFailure, vm.start_lpar, self.apt,
+                          lpar_w, 'host_uuid')
+
+        # The same for an immediate power off.
+        mock_run_job.reset_mock()
+        mock_run_job.side_effect = None
+        vm.stop_lpar_immediate(self.apt, lpar_w, 'host_uuid')
+        self.assertEqual('PowerOff', mock_run_job.call_args[0][3])
+        self.assertEqual(2, len(mock_run_job.call_args[1]['job_parms']))
+        mock_run_job.side_effect = pvm_exc.JobRequestFailed(
+            operation_name='PowerOff', error='HSCL1558 already off')
+        vm.stop_lpar_immediate(self.apt, lpar_w, 'host_uuid')
+        mock_run_job.side_effect = pvm_exc.JobRequestFailed(
+            operation_name='PowerOff', error='HSCL0000 busy')
+        self.assertRaises(pvm_exc.VMPowerOffFailure, vm.stop_lpar_immediate,
+                          self.apt, lpar_w, 'host_uuid')
+
+    @mock.patch('nova_powervm.virt.powervm.vm.stop_lpar')
+    def test_power_off(self, mock_stop):
+        """Validates the power off of a VM that can be stopped."""
+        entry = mock.Mock(state='running')
+        self.assertTrue(vm.power_off(self.apt, None, 'host_uuid',
+                                     entry=entry, force_immediate=True))
+        mock_stop.assert_called_once_with(self.apt, entry, 'host_uuid',
+                                          force_immediate=True)
+
+        mock_stop.reset_mock()
+        self.assertTrue(vm.power_off(self.apt, None, 'host_uuid',
+                                     entry=entry))
+        mock_stop.assert_called_once_with(self.apt, entry, 'host_uuid',
+                                          force_immediate=False)
+
+        # Nothing to do for a stopped VM.
+        entry.state = 'not activated'
+        self.assertFalse(vm.power_off(self.apt, None, 'host_uuid',
+                                      entry=entry))
+        self.assertEqual(1, mock_stop.call_count)
+
+    @mock.patch('nova_powervm.virt.powervm.vm.stop_lpar_immediate')
+    @mock.patch('nova_powervm.virt.powervm.vm._run_power_job')
+    def test_stop_lpar(self, mock_run, mock_stop_imm):
+        """Validates the OS shutdown and its immediate fallback."""
+        lpar_w = mock.Mock(rmc_state=pvm_bp.RMCState.ACTIVE)
+
+        def operation():
+            parms = mock_run.call_args[0][4]
+            self.assertEqual(1, len(parms))
+            return parms[0]
+
+        # With RMC, the operating system is shut down through it.
+        with mock.patch('pypowervm.wrappers.job.Job.'
+                        'create_job_parameter') as mock_parm:
+            mock_parm.side_effect = lambda key, value: (key, value)
+            vm.stop_lpar(self.apt, lpar_w, 'host_uuid')
+            self.assertEqual(('operation', 'osshutdown'), operation())
+            mock_run.assert_called_once_with(self.apt, lpar_w, 'host_uuid',
+                                             'PowerOff', mock.ANY)
+            self.assertFalse(mock_stop_imm.called)
+
+            # Without it, through the virtual service processor.
+            lpar_w.rmc_state = 'inactive'
+            vm.stop_lpar(self.apt, lpar_w, 'host_uuid')
+            self.assertEqual(('operation', 'shutdown'), operation())
+
+        # A shutdown that fails or times out falls back to an immediate
+        # power off.
+        for error in (pvm_exc.JobRequestFailed(operation_name='PowerOff',
+                                               error='HSCL0000 busy'),
+                      pvm_exc.JobRequestTimedOut(operation_name='PowerOff',
+                                                 seconds=1800)):
+            mock_stop_imm.reset_mock()
+            mock_run.side_effect = error
+            vm.stop_lpar(self.apt, lpar_w, 'host_uuid')
+            mock_stop_imm.assert_called_once_with(self.apt, lpar_w,
+                                                  'host_uuid')
+
+        # A VM that is already off is left alone.
+        mock_stop_imm.reset_mock()
+        mock_run.side_effect = pvm_exc.JobRequestFailed(
+            operation_name='PowerOff', error='HSCL1558 already off')
+        vm.stop_lpar(self.apt, lpar_w, 'host_uuid')
+        self.assertFalse(mock_stop_imm.called)
+
+        # A forced power off skips the shutdown.
+        mock_run.reset_mock()
+        vm.stop_lpar(self.apt, lpar_w, 'host_uuid', force_immediate=True)
+        self.assertFalse(mock_run.called)
+        mock_stop_imm.assert_called_once_with(self.apt, lpar_w, 'host_uuid')
+
     @mock.patch('pypowervm.tasks.vterm.close_vterm')
     def test_dlt_lpar(self, mock_vterm):
         """Performs a delete LPAR test."""
+        # No console was opened, so none is closed.
         vm.dlt_lpar(self.apt, '12345')
         self.assertEqual(1, self.apt.delete.call_count)
-        self.assertEqual(1, mock_vterm.call_count)
+        self.assertEqual(0, mock_vterm.call_count)
 
         # Test Failure Path
         # build a mock response body with the expected HSCL msg
@@ -173,11 +322,36 @@ class TestVM(test.TestCase):
         self.apt.reset_mock()
         mock_vterm.reset_mock()
 
+        # The open console is closed and the delete tried again.
         self.assertRaises(pvm_exc.Error,
                           vm.dlt_lpar, self.apt, '12345')
         self.assertEqual(1, mock_vterm.call_count)
+        self.assertEqual(2, self.apt.delete.call_count)
+
+        # Any other error is raised right away.
+        resp.body = 'error msg: HSCL0000 more text'
+        self.apt.reset_mock()
+        mock_vterm.reset_mock()
+        self.assertRaises(pvm_exc.Error,
+                          vm.dlt_lpar, self.apt, '12345')
+        self.assertEqual(0, mock_vterm.call_count)
         self.assertEqual(1, self.apt.delete.call_count)
 
+    @mock.patch('pypowervm.tasks.vterm.open_vnc_vterm')
+    @mock.patch('pypowervm.tasks.vterm.close_vterm')
+    def test_dlt_lpar_open_vterm(self, mock_close, mock_open):
+        """A console the driver opened is closed before the delete."""
+        with mock.patch.object(vm, '_open_vterms', set()):
+            self.assertEqual(mock_open.return_value, vm.open_vnc_vterm(
+                self.apt, '12345', bind_ip='127.0.0.1'))
+            mock_open.assert_called_once_with(self.apt, '12345',
+                                              bind_ip='127.0.0.1')
+
+            vm.dlt_lpar(self.apt, '12345')
+            mock_close.assert_called_once_with(self.apt, '12345')
+            self.assertEqual(1, self.apt.delete.call_count)
+            self.assertEqual(set(), vm._open_vterms)
+
     def test_build_attr(self):
         """Perform tests against _build_attrs."""
         instance = objects.Instance(**powervm.TEST_INSTANCE)
@@ -226,6 +400,44 @@ class TestVM(test.TestCase):
         test_attrs = dict(lpar_attrs, **{'min_mem': '1024', 'max_mem': '4096'})
         self.assertEqual(vm._build_attrs(instance, flavor), test_attrs)
 
+    @mock.patch.dict(vm._flavor_attrs, clear=True)
+    @mock.patch('nova_powervm.virt.powervm.vm._build_flavor_attrs')
+    def test_build_attrs_cached(self, mock_flavor_attrs):
+        """Tests that each flavor is only validated once."""
+        instance = objects.Instance(**powervm.TEST_INSTANCE)
+        flavor = instance.get_flavor()
+        flavor.extra_specs = {'powervm:dedicated_proc': 'true'}
+        mock_flavor_attrs.return_value = {'memory': 2048}
+
+        self.assertEqual({'memory': 2048, 'name': 'instance-00000001'},
+                         vm._build_attrs(instance, flavor))
+        self.assertEqual({'memory': 2048, 'name': 'instance-00000001'},
+                         vm._build_attrs(instance, flavor))
+        self.assertEqual(1, mock_flavor_attrs.call_count)
+
+        # New extra specs are validated again, and a failure is kept.
+        flavor.extra_specs = {'powervm:BADATTR': 'true'}
+        mock_flavor_attrs.side_effect = exception.InvalidAttribute(
+            attr='powervm:BADATTR')
+        errors = [self.assertRaises(exception.InvalidAttribute,
+                                    vm._build_attrs, instance, flavor)
+                  for i in range(2)]
+        self.assertEqual(2, mock_flavor_attrs.call_count)
+        self.assertIsNot(errors[0], errors[1])
+        self.assertIsNot(mock_flavor_attrs.side_effect, errors[1])
+        self.assertIn('powervm:BADATTR', six.text_type(errors[1]))
+
+    @mock.patch('pypowervm.utils.lpar_builder.DefaultStandardize')
+    def test_get_standardize(self, mock_stdz):
+        """Tests that each builder gets its own standardizer."""
+        self.flags(proc_units_factor=0.5)
+        host_wrapper = mock.Mock(uuid='host_uuid')
+        mock_stdz.side_effect = [mock.Mock(), mock.Mock()]
+
+        stdz = vm._get_standardize(host_wrapper)
+        self.assertIsNot(stdz, vm._get_standardize(host_wrapper))
+        mock_stdz.assert_called_with(host_wrapper, proc_units_factor=0.5)
+
     @mock.patch('nova_powervm.virt.powervm.vm.UUIDCache')
     @mock.patch('pypowervm.utils.lpar_builder.DefaultStandardize')
     @mock.patch('pypowervm.utils.lpar_builder.LPARBuilder.build')
@@ -234,7 +446,7 @@ class TestVM(test.TestCase):
         flavor = instance.get_flavor()
         flavor.extra_specs = {'powervm:dedicated_proc': 'true'}
 
-        host_wrapper = mock.Mock()
+        host_wrapper = mock.MagicMock()
         singleton = mock.Mock()
         mock_cache.get_cache.return_value = singleton
         lparw = pvm_lpar.LPAR.wrap(self.resp.feed.entries[0])
@@ -245,10 +457,92 @@ class TestVM(test.TestCase):
         singleton.add.assert_called_with(instance.name, mock.ANY)
 
         flavor.extra_specs = {'powervm:BADATTR': 'true'}
-        host_wrapper = mock.Mock()
+        host_wrapper = mock.MagicMock()
         self.assertRaises(exception.InvalidAttribute, vm.crt_lpar,
                           self.apt, host_wrapper, instance, flavor)
 
+    @mock.patch('nova_powervm.virt.powervm.vm.UUIDCache')
+    @mock.patch('pypowervm.wrappers.logical_partition.LPAR.wrap')
+    def test_rename(self, mock_wrap, mock_cache):
+        instance = objects.Instance(**powervm.TEST_INSTANCE)
+        lpar_w = mock_wrap.return_value
+
+        new_w = vm.rename(self.apt, 'host_uuid', instance, 'lpar_uuid')
+        self.assertEqual(lpar_w.update.return_value, new_w)
+        self.assertEqual(instance.name, lpar_w.name)
+        self.apt.read.assert_called_once_with(
+            'ManagedSystem', root_id='host_uuid',
+            child_type='LogicalPartition', child_id='lpar_uuid')
+        mock_cache.get_cache.return_value.add.assert_called_once_with(
+            instance.name, new_w.uuid)
+
+    @mock.patch('nova_powervm.virt.powervm.vm.power_off')
+    @mock.patch('nova_powervm.virt.powervm.vm._dlpar_capable')
+    @mock.patch('nova_powervm.virt.powervm.vm._resize_profile')
+    @mock.patch('nova_powervm.virt.powervm.vm._crt_lpar_builder')
+    @mock.patch('nova_powervm.virt.powervm.vm.get_instance_wrapper')
+    def test_resize(self, mock_get_inst, mock_bldr, mock_profile,
+                    mock_dlpar, mock_pwr_off):
+        instance = objects.Instance(**powervm.TEST_INSTANCE)
+        host_wrapper = mock.Mock(uuid='host_uuid')
+        entry1, entry2 = mock.Mock(), mock.Mock()
+        mock_get_inst.side_effect = [entry1, entry2]
+
+        # Nothing changed, so nothing is updated.
+        mock_profile.side_effect = [{'mem': 1}, {'mem': 1}]
+        self.assertFalse(vm.resize(self.apt, host_wrapper, instance,
+                                   'flavor'))
+        mock_bldr.return_value.rebuild.assert_called_once_with(entry1)
+        self.assertFalse(entry1.update.called)
+        self.assertFalse(mock_dlpar.called)
+
+        # A DLPAR change is made on the one read.
+        mock_get_inst.side_effect = [entry1, entry2]
+        mock_profile.side_effect = [{'mem': 1}, {'mem': 2}]
+        mock_dlpar.return_value = True
+        self.assertFalse(vm.resize(self.apt, host_wrapper, instance,
+                                   'flavor'))
+        entry1.update.assert_called_once_with()
+        self.assertFalse(mock_pwr_off.called)
+        mock_dlpar.assert_called_once_with(entry1, {'mem': 1}, {'mem': 2})
+
+        # Otherwise the LPAR is powered off, and read again for the etag.
+        entry1.reset_mock()
+        mock_bldr.reset_mock()
+        mock_get_inst.side_effect = [entry1, entry2]
+        mock_profile.side_effect = [{'mem': 1}, {'mem': 2}]
+        mock_dlpar.return_value = False
+        mock_pwr_off.return_value = True
+        self.assertTrue(vm.resize(self.apt, host_wrapper, instance,
+                                  'flavor'))
+        mock_pwr_off.assert_called_once_with(self.apt, instance, 'host_uuid',
+                                             entry=entry1)
+        mock_bldr.return_value.rebuild.assert_called_with(entry2)
+        self.assertFalse(entry1.update.called)
+        entry2.update.assert_called_once_with()
+
+    def test_dlpar_capable(self):
+        lpar_w = mock.Mock()
+        lpar_w.can_modify_mem.return_value = (True, None)
+        lpar_w.can_modify_proc.return_value = (False, 'No RMC')
+        old = {'mem': (1024, 2048, 4096), 'procs': (1, 2, 4),
+               'sharing_mode': 'uncapped'}
+
+        # Desired memory within the current range.
+        new = dict(old, mem=(1024, 4096, 4096))
+        self.assertTrue(vm._dlpar_capable(lpar_w, old, new))
+        # A new range, or a desired value outside of it.
+        new = dict(old, mem=(2048, 4096, 4096))
+        self.assertFalse(vm._dlpar_capable(lpar_w, old, new))
+        new = dict(old, mem=(1024, 8192, 4096))
+        self.assertFalse(vm._dlpar_capable(lpar_w, old, new))
+        # Processors the LPAR can not take while it runs.
+        new = dict(old, procs=(1, 3, 4))
+        self.assertFalse(vm._dlpar_capable(lpar_w, old, new))
+        # Any other setting.
+        new = dict(old, sharing_mode='capped')
+        self.assertFalse(vm._dlpar_capable(lpar_w, old, new))
+
     @mock.patch('nova_powervm.virt.powervm.vm.get_pvm_uuid')
     @mock.patch('pypowervm.tasks.cna.crt_cna')
     def test_crt_vif(self, mock_crt_cna, mock_pvm_uuid):
@@ -270,6 +564,29 @@ class TestVM(test.TestCase):
         # Validate (along with validate method above)
         self.assertEqual(1, mock_crt_cna.call_count)
 
+    @mock.patch('pypowervm.wrappers.network.VSwitch.wrap')
+    def test_get_secure_rmc_vswitch(self, mock_wrap):
+        """Tests that the secure RMC vSwitch lookup is cached."""
+        mgmt = mock.Mock()
+        mgmt.name = vm.SECURE_RMC_VSWITCH
+        other = mock.Mock()
+        other.name = 'ETHERNET0'
+
+        with mock.patch.dict(vm._secure_rmc_vswitches, clear=True):
+            self.apt.read.reset_mock()
+            # A host without the vSwitch is read on every lookup.
+            mock_wrap.return_value = [other]
+            self.assertIsNone(vm.get_secure_rmc_vswitch(self.apt, 'host'))
+            mock_wrap.return_value = [other, mgmt]
+            self.assertEqual(mgmt, vm.get_secure_rmc_vswitch(self.apt,
+                                                             'host'))
+            self.assertEqual(2, self.apt.read.call_count)
+
+            # Once found, it is not read again.
+            self.assertEqual(mgmt, vm.get_secure_rmc_vswitch(self.apt,
+                                                             'host'))
+            self.assertEqual(2, self.apt.read.call_count)
+
     def test_get_vm_qp(self):
         def adapter_read(root_type, root_id=None, suffix_type=None,
                          suffix_parm=None):
@@ -0,0 +1,190 @@
+# Copyright 2015 IBM Corp.
+#
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from nova import exception
+from nova import objects
+from nova import test
+
+from nova_powervm.tests.virt import powervm
+from nova_powervm.tests.virt.powervm import fixtures as fx
+from nova_powervm.virt.powervm import warm_pool
+
+
+class TestWarmPool(test.TestCase):
+
+    def setUp(self):
+        super(TestWarmPool, self).setUp()
+        self.adpt = self.useFixture(fx.PyPowerVM()).apt
+        self.flags(warm_pool_flavors=['1'], warm_pool_size=2)
+
+        # Run the background fill right away.
+        patcher = mock.patch('eventlet.spawn_n', side_effect=lambda f: f())
+        self.mock_spawn = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.inst = objects.Instance(**powervm.TEST_INSTANCE)
+        self.flavor = self.inst.get_flavor()
+        self.tag = warm_pool._settings_tag(self.flavor)
+        self.pool = warm_pool.WarmPool(self.adpt, mock.Mock(uuid='host'))
+        self.pool._loaded = True
+
+    def test_is_shell(self):
+        name = 'pvm-warm-%s-0a1b2c3d' % warm_pool._flavor_tag('1')
+        self.assertTrue(warm_pool.is_shell(name))
+        self.assertFalse(warm_pool.is_shell('instance-00000001'))
+
+    def test_settings_tag(self):
+        # The tag follows the LPAR settings of the flavor.
+        self.flavor.extra_specs = {'powervm:proc_units': '0.5'}
+        tag = warm_pool._settings_tag(self.flavor)
+        self.assertNotEqual(self.tag, tag)
+        self.flavor.extra_specs = {'powervm:proc_units': '0.5'}
+        self.assertEqual(tag, warm_pool._settings_tag(self.flavor))
+        self.flavor.extra_specs = {'powervm:proc_units': '1.0'}
+        self.assertNotEqual(tag, warm_pool._settings_tag(self.flavor))
+
+    @mock.patch('nova_powervm.virt.powervm.vm.crt_secure_rmc_cna')
+    @mock.patch('nova_powervm.virt.powervm.vm.get_secure_rmc_vswitch')
+    @mock.patch('nova_powervm.virt.powervm.vm.crt_lpar_shell')
+    @mock.patch('nova.objects.flavor.Flavor.get_by_flavor_id')
+    def test_fill(self, mock_get_flv, mock_crt, mock_vswitch, mock_crt_rmc):
+        mock_get_flv.return_value = self.flavor
+        mock_crt.side_effect = [mock.Mock(uuid='lpar1'),
+                                mock.Mock(uuid='lpar2')]
+
+        self.pool.fill()
+        self.assertEqual(2, self.pool.size())
+        self.assertEqual(2, mock_crt.call_count)
+        name = mock_crt.call_args[0][2]
+        self.assertTrue(name.startswith('pvm-warm-%s-%s-' %
+                                        (warm_pool._flavor_tag('1'),
+                                         self.tag)))
+        mock_crt_rmc.assert_called_with(self.adpt, 'host', 'lpar2')
+
+        # A full pool is left alone.
+        self.pool.fill()
+        self.assertEqual(2, mock_crt.call_count)
+
+        # The LPARs built with older settings of the flavor are replaced.
+        with mock.patch('nova_powervm.virt.powervm.vm.dlt_lpar') as mock_dlt:
+            self.pool._shells['1'][0] = ('lpar1', 'oldsttng')
+            mock_crt.side_effect = [mock.Mock(uuid='lpar3')]
+            self.pool.fill()
+            mock_dlt.assert_called_once_with(self.adpt, 'lpar1')
+        self.assertEqual({'1': [('lpar2', self.tag), ('lpar3', self.tag)]},
+                         self.pool._shells)
+
+        # A disabled pool is never filled.
+        self.flags(warm_pool_size=0)
+        self.pool._shells = {}
+        self.pool.fill()
+        self.assertEqual(3, mock_crt.call_count)
+
+    @mock.patch('nova_powervm.virt.powervm.vm.dlt_lpar')
+    @mock.patch('nova_powervm.virt.powervm.vm.crt_secure_rmc_cna')
+    @mock.patch('nova_powervm.virt.powervm.vm.get_secure_rmc_vswitch')
+    @mock.patch('nova_powervm.virt.powervm.vm.crt_lpar_shell')
+    @mock.patch('nova.objects.flavor.Flavor.get_by_flavor_id')
+    def test_fill_fail(self, mock_get_flv, mock_crt, mock_vswitch,
+                       mock_crt_rmc, mock_dlt):
+        # An unknown flavor is skipped.
+        mock_get_flv.side_effect = exception.FlavorNotFound(flavor_id='1')
+        self.pool.fill()
+        self.assertFalse(mock_crt.called)
+
+        # An LPAR that did not get its RMC adapter is deleted.
+        mock_get_flv.side_effect = None
+        mock_get_flv.return_value = self.flavor
+        mock_crt.return_value = mock.Mock(uuid='lpar1')
+        mock_crt_rmc.side_effect = ValueError()
+        self.pool.fill()
+        mock_dlt.assert_called_once_with(self.adpt, 'lpar1')
+        self.assertEqual(0, self.pool.size())
+        self.assertFalse(self.pool._filling)
+
+    @mock.patch('nova.objects.flavor.Flavor.get_by_flavor_id')
+    @mock.patch('pypowervm.wrappers.logical_partition.LPAR.wrap')
+    @mock.patch('nova_powervm.virt.powervm.vm.dlt_lpar')
+    @mock.patch('nova_powervm.virt.powervm.vm.get_lpar_feed')
+    def test_load(self, mock_feed, mock_dlt, mock_wrap, mock_get_flv):
+        mock_get_flv.return_value = self.flavor
+        tag = warm_pool._flavor_tag('1')
+        names = {'lpar1': 'pvm-warm-%s-%s-0a1b2c3d' % (tag, self.tag),
+                 'lpar2': 'pvm-warm-ffffffff-%s-0a1b2c3d' % self.tag,
+                 'lpar3': 'instance-00000001',
+                 'lpar4': 'pvm-warm-%s-oldsttng-0a1b2c3d' % tag,
+                 'lpar5': 'pvm-warm-%s-0a1b2c3d' % tag}
+        mock_feed.return_value.entries = ['lpar1', 'lpar2', 'lpar3',
+                                          'lpar4', 'lpar5']
+
+        def wrap(entry):
+            lpar_w = mock.Mock(uuid=entry)
+            lpar_w.name = names[entry]
+            return lpar_w
+        mock_wrap.side_effect = wrap
+
+        # The LPARs of pool flavors, built with their current settings, are
+        # kept.  The others are deleted.
+        self.pool._load()
+        self.assertEqual({'1': [('lpar1', self.tag)]}, self.pool._shells)
+        self.assertEqual(3, mock_dlt.call_count)
+        for lpar_uuid in ('lpar2', 'lpar4', 'lpar5'):
+            mock_dlt.assert_any_call(self.adpt, lpar_uuid)
+        self.assertTrue(self.pool._loaded)
+
+        # With the pool disabled, the first fill deletes all of them.  That
+        # is the only read.
+        mock_dlt.reset_mock()
+        self.flags(warm_pool_size=0)
+        pool = warm_pool.WarmPool(self.adpt, mock.Mock(uuid='host'))
+        pool.fill()
+        self.assertEqual(4, mock_dlt.call_count)
+        mock_dlt.assert_any_call(self.adpt, 'lpar1')
+        mock_dlt.assert_any_call(self.adpt, 'lpar2')
+        self.assertEqual(0, pool.size())
+        pool.fill()
+        self.assertEqual(2, mock_feed.call_count)
+
+    @mock.patch('nova_powervm.virt.powervm.warm_pool.WarmPool.fill')
+    @mock.patch('nova_powervm.virt.powervm.vm.dlt_lpar')
+    @mock.patch('nova_powervm.virt.powervm.vm.rename')
+    def test_claim(self, mock_rename, mock_dlt, mock_fill):
+        self.pool._shells = {'1': [('lpar1', self.tag), ('lpar2', self.tag),
+                                   ('lpar3', 'oldsttng')]}
+
+        # An LPAR built with older settings of the flavor is skipped.
+        self.assertEqual(mock_rename.return_value,
+                         self.pool.claim(self.inst, self.flavor))
+        mock_rename.assert_called_once_with(self.adpt, 'host', self.inst,
+                                            'lpar2')
+        self.assertEqual(2, self.pool.size())
+        self.assertEqual(1, mock_fill.call_count)
+
+        # An LPAR that can not be renamed is deleted.
+        mock_rename.side_effect = ValueError()
+        self.assertIsNone(self.pool.claim(self.inst, self.flavor))
+        mock_dlt.assert_called_once_with(self.adpt, 'lpar1')
+
+        # An empty pool, or a flavor that is not in it, has nothing.  Nor
+        # does one with only LPARs of older settings.
+        mock_rename.reset_mock()
+        self.assertIsNone(self.pool.claim(self.inst, self.flavor))
+        self.assertEqual(1, self.pool.size())
+        self.flags(warm_pool_flavors=['2'])
+        self.assertIsNone(self.pool.claim(self.inst, self.flavor))
+        self.assertFalse(mock_rename.called)
@@ -14,6 +14,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import eventlet
 import mock
 
 from nova.compute import task_states
@@ -66,6 +67,9 @@ class TestNPIVAdapter(test.TestCase):
         self.adpt_fix = self.useFixture(fx.PyPowerVM())
         self.adpt = self.adpt_fix.apt
 
+        npiv._NPIVHostCache._caches = {}
+        self.flags(wwpn_pool_size=0, group='npiv')
+
     def tearDown(self):
         super(TestNPIVAdapter, self).tearDown()
 
@@ -158,7 +162,9 @@ class TestNPIVAdapter(test.TestCase):
         self.assertEqual('21000024FF649104,AA,BB',
                          inst.system_metadata[meta_key])
         xags = [pvm_vios.VIOS.xags.FC_MAPPING, pvm_vios.VIOS.xags.STORAGE]
-        self.adpt.read.assert_called_once_with('VirtualIOServer', xag=xags)
+        self.adpt.read.assert_called_once_with(
+            'ManagedSystem', root_id='host_uuid', child_type='VirtualIOServer',
+            xag=xags)
 
     def test_wwpns_on_sys_meta(self):
         """Tests that previously stored WWPNs are returned."""
@@ -172,3 +178,172 @@ class TestNPIVAdapter(test.TestCase):
 
         # Verify
         self.assertListEqual(['a b', 'c d'], wwpns)
+
+    @mock.patch('nova_powervm.virt.powervm.vios.get_vios_feed')
+    @mock.patch('pypowervm.tasks.wwpn.add_npiv_port_mappings')
+    @mock.patch('pypowervm.tasks.wwpn.derive_npiv_map')
+    @mock.patch('pypowervm.tasks.wwpn.build_wwpn_pair')
+    def test_wwpns_topology(self, mock_build_wwpns, mock_derive,
+                            mock_add_p_maps, mock_vios_feed):
+        """Tests that the VIOS topology is read once and refreshed."""
+        mock_build_wwpns.return_value = ['aa', 'bb']
+        mock_derive.return_value = [('phys1', 'aa bb')]
+        # No free NPIV ports, so the mapping is left to derive_npiv_map.
+        vioses = [mock.Mock(pfc_ports=[], vfc_mappings=[]),
+                  mock.Mock(pfc_ports=[], vfc_mappings=[])]
+        expected = list(vioses)
+        mock_vios_feed.return_value = vioses
+
+        def inst():
+            inst = mock.Mock()
+            inst.system_metadata = {}
+            return inst
+
+        self.vol_drv.wwpns(self.adpt, 'host_uuid', inst())
+        self.vol_drv.wwpns(self.adpt, 'host_uuid', inst())
+        mock_vios_feed.assert_called_once_with(
+            self.adpt, 'host_uuid', xag=[pvm_vios.VIOS.xags.FC_MAPPING,
+                                         pvm_vios.VIOS.xags.STORAGE])
+        self.assertEqual(2, mock_derive.call_count)
+        self.assertEqual(expected, vioses)
+
+        # A change to the mappings refreshes it in the background.
+        self.vol_drv.connect_volume(self.adpt, 'host_uuid', 'vm_uuid',
+                                    mock.MagicMock(), mock.MagicMock())
+        eventlet.sleep(0)
+        self.assertEqual(2, mock_vios_feed.call_count)
+
+        # As does age.  The old topology is used in the meantime.
+        self.flags(topology_refresh_interval=0, group='npiv')
+        mock_vios_feed.return_value = [mock.Mock(vfc_mappings=[])]
+        self.assertEqual(vioses, npiv._NPIVHostCache.get(
+            self.adpt, 'host_uuid').vios_wraps())
+        eventlet.sleep(0)
+        self.assertEqual(3, mock_vios_feed.call_count)
+
+    @mock.patch('pypowervm.tasks.wwpn.build_wwpn_pair')
+    def test_wwpn_pool(self, mock_build_wwpns):
+        """Tests that the WWPN pairs come from a pool filled ahead."""
+        self.flags(wwpn_pool_size=2, group='npiv')
+        pairs = iter([['a%d' % i, 'b%d' % i] for i in range(10)])
+        mock_build_wwpns.side_effect = lambda *a: next(pairs)
+        host_cache = npiv._NPIVHostCache.get(self.adpt, 'host_uuid')
+
+        # Nothing in the pool yet, so they are built on the spot.
+        self.assertEqual(['a0', 'b0', 'a1', 'b1'], host_cache.take_wwpns(2))
+        self.assertEqual(2, mock_build_wwpns.call_count)
+
+        # The pool is filled in the background.
+        eventlet.sleep(0)
+        self.assertEqual(4, mock_build_wwpns.call_count)
+        self.assertEqual(['a2', 'b2'], host_cache.take_wwpns(1))
+        self.assertEqual(4, mock_build_wwpns.call_count)
+
+        # And topped back up.
+        eventlet.sleep(0)
+        self.assertEqual(5, mock_build_wwpns.call_count)
+        mock_build_wwpns.assert_called_with(self.adpt, 'host_uuid')
+
+    def test_balanced_npiv_map(self):
+        """Tests that virtual ports go on the least loaded physical ports."""
+        def port(wwpn, available, total=64):
+            return mock.Mock(wwpn=wwpn, npiv_available_ports=available,
+                             npiv_total_ports=total)
+
+        def vfc_map(p_port):
+            return mock.Mock(backing_port=p_port)
+
+        # vios1's first port backs two mappings, its second one.  vios2's
+        # port is unused but has no free NPIV ports.  The fourth port is on
+        # another fabric.
+        p1, p2, p3, p4 = (port('P1', 62), port('p2', 63), port('P3', 0),
+                          port('P4', 64))
+        vios1 = mock.Mock(uuid='vios1', pfc_ports=[p1, p2],
+                          vfc_mappings=[vfc_map(p1), vfc_map(p1),
+                                        vfc_map(p2), vfc_map(None)])
+        vios2 = mock.Mock(uuid='vios2', pfc_ports=[p3, p4], vfc_mappings=[])
+        vioses = [vios1, vios2]
+        pending = {}
+        used = set()
+
+        port_map = npiv._balanced_npiv_map(vioses, ['P1', 'P2', 'P3'],
+                                           ['a', 'b'], pending, used)
+        self.assertEqual([('p2', 'a b')], port_map)
+        self.assertEqual({'p2': 1}, pending)
+        self.assertEqual({'vios1'}, used)
+
+        # The pending assignment counts, so the next pair gets P1.
+        port_map = npiv._balanced_npiv_map(vioses, ['P1', 'P2', 'P3'],
+                                           ['c', 'd', 'e', 'f'], pending,
+                                           set())
+        self.assertEqual([('P1', 'c d'), ('p2', 'e f')], port_map)
+
+        # Another VIOS is preferred over a lighter loaded port.
+        p3.npiv_available_ports = 64
+        vios2.vfc_mappings = [vfc_map(p3)] * 10
+        port_map = npiv._balanced_npiv_map(vioses, ['P1', 'P2', 'P3'],
+                                           ['g', 'h'], {}, {'vios1'})
+        self.assertEqual([('P3', 'g h')], port_map)
+
+    @mock.patch('time.time')
+    @mock.patch('nova_powervm.virt.powervm.vios.get_vios_feed')
+    def test_assign_ports_pending(self, mock_vios_feed, mock_time):
+        """Tests that assignments count until their mappings are read."""
+        mock_time.return_value = 1000
+        p1 = mock.Mock(wwpn='P1', npiv_available_ports=64,
+                       npiv_total_ports=64)
+        p2 = mock.Mock(wwpn='P2', npiv_available_ports=64,
+                       npiv_total_ports=64)
+        vios1 = mock.Mock(uuid='vios1', pfc_ports=[p1, p2], vfc_mappings=[])
+        mock_vios_feed.return_value = [vios1]
+        host_cache = npiv._NPIVHostCache.get(self.adpt, 'host_uuid')
+        wraps = host_cache.vios_wraps()
+
+        self.assertEqual([('P1', 'a b'), ('P2', 'c d')],
+                         host_cache.assign_ports(wraps, ['P1', 'P2'],
+                                                 ['a', 'b', 'c', 'd'], set()))
+
+        # A read that does not have the mappings yet keeps the assignments.
+        host_cache._load_topology()
+        self.assertEqual([('P1', 'e f')],
+                         host_cache.assign_ports(wraps, ['P1', 'P2'],
+                                                 ['e', 'f'], set()))
+
+        # Once 'a b' is mapped, only its assignment is dropped.
+        client = mock.Mock(wwpns=['A', 'B'])
+        vios1.vfc_mappings = [mock.Mock(backing_port=p1,
+                                        client_adapter=client)]
+        host_cache._load_topology()
+        self.assertEqual([('P1', 'e', 1000), ('P2', 'c', 1000)],
+                         sorted(host_cache._assigned))
+
+        # Assignments that are never mapped expire.
+        mock_time.return_value = 1000 + npiv._ASSIGNMENT_TIMEOUT
+        host_cache._load_topology()
+        self.assertEqual([], host_cache._assigned)
+
+    @mock.patch('pypowervm.tasks.wwpn.derive_npiv_map')
+    def test_balanced_npiv_map_full(self, mock_derive):
+        """Tests that full ports are left to derive_npiv_map."""
+        vios1 = mock.Mock(uuid='vios1', vfc_mappings=[], pfc_ports=[
+            mock.Mock(wwpn='P1', npiv_available_ports=0, npiv_total_ports=1),
+            mock.Mock(wwpn='P2', npiv_available_ports=None,
+                      npiv_total_ports=None)])
+        self.assertEqual(mock_derive.return_value,
+                         npiv._balanced_npiv_map([vios1], ['P1', 'P2'],
+                                                 ['a', 'b'], {}, set()))
+        mock_derive.assert_called_once_with([vios1], ['P1', 'P2'],
+                                            ['a', 'b'])
+
+    @mock.patch('nova_powervm.virt.powervm.vios.get_vios_feed')
+    @mock.patch('pypowervm.tasks.wwpn.build_wwpn_pair')
+    def test_init_host(self, mock_build_wwpns, mock_vios_feed):
+        """Tests that the topology and WWPN pool are warmed at start."""
+        self.flags(wwpn_pool_size=2, group='npiv')
+        mock_build_wwpns.return_value = ['aa', 'bb']
+
+        self.vol_drv.init_host(self.adpt, 'host_uuid')
+        self.assertFalse(mock_vios_feed.called)
+        eventlet.sleep(0)
+        self.assertEqual(1, mock_vios_feed.call_count)
+        self.assertEqual(2, mock_build_wwpns.call_count)
@@ -14,6 +14,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import eventlet
 import mock
 
 from nova import test
@@ -24,14 +25,38 @@ from oslo_config import cfg
 from nova_powervm.tests.virt.powervm import fixtures as fx
 from nova_powervm.virt.powervm.volume import vscsi
 
+import pypowervm.exceptions as pexc
 from pypowervm.tasks import hdisk
 from pypowervm.tests.wrappers.util import pvmhttp
+from pypowervm.wrappers import base_partition as pvm_bp
+from pypowervm.wrappers import storage as pvm_stor
+from pypowervm.wrappers import virtual_io_server as pvm_vios
 
 CONF = cfg.CONF
 
 VIOS_FEED = 'fake_vios_feed.txt'
 
 
+def _mock_vios(uuid, mappings):
+    """Builds a mock active VIOS wrapper with hdisk mappings.
+
+    :param uuid: The UUID of the VIOS.
+    :param mappings: List of (device_name, udid, lpar_id) tuples.
+    """
+    vio_w = mock.Mock(uuid=uuid, rmc_state=pvm_bp.RMCState.ACTIVE,
+                      state=pvm_bp.LPARState.RUNNING)
+    vio_w.phys_vols = []
+    vio_w.scsi_mappings = []
+    for device_name, udid, lpar_id in mappings:
+        pv = mock.Mock(spec=pvm_stor.PV, udid=udid)
+        pv.name = device_name
+        vio_w.phys_vols.append(pv)
+        smap = mock.Mock(backing_storage=pv)
+        smap.server_adapter.lpar_id = lpar_id
+        vio_w.scsi_mappings.append(smap)
+    return vio_w
+
+
 class TestVSCSIAdapter(test.TestCase):
     """Tests the vSCSI Volume Connector Adapter."""
 
@@ -55,16 +80,23 @@ class TestVSCSIAdapter(test.TestCase):
         self.udid = (
             '01M0lCTTIxNDUxMjQ2MDA1MDc2ODAyODI4NjFEODgwMDAwMDAwMDAwMDA1Rg==')
 
+        vscsi.UDIDIndex._indexes = {}
+        vscsi._discovery_cache = vscsi._DiscoveryCache()
+        self.flags(vscsi_discovery_cache_size=0)
+
+    @mock.patch('nova_powervm.virt.powervm.vm.get_vm_id')
     @mock.patch('pypowervm.tasks.hdisk.build_itls')
     @mock.patch('pypowervm.tasks.hdisk.discover_hdisk')
     @mock.patch('pypowervm.tasks.scsi_mapper.add_vscsi_mapping')
     def test_connect_volume(self, mock_add_vscsi_mapping,
-                            mock_discover_hdisk, mock_build_itls):
+                            mock_discover_hdisk, mock_build_itls,
+                            mock_get_vm_id):
         con_info = {'data': {'initiator_target_map': {'i1': ['t1'],
                                                       'i2': ['t2', 't3']},
                     'target_lun': '1', 'volume_id': 'id'}}
         mock_discover_hdisk.return_value = (
             hdisk.LUAStatus.DEVICE_AVAILABLE, 'devname', 'udid')
+        mock_get_vm_id.return_value = '2'
 
         self.adpt.read.return_value = self.vios_feed_resp
         mock_instance = mock.Mock()
@@ -79,13 +111,231 @@ class TestVSCSIAdapter(test.TestCase):
             'host_uuid', '3443DB77-AED1-47ED-9AA5-3DB9C6CF7089', 'vm_uuid',
             mock.ANY)
 
+    @mock.patch('nova_powervm.virt.powervm.vm.get_vm_id')
+    @mock.patch('nova_powervm.virt.powervm.vios.get_active_vioses')
+    @mock.patch('pypowervm.tasks.hdisk.discover_hdisk')
+    @mock.patch('pypowervm.tasks.scsi_mapper.add_vscsi_mapping')
+    def test_connect_volume_multi_vios(self, mock_add_vscsi_mapping,
+                                       mock_discover_hdisk, mock_vioses,
+                                       mock_get_vm_id):
+        con_info = {'data': {'initiator_target_map': {'i1': ['t1']},
+                    'target_lun': '1', 'volume_id': 'id'}}
+
+        def vio(uuid):
+            vio_w = mock.Mock(uuid=uuid)
+            vio_w.name = uuid + '_name'
+            return vio_w
+        mock_vioses.return_value = [vio('vios1'), vio('vios2'), vio('vios3'),
+                                    vio('vios4')]
+
+        # All of the discovery jobs run at the same time.
+        started = []
+
+        def discover(adapter, vios_uuid, itls):
+            started.append(vios_uuid)
+            while len(started) < 4:
+                eventlet.sleep(0)
+            if vios_uuid == 'vios2':
+                raise pexc.Error('job failed')
+            if vios_uuid == 'vios3':
+                return hdisk.LUAStatus.DEVICE_IN_USE, 'hdisk3', 'udid3'
+            return hdisk.LUAStatus.DEVICE_AVAILABLE, 'hdisk1', 'udid1'
+        mock_discover_hdisk.side_effect = discover
+        mock_get_vm_id.return_value = '2'
+
+        mock_instance = mock.Mock()
+        mock_instance.system_metadata = {}
+
+        vol_drv = vscsi.VscsiVolumeAdapter()
+        vol_drv.connect_volume(self.adpt, 'host_uuid', 'vm_uuid',
+                               mock_instance, con_info)
+
+        # A failure on one VIOS does not fail the attach.  Both VIOSes that
+        # found the disk map it.
+        self.assertEqual(4, mock_discover_hdisk.call_count)
+        self.assertEqual(2, mock_add_vscsi_mapping.call_count)
+        mock_add_vscsi_mapping.assert_any_call('host_uuid', 'vios1',
+                                               'vm_uuid', mock.ANY)
+        mock_add_vscsi_mapping.assert_any_call('host_uuid', 'vios4',
+                                               'vm_uuid', mock.ANY)
+        self.assertEqual('udid1', con_info['data']['target_UDID'])
+        self.assertEqual(
+            {vol_drv._build_udid_key('vios1', 'id'): 'udid1',
+             vol_drv._build_udid_key('vios4', 'id'): 'udid1'},
+            mock_instance.system_metadata)
+        index = vscsi.UDIDIndex.get(self.adpt, 'host_uuid')
+        self.assertEqual('udid1', index.volume_udid('id'))
+
+        # No VIOS with a usable hdisk fails the attach.
+        mock_add_vscsi_mapping.reset_mock()
+        mock_discover_hdisk.side_effect = pexc.Error('job failed')
+        self.assertRaises(pexc.VolumeAttachFailed, vol_drv.connect_volume,
+                          self.adpt, 'host_uuid', 'vm_uuid', mock_instance,
+                          con_info)
+        self.assertFalse(mock_add_vscsi_mapping.called)
+
+        # A mapping failure still fails the attach, but the good mappings
+        # are recorded.
+        mock_instance.system_metadata = {}
+        mock_discover_hdisk.side_effect = None
+        mock_discover_hdisk.return_value = (
+            hdisk.LUAStatus.DEVICE_AVAILABLE, 'hdisk1', 'udid1')
+
+        def add_map(host_uuid, vios_uuid, vm_uuid, pv):
+            if vios_uuid == 'vios2':
+                raise pexc.Error('mapping failed')
+        mock_add_vscsi_mapping.side_effect = add_map
+        self.assertRaises(pexc.Error, vol_drv.connect_volume, self.adpt,
+                          'host_uuid', 'vm_uuid', mock_instance, con_info)
+        self.assertEqual(4, mock_add_vscsi_mapping.call_count)
+        self.assertEqual(3, len(mock_instance.system_metadata))
+
     @mock.patch('pypowervm.tasks.hdisk.remove_hdisk')
-    @mock.patch('pypowervm.tasks.scsi_mapper.remove_pv_mapping')
+    @mock.patch('nova_powervm.virt.powervm.vios.get_active_vioses')
+    @mock.patch('pypowervm.tasks.hdisk.discover_hdisk')
+    @mock.patch('pypowervm.tasks.scsi_mapper.add_vscsi_mapping')
+    def test_live_migration_on_destination(self, mock_add_vscsi_mapping,
+                                           mock_discover_hdisk, mock_vioses,
+                                           mock_rm_hdisk):
+        con_info = {'data': {'initiator_target_map': {'i1': ['t1']},
+                    'target_lun': '1', 'volume_id': 'id'}}
+
+        def vio(uuid):
+            vio_w = mock.Mock(uuid=uuid)
+            vio_w.name = uuid + '_name'
+            return vio_w
+        mock_vioses.return_value = [vio('vios1'), vio('vios2')]
+        mock_discover_hdisk.return_value = (
+            hdisk.LUAStatus.DEVICE_AVAILABLE, 'hdisk1', 'udid1')
+        mock_instance = mock.Mock(uuid='inst')
+        mock_instance.system_metadata = {}
+
+        # The hdisks are discovered on each VIOS, but not mapped.
+        vol_drv = vscsi.VscsiVolumeAdapter()
+        vol_drv.pre_live_migration_on_destination(
+            self.adpt, 'host_uuid', mock_instance, con_info)
+        self.assertEqual(2, mock_discover_hdisk.call_count)
+        self.assertFalse(mock_add_vscsi_mapping.called)
+        self.assertEqual({}, mock_instance.system_metadata)
+
+        # Once the LPAR is here, they are recorded as for an attach.
+        vol_drv.post_live_migration_at_destination(
+            self.adpt, 'host_uuid', mock_instance, con_info, 3)
+        self.assertEqual(
+            {vol_drv._build_udid_key('vios1', 'id'): 'udid1',
+             vol_drv._build_udid_key('vios2', 'id'): 'udid1'},
+            mock_instance.system_metadata)
+        index = vscsi.UDIDIndex.get(self.adpt, 'host_uuid')
+        self.assertEqual('udid1', index.volume_udid('id'))
+        self.assertEqual({}, vol_drv._migrating)
+
+        # A failed migration removes the hdisks again.
+        vol_drv.pre_live_migration_on_destination(
+            self.adpt, 'host_uuid', mock.Mock(uuid='inst2'), con_info)
+        vol_drv.rollback_live_migration_at_destination(
+            self.adpt, 'host_uuid', mock.Mock(uuid='inst2'), con_info)
+        mock_rm_hdisk.assert_any_call(self.adpt, mock.ANY, 'hdisk1', 'vios1')
+        mock_rm_hdisk.assert_any_call(self.adpt, mock.ANY, 'hdisk1', 'vios2')
+        self.assertEqual({}, vol_drv._migrating)
+
+        # No VIOS with a usable hdisk fails the migration.
+        mock_discover_hdisk.side_effect = pexc.Error('job failed')
+        self.assertRaises(pexc.VolumeAttachFailed,
+                          vol_drv.pre_live_migration_on_destination,
+                          self.adpt, 'host_uuid', mock_instance, con_info)
+
+    @mock.patch('pypowervm.tasks.hdisk.remove_hdisk')
+    @mock.patch('nova_powervm.virt.powervm.vios.get_vios_feed')
+    @mock.patch('nova_powervm.virt.powervm.vm.get_vm_id')
+    @mock.patch('nova_powervm.virt.powervm.vios.get_active_vioses')
+    @mock.patch('pypowervm.tasks.hdisk.discover_hdisk')
+    @mock.patch('pypowervm.tasks.scsi_mapper.add_vscsi_mapping')
+    def test_connect_volume_discovery_cache(self, mock_add_vscsi_mapping,
+                                            mock_discover_hdisk, mock_vioses,
+                                            mock_get_vm_id, mock_vios_feed,
+                                            mock_remove_hdisk):
+        self.flags(vscsi_discovery_cache_size=10)
+        con_info = {'data': {'initiator_target_map': {'i1': ['t1']},
+                    'target_lun': '1', 'volume_id': 'id'}}
+        vio_w = _mock_vios('vios1', [('hdisk1', 'udid1', 2)])
+        # The hdisk is not mapped yet.
+        vio_w.scsi_mappings = []
+        mock_vioses.return_value = [vio_w]
+        mock_vios_feed.return_value = [vio_w]
+        mock_discover_hdisk.return_value = (
+            hdisk.LUAStatus.DEVICE_AVAILABLE, 'hdisk1', 'udid1')
+        mock_get_vm_id.return_value = '2'
+        instance = mock.Mock()
+        instance.system_metadata = {}
+        vol_drv = vscsi.VscsiVolumeAdapter()
+
+        # The second attach reuses the discovered hdisk.
+        for i in range(2):
+            vol_drv.connect_volume(self.adpt, 'host_uuid', 'vm_uuid',
+                                   instance, con_info)
+        self.assertEqual(1, mock_discover_hdisk.call_count)
+        self.assertEqual(2, mock_add_vscsi_mapping.call_count)
+        mock_vios_feed.assert_called_once_with(
+            self.adpt, 'host_uuid',
+            xag=[pvm_vios.VIOS.xags.STORAGE, pvm_vios.VIOS.xags.SCSI_MAPPING])
+
+        # Not if the hdisk has since been mapped to a partition.  The
+        # discovery decides whether it is in use.
+        mock_vios_feed.return_value = [_mock_vios('vios1',
+                                                  [('hdisk1', 'udid1', 3)])]
+        vol_drv.connect_volume(self.adpt, 'host_uuid', 'vm_uuid', instance,
+                               con_info)
+        self.assertEqual(2, mock_discover_hdisk.call_count)
+        mock_vios_feed.return_value = [vio_w]
+
+        # Not if the hdisk has gone from the VIOS.
+        mock_vios_feed.return_value = [_mock_vios('vios1', [])]
+        vol_drv.connect_volume(self.adpt, 'host_uuid', 'vm_uuid', instance,
+                               con_info)
+        self.assertEqual(3, mock_discover_hdisk.call_count)
+
+        # Nor once the driver has removed it.
+        mock_vios_feed.return_value = [vio_w]
+        vol_drv._rm_hdisk(self.adpt, instance,
+                          vscsi.UDIDIndex.get(self.adpt, 'host_uuid'),
+                          'udid1', '2', 'vios1', 'id', 'hdisk1')
+        vol_drv.connect_volume(self.adpt, 'host_uuid', 'vm_uuid', instance,
+                               con_info)
+        self.assertEqual(4, mock_discover_hdisk.call_count)
+
+    def test_discovery_cache(self):
+        self.flags(vscsi_discovery_cache_size=2)
+        cache = vscsi._DiscoveryCache()
+        key1 = cache.key('vios1', ['i1', 'i2'], ['t1'], 1)
+        key2 = cache.key('vios1', ['i1'], ['t1'], 1)
+        key3 = cache.key('vios2', ['i1'], ['t1'], 1)
+        self.assertEqual(key1, cache.key('vios1', ['i2', 'i1'], ['t1'], '1'))
+
+        cache.put(key1, ('status', 'hdisk1', 'udid1'))
+        cache.put(key2, ('status', 'hdisk2', 'udid2'))
+        # Using key1 makes key2 the oldest, so it is dropped.
+        self.assertEqual(('status', 'hdisk1', 'udid1'), cache.get(key1))
+        cache.put(key3, ('status', 'hdisk1', 'udid1'))
+        self.assertIsNone(cache.get(key2))
+
+        cache.invalidate('vios1', 'hdisk1')
+        self.assertIsNone(cache.get(key1))
+        self.assertIsNotNone(cache.get(key3))
+
+        # Disabled
+        self.flags(vscsi_discovery_cache_size=0)
+        cache.put(key1, ('status', 'hdisk1', 'udid1'))
+        self.assertIsNone(cache.get(key1))
+
+    @mock.patch('pypowervm.tasks.hdisk.discover_hdisk')
+    @mock.patch('pypowervm.tasks.hdisk.remove_hdisk')
+    @mock.patch('nova_powervm.virt.powervm.volume.vscsi.'
+                'VscsiMappingAccumulator._update')
     @mock.patch('nova_powervm.virt.powervm.vm.get_vm_id')
-    @mock.patch('pypowervm.wrappers.virtual_io_server.VIOS.hdisk_from_uuid')
-    def test_disconnect_volume(self, mock_hdisk_from_uuid,
-                               mock_get_vm_id, mock_remove_pv_mapping,
-                               mock_remove_hdisk):
+    @mock.patch('nova_powervm.virt.powervm.vios.get_vios_feed')
+    def test_disconnect_volume(self, mock_vios_feed, mock_get_vm_id,
+                               mock_update, mock_remove_hdisk,
+                               mock_discover_hdisk):
         con_info = {'data': {'initiator_target_map': {'i1': ['t1'],
                                                       'i2': ['t2', 't3']},
                     'target_lun': '1', 'volume_id': 'id'}}
@@ -95,27 +345,199 @@ class TestVSCSIAdapter(test.TestCase):
         volid_meta_key = vscsi.VscsiVolumeAdapter()._build_udid_key(vios_uuid,
                                                                     'id')
         instance.system_metadata = {volid_meta_key: self.udid}
-        # Set test scenario
-        self.adpt.read.return_value = self.vios_feed_resp
-        mock_hdisk_from_uuid.return_value = 'device_name'
-        mock_get_vm_id.return_value = 'partion_id'
+        # Set test scenario.  The hdisk is also mapped to another LPAR.
+        mock_vios_feed.return_value = [
+            _mock_vios(vios_uuid, [('device_name', self.udid, 2),
+                                   ('device_name', self.udid, 3),
+                                   ('other', 'other_udid', 2)])]
+        mock_get_vm_id.return_value = '2'
         # Run the test
-        vscsi.VscsiVolumeAdapter().disconnect_volume(self.adpt, 'host_uuid',
-                                                     'vm_uuid',
-                                                     instance, con_info)
-        self.assertEqual(1, mock_remove_pv_mapping.call_count)
-        self.assertEqual(1, mock_remove_hdisk.call_count)
+        vol_drv = vscsi.VscsiVolumeAdapter()
+        vol_drv.disconnect_volume(self.adpt, 'host_uuid', 'vm_uuid',
+                                  instance, con_info)
+        mock_update.assert_called_once_with(
+            vios_uuid, [], [('vm_uuid', 'device_name')])
+        mock_remove_hdisk.assert_called_once_with(
+            self.adpt, CONF.host, 'device_name', vios_uuid)
         # Verify entry deleted
         self.assertDictEqual({}, instance.system_metadata)
 
-    @mock.patch('nova_powervm.virt.powervm.vios.get_physical_wwpns')
-    def test_wwpns(self, mock_vio_wwpns):
-        mock_vio_wwpns.return_value = ['aa', 'bb']
+        # The system_metadata is not needed when the connection_info has the
+        # UDID, and the index is not reread.  A partition ID from the caller
+        # is used rather than looked up.
+        mock_update.reset_mock()
+        mock_get_vm_id.reset_mock()
+        con_info['data']['target_UDID'] = 'other_udid'
+        vol_drv.disconnect_volume(self.adpt, 'host_uuid', 'vm_uuid',
+                                  instance, con_info, lpar_id=2)
+        mock_update.assert_called_once_with(
+            vios_uuid, [], [('vm_uuid', 'other')])
+        self.assertEqual(1, mock_vios_feed.call_count)
+        self.assertFalse(mock_get_vm_id.called)
+
+        self.assertFalse(mock_discover_hdisk.called)
+
+        # Nothing recorded for the volume, for example after a restart with
+        # the system_metadata lost.  The VIOSes are asked for the hdisk of
+        # the volume's ITLs.
+        mock_update.reset_mock()
+        del con_info['data']['target_UDID']
+        mock_discover_hdisk.return_value = (
+            hdisk.LUAStatus.DEVICE_IN_USE, 'device_name', self.udid)
+        vol_drv.disconnect_volume(self.adpt, 'host_uuid', 'vm_uuid',
+                                  instance, con_info)
+        mock_discover_hdisk.assert_called_once_with(
+            self.adpt, vios_uuid, mock.ANY)
+        mock_update.assert_called_once_with(
+            vios_uuid, [], [('vm_uuid', 'device_name')])
+
+        # Not found there either.
+        mock_update.reset_mock()
+        mock_discover_hdisk.return_value = (
+            hdisk.LUAStatus.DEVICE_AVAILABLE, None, None)
+        vol_drv.disconnect_volume(self.adpt, 'host_uuid', 'vm_uuid',
+                                  instance, con_info)
+        self.assertFalse(mock_update.called)
+
+    @mock.patch('pypowervm.tasks.hdisk.remove_hdisk')
+    @mock.patch('nova_powervm.virt.powervm.volume.vscsi.'
+                'VscsiMappingAccumulator.rollback')
+    @mock.patch('nova_powervm.virt.powervm.volume.vscsi.'
+                'VscsiMappingAccumulator._update')
+    @mock.patch('nova_powervm.virt.powervm.vios.get_vios_feed')
+    def test_disconnect_volume_update_fail(self, mock_vios_feed, mock_update,
+                                           mock_rollback, mock_remove_hdisk):
+        con_info = {'data': {'initiator_target_map': {'i1': ['t1']},
+                    'target_lun': '1', 'volume_id': 'id',
+                    'target_UDID': self.udid}}
+        instance = mock.Mock()
+        instance.system_metadata = {}
+        mock_vios_feed.return_value = [
+            _mock_vios(self.vios_uuid, [('device_name', self.udid, 2)])]
+        mock_update.side_effect = pexc.Error('vios down')
+
+        # The mapping is put back and the hdisk is left alone.
+        vol_drv = vscsi.VscsiVolumeAdapter()
+        self.assertRaises(pexc.VolumeDetachFailed, vol_drv.disconnect_volume,
+                          self.adpt, 'host_uuid', 'vm_uuid', instance,
+                          con_info, lpar_id=2)
+        mock_rollback.assert_called_once_with()
+        self.assertFalse(mock_remove_hdisk.called)
+
+    @mock.patch('pypowervm.tasks.hdisk.remove_hdisk')
+    @mock.patch('pypowervm.tasks.scsi_mapper.remove_pv_mapping')
+    @mock.patch('pypowervm.tasks.hdisk.discover_hdisk')
+    @mock.patch('pypowervm.tasks.scsi_mapper.add_vscsi_mapping')
+    @mock.patch('nova_powervm.virt.powervm.vm.get_vm_id')
+    @mock.patch('nova_powervm.virt.powervm.vios.get_vios_feed')
+    def test_volume_mapping_acc(self, mock_vios_feed, mock_get_vm_id,
+                                mock_add_map, mock_discover_hdisk,
+                                mock_remove_pv_mapping, mock_remove_hdisk):
+        con_info = {'data': {'initiator_target_map': {'i1': ['t1']},
+                    'target_lun': '1', 'volume_id': 'id'}}
+        mock_discover_hdisk.return_value = (
+            hdisk.LUAStatus.DEVICE_AVAILABLE, 'devname', 'udid')
+        self.adpt.read.return_value = self.vios_feed_resp
+        instance = mock.Mock()
+        instance.system_metadata = {}
+        mapping_acc = mock.Mock()
+        mock_get_vm_id.return_value = '2'
+        mock_vios_feed.return_value = [
+            _mock_vios(self.vios_uuid, [('devname', 'udid', 2)])]
+
+        # The connect queues the mapping instead of sending it.
+        vol_drv = vscsi.VscsiVolumeAdapter()
+        vol_drv.connect_volume(self.adpt, 'host_uuid', 'vm_uuid', instance,
+                               con_info, mapping_acc=mapping_acc)
+        self.assertFalse(mock_add_map.called)
+        mapping_acc.add_mapping.assert_called_once_with(
+            self.vios_uuid, 'vm_uuid', 'devname', post_apply=mock.ANY,
+            post_rollback=mock.ANY)
+        mapping_acc.set_lpar_id.assert_called_once_with('vm_uuid', '2')
+
+        # The UDID is recorded once the mapping is sent.
+        udid_key = vol_drv._build_udid_key(self.vios_uuid, 'id')
+        index = vscsi.UDIDIndex.get(self.adpt, 'host_uuid')
+        self.assertEqual({}, instance.system_metadata)
+        self.assertIsNone(index.volume_udid('id'))
+        mapping_acc.add_mapping.call_args[1]['post_apply']()
+        self.assertEqual('udid', index.volume_udid('id'))
+        self.assertEqual('udid', instance.system_metadata[udid_key])
+        self.assertEqual('udid', con_info['data']['target_UDID'])
+
+        # A rollback forgets it and removes the discovered hdisk again.
+        mapping_acc.add_mapping.call_args[1]['post_rollback']()
+        self.assertEqual({}, instance.system_metadata)
+        self.assertIsNone(index.volume_udid('id'))
+        mock_remove_hdisk.assert_called_once_with(
+            self.adpt, CONF.host, 'devname', self.vios_uuid)
+        mock_remove_hdisk.reset_mock()
+        mapping_acc.add_mapping.call_args[1]['post_apply']()
+
+        # So does the disconnect.  The hdisk goes once the removal is sent.
+        vol_drv.disconnect_volume(self.adpt, 'host_uuid', 'vm_uuid',
+                                  instance, con_info, mapping_acc=mapping_acc)
+        self.assertFalse(mock_remove_pv_mapping.called)
+        self.assertFalse(mock_remove_hdisk.called)
+        mapping_acc.remove_mapping.assert_called_once_with(
+            self.vios_uuid, 'vm_uuid', 'devname', post_apply=mock.ANY)
+
+        post_apply = mapping_acc.remove_mapping.call_args[1]['post_apply']
+        post_apply()
+        mock_remove_hdisk.assert_called_once_with(
+            self.adpt, CONF.host, 'devname', self.vios_uuid)
+        self.assertEqual({}, instance.system_metadata)
+        self.assertIsNone(index.volume_udid('id'))
 
+    @mock.patch('nova_powervm.virt.powervm.vios.get_vios_feed')
+    def test_wwpns(self, mock_vios_feed):
+        def vio(etag, wwpns):
+            vio_w = mock.Mock(etag=etag)
+            vio_w.get_active_pfc_wwpns.return_value = wwpns
+            return vio_w
+        vios1 = vio('1', ['aa'])
+        mock_vios_feed.return_value = [vios1, vio('2', ['bb'])]
+
+        # Read once, then served from memory.
         vol_drv = vscsi.VscsiVolumeAdapter()
-        wwpns = vol_drv.wwpns(mock.ANY, 'host_uuid', mock.ANY)
+        for i in range(2):
+            wwpns = vol_drv.wwpns(self.adpt, 'host_uuid', mock.ANY)
+            self.assertListEqual(['aa', 'bb'], wwpns)
+        mock_vios_feed.assert_called_once_with(
+            self.adpt, 'host_uuid', xag=[pvm_vios.VIOS.xags.STORAGE])
 
+        # Once old, they are checked in the background.  The old WWPNs are
+        # used in the meantime, and only worked out again if a VIOS changed.
+        self.flags(pfc_wwpn_refresh_interval=0)
+        wwpns = vol_drv.wwpns(self.adpt, 'host_uuid', mock.ANY)
         self.assertListEqual(['aa', 'bb'], wwpns)
+        eventlet.sleep(0)
+        self.assertEqual(2, mock_vios_feed.call_count)
+        self.assertEqual(1, vios1.get_active_pfc_wwpns.call_count)
+
+        mock_vios_feed.return_value = [vios1, vio('3', ['cc'])]
+        vol_drv.wwpns(self.adpt, 'host_uuid', mock.ANY)
+        eventlet.sleep(0)
+        self.flags(pfc_wwpn_refresh_interval=300)
+        self.assertListEqual(['aa', 'cc'],
+                             vol_drv.wwpns(self.adpt, 'host_uuid', mock.ANY))
+
+    @mock.patch('nova_powervm.virt.powervm.vios.get_vios_feed')
+    def test_init_host(self, mock_vios_feed):
+        vios1 = mock.Mock(etag='1')
+        vios1.get_active_pfc_wwpns.return_value = ['aa']
+        mock_vios_feed.return_value = [vios1]
+
+        # The WWPNs are read in the background.
+        vol_drv = vscsi.VscsiVolumeAdapter()
+        vol_drv.init_host(self.adpt, 'host_uuid')
+        self.assertFalse(mock_vios_feed.called)
+        eventlet.sleep(0)
+        self.assertEqual(1, mock_vios_feed.call_count)
+
+        self.assertListEqual(['aa'],
+                             vol_drv.wwpns(self.adpt, 'host_uuid', mock.ANY))
+        self.assertEqual(1, mock_vios_feed.call_count)
 
     def test_set_udid(self):
         # Mock Data
@@ -129,23 +551,30 @@ class TestVSCSIAdapter(test.TestCase):
         self.assertEqual(self.udid,
                          instance.system_metadata[volid_meta_key])
 
-    def test_get_udid(self):
+    def test_get_udids(self):
         instance = mock.Mock()
-        volid_meta_key = (vscsi.VscsiVolumeAdapter().
-                          _build_udid_key(self.vios_uuid, self.volume_id))
-        # set the key to retrieve
-        instance.system_metadata = {volid_meta_key: self.udid}
-        retrieved_udid = (vscsi.VscsiVolumeAdapter().
-                          _get_udid(instance, self.vios_uuid, self.volume_id))
-        # Check key found
-        self.assertEqual(self.udid, retrieved_udid)
-
-        # check key not found
-        retrieved_udid = (vscsi.VscsiVolumeAdapter().
-                          _get_udid(instance, self.vios_uuid,
-                                    'non_existent_key'))
-        # Check key not found
-        self.assertIsNone(retrieved_udid)
+        vol_drv = vscsi.VscsiVolumeAdapter()
+        index = vscsi.UDIDIndex(self.adpt, 'host_uuid')
+        con_info = {'data': {'volume_id': self.volume_id}}
+        instance.system_metadata = {}
+        self.assertEqual(set(), vol_drv._get_udids(index, instance, con_info))
+
+        # From the system_metadata of each VIOS
+        instance.system_metadata = {
+            vol_drv._build_udid_key(self.vios_uuid, self.volume_id): 'udid1',
+            vol_drv._build_udid_key('vios2', self.volume_id): 'udid1',
+            vol_drv._build_udid_key(self.vios_uuid, 'other'): 'udid2',
+            self.volume_id: 'udid3'}
+        self.assertEqual({'udid1'},
+                         vol_drv._get_udids(index, instance, con_info))
+
+        # From the connection_info and the index
+        instance.system_metadata = {}
+        con_info['data']['target_UDID'] = 'udid4'
+        index.add('udid5', self.vios_uuid, 'hdisk1', 2,
+                  volume_id=self.volume_id)
+        self.assertEqual({'udid4', 'udid5'},
+                         vol_drv._get_udids(index, instance, con_info))
 
     def test_delete_udid_key(self):
         instance = mock.Mock()
@@ -158,3 +587,337 @@ class TestVSCSIAdapter(test.TestCase):
                                                     self.volume_id)
         # Verify empty list
         self.assertDictEqual({}, instance.system_metadata)
+
+
+class TestUDIDIndex(test.TestCase):
+    """Tests the index of where hdisks are mapped."""
+
+    def setUp(self):
+        super(TestUDIDIndex, self).setUp()
+        self.adpt = self.useFixture(fx.PyPowerVM()).apt
+        vscsi.UDIDIndex._indexes = {}
+
+        patcher = mock.patch('nova_powervm.virt.powervm.vios.get_vios_feed')
+        self.mock_feed = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.mock_feed.return_value = [
+            _mock_vios('vios1', [('hdisk1', 'udid1', 2),
+                                 ('hdisk2', 'udid2', 3)]),
+            _mock_vios('vios2', [('hdisk4', 'udid1', 2)])]
+
+        self.index = vscsi.UDIDIndex.get(self.adpt, 'host_uuid')
+
+    def test_get(self):
+        self.assertIs(self.index,
+                      vscsi.UDIDIndex.get(self.adpt, 'host_uuid'))
+        self.assertIsNot(self.index,
+                         vscsi.UDIDIndex.get(self.adpt, 'host_uuid2'))
+
+    @mock.patch('nova_powervm.virt.powervm.vios.invalidate_vios_feed')
+    def test_lookup(self, mock_invalidate):
+        # The VIOSes are read once for any number of hits.
+        self.assertEqual([('vios1', 'hdisk1'), ('vios2', 'hdisk4')],
+                         self.index.lookup('udid1', '2'))
+        self.assertEqual([('vios1', 'hdisk2')],
+                         self.index.lookup('udid2', 3))
+        self.assertEqual(1, self.mock_feed.call_count)
+        self.mock_feed.assert_called_once_with(
+            self.adpt, 'host_uuid', xag=[pvm_vios.VIOS.xags.STORAGE,
+                                         pvm_vios.VIOS.xags.SCSI_MAPPING])
+        self.assertFalse(mock_invalidate.called)
+
+        # A miss rereads them, fresh from the REST API.
+        self.assertEqual([], self.index.lookup('udid2', 2))
+        self.assertEqual(2, self.mock_feed.call_count)
+        mock_invalidate.assert_called_once_with('host_uuid')
+
+    def test_lookup_reread_unlocked(self):
+        self.index.lookup('udid1', 2)
+
+        # The reread is done without the lock, and changes made while it
+        # runs are kept.
+        feed = self.mock_feed.return_value
+
+        def _try_lock():
+            locked = vscsi.UDIDIndex._lock.acquire(False)
+            if locked:
+                vscsi.UDIDIndex._lock.release()
+            return locked
+
+        def _read(*args, **kwargs):
+            # The lock is reentrant, so try it from another thread.
+            self.assertTrue(eventlet.spawn(_try_lock).wait())
+            self.index.add('udid3', 'vios1', 'hdisk3', 2)
+            self.index.remove('udid1', 'vios2', 2)
+            return feed
+        self.mock_feed.side_effect = _read
+        self.assertEqual([], self.index.lookup('udid9', 2))
+        self.mock_feed.side_effect = None
+        self.assertEqual([('vios1', 'hdisk3')],
+                         self.index.lookup('udid3', 2))
+        self.assertEqual([('vios1', 'hdisk1')],
+                         self.index.lookup('udid1', 2))
+        self.assertEqual(2, self.mock_feed.call_count)
+
+    def test_add_remove(self):
+        # Adds before the index is loaded just record the volume.
+        self.index.add('udid3', 'vios2', 'hdisk3', 2, volume_id='vol3')
+        self.assertEqual('udid3', self.index.volume_udid('vol3'))
+        self.index.lookup('udid1', 2)
+
+        self.index.add('udid3', 'vios1', 'hdisk3', '2', volume_id='vol3')
+        self.assertEqual([('vios1', 'hdisk3')],
+                         self.index.lookup('udid3', 2))
+        self.assertEqual(1, self.mock_feed.call_count)
+
+        self.index.remove('udid1', 'vios1', 2)
+        self.assertEqual([('vios2', 'hdisk4')],
+                         self.index.lookup('udid1', 2))
+
+        # The volume is forgotten once its last mapping is removed.
+        self.index.remove('udid3', 'vios1', '2')
+        self.assertIsNone(self.index.volume_udid('vol3'))
+        self.index.remove('udid9', 'vios1', 2)
+        self.assertEqual(1, self.mock_feed.call_count)
+
+
+class TestVscsiMappingAccumulator(test.TestCase):
+    """Tests the batching of vSCSI mapping changes."""
+
+    def setUp(self):
+        super(TestVscsiMappingAccumulator, self).setUp()
+        self.adpt = self.useFixture(fx.PyPowerVM()).apt
+        self.adpt.read.side_effect = lambda *a, **k: k['root_id']
+
+        # Each VIOS starts with one existing mapping of hdisk0.  Later reads
+        # see the updated mappings.
+        self.vioses = {}
+        self.failing = set()
+
+        def wrap(resp):
+            vios_w = self.vioses.get(resp)
+            if vios_w is None:
+                vios_w = mock.Mock()
+                vios_w.scsi_mappings = [self._smap('hdisk0')]
+            if resp in self.failing:
+                vios_w.update.side_effect = pexc.Error('vios down')
+            self.vioses[resp] = vios_w
+            return vios_w
+        self._patch('pypowervm.wrappers.virtual_io_server.VIOS.wrap',
+                    side_effect=wrap)
+        self._patch('pypowervm.wrappers.virtual_io_server.VSCSIMapping.bld',
+                    side_effect=lambda adpt, host, vm, pv: self._smap(pv.name))
+        self._patch('pypowervm.wrappers.storage.PV.bld',
+                    side_effect=lambda adpt, name: self._pv(name))
+        self._patch('nova_powervm.virt.powervm.vm.get_vm_id',
+                    return_value='2')
+
+        self.acc = vscsi.VscsiMappingAccumulator(self.adpt, 'host_uuid')
+
+    def _patch(self, target, **kwargs):
+        patcher = mock.patch(target, **kwargs)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def _pv(device_name):
+        pv = mock.Mock(spec=pvm_stor.PV)
+        pv.name = device_name
+        return pv
+
+    def _smap(self, device_name):
+        smap = mock.Mock()
+        smap.server_adapter.lpar_id = 2
+        smap.backing_storage = self._pv(device_name)
+        return smap
+
+    def _names(self, vios_uuid):
+        return sorted(smap.backing_storage.name
+                      for smap in self.vioses[vios_uuid].scsi_mappings)
+
+    def test_apply(self):
+        post_apply = mock.Mock()
+        self.acc.add_mapping('vios1', 'vm_uuid', 'hdisk1')
+        self.acc.add_mapping('vios1', 'vm_uuid', 'hdisk2')
+        self.acc.add_mapping('vios2', 'vm_uuid', 'hdisk1')
+        # Already mapped.
+        self.acc.add_mapping('vios2', 'vm_uuid', 'hdisk0')
+        self.acc.remove_mapping('vios1', 'vm_uuid', 'hdisk0',
+                                post_apply=post_apply)
+
+        self.acc.apply()
+
+        # One read and one update per VIOS.
+        self.assertEqual(2, self.adpt.read.call_count)
+        self.assertEqual(['hdisk1', 'hdisk2'], self._names('vios1'))
+        self.assertEqual(['hdisk0', 'hdisk1'], self._names('vios2'))
+        self.assertEqual(1, self.vioses['vios1'].update.call_count)
+        self.assertEqual(1, self.vioses['vios2'].update.call_count)
+        post_apply.assert_called_once_with()
+
+    def test_add_storage_mapping(self):
+        vopt = mock.Mock(spec=pvm_stor.VOptMedia)
+        vopt.name = 'cfg.iso'
+        self.acc.add_mapping('vios1', 'vm_uuid', 'hdisk1')
+        self.acc.add_storage_mapping('vios1', 'vm_uuid', vopt)
+
+        # Other storage goes in the same update as the hdisks.
+        self.acc.apply()
+        self.assertEqual(['cfg.iso', 'hdisk0', 'hdisk1'],
+                         self._names('vios1'))
+        self.assertEqual(1, self.vioses['vios1'].update.call_count)
+
+        self.acc.rollback()
+        self.assertEqual(['hdisk0'], self._names('vios1'))
+
+    def test_set_lpar_id(self):
+        vm_get_id = vscsi.vm.get_vm_id
+        self.acc.set_lpar_id('vm_uuid', '2')
+        self.acc.remove_mapping('vios1', 'vm_uuid', 'hdisk0')
+        self.acc.apply()
+        self.assertEqual([], self._names('vios1'))
+        self.assertFalse(vm_get_id.called)
+
+    def test_apply_no_change(self):
+        self.acc.add_mapping('vios1', 'vm_uuid', 'hdisk0')
+        self.acc.apply()
+        self.assertFalse(self.vioses['vios1'].update.called)
+
+        # Nothing queued means no REST calls at all.
+        self.adpt.reset_mock()
+        vscsi.VscsiMappingAccumulator(self.adpt, 'host_uuid').apply()
+        self.assertFalse(self.adpt.read.called)
+
+    def test_rollback(self):
+        post_apply = mock.Mock()
+        self.acc.add_mapping('vios1', 'vm_uuid', 'hdisk1')
+        self.acc.remove_mapping('vios1', 'vm_uuid', 'hdisk0',
+                                post_apply=post_apply)
+        self.acc.add_mapping('vios2', 'vm_uuid', 'hdisk1')
+
+        # vios1 is updated, vios2 fails.
+        self.failing.add('vios2')
+        self.assertRaises(pexc.Error, self.acc.apply)
+        self.assertFalse(post_apply.called)
+
+        # Only the updated VIOS is rolled back.  The hdisk is still there, so
+        # its mapping is put back.
+        self.assertEqual(['hdisk1'], self._names('vios1'))
+        self.adpt.read.reset_mock()
+        self.acc.rollback()
+        self.adpt.read.assert_called_once_with(
+            mock.ANY, root_id='vios1', xag=mock.ANY)
+        self.assertEqual(['hdisk0'], self._names('vios1'))
+
+    def test_rollback_post_apply(self):
+        post_rollback1, post_rollback2 = mock.Mock(), mock.Mock()
+        self.acc.add_mapping('vios1', 'vm_uuid', 'hdisk1',
+                             post_rollback=post_rollback1)
+        self.acc.add_mapping('vios2', 'vm_uuid', 'hdisk1',
+                             post_rollback=post_rollback2)
+        self.acc.apply()
+
+        # The work done for the mappings is undone for each VIOS whose
+        # mappings were removed again.
+        self.failing.add('vios2')
+        self.acc.rollback()
+        self.assertEqual(['hdisk0'], self._names('vios1'))
+        post_rollback1.assert_called_once_with()
+        self.assertFalse(post_rollback2.called)
+
+        # Mappings that were never sent are cleaned up too.
+        acc = vscsi.VscsiMappingAccumulator(self.adpt, 'host_uuid')
+        post_rollback3 = mock.Mock()
+        acc.add_mapping('vios2', 'vm_uuid', 'hdisk3',
+                        post_rollback=post_rollback3)
+        self.assertRaises(pexc.Error, acc.apply)
+        acc.rollback()
+        post_rollback3.assert_called_once_with()
+
+    def test_apply_batched(self):
+        self.flags(spawn_batch_window=10)
+        post_apply = mock.Mock()
+        acc2 = vscsi.VscsiMappingAccumulator(self.adpt, 'host_uuid')
+        self.acc.add_mapping('vios1', 'vm_uuid', 'hdisk1',
+                             post_apply=post_apply)
+        acc2.add_mapping('vios1', 'vm_uuid', 'hdisk2')
+        acc2.add_mapping('vios2', 'vm_uuid', 'hdisk2')
+
+        # Both spawns arrive within the window, so each VIOS is updated once
+        # for the two of them.  The first sends them as soon as the second
+        # has joined, rather than waiting out the window.
+        with self.acc.spawning(), acc2.spawning():
+            thread1 = eventlet.spawn(self.acc.apply_batched)
+            thread2 = eventlet.spawn(acc2.apply_batched)
+            with eventlet.Timeout(5):
+                thread1.wait()
+                thread2.wait()
+        self.assertEqual(2, self.adpt.read.call_count)
+        self.assertEqual(['hdisk0', 'hdisk1', 'hdisk2'], self._names('vios1'))
+        self.assertEqual(['hdisk0', 'hdisk2'], self._names('vios2'))
+        self.assertEqual(1, self.vioses['vios1'].update.call_count)
+        post_apply.assert_called_once_with()
+        self.assertEqual({}, vscsi.VscsiMappingAccumulator._batches)
+
+        # Each is still rolled back on its own.
+        acc2.rollback()
+        self.assertEqual(['hdisk0', 'hdisk1'], self._names('vios1'))
+        self.assertEqual(['hdisk0'], self._names('vios2'))
+
+    def test_apply_batched_alone(self):
+        self.flags(spawn_batch_window=10)
+        self.acc.add_mapping('vios1', 'vm_uuid', 'hdisk1')
+
+        # With no other spawn in flight, there is nothing to wait for.
+        with self.acc.spawning():
+            with eventlet.Timeout(5):
+                self.acc.apply_batched()
+        self.assertEqual(['hdisk0', 'hdisk1'], self._names('vios1'))
+
+        # A spawn that ends without sending mappings stops the wait too.
+        acc2 = vscsi.VscsiMappingAccumulator(self.adpt, 'host_uuid')
+        acc2.add_mapping('vios1', 'vm_uuid', 'hdisk2')
+        acc3 = vscsi.VscsiMappingAccumulator(self.adpt, 'host_uuid')
+        spawn3 = acc3.spawning()
+        spawn3.__enter__()
+        with acc2.spawning():
+            thread = eventlet.spawn(acc2.apply_batched)
+            eventlet.sleep(0)
+            self.assertFalse(thread.dead)
+            spawn3.__exit__(None, None, None)
+            with eventlet.Timeout(5):
+                thread.wait()
+        self.assertEqual(['hdisk0', 'hdisk1', 'hdisk2'], self._names('vios1'))
+        self.assertEqual({}, vscsi.VscsiMappingAccumulator._spawns)
+
+    def test_apply_batched_no_window(self):
+        self.flags(spawn_batch_window=0)
+        self.acc.add_mapping('vios1', 'vm_uuid', 'hdisk1')
+        self.acc.apply_batched()
+        self.assertEqual(['hdisk0', 'hdisk1'], self._names('vios1'))
+
+    def test_apply_together_fail(self):
+        acc2 = vscsi.VscsiMappingAccumulator(self.adpt, 'host_uuid')
+        post_apply = mock.Mock()
+        self.acc.add_mapping('vios1', 'vm_uuid', 'hdisk1',
+                             post_apply=post_apply)
+        self.acc.add_mapping('vios2', 'vm_uuid', 'hdisk1')
+        post_apply2 = mock.Mock()
+        acc2.add_mapping('vios1', 'vm_uuid', 'bad_hdisk',
+                         post_apply=post_apply2)
+
+        def update(acc, vios_uuid, adds, removes):
+            if 'bad_hdisk' in [stg_elem.name for vm_uuid, stg_elem in adds]:
+                raise pexc.Error('bad hdisk')
+        with mock.patch.object(vscsi.VscsiMappingAccumulator, '_update',
+                               autospec=True, side_effect=update) as mock_upd:
+            errors = vscsi._apply_together([self.acc, acc2])
+
+        # The combined update failed, so each was tried on its own.  Only
+        # the VM with the bad mapping fails.
+        self.assertEqual([acc2], list(errors))
+        self.assertEqual(4, mock_upd.call_count)
+        self.assertEqual(['vios1', 'vios2'], sorted(self.acc._applied))
+        self.assertEqual([], acc2._applied)
+        post_apply.assert_called_once_with()
+        self.assertFalse(post_apply2.called)
@@ -36,19 +36,99 @@ pvm_opts = [
                default=1,
                help='The size of the media repository in GB for the metadata '
                     'for config drive.'),
+    cfg.IntOpt('vopt_media_rep_cache_time',
+               default=600,
+               help='The number of seconds the location of the virtual '
+                    'optical media repository is trusted without being '
+                    'revalidated against the Virtual I/O Server.  A failed '
+                    'upload or delete of the media always forces a '
+                    'revalidation.'),
+    cfg.FloatOpt('vopt_media_delete_window',
+                 default=2.0,
+                 help='The most seconds to wait for the other deletes of '
+                      'virtual optical media in progress, so that they can '
+                      'be removed from the media repository in a single '
+                      'update.  A delete with no others in progress does not '
+                      'wait.  The SCSI mappings are always removed '
+                      'immediately.  Set to 0 to remove the media without '
+                      'waiting.'),
     cfg.StrOpt('image_meta_local_path',
                default='/tmp/cfgdrv/',
                help='The location where the config drive ISO files should be '
                     'built.'),
+    cfg.BoolOpt('image_meta_in_memory',
+                default=False,
+                help='If set to True, the config drive ISO is built into an '
+                     'anonymous file on a memory backed file system (see '
+                     'image_meta_memory_path) and streamed directly to the '
+                     'Virtual I/O Server.  No named file is written to '
+                     'image_meta_local_path.'),
+    cfg.StrOpt('image_meta_memory_path',
+               default='/dev/shm',
+               help='A memory backed (tmpfs) directory used to hold the '
+                    'config drive ISO when image_meta_in_memory is set.  The '
+                    'file is unlinked on creation, so nothing is left behind '
+                    'in the directory.'),
     cfg.StrOpt('fc_attach_strategy',
                default='vscsi',
                help='The Fibre Channel Volume Strategy defines how FC Cinder '
                     'volumes should be attached to the Virtual Machine.  The '
                     'options are: npiv or vscsi.'),
+    cfg.IntOpt('vscsi_discovery_cache_size',
+               default=256,
+               help='The number of vSCSI hdisk discovery results to keep, '
+                    'per Virtual I/O Server and initiator/target/LUN set.  '
+                    'A cached hdisk that is still on the Virtual I/O Server '
+                    'is attached again without rerunning discovery.  Set '
+                    'to 0 to always run discovery.'),
+    cfg.IntOpt('pfc_wwpn_refresh_interval',
+               default=300,
+               help='The number of seconds the physical Fibre Channel port '
+                    'WWPNs given to vSCSI volume connectors are used before '
+                    'they are checked against the Virtual I/O Servers in the '
+                    'background.'),
+    cfg.IntOpt('power_op_concurrency',
+               default=10,
+               help='The number of power on or power off jobs that are run '
+                    'at the same time when many instances are powered on or '
+                    'off at once, for example for host maintenance.  Power '
+                    'ons and immediate power offs are waited on with one '
+                    'shared read of the job feed per check.  Normal power '
+                    'offs poll their own jobs.'),
+    cfg.ListOpt('warm_pool_flavors',
+                default=[],
+                help='The IDs of the flavors to keep powered off LPARs ready '
+                     'for.  A spawn of one of these flavors renames one of '
+                     'the ready LPARs instead of creating a new one.  The '
+                     'LPARs are replaced in the background.'),
+    cfg.IntOpt('warm_pool_size',
+               default=0,
+               help='The number of ready LPARs to keep for each of the '
+                    'warm_pool_flavors.  Set to 0 to disable the pool.'),
+    cfg.FloatOpt('spawn_batch_window',
+                 default=0.5,
+                 help='The most seconds a spawn waits for the other spawns '
+                      'in flight on the host so that the disk, volume and '
+                      'config drive mappings of all of them are sent to '
+                      'each Virtual I/O Server in a single update.  Set to 0 '
+                      'to send the mappings of each spawn on their own.'),
+    cfg.IntOpt('volume_op_concurrency',
+               default=8,
+               help='The number of volumes of an attach or detach of many '
+                    'volumes that are worked on at the same time.  Only '
+                    'applies to volumes whose mappings are sent together, '
+                    'such as vSCSI.  Others are handled one at a time.'),
     cfg.StrOpt('disk_driver',
                default='localdisk',
                help='The disk driver to use for PowerVM disks. '
-               'Valid options are: localdisk, ssp')
+               'Valid options are: localdisk, ssp'),
+    cfg.IntOpt('vios_feed_cache_time',
+               default=15,
+               help='The number of seconds a Virtual I/O Server feed read '
+                    'by the driver may be reused before it is checked '
+                    'against the REST API again.  Feeds are also refreshed '
+                    'after the driver changes the mappings on a Virtual I/O '
+                    'Server.  Set to 0 to disable the cache.')
 ]
 
 
@@ -79,7 +159,18 @@ npiv_opts = [
                     'are two fabrics for multi-pathing, then this could be '
                     'set to A,B.'
                     'The fabric identifiers are used for the '
-                    '\'fabric_<identifier>_port_wwpns\' key.')
+                    '\'fabric_<identifier>_port_wwpns\' key.'),
+    cfg.IntOpt('wwpn_pool_size', default=8,
+               help='The number of virtual WWPN pairs to generate ahead of '
+                    'time, so that building the volume connector of a new '
+                    'instance does not have to wait for them.  The pool is '
+                    'refilled in the background.  Set to 0 to generate the '
+                    'WWPNs only when needed.'),
+    cfg.IntOpt('topology_refresh_interval', default=300,
+               help='The number of seconds the physical Fibre Channel port '
+                    'topology of the Virtual I/O Servers is used before it '
+                    'is refreshed in the background.  It is also refreshed '
+                    'after the NPIV mappings are changed.')
 ]
 CONF.register_opts(npiv_opts, group='npiv')
 
@@ -125,7 +125,7 @@ class DiskAdapter(object):
         return disk_bytes
 
     def disconnect_image_disk(self, context, instance, lpar_uuid,
-                              disk_type=None):
+                              disk_type=None, lpar_id=None):
         """Disconnects the storage adapters from the image disk.
 
         :param context: nova context for operation
@@ -133,6 +133,8 @@ class DiskAdapter(object):
         :param lpar_uuid: The UUID for the pypowervm LPAR element.
         :param disk_type: The list of disk types to remove or None which means
             to remove all disks from the VM.
+        :param lpar_id: (Optional) The partition ID of the VM.  If not set,
+                        it is looked up from the lpar_uuid.
         :return: A list of all the backing storage elements that were
                  disconnected from the I/O Server and VM.
         """
@@ -165,7 +167,21 @@ class DiskAdapter(object):
         """
         pass
 
-    def connect_disk(self, context, instance, disk_info, lpar_uuid):
+    def get_disk(self, context, instance, disk_type=DiskType.BOOT):
+        """Returns an existing disk of the instance.
+
+        Used to map a disk that is already in the storage to a new LPAR, for
+        example on the destination host of a migration.
+
+        :param context: nova context for operation.
+        :param instance: instance to find the disk of.
+        :param disk_type: the disk type. See disk constants above.
+        :returns: The backing pypowervm storage object of the disk.
+        """
+        raise NotImplementedError()
+
+    def connect_disk(self, context, instance, disk_info, lpar_uuid,
+                     mapping_acc=None):
         """Connects the disk image to the Virtual Machine.
 
         :param context: nova context for the transaction.
@@ -174,6 +190,8 @@ class DiskAdapter(object):
                           create_disk_from_image.  Ex. VOptMedia, VDisk, LU,
                           or PV.
         :param: lpar_uuid: The pypowervm UUID that corresponds to the VM.
+        :param mapping_acc: Optional VscsiMappingAccumulator to queue the
+                            mappings on, rather than adding them right away.
         """
         pass
 
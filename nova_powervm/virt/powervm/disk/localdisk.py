@@ -24,12 +24,12 @@ from nova.i18n import _LI, _LE
 from pypowervm import exceptions as pvm_exc
 from pypowervm.tasks import scsi_mapper as tsk_map
 from pypowervm.tasks import storage as tsk_stg
-from pypowervm.wrappers import managed_system as pvm_ms
 from pypowervm.wrappers import storage as pvm_stg
 from pypowervm.wrappers import virtual_io_server as pvm_vios
 
 import nova_powervm.virt.powervm.disk as disk
 from nova_powervm.virt.powervm.disk import driver as disk_dvr
+from nova_powervm.virt.powervm import vios
 from nova_powervm.virt.powervm import vm
 
 localdisk_opts = [
@@ -120,7 +120,7 @@ class LocalStorage(disk_dvr.DiskAdapter):
         vg_wrap.update()
 
     def disconnect_image_disk(self, context, instance, lpar_uuid,
-                              disk_type=None):
+                              disk_type=None, lpar_id=None):
         """Disconnects the storage adapters from the image disk.
 
         :param context: nova context for operation
@@ -128,13 +128,19 @@ class LocalStorage(disk_dvr.DiskAdapter):
         :param lpar_uuid: The UUID for the pypowervm LPAR element.
         :param disk_type: The list of disk types to remove or None which means
             to remove all disks from the VM.
+        :param lpar_id: (Optional) The partition ID of the VM.  If not set,
+                        it is looked up from the lpar_uuid.
         :return: A list of all the backing storage elements that were
                  disconnected from the I/O Server and VM.
         """
-        partition_id = vm.get_vm_id(self.adapter, lpar_uuid)
-        return tsk_map.remove_vdisk_mapping(self.adapter, self.vios_uuid,
-                                            partition_id,
-                                            disk_prefixes=disk_type)
+        partition_id = lpar_id
+        if partition_id is None:
+            partition_id = vm.get_vm_id(self.adapter, lpar_uuid)
+        removed = tsk_map.remove_vdisk_mapping(self.adapter, self.vios_uuid,
+                                               partition_id,
+                                               disk_prefixes=disk_type)
+        vios.invalidate_vios_feed(self.host_uuid, self.vios_uuid)
+        return removed
 
     def create_disk_from_image(self, context, instance, image, disk_size,
                                image_type=disk_dvr.DiskType.BOOT):
@@ -170,7 +176,8 @@ class LocalStorage(disk_dvr.DiskAdapter):
 
         return vdisk
 
-    def connect_disk(self, context, instance, disk_info, lpar_uuid):
+    def connect_disk(self, context, instance, disk_info, lpar_uuid,
+                     mapping_acc=None):
         """Connects the disk image to the Virtual Machine.
 
         :param context: nova context for the transaction.
@@ -179,10 +186,17 @@ class LocalStorage(disk_dvr.DiskAdapter):
                           create_disk_from_image.  Ex. VOptMedia, VDisk, LU,
                           or PV.
         :param: lpar_uuid: The pypowervm UUID that corresponds to the VM.
+        :param mapping_acc: Optional VscsiMappingAccumulator to queue the
+                            mappings on, rather than adding them right away.
         """
         # Add the mapping to the VIOS
+        if mapping_acc is not None:
+            mapping_acc.add_storage_mapping(self.vios_uuid, lpar_uuid,
+                                            disk_info)
+            return
         tsk_map.add_vscsi_mapping(self.host_uuid, self.vios_uuid, lpar_uuid,
                                   disk_info)
+        vios.invalidate_vios_feed(self.host_uuid, self.vios_uuid)
 
     def extend_disk(self, context, instance, disk_info, size):
         """Extends the disk.
@@ -239,10 +253,7 @@ class LocalStorage(disk_dvr.DiskAdapter):
             vios_wraps = pvm_vios.VIOS.search(self.adapter,
                                               name=CONF.volume_group_vios_name)
         else:
-            vios_resp = self.adapter.read(pvm_ms.System.schema_type,
-                                          root_id=self.host_uuid,
-                                          child_type=pvm_vios.VIOS.schema_type)
-            vios_wraps = pvm_vios.VIOS.wrap(vios_resp)
+            vios_wraps = vios.get_vios_feed(self.adapter, self.host_uuid)
 
         # Loop through each vios to find the one with the appropriate name.
         for vios_wrap in vios_wraps:
@@ -19,15 +19,18 @@ import random
 from oslo_config import cfg
 import oslo_log.log as logging
 
+from nova import exception as nova_exc
 from nova import image
 from nova.i18n import _LI, _LE
 import nova_powervm.virt.powervm.disk as disk
 from nova_powervm.virt.powervm.disk import driver as disk_drv
+from nova_powervm.virt.powervm import vios
 from nova_powervm.virt.powervm import vm
 
 from pypowervm.tasks import scsi_mapper as tsk_map
 from pypowervm.tasks import storage as tsk_stg
 import pypowervm.util as pvm_u
+from pypowervm.utils import retry as pvm_retry
 import pypowervm.wrappers.cluster as pvm_clust
 import pypowervm.wrappers.storage as pvm_stg
 
@@ -107,7 +110,7 @@ class SSPDiskAdapter(disk_drv.DiskAdapter):
         return float(ssp.capacity) - float(ssp.free_space)
 
     def disconnect_image_disk(self, context, instance, lpar_uuid,
-                              disk_type=None):
+                              disk_type=None, lpar_id=None):
         """Disconnects the storage adapters from the image disk.
 
         :param context: nova context for operation
@@ -115,13 +118,19 @@ class SSPDiskAdapter(disk_drv.DiskAdapter):
         :param lpar_uuid: The UUID for the pypowervm LPAR element.
         :param disk_type: The list of disk types to remove or None which means
             to remove all disks from the VM.
+        :param lpar_id: (Optional) The partition ID of the VM.  If not set,
+                        it is looked up from the lpar_uuid.
         :return: A list of all the backing storage elements that were
                  disconnected from the I/O Server and VM.
         """
-        lpar_qps = vm.get_vm_qp(self.adapter, lpar_uuid)
-        lpar_id = lpar_qps['PartitionID']
-        host_uuid = pvm_u.get_req_path_uuid(
-            lpar_qps['AssociatedManagedSystem'], preserve_case=True)
+        if lpar_id is None:
+            lpar_qps = vm.get_vm_qp(self.adapter, lpar_uuid)
+            lpar_id = lpar_qps['PartitionID']
+            host_uuid = pvm_u.get_req_path_uuid(
+                lpar_qps['AssociatedManagedSystem'], preserve_case=True)
+        else:
+            # The caller found the partition ID on the host of this driver.
+            host_uuid = self.host_uuid
         lu_set = set()
         # The mappings will normally be the same on all VIOSes, unless a VIOS
         # was down when a disk was added.  So for the return value, we need to
@@ -130,6 +139,7 @@ class SSPDiskAdapter(disk_drv.DiskAdapter):
             for lu in tsk_map.remove_lu_mapping(
                     self.adapter, vios_uuid, lpar_id, disk_prefixes=disk_type):
                 lu_set.add(lu)
+            vios.invalidate_vios_feed(host_uuid, vios_uuid)
         return list(lu_set)
 
     def delete_disks(self, context, instance, storage_elems):
@@ -216,7 +226,8 @@ class SSPDiskAdapter(disk_drv.DiskAdapter):
                                            luname, img_meta['size'])
         return lu
 
-    def connect_disk(self, context, instance, disk_info, lpar_uuid):
+    def connect_disk(self, context, instance, disk_info, lpar_uuid,
+                     mapping_acc=None):
         """Connects the disk image to the Virtual Machine.
 
         :param context: nova context for the transaction.
@@ -225,6 +236,8 @@ class SSPDiskAdapter(disk_drv.DiskAdapter):
                           create_disk_from_image.  Ex. VOptMedia, VDisk, LU,
                           or PV.
         :param: lpar_uuid: The pypowervm UUID that corresponds to the VM.
+        :param mapping_acc: Optional VscsiMappingAccumulator to queue the
+                            mappings on, rather than adding them right away.
         """
         # Create the LU structure
         lu = pvm_stg.LU.bld_ref(self.adapter, disk_info.name, disk_info.udid)
@@ -236,17 +249,81 @@ class SSPDiskAdapter(disk_drv.DiskAdapter):
                                  'AssociatedManagedSystem')
         host_uuid = pvm_u.get_req_path_uuid(host_href, preserve_case=True)
         for vios_uuid in self._vios_uuids(host_uuid=host_uuid):
+            if mapping_acc is not None:
+                mapping_acc.add_storage_mapping(vios_uuid, lpar_uuid, lu)
+                continue
             tsk_map.add_vscsi_mapping(host_uuid, vios_uuid, lpar_uuid, lu)
+            vios.invalidate_vios_feed(host_uuid, vios_uuid)
+
+    def get_disk(self, context, instance,
+                 disk_type=disk_drv.DiskType.BOOT):
+        """Returns an existing disk of the instance.
+
+        The LU is in the SSP, so any host of the cluster can map it.
+
+        :param context: nova context for operation.
+        :param instance: instance to find the disk of.
+        :param disk_type: the disk type. See disk_drv.DiskType.
+        :returns: The pypowervm LU ElementWrapper of the disk.
+        """
+        lu_name = self._get_disk_name(disk_type, instance)
+        lu = self._find_disk_lu(self._ssp, lu_name)
+        if lu is None:
+            raise nova_exc.DiskNotFound(
+                location=self.ssp_name + '/' + lu_name)
+        return lu
 
     def extend_disk(self, context, instance, disk_info, size):
         """Extends the disk.
 
+        The LU is grown in place by raising its capacity in the SSP.  No data
+        is copied; the clone link to the image LU is preserved.
+
         :param context: nova context for operation.
         :param instance: instance to extend the disk for.
         :param disk_info: dictionary with disk info.
         :param size: the new size in gb.
         """
-        raise NotImplementedError()
+        @pvm_retry.retry()
+        def _extend():
+            # Refetch the SSP on every attempt so that a retry after an etag
+            # mismatch works against the current LU list.
+            ssp = self._ssp
+            lu = self._find_disk_lu(ssp, lu_name)
+            if lu is None:
+                LOG.error(_LE('Disk %s not found during resize.') % lu_name,
+                          instance=instance)
+                raise nova_exc.DiskNotFound(
+                    location=self.ssp_name + '/' + lu_name)
+
+            if float(lu.capacity) >= size:
+                LOG.info(_LI('SSP: Disk %(lu)s is already %(cap)s GB.  No '
+                             'extend needed.') %
+                         {'lu': lu_name, 'cap': lu.capacity},
+                         instance=instance)
+                return
+
+            # Set the new size and post it to the SSP
+            lu.capacity = size
+            ssp.update()
+
+        lu_name = self._get_disk_name(disk_info['type'], instance)
+        LOG.info(_LI('SSP: Extending disk %(lu)s to %(size)d GB.') %
+                 {'lu': lu_name, 'size': size}, instance=instance)
+        _extend()
+
+    @staticmethod
+    def _find_disk_lu(ssp, lu_name):
+        """Finds a DISK type LU by name within the SSP.
+
+        :param ssp: The SSP EntryWrapper to search.
+        :param lu_name: The name of the LU.
+        :return: The LU ElementWrapper, or None if it was not found.
+        """
+        for lu in ssp.logical_units:
+            if lu.lu_type == pvm_stg.LUType.DISK and lu.name == lu_name:
+                return lu
+        return None
 
     def check_instance_shared_storage_local(self, context, instance):
         """Check if instance files located on shared storage.
@@ -14,13 +14,15 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+from eventlet import greenpool
+import functools
 from nova.compute import task_states
 from nova.compute import utils as compute_utils
 from nova.console import type as console_type
 from nova import context as ctx
 from nova import exception
 from nova import image
-from nova.i18n import _LI, _LW, _
+from nova.i18n import _LE, _LI, _LW, _
 from nova.objects import flavor as flavor_obj
 from nova import utils as n_utils
 from nova.virt import configdrive
@@ -30,6 +32,7 @@ import time
 
 from oslo_config import cfg
 from oslo_log import log as logging
+from oslo_utils import excutils
 from oslo_utils import importutils
 import taskflow.engines
 from taskflow.patterns import linear_flow as lf
@@ -38,18 +41,19 @@ import taskflow.task
 from pypowervm import adapter as pvm_apt
 from pypowervm import exceptions as pvm_exc
 from pypowervm.helpers import log_helper as log_hlp
-from pypowervm.tasks import power as pvm_pwr
-from pypowervm.tasks import vterm as pvm_vterm
 from pypowervm import util as pvm_util
 from pypowervm.utils import retry as pvm_retry
 from pypowervm.wrappers import managed_system as pvm_ms
 
 from nova_powervm.virt.powervm.disk import driver as disk_dvr
 from nova_powervm.virt.powervm import host as pvm_host
+from nova_powervm.virt.powervm import live_migration as lpm
 from nova_powervm.virt.powervm.tasks import storage as tf_stg
 from nova_powervm.virt.powervm.tasks import vm as tf_vm
 from nova_powervm.virt.powervm import vm
+from nova_powervm.virt.powervm import warm_pool
 from nova_powervm.virt.powervm import volume as vol_attach
+from nova_powervm.virt.powervm.volume import vscsi
 
 LOG = logging.getLogger(__name__)
 CONF = cfg.CONF
@@ -61,6 +65,11 @@ VOLUME_DRIVER_MAPPINGS = {
     'fibre_channel': vol_attach.FC_STRATEGY_MAPPING[CONF.fc_attach_strategy]
 }
 
+# Set in the system metadata of an instance that is cold migrating to another
+# host on the same shared storage.  The value is the UUID of the source host,
+# which keeps the instance's LPAR, without its disks, for a revert.
+SHARED_STG_MIGRATION_KEY = 'powervm_shared_stg_migration_src'
+
 DISK_ADPT_NS = 'nova_powervm.virt.powervm.disk'
 DISK_ADPT_MAPPINGS = {
     'localdisk': 'localdisk.LocalStorage',
@@ -75,6 +84,9 @@ class PowerVMDriver(driver.ComputeDriver):
     def __init__(self, virtapi):
         super(PowerVMDriver, self).__init__(virtapi)
 
+        # The live migrations running from this host, by instance UUID.
+        self.live_migrations = {}
+
     def init_host(self, host):
         """Initialize anything that is necessary for the driver to function,
         including catching up with currently running VM's on the given host.
@@ -93,6 +105,12 @@ class PowerVMDriver(driver.ComputeDriver):
 
         # Initialize the volume drivers
         self.vol_drvs = _inst_dict(VOLUME_DRIVER_MAPPINGS)
+        for vol_drv in self.vol_drvs.values():
+            vol_drv.init_host(self.adapter, self.host_uuid)
+
+        # Create the LPARs of the warm pool in the background
+        self.warm_pool = warm_pool.WarmPool(self.adapter, self.host_wrapper)
+        self.warm_pool.fill()
 
         LOG.info(_LI("The compute driver has been initialized."))
 
@@ -147,7 +165,8 @@ class PowerVMDriver(driver.ComputeDriver):
         layer, as a list.
         """
         lpar_list = vm.get_lpar_list(self.adapter, self.host_uuid)
-        return lpar_list
+        # The LPARs of the warm pool are not instances (yet).
+        return [name for name in lpar_list if not warm_pool.is_shell(name)]
 
     def spawn(self, context, instance, image_meta, injected_files,
               admin_password, network_info=None, block_device_info=None,
@@ -189,13 +208,19 @@ class PowerVMDriver(driver.ComputeDriver):
 
         # Create the LPAR
         flow.add(tf_vm.Create(self.adapter, self.host_wrapper, instance,
-                              flavor))
+                              flavor, warm_pool=self.warm_pool))
 
         # Plug the VIFs
         vif_plug_info = {'instance': instance, 'network_info': network_info}
         flow.add(taskflow.task.FunctorTask(self._plug_vifs, name='plug_vifs',
                                            inject=vif_plug_info))
 
+        # The vSCSI mappings of the boot disk, the volumes and the config
+        # drive are sent together, with one update per VIOS, along with those
+        # of other spawns on the host.
+        mapping_acc = vscsi.VscsiMappingAccumulator(self.adapter,
+                                                    self.host_uuid)
+
         # Only add the image disk if this is from Glance.
         if not is_boot_from_volume:
             # Creates the boot image.
@@ -204,18 +229,13 @@ class PowerVMDriver(driver.ComputeDriver):
                 disk_size=flavor.root_gb))
 
             # Connects up the disk to the LPAR
-            flow.add(tf_stg.ConnectDisk(self.disk_dvr, context, instance))
+            flow.add(tf_stg.ConnectDisk(self.disk_dvr, context, instance,
+                                        mapping_acc=mapping_acc))
 
         # Determine if there are volumes to connect.  If so, add a connection
         # for each type.
-        bdms = self._extract_bdm(block_device_info)
-        if bdms is not None:
-            for bdm in bdms:
-                conn_info = bdm.get('connection_info')
-                drv_type = conn_info.get('driver_volume_type')
-                vol_drv = self.vol_drvs.get(drv_type)
-                flow.add(tf_stg.ConnectVolume(self.adapter, vol_drv, instance,
-                                              conn_info, self.host_uuid))
+        self._add_connect_volumes(flow, instance, block_device_info,
+                                  mapping_acc)
 
         # If the config drive is needed, add those steps.
         if configdrive.required_by(instance):
@@ -223,7 +243,11 @@ class PowerVMDriver(driver.ComputeDriver):
                                                      self.host_uuid,
                                                      instance, injected_files,
                                                      network_info,
-                                                     admin_password))
+                                                     admin_password,
+                                                     mapping_acc=mapping_acc))
+
+        flow.add(tf_stg.ApplyVolumeMappings(mapping_acc, instance,
+                                            batch=True))
 
         # Last step is to power on the system.
         # Note: If moving to a Graph Flow, will need to change to depend on
@@ -232,7 +256,33 @@ class PowerVMDriver(driver.ComputeDriver):
 
         # Build the engine & run!
         engine = taskflow.engines.load(flow)
-        engine.run()
+        with mapping_acc.spawning():
+            engine.run()
+
+    def _add_connect_volumes(self, flow, instance, block_device_info,
+                             mapping_acc):
+        """Adds the tasks to connect the volumes of an instance to a flow.
+
+        The flow must provide the 'lpar_wrap'.  The mappings are queued on
+        the accumulator, so an ApplyVolumeMappings task must follow.
+
+        :param flow: The flow to add the tasks to.
+        :param instance: The nova instance.
+        :param block_device_info: Information about the block devices to
+                                  connect.
+        :param mapping_acc: The VscsiMappingAccumulator to queue the
+                            mappings on.
+        """
+        bdms = self._extract_bdm(block_device_info)
+        if not bdms:
+            return
+        for bdm in bdms:
+            conn_info = bdm.get('connection_info')
+            drv_type = conn_info.get('driver_volume_type')
+            vol_drv = self.vol_drvs.get(drv_type)
+            flow.add(tf_stg.ConnectVolume(self.adapter, vol_drv, instance,
+                                          conn_info, self.host_uuid,
+                                          mapping_acc=mapping_acc))
 
     def destroy(self, context, instance, network_info, block_device_info=None,
                 destroy_disks=True, migrate_data=None):
@@ -261,6 +311,10 @@ class PowerVMDriver(driver.ComputeDriver):
             flow.add(tf_vm.PowerOff(self.adapter, self.host_uuid,
                                     pvm_inst_uuid, instance))
 
+            # Look up the partition ID once for the storage tasks below
+            flow.add(tf_vm.GetPartitionID(self.adapter, pvm_inst_uuid,
+                                          instance))
+
             # Delete the virtual optical
             flow.add(tf_stg.DeleteVOpt(self.adapter, self.host_uuid, instance,
                                        pvm_inst_uuid))
@@ -268,15 +322,18 @@ class PowerVMDriver(driver.ComputeDriver):
             # Determine if there are volumes to disconnect.  If so, remove each
             # volume
             bdms = self._extract_bdm(block_device_info)
-            if bdms is not None:
+            if bdms:
+                mapping_acc = vscsi.VscsiMappingAccumulator(self.adapter,
+                                                            self.host_uuid)
                 for bdm in bdms:
                     conn_info = bdm.get('connection_info')
                     drv_type = conn_info.get('driver_volume_type')
                     vol_drv = self.vol_drvs.get(drv_type)
-                    flow.add(tf_stg.DisconnectVolume(self.adapter, vol_drv,
-                                                     instance, conn_info,
-                                                     self.host_uuid,
-                                                     pvm_inst_uuid))
+                    flow.add(tf_stg.DisconnectVolume(
+                        self.adapter, vol_drv, instance, conn_info,
+                        self.host_uuid, pvm_inst_uuid,
+                        mapping_acc=mapping_acc))
+                flow.add(tf_stg.ApplyVolumeMappings(mapping_acc, instance))
 
             # Detach the disk storage adapters
             flow.add(tf_stg.DetachDisk(self.disk_dvr, context, instance,
@@ -297,10 +354,16 @@ class PowerVMDriver(driver.ComputeDriver):
 
         self._log_operation('destroy', instance)
         if instance.task_state == task_states.RESIZE_REVERTING:
-            # This destroy is part of resize, just skip destroying
-            # TODO(IBM): What to do longer term
-            LOG.info(_LI('Ignoring destroy call during resize revert.'))
-            return
+            src_host_uuid = instance.system_metadata.get(
+                SHARED_STG_MIGRATION_KEY)
+            if src_host_uuid in (None, self.host_uuid):
+                # This destroy is part of resize, just skip destroying
+                # TODO(IBM): What to do longer term
+                LOG.info(_LI('Ignoring destroy call during resize revert.'))
+                return
+            # The LPAR was migrated to this host on the shared storage.  Its
+            # disks go back to the LPAR on the source host.
+            destroy_disks = False
 
         try:
             pvm_inst_uuid = vm.get_pvm_uuid(instance)
@@ -362,6 +425,7 @@ class PowerVMDriver(driver.ComputeDriver):
         drv_type = connection_info.get('driver_volume_type')
         vol_drv = self.vol_drvs.get(drv_type)
         pvm_inst_uuid = vm.get_pvm_uuid(instance)
+        flow.add(tf_vm.GetPartitionID(self.adapter, pvm_inst_uuid, instance))
         flow.add(tf_stg.DisconnectVolume(self.adapter, vol_drv, instance,
                                          connection_info, self.host_uuid,
                                          pvm_inst_uuid))
@@ -370,6 +434,113 @@ class PowerVMDriver(driver.ComputeDriver):
         engine = taskflow.engines.load(flow)
         engine.run()
 
+    def attach_volumes(self, context, instance, connection_infos):
+        """Attaches many volumes to an instance at once.
+
+        The hdisks of all of the volumes are discovered at the same time, and
+        their mappings are sent with one update per VIOS.  A volume that
+        fails does not stop the others from being attached.
+
+        :param context: security context
+        :param instance: The nova instance.
+        :param connection_infos: List of the connection_info of each volume.
+        :return: A list of (connection_info, exception) tuples in the order
+                 of connection_infos.  The exception is None for each volume
+                 that was attached.
+        """
+        self._log_operation('attach_volumes', instance)
+
+        def _connect(vol_drv, pvm_inst_uuid, lpar_id, conn_info,
+                     mapping_acc):
+            vol_drv.connect_volume(self.adapter, self.host_uuid,
+                                   pvm_inst_uuid, instance, conn_info,
+                                   mapping_acc=mapping_acc, lpar_id=lpar_id)
+        return self._bulk_volume_op(instance, connection_infos, _connect)
+
+    def detach_volumes(self, instance, connection_infos):
+        """Detaches many volumes from an instance at once.
+
+        The counterpart of attach_volumes.  The mappings of all of the
+        volumes are removed with one update per VIOS.
+
+        :param instance: The nova instance.
+        :param connection_infos: List of the connection_info of each volume.
+        :return: A list of (connection_info, exception) tuples in the order
+                 of connection_infos.  The exception is None for each volume
+                 that was detached.
+        """
+        self._log_operation('detach_volumes', instance)
+
+        def _disconnect(vol_drv, pvm_inst_uuid, lpar_id, conn_info,
+                        mapping_acc):
+            vol_drv.disconnect_volume(self.adapter, self.host_uuid,
+                                      pvm_inst_uuid, instance, conn_info,
+                                      mapping_acc=mapping_acc,
+                                      lpar_id=lpar_id)
+        return self._bulk_volume_op(instance, connection_infos, _disconnect)
+
+    def _bulk_volume_op(self, instance, connection_infos, func):
+        """Runs a volume operation for many volumes, then sends the mappings.
+
+        The volumes whose adapters queue their mappings are worked on
+        volume_op_concurrency at a time.  The others change the VIOSes
+        themselves, so they are run one at a time so that they do not race
+        each other's VIOS updates.
+
+        :param instance: The nova instance.
+        :param connection_infos: List of the connection_info of each volume.
+        :param func: The operation.  Takes the volume driver, the PowerVM
+                     UUID and partition ID of the instance, a connection_info
+                     and the mapping accumulator.
+        :return: A list of (connection_info, exception) tuples, see
+                 attach_volumes.
+        """
+        pvm_inst_uuid = vm.get_pvm_uuid(instance)
+        lpar_id = vm.get_vm_id(self.adapter, pvm_inst_uuid)
+        mapping_acc = vscsi.VscsiMappingAccumulator(self.adapter,
+                                                    self.host_uuid)
+
+        def _run(conn_info):
+            vol_drv = self.vol_drvs.get(conn_info.get('driver_volume_type'))
+            try:
+                func(vol_drv, pvm_inst_uuid, lpar_id, conn_info, mapping_acc)
+                return [conn_info, None]
+            except Exception as e:
+                LOG.exception(_LE('Volume operation failed for volume '
+                                  '%(volume)s: %(error)s'),
+                              {'volume': conn_info.get('serial'),
+                               'error': e}, instance=instance)
+                return [conn_info, e]
+
+        def _queues(conn_info):
+            vol_drv = self.vol_drvs.get(conn_info.get('driver_volume_type'))
+            return vol_drv is not None and vol_drv.queues_mappings
+
+        results = [None] * len(connection_infos)
+        queued = [idx for idx, conn_info in enumerate(connection_infos)
+                  if _queues(conn_info)]
+        pool = greenpool.GreenPool(max(CONF.volume_op_concurrency, 1))
+        for idx, result in zip(queued, pool.imap(
+                _run, [connection_infos[idx] for idx in queued])):
+            results[idx] = result
+        for idx, conn_info in enumerate(connection_infos):
+            if results[idx] is None:
+                results[idx] = _run(conn_info)
+
+        # The queued mappings of the volumes that made it this far go in one
+        # update per VIOS.  If that fails, none of them are changed, and the
+        # rollback also removes the hdisks the connects discovered.
+        try:
+            mapping_acc.apply()
+        except Exception as e:
+            LOG.exception(_LE('Unable to update the volume mappings: %s'), e,
+                          instance=instance)
+            mapping_acc.rollback()
+            for idx in queued:
+                if results[idx][1] is None:
+                    results[idx][1] = e
+        return [tuple(result) for result in results]
+
     def snapshot(self, context, instance, image_id, update_task_state):
         """Snapshots the specified instance.
 
@@ -443,6 +614,9 @@ class PowerVMDriver(driver.ComputeDriver):
         flow.add(tf_vm.PowerOff(self.adapter, self.host_uuid,
                                 pvm_inst_uuid, instance))
 
+        # Look up the partition ID for the detach
+        flow.add(tf_vm.GetPartitionID(self.adapter, pvm_inst_uuid, instance))
+
         # Detach the disk adapter for the rescue image
         flow.add(tf_stg.DetachDisk(self.disk_dvr, context, instance,
                                    pvm_inst_uuid,
@@ -478,6 +652,35 @@ class PowerVMDriver(driver.ComputeDriver):
         self._log_operation('power_on', instance)
         vm.power_on(self.adapter, instance, self.host_uuid)
 
+    def power_off_instances(self, instances):
+        """Power off many instances at once.
+
+        The states of the instances are read together, and up to
+        power_op_concurrency power off jobs are run at the same time.
+
+        :param instances: List of nova.objects.instance.Instance
+        :return: A list of (instance, exception) tuples in the order of
+                 instances.  The exception is None for each instance that
+                 was powered off.
+        """
+        for instance in instances:
+            self._log_operation('power_off', instance)
+        return vm.power_off_many(self.adapter, instances, self.host_uuid)
+
+    def power_on_instances(self, instances):
+        """Power on many instances at once.
+
+        The counterpart of power_off_instances.
+
+        :param instances: List of nova.objects.instance.Instance
+        :return: A list of (instance, exception) tuples in the order of
+                 instances.  The exception is None for each instance that
+                 was powered on.
+        """
+        for instance in instances:
+            self._log_operation('power_on', instance)
+        return vm.power_on_many(self.adapter, instances, self.host_uuid)
+
     def reboot(self, context, instance, network_info, reboot_type,
                block_device_info=None, bad_volumes_callback=None):
         """Reboot the specified instance.
@@ -501,12 +704,12 @@ class PowerVMDriver(driver.ComputeDriver):
         entry = vm.get_instance_wrapper(self.adapter, instance, self.host_uuid)
         # Note: We're bypassing vm.power_off/_on because we don't want the
         # state checks imposed thereby.
-        pvm_pwr.power_off(entry, self.host_uuid,
-                          force_immediate=force_immediate)
-        # pypowervm does NOT throw an exception if "already down".  Any other
-        # exception from pypowervm is a legitimate failure; let it raise up.
-        # If we get here, pypowervm thinks the instance is down.
-        pvm_pwr.power_on(entry, self.host_uuid)
+        vm.stop_lpar(self.adapter, entry, self.host_uuid,
+                     force_immediate=force_immediate)
+        # Neither power off throws an exception if "already down".  Any other
+        # exception is a legitimate failure; let it raise up.
+        # If we get here, the instance is down.
+        vm.start_lpar(self.adapter, entry, self.host_uuid)
         # Again, pypowervm exceptions are sufficient to indicate real failure.
         # Otherwise, pypowervm thinks the instance is up.
         return True
@@ -534,6 +737,10 @@ class PowerVMDriver(driver.ComputeDriver):
         data["local_gb"] = self.disk_dvr.capacity
         data["local_gb_used"] = self.disk_dvr.capacity_used
 
+        # The LPARs of the warm pool are powered off, so they do not take
+        # any of the host's processors or memory until they are claimed.
+        data["stats"]["warm_pool_lpars"] = self.warm_pool.size()
+
         return data
 
     def get_host_uptime(self):
@@ -549,21 +756,19 @@ class PowerVMDriver(driver.ComputeDriver):
 
     def _plug_vifs(self, instance, network_info):
         """Actual logic to plug VIFs into networks."""
-        # Get all the current VIFs.  Only create new ones.
+        # Get all the current VIFs, by MAC.  Only create new ones.
         cna_w_list = vm.get_cnas(self.adapter, instance, self.host_uuid)
+        cna_macs = set(cna_w.mac for cna_w in cna_w_list)
+        crt_funcs = []
         for vif in network_info:
-            crt_cna = True
-            for cna_w in cna_w_list:
-                if cna_w.mac == pvm_util.sanitize_mac_for_api(vif['address']):
-                    crt_cna = False
-
-            # If the crt_cna flag is true, then actually kick off the create
-            if crt_cna:
-                LOG.info(_LI('Creating VIF with mac %(mac)s for instance '
-                             '%(inst)s') % {'mac': vif['address'],
-                                            'inst': instance.name},
-                         instance=instance)
-                vm.crt_vif(self.adapter, instance, self.host_uuid, vif)
+            if pvm_util.sanitize_mac_for_api(vif['address']) in cna_macs:
+                continue
+            LOG.info(_LI('Creating VIF with mac %(mac)s for instance '
+                         '%(inst)s') % {'mac': vif['address'],
+                                        'inst': instance.name},
+                     instance=instance)
+            crt_funcs.append(functools.partial(
+                vm.crt_vif, self.adapter, instance, self.host_uuid, vif))
 
         # Determine if we need to create the secure RMC VIF.  This should only
         # be needed if there is not a VIF on the secure RMC vSwitch
@@ -572,14 +777,25 @@ class PowerVMDriver(driver.ComputeDriver):
             # If the vSwitch had been none, we can't create the VIF.  This
             # next check verifies that there are no existing NICs on the
             # vSwitch, so that the VM does not end up with multiple RMC VIFs.
-            must_create_rmc_conn = True
-            for cna_w in cna_w_list:
-                if cna_w.vswitch_uri == vswitch_w.href:
-                    must_create_rmc_conn = False
-                    break
-
-            if must_create_rmc_conn:
-                vm.crt_secure_rmc_vif(self.adapter, instance, self.host_uuid)
+            if vswitch_w.href not in set(cna_w.vswitch_uri
+                                         for cna_w in cna_w_list):
+                crt_funcs.append(functools.partial(
+                    vm.crt_secure_rmc_vif, self.adapter, instance,
+                    self.host_uuid))
+
+        # The missing VIFs are all created at once.  If any of them fail, the
+        # first failure is raised once the others are done.
+        def _run(crt_func):
+            try:
+                crt_func()
+            except Exception as e:
+                LOG.exception(_LE('Unable to create VIF: %s'), e,
+                              instance=instance)
+                return e
+        errors = [e for e in greenpool.GreenPool().imap(_run, crt_funcs)
+                  if e is not None]
+        if errors:
+            raise errors[0]
 
     def unplug_vifs(self, instance, network_info):
         """Unplug VIFs from networks."""
@@ -680,11 +896,112 @@ class PowerVMDriver(driver.ComputeDriver):
             self._resize_vm(context, instance, flav_obj, retry_interval)
         else:
             self._log_operation('migration', instance)
-            raise NotImplementedError()
+            disk_info = self._migrate_shared_stg(context, instance, flav_obj,
+                                                 block_device_info)
 
         # TODO(IBM): The caller is expecting disk info returned
         return disk_info
 
+    def _migrate_shared_stg(self, context, instance, flav_obj,
+                            block_device_info):
+        """Releases the disks of an instance migrating to another host.
+
+        The disks are not copied.  The boot disk stays in the shared storage
+        and is grown in place.  The LPAR is powered off and its volumes are
+        disconnected for the compute manager to connect them to the
+        destination, where finish_migration maps them and the boot disk to a
+        new LPAR.
+
+        The LPAR is kept, powered off and with its boot disk still mapped,
+        until the migration is confirmed or reverted.  Only this host's own
+        access to the shared storage is checked here; the destination's is
+        checked by finish_migration, after this host has powered off the
+        LPAR.  If that check or anything else in finish_migration fails, the
+        boot disk has not left this host's LPAR.  See finish_migration.
+
+        :param context: the context for the migration
+        :param instance: nova.objects.instance.Instance being migrated
+        :param flav_obj: the flavor of the instance after the migration
+        :param block_device_info: instance volume block device info
+        :return: The disk info for finish_migration.
+        """
+        try:
+            stg_data = self.disk_dvr.check_instance_shared_storage_local(
+                context, instance)
+        except NotImplementedError:
+            stg_data = None
+        if not stg_data:
+            raise exception.InstanceFaultRollback(
+                exception.MigrationPreCheckError(
+                    reason=_('The disk driver does not share the instance '
+                             'storage with other hosts.')))
+
+        pvm_inst_uuid = vm.get_pvm_uuid(instance)
+
+        # Define the flow
+        flow = lf.Flow("migrate_disk")
+
+        # The shared disk is grown in place.  That is done first, so that a
+        # disk that can not grow fails the migration before the LPAR is
+        # touched.
+        if flav_obj and flav_obj.root_gb > instance.root_gb:
+            flow.add(tf_stg.ExtendDisk(self.disk_dvr, context, instance,
+                                       dict(type='boot'), flav_obj.root_gb))
+
+        # Power Off the LPAR
+        flow.add(tf_vm.PowerOff(self.adapter, self.host_uuid,
+                                pvm_inst_uuid, instance))
+
+        # Look up the partition ID once for the storage tasks below
+        flow.add(tf_vm.GetPartitionID(self.adapter, pvm_inst_uuid, instance))
+
+        # Disconnect the volumes.  The compute manager connects them to the
+        # destination host.
+        bdms = self._extract_bdm(block_device_info)
+        if bdms:
+            mapping_acc = vscsi.VscsiMappingAccumulator(self.adapter,
+                                                        self.host_uuid)
+            for bdm in bdms:
+                conn_info = bdm.get('connection_info')
+                vol_drv = self.vol_drvs.get(
+                    conn_info.get('driver_volume_type'))
+                flow.add(tf_stg.DisconnectVolume(
+                    self.adapter, vol_drv, instance, conn_info,
+                    self.host_uuid, pvm_inst_uuid, mapping_acc=mapping_acc))
+            flow.add(tf_stg.ApplyVolumeMappings(mapping_acc, instance))
+
+        # The boot disk stays mapped.  A shared storage pool LU can be mapped
+        # on several hosts, and the LPAR here is powered off.
+
+        # Build the engine & run!
+        engine = taskflow.engines.load(flow)
+        engine.run()
+
+        instance.system_metadata[SHARED_STG_MIGRATION_KEY] = self.host_uuid
+        return {'shared_storage': stg_data}
+
+    def _connect_shared_stg(self, flow, context, instance, block_device_info,
+                            boot_disk=True):
+        """Adds the tasks to map the disks of a migration to an LPAR.
+
+        The flow must provide the 'lpar_wrap'.
+
+        :param flow: The flow to add the tasks to.
+        :param context: the context for the migration
+        :param instance: nova.objects.instance.Instance being migrated
+        :param block_device_info: instance volume block device info
+        :param boot_disk: If False, only the volumes are mapped.
+        """
+        mapping_acc = vscsi.VscsiMappingAccumulator(self.adapter,
+                                                    self.host_uuid)
+        if boot_disk:
+            flow.add(tf_stg.FindDisk(self.disk_dvr, context, instance))
+            flow.add(tf_stg.ConnectDisk(self.disk_dvr, context, instance,
+                                        mapping_acc=mapping_acc))
+        self._add_connect_volumes(flow, instance, block_device_info,
+                                  mapping_acc)
+        flow.add(tf_stg.ApplyVolumeMappings(mapping_acc, instance))
+
     def _resize_vm(self, context, instance, flav_obj, retry_interval=0):
 
         def _delay(attempt, max_attempts, *args, **kwds):
@@ -695,18 +1012,7 @@ class PowerVMDriver(driver.ComputeDriver):
         def _update_vm():
             LOG.debug('Resizing instance %s.' % instance.name,
                       instance=instance)
-            entry = vm.get_instance_wrapper(self.adapter, instance,
-                                            self.host_uuid)
-
-            pwrd = vm.power_off(self.adapter, instance,
-                                self.host_uuid, entry=entry)
-            # If it was powered off then the etag changed, fetch it again
-            if pwrd:
-                entry = vm.get_instance_wrapper(self.adapter, instance,
-                                                self.host_uuid)
-
-            vm.update(self.adapter, self.host_wrapper,
-                      instance, flav_obj, entry=entry)
+            vm.resize(self.adapter, self.host_wrapper, instance, flav_obj)
 
         # Update the VM
         _update_vm()
@@ -730,11 +1036,68 @@ class PowerVMDriver(driver.ComputeDriver):
         :param block_device_info: instance volume block device info
         :param power_on: True if the instance should be powered on, False
                          otherwise
+
+        For a migration over shared storage, the source host has already
+        powered off its LPAR and disconnected the volumes, but left the boot
+        disk mapped to it (see _migrate_shared_stg).  If this host does not
+        share the storage, or the flow fails, the flow has reverted its own
+        LPAR and mappings and a MigrationError is raised.  The LPAR and boot
+        disk of the instance are then left, powered off, on the source host,
+        where reverting the resize powers them back on.
         """
-        # TODO(IBM): Finish this up
+        if not disk_info or 'shared_storage' not in disk_info:
+            # A resize on this host.  The LPAR was already updated.
+            if power_on:
+                vm.power_on(self.adapter, instance, self.host_uuid)
+            return
+
+        self._log_operation('finish migration', instance)
+        if not self.disk_dvr.check_instance_shared_storage_remote(
+                context, disk_info['shared_storage']):
+            raise exception.MigrationError(
+                reason=_('The storage of the instance is not shared with '
+                         'this host.  The instance remains powered off on '
+                         'the source host.'))
+
+        # Define the flow
+        flow = lf.Flow("finish_migration")
+
+        # Create the LPAR
+        flow.add(tf_vm.Create(self.adapter, self.host_wrapper, instance,
+                              instance.get_flavor(),
+                              warm_pool=self.warm_pool))
+
+        # Plug the VIFs
+        vif_plug_info = {'instance': instance, 'network_info': network_info}
+        flow.add(taskflow.task.FunctorTask(self._plug_vifs, name='plug_vifs',
+                                           inject=vif_plug_info))
+
+        # Map the boot disk and volumes released by the source host
+        self._connect_shared_stg(flow, context, instance, block_device_info)
+
+        # The config drive media stays on the source host.  Build it again,
+        # without the files and password the instance already got at spawn.
+        if configdrive.required_by(instance):
+            flow.add(tf_stg.CreateAndConnectCfgDrive(self.adapter,
+                                                     self.host_uuid,
+                                                     instance, [],
+                                                     network_info, None))
 
         if power_on:
-            vm.power_on(self.adapter, instance, self.host_uuid)
+            flow.add(tf_vm.PowerOn(self.adapter, self.host_uuid, instance))
+
+        # Build the engine & run!  The flow reverts what it did here; the
+        # instance is left on the source host.
+        engine = taskflow.engines.load(flow)
+        try:
+            engine.run()
+        except Exception as e:
+            LOG.exception(_LE('Unable to finish the migration: %s'), e,
+                          instance=instance)
+            raise exception.MigrationError(
+                reason=_('The instance could not be started on this host: '
+                         '%s.  The instance remains powered off on the '
+                         'source host.') % e)
 
     def confirm_migration(self, migration, instance, network_info):
         """Confirms a resize, destroying the source VM.
@@ -744,8 +1107,17 @@ class PowerVMDriver(driver.ComputeDriver):
         :param network_info:
            :py:meth:`~nova.network.manager.NetworkManager.get_instance_nw_info`
         """
-        # TODO(IBM): Anything to do here?
-        pass
+        if (instance.system_metadata.get(SHARED_STG_MIGRATION_KEY) !=
+                self.host_uuid):
+            # A resize on this host.  Nothing to clean up.
+            return
+
+        # The LPAR left for a revert of the migration goes.  Its disks now
+        # belong to the LPAR on the destination host.
+        self._log_operation('confirm migration', instance)
+        del instance.system_metadata[SHARED_STG_MIGRATION_KEY]
+        self.destroy(ctx.get_admin_context(), instance, network_info,
+                     destroy_disks=False)
 
     def finish_revert_migration(self, context, instance, network_info,
                                 block_device_info=None, power_on=True):
@@ -760,6 +1132,18 @@ class PowerVMDriver(driver.ComputeDriver):
                          otherwise
         """
         self._log_operation('revert resize', instance)
+        if (instance.system_metadata.get(SHARED_STG_MIGRATION_KEY) ==
+                self.host_uuid):
+            # Map the volumes back to the LPAR kept on this host.  The boot
+            # disk was never unmapped from it.
+            flow = lf.Flow("revert_migration")
+            flow.add(tf_vm.Get(self.adapter, self.host_uuid, instance))
+            self._connect_shared_stg(flow, context, instance,
+                                     block_device_info, boot_disk=False)
+            engine = taskflow.engines.load(flow)
+            engine.run()
+            del instance.system_metadata[SHARED_STG_MIGRATION_KEY]
+
         # TODO(IBM): What to do here?  Do we want to recreate the LPAR
         # Or just change the settings back to the flavor?
 
@@ -768,9 +1152,7 @@ class PowerVMDriver(driver.ComputeDriver):
         flav_obj = (
             flavor_obj.Flavor.get_by_id(admin_ctx,
                                         instance.instance_type_id))
-        # TODO(IBM)  Get the entry once for both power_off and update
-        vm.power_off(self.adapter, instance, self.host_uuid)
-        vm.update(self.adapter, self.host_uuid, instance, flav_obj)
+        self._resize_vm(context, instance, flav_obj)
 
         if power_on:
             vm.power_on(self.adapter, instance, self.host_uuid)
@@ -790,9 +1172,10 @@ class PowerVMDriver(driver.ComputeDriver):
         :param disk_over_commit: if true, allow disk over commit
         :returns dest_check_data: dictionary containing destination data
         """
-        # dest_check_data = \
-        # TODO(IBM): Implement live migration check
-        pass
+        self._log_operation('check_can_live_migrate_destination',
+                            instance_ref)
+        mig = lpm.LiveMigrationDest(self, instance_ref)
+        return mig.check_destination(ctxt)
 
     def check_can_live_migrate_source(self, context, instance,
                                       dest_check_data, block_device_info=None):
@@ -807,9 +1190,10 @@ class PowerVMDriver(driver.ComputeDriver):
         :param block_device_info: result of _get_instance_block_device_info
         :returns: a dict containing migration info (hypervisor-dependent)
         """
-        # migrate_data = \
-        # TODO(IBM): Implement live migration check
-        pass
+        self._log_operation('check_can_live_migrate_source', instance)
+        mig = lpm.LiveMigrationSrc(self, instance, dest_check_data)
+        mig.check_source(context)
+        return dest_check_data
 
     def pre_live_migration(self, context, instance, block_device_info,
                            network_info, disk_info, migrate_data=None):
@@ -822,8 +1206,12 @@ class PowerVMDriver(driver.ComputeDriver):
         :param disk_info: instance disk information
         :param migrate_data: implementation specific data dict.
         """
-        # TODO(IBM): Implement migration prerequisites
-        pass
+        self._log_operation('pre_live_migration', instance)
+        # The migration itself creates the LPAR, its network adapters and its
+        # VIOS mappings on this host.  The hdisks of its volumes have to be
+        # discovered here first.
+        mig = lpm.LiveMigrationDest(self, instance)
+        mig.pre_live_migration(block_device_info)
 
     def live_migration(self, ctxt, instance_ref, dest,
                        post_method, recover_method,
@@ -841,7 +1229,45 @@ class PowerVMDriver(driver.ComputeDriver):
         :params migrate_data: implementation specific data dictionary.
         """
         self._log_operation('live_migration', instance_ref)
-        # TODO(IBM): Implement live migration
+        mig = lpm.LiveMigrationSrc(self, instance_ref, migrate_data)
+        self.live_migrations[instance_ref.uuid] = mig
+        try:
+            mig.live_migration(ctxt)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                LOG.exception(_LE('Live migration of instance %s failed.'),
+                              instance_ref.name)
+                mig.rollback_live_migration()
+                recover_method(ctxt, instance_ref, dest, block_migration,
+                               migrate_data)
+        finally:
+            self.live_migrations.pop(instance_ref.uuid, None)
+
+        post_method(ctxt, instance_ref, dest, block_migration, migrate_data)
+
+    def live_migration_abort(self, instance):
+        """Aborts an in-progress live migration.
+
+        :param instance: instance that is live migrating
+        """
+        self._log_operation('live_migration_abort', instance)
+        mig = self.live_migrations.get(instance.uuid)
+        if mig is None:
+            LOG.warn(_LW('Instance %s is not live migrating from this host.'),
+                     instance.name)
+            return
+        mig.abort()
+
+    def post_live_migration_at_source(self, context, instance, network_info):
+        """Unplug VIFs from networks at source.
+
+        :param context: security context
+        :param instance: instance object reference
+        :param network_info: instance network information
+        """
+        # The network adapters left with the LPAR.
+        mig = lpm.LiveMigrationSrc(self, instance, None)
+        mig.post_live_migration_at_source()
 
     def check_instance_shared_storage_local(self, context, instance):
         """Check if instance files located on shared storage.
@@ -887,9 +1313,33 @@ class PowerVMDriver(driver.ComputeDriver):
         :param instance_ref: migrated instance
         :param network_info: dictionary of network info for instance
         :param block_migration: boolean for block migration
+        :param block_device_info: instance block device information
+        """
+        self._log_operation('post_live_migration_at_destination',
+                            instance_ref)
+        mig = lpm.LiveMigrationDest(self, instance_ref)
+        mig.post_live_migration_at_destination(network_info,
+                                               block_device_info)
+
+    def rollback_live_migration_at_destination(self, context, instance,
+                                               network_info,
+                                               block_device_info,
+                                               destroy_disks=True,
+                                               migrate_data=None):
+        """Clean up destination node after a failed live migration.
+
+        :param context: security context
+        :param instance: instance object that was being migrated
+        :param network_info: instance network information
+        :param block_device_info: instance block device information
+        :param destroy_disks:
+            if true, destroy disks at destination during cleanup
+        :param migrate_data: implementation specific data dict.
         """
-        # TODO(IBM): Implement post migration
-        pass
+        self._log_operation('rollback_live_migration_at_destination',
+                            instance)
+        mig = lpm.LiveMigrationDest(self, instance)
+        mig.rollback_live_migration_at_destination(block_device_info)
 
     @staticmethod
     def _extract_bdm(block_device_info):
@@ -938,8 +1388,8 @@ class PowerVMDriver(driver.ComputeDriver):
         """
         self._log_operation('get_vnc_console', instance)
         lpar_uuid = vm.get_pvm_uuid(instance)
-        port = pvm_vterm.open_vnc_vterm(self.adapter, lpar_uuid,
-                                        bind_ip=CONF.vncserver_listen)
+        port = vm.open_vnc_vterm(self.adapter, lpar_uuid,
+                                 bind_ip=CONF.vncserver_listen)
         host = CONF.vncserver_proxyclient_address
         return console_type.ConsoleVNC(host=host, port=port)
 
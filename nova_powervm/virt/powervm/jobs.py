@@ -0,0 +1,231 @@
+# Copyright 2015 IBM Corp.
+#
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import eventlet
+from eventlet import event
+import threading
+import time
+
+from nova.i18n import _LW
+from oslo_log import log as logging
+from pypowervm import exceptions as pvm_exc
+from pypowervm.wrappers import job as pvm_job
+
+LOG = logging.getLogger(__name__)
+
+_JOBS = 'jobs'
+
+# The number of seconds to wait before the first status check of a job, by
+# job type.  A power on runs for much longer than an immediate power off.
+_POLL_INTERVALS = {'PowerOn': 2.0, 'PowerOff': 1.0}
+_DEFAULT_POLL_INTERVAL = 1.0
+# Each check that finds the job still running waits longer for the next one,
+# up to the maximum.
+_POLL_BACKOFF = 1.5
+_MAX_POLL_INTERVAL = 5.0
+
+DEFAULT_TIMEOUT = 1800
+
+_RUNNING_STATES = (pvm_job.JobStatus.NOT_ACTIVE, pvm_job.JobStatus.RUNNING)
+
+
+class _Waiter(object):
+    """An outstanding job and the caller waiting for it."""
+
+    def __init__(self, job_id, job_type, timeout):
+        self.job_id = job_id
+        self.job_type = job_type
+        self.interval = _POLL_INTERVALS.get(job_type, _DEFAULT_POLL_INTERVAL)
+        now = time.time()
+        self.next_poll = now + self.interval
+        self.deadline = now + timeout if timeout else None
+        self.event = event.Event()
+
+    def backoff(self, now):
+        self.interval = min(self.interval * _POLL_BACKOFF, _MAX_POLL_INTERVAL)
+        self.next_poll = now + self.interval
+
+
+class JobMonitor(object):
+    """Waits for the REST API jobs of a host.
+
+    A single green thread checks the status of every outstanding job, using
+    one read of the job feed per pass, and wakes the callers of the jobs that
+    have finished.  It is woken when a job is added, so a new job is checked
+    on its own schedule rather than after the current wait.
+
+    Only the jobs started through run_job or passed to wait are covered.
+    Normal (not immediate) power offs still run through pypowervm, which
+    polls its jobs itself.
+    """
+    _monitors = {}
+    _monitors_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, adapter, host_uuid):
+        """Returns the job monitor for a host.
+
+        :param adapter: The pypowervm adapter.
+        :param host_uuid: The pypowervm UUID of the host.
+        :return: The JobMonitor of the host.
+        """
+        with cls._monitors_lock:
+            monitor = cls._monitors.get(host_uuid)
+            if monitor is None:
+                monitor = cls(adapter, host_uuid)
+                cls._monitors[host_uuid] = monitor
+            return monitor
+
+    def __init__(self, adapter, host_uuid):
+        self.adapter = adapter
+        self.host_uuid = host_uuid
+        self._lock = threading.Lock()
+        # Notified when a job is added, to wake the poller from its wait.
+        self._added = threading.Condition(self._lock)
+        # The outstanding jobs, by job ID.
+        self._waiters = {}
+        self._polling = False
+
+    def run_job(self, job_w, uuid, group, job_type, job_parms=None,
+                timeout=DEFAULT_TIMEOUT):
+        """Starts a job and waits for it to finish.
+
+        :param job_w: The Job wrapper of the job request, as read from the
+                      'do' suffix of the object.
+        :param uuid: The UUID of the object the job runs against.
+        :param group: The schema type of the object (ex. LogicalPartition).
+        :param job_type: The name of the operation (ex. PowerOn).  Sets how
+                         often the job is checked.
+        :param job_parms: Optional list of job parameters to add.
+        :param timeout: The number of seconds to wait for the job.
+        :return: The Job wrapper of the completed job.
+        :raise JobRequestFailed: If the job did not complete successfully.
+        :raise JobRequestTimedOut: If the job did not finish in time.
+        """
+        if job_parms:
+            job_w.add_job_parameters_to_existing(*job_parms)
+        try:
+            job_w = pvm_job.Job.wrap(self.adapter.create_job(
+                job_w.entry.element, group, uuid).entry)
+        except pvm_exc.Error as e:
+            LOG.exception(e)
+            raise pvm_exc.JobRequestFailed(operation_name=job_type, error=e)
+
+        result = self.wait(job_w.job_id, job_type, timeout=timeout)
+        if result is None:
+            raise pvm_exc.JobRequestTimedOut(operation_name=job_type,
+                                             seconds=timeout)
+
+        self._delete(result.job_id)
+        if result.job_status != pvm_job.JobStatus.COMPLETED_OK:
+            raise pvm_exc.JobRequestFailed(
+                operation_name=job_type,
+                error=result.get_job_resp_exception_msg())
+        return result
+
+    def wait(self, job_id, job_type, timeout=DEFAULT_TIMEOUT):
+        """Waits for a started job to finish.
+
+        :param job_id: The ID of the job.
+        :param job_type: The name of the operation (ex. PowerOn).
+        :param timeout: The number of seconds to wait for the job.  0 waits
+                        forever.
+        :return: The Job wrapper of the finished job, or None if it did not
+                 finish in time.
+        """
+        waiter = _Waiter(job_id, job_type, timeout)
+        with self._lock:
+            self._waiters[job_id] = waiter
+            start = not self._polling
+            self._polling = True
+            self._added.notify()
+        if start:
+            eventlet.spawn_n(self._poll)
+        return waiter.event.wait()
+
+    def _poll(self):
+        """Checks the outstanding jobs until there are none left."""
+        while True:
+            with self._lock:
+                if not self._waiters:
+                    self._polling = False
+                    return
+                now = time.time()
+                due = [waiter for waiter in self._waiters.values()
+                       if waiter.next_poll <= now]
+                if not due:
+                    next_poll = min(waiter.next_poll
+                                    for waiter in self._waiters.values())
+                    self._added.wait(next_poll - now)
+                    continue
+
+            try:
+                jobs = self._read_jobs([waiter.job_id for waiter in due])
+            except Exception as e:
+                LOG.warn(_LW('Unable to check the status of the jobs: %s'), e)
+                jobs = {}
+
+            now = time.time()
+            for waiter in due:
+                job_w = jobs.get(waiter.job_id)
+                if job_w is not None and job_w.job_status not in (
+                        _RUNNING_STATES):
+                    self._finish(waiter, job_w)
+                elif waiter.deadline is not None and now > waiter.deadline:
+                    self._finish(waiter, None)
+                else:
+                    waiter.backoff(now)
+
+    def _finish(self, waiter, job_w):
+        with self._lock:
+            self._waiters.pop(waiter.job_id, None)
+        waiter.event.send(job_w)
+
+    def _read_jobs(self, job_ids):
+        """Reads the status of jobs.
+
+        :param job_ids: The IDs of the jobs to read.
+        :return: Dict of the Job wrappers that could be read, by job ID.
+        """
+        jobs = {}
+        if len(job_ids) > 1:
+            # One read of the feed covers every job.
+            try:
+                for entry in self.adapter.read(_JOBS).feed.entries:
+                    job_w = pvm_job.Job.wrap(entry)
+                    jobs[job_w.job_id] = job_w
+            except pvm_exc.Error as e:
+                LOG.warn(_LW('Unable to read the job feed, reading each job '
+                             'instead: %s'), e)
+
+        # Any job not in the feed is read on its own.
+        for job_id in job_ids:
+            if job_id in jobs:
+                continue
+            try:
+                jobs[job_id] = pvm_job.Job.wrap(
+                    self.adapter.read(_JOBS, root_id=job_id).entry)
+            except pvm_exc.Error as e:
+                LOG.warn(_LW('Unable to read job %(job)s: %(error)s'),
+                         {'job': job_id, 'error': e})
+        return jobs
+
+    def _delete(self, job_id):
+        try:
+            self.adapter.delete(_JOBS, root_id=job_id)
+        except pvm_exc.Error as e:
+            LOG.warn(_LW('Unable to delete job %(job)s: %(error)s'),
+                     {'job': job_id, 'error': e})
@@ -0,0 +1,445 @@
+# Copyright 2015 IBM Corp.
+#
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import eventlet
+from eventlet import greenpool
+import threading
+
+from nova import exception
+from nova.i18n import _, _LI, _LW
+from nova.virt import configdrive
+from oslo_config import cfg
+from oslo_log import log as logging
+from pypowervm.tasks import migration as pvm_mig
+from pypowervm.wrappers import logical_partition as pvm_lpar
+from pypowervm.wrappers import managed_system as pvm_ms
+from pypowervm.wrappers import network as pvm_net
+from pypowervm.wrappers import storage as pvm_stor
+from pypowervm.wrappers import virtual_io_server as pvm_vios
+
+from nova_powervm.virt.powervm import media
+from nova_powervm.virt.powervm import vios
+from nova_powervm.virt.powervm import vm
+
+LOG = logging.getLogger(__name__)
+CONF = cfg.CONF
+
+# Seconds between reads of the LPAR's migration state while it migrates.
+_PROGRESS_INTERVAL = 5
+
+# The instance progress reported for the LPAR migration states.  Other
+# states leave the progress as it is.
+_PROGRESS = {'Migration_Starting': 10,
+             'Migration_Running': 50,
+             'Migration_Completing': 90,
+             'Migration_Completed': 100}
+
+
+class _CheckFailed(Exception):
+    """A check of a migration failed.  The message is the reason."""
+
+
+def _run_checks(checks):
+    """Runs the checks of a migration concurrently.
+
+    :param checks: The functions to run.  Each takes no arguments.
+    :return: The results of the checks, in their order.
+    :raise MigrationPreCheckError: If any check raised.  All the failures
+                                   are in the reason.
+    """
+    def _run(check):
+        try:
+            return check(), None
+        except Exception as e:
+            return None, e
+
+    results = list(greenpool.GreenPool().imap(_run, checks))
+    reasons = [str(e) for result, e in results if e is not None]
+    if reasons:
+        raise exception.MigrationPreCheckError(reason='; '.join(reasons))
+    return [result for result, e in results]
+
+
+def _get_bridged_vlans(adapter, host_uuid):
+    """Returns the VLANs that a host bridges, by vSwitch.
+
+    :param adapter: The pypowervm adapter.
+    :param host_uuid: The host system UUID.
+    :return: A dict of each vSwitch name to a sorted list of the VLANs that
+             the host's network bridges carry on it.  Every vSwitch of the
+             host is in the dict.
+    """
+    resp = adapter.read(pvm_ms.System.schema_type, root_id=host_uuid,
+                        child_type=pvm_net.VSwitch.schema_type)
+    names = dict((vswitch.switch_id, vswitch.name)
+                 for vswitch in pvm_net.VSwitch.wrap(resp))
+    vlans = dict((name, set()) for name in names.values())
+
+    resp = adapter.read(pvm_ms.System.schema_type, root_id=host_uuid,
+                        child_type=pvm_net.NetBridge.schema_type)
+    for nb in pvm_net.NetBridge.wrap(resp):
+        name = names.get(nb.vswitch_id)
+        if name is not None:
+            vlans[name].update(nb.list_vlans())
+    return dict((name, sorted(ids)) for name, ids in vlans.items())
+
+
+class LiveMigrationDest(object):
+    """The destination host's side of a live partition migration.
+
+    :param drvr: The PowerVM driver of the host.
+    :param instance: The nova instance being migrated.
+    """
+
+    def __init__(self, drvr, instance):
+        self.drvr = drvr
+        self.instance = instance
+
+    def check_destination(self, context):
+        """Checks that the host can take the instance.
+
+        The checks of the host run concurrently.
+
+        :param context: security context
+        :return: The destination data for the source host's checks.
+        :raise MigrationPreCheckError: If the host can not take the instance.
+        """
+        adapter, host_uuid = self.drvr.adapter, self.drvr.host_uuid
+        host_w, vlans, shared_stg = _run_checks([
+            self._check_host,
+            lambda: _get_bridged_vlans(adapter, host_uuid),
+            lambda: self._shared_storage_data(context)])
+        return {'dest_sys_name': host_w.system_name,
+                'dest_vlans': vlans,
+                'dest_shared_storage': shared_stg}
+
+    def _check_host(self):
+        resp = self.drvr.adapter.read(pvm_ms.System.schema_type,
+                                      root_id=self.drvr.host_uuid)
+        host_w = pvm_ms.System.wrap(resp.entry)
+
+        if not host_w.get_capability('active_lpar_mobility_capable'):
+            raise _CheckFailed(
+                _('The destination host is not capable of active '
+                  'partition mobility.'))
+        flavor = self.instance.get_flavor()
+        if host_w.memory_free < flavor.memory_mb:
+            raise _CheckFailed(
+                _('The destination host has %(free)d MB of memory '
+                  'free, %(need)d MB are needed.') %
+                {'free': host_w.memory_free, 'need': flavor.memory_mb})
+        proc_units = flavor.vcpus * CONF.proc_units_factor
+        if float(host_w.proc_units_avail) < proc_units:
+            raise _CheckFailed(
+                _('The destination host has %(free)s processor units '
+                  'free, %(need).2f are needed.') %
+                {'free': host_w.proc_units_avail, 'need': proc_units})
+        return host_w
+
+    def _shared_storage_data(self, context):
+        try:
+            return self.drvr.check_instance_shared_storage_local(
+                context, self.instance)
+        except NotImplementedError:
+            # The disk driver's storage is never shared.
+            return None
+
+    def _volumes(self, block_device_info):
+        """Returns the (volume adapter, connection_info) of each volume."""
+        vols = []
+        for bdm in self.drvr._extract_bdm(block_device_info):
+            conn_info = bdm.get('connection_info')
+            vol_drv = self.drvr.vol_drvs.get(
+                conn_info.get('driver_volume_type'))
+            vols.append((vol_drv, conn_info))
+        return vols
+
+    def pre_live_migration(self, block_device_info):
+        """Prepares the host's VIOSes for the volumes of the instance.
+
+        The hdisks of the volumes are discovered on the host's VIOSes, up to
+        volume_op_concurrency volumes at a time.
+
+        :param block_device_info: The instance's block device information.
+        """
+        adapter, host_uuid = self.drvr.adapter, self.drvr.host_uuid
+
+        def _prepare(vol):
+            vol_drv, conn_info = vol
+            try:
+                vol_drv.pre_live_migration_on_destination(
+                    adapter, host_uuid, self.instance, conn_info)
+            except Exception as e:
+                return e
+
+        pool = greenpool.GreenPool(max(CONF.volume_op_concurrency, 1))
+        for error in pool.imap(_prepare, self._volumes(block_device_info)):
+            if error is not None:
+                # The rollback of the migration removes the hdisks that were
+                # discovered.
+                raise error
+
+    def post_live_migration_at_destination(self, network_info,
+                                           block_device_info):
+        """Picks up the LPAR of the instance once it is on the host.
+
+        :param network_info: The instance's network information.
+        :param block_device_info: The instance's block device information.
+        """
+        # The migration added the LPAR and its VIOS mappings behind the
+        # driver's back.  Find them again on their next use.
+        vm.UUIDCache.get_cache().remove(self.instance.name)
+        vios.invalidate_vios_feed(self.drvr.host_uuid)
+
+        vols = self._volumes(block_device_info)
+        cfg_drive = configdrive.required_by(self.instance)
+        if vols or cfg_drive:
+            lpar_w = vm.get_instance_wrapper(
+                self.drvr.adapter, self.instance, self.drvr.host_uuid)
+
+        # Record the volumes' hdisks as connect_volume does, now that the
+        # partition ID of the LPAR is known.
+        for vol_drv, conn_info in vols:
+            vol_drv.post_live_migration_at_destination(
+                self.drvr.adapter, self.drvr.host_uuid, self.instance,
+                conn_info, lpar_w.id)
+
+        # The config drive media was removed on the source host.  Build it
+        # again, without the files and password the instance already got at
+        # spawn.
+        if cfg_drive:
+            cfg_dr = media.ConfigDrivePowerVM(self.drvr.adapter,
+                                              self.drvr.host_uuid)
+            cfg_dr.create_cfg_drv_vopt(self.instance, [], network_info,
+                                       lpar_w.uuid)
+        LOG.info(_LI('Instance %s was migrated to this host.'),
+                 self.instance.name)
+
+    def rollback_live_migration_at_destination(self, block_device_info):
+        """Forgets the LPAR of the instance after a failed migration.
+
+        The recovery of the migration on the source host removes whatever
+        the migration had created on this host.  The hdisks discovered for
+        the volumes by pre_live_migration are removed here.
+
+        :param block_device_info: The instance's block device information.
+        """
+        vm.UUIDCache.get_cache().remove(self.instance.name)
+        vios.invalidate_vios_feed(self.drvr.host_uuid)
+        for vol_drv, conn_info in self._volumes(block_device_info):
+            vol_drv.rollback_live_migration_at_destination(
+                self.drvr.adapter, self.drvr.host_uuid, self.instance,
+                conn_info)
+
+
+class LiveMigrationSrc(object):
+    """The source host's side of a live partition migration.
+
+    :param drvr: The PowerVM driver of the host.
+    :param instance: The nova instance being migrated.
+    :param dest_data: The result of LiveMigrationDest.check_destination.
+    """
+
+    def __init__(self, drvr, instance, dest_data):
+        self.drvr = drvr
+        self.instance = instance
+        self.dest_data = dest_data
+        self.lpar_w = None
+        self._done = threading.Event()
+        # Whether live_migration removed the config drive media.
+        self._cfg_drive_removed = False
+
+    def check_source(self, context):
+        """Checks that the instance can migrate to the destination.
+
+        The PowerVM validation of the migration and the driver's own checks
+        of the networks, VIOS mappings and storage all run concurrently.
+
+        :param context: security context
+        :raise MigrationPreCheckError: If the instance can not migrate.
+        """
+        self.lpar_w = vm.get_instance_wrapper(
+            self.drvr.adapter, self.instance, self.drvr.host_uuid)
+        _run_checks([self._validate, self._check_vlans,
+                     self._check_vios_mappings,
+                     lambda: self._check_shared_storage(context)])
+
+    def _validate(self):
+        try:
+            pvm_mig.migrate_lpar(self.lpar_w, self.dest_data['dest_sys_name'],
+                                 validate_only=True)
+        except Exception as e:
+            raise _CheckFailed(
+                _('PowerVM validation of the migration failed: %s') % e)
+
+    def _check_vlans(self):
+        """Checks the destination has the networks of the instance's CNAs.
+
+        Each CNA's vSwitch must be on the destination.  A VLAN the source
+        host bridges must also be bridged there.
+        """
+        adapter, host_uuid = self.drvr.adapter, self.drvr.host_uuid
+        resp = adapter.read(pvm_ms.System.schema_type, root_id=host_uuid,
+                            child_type=pvm_net.VSwitch.schema_type)
+        names = dict((vswitch.switch_id, vswitch.name)
+                     for vswitch in pvm_net.VSwitch.wrap(resp))
+        src_vlans = _get_bridged_vlans(adapter, host_uuid)
+        dest_vlans = self.dest_data['dest_vlans']
+
+        for cna_w in vm.get_cnas(adapter, self.instance, host_uuid):
+            name = names.get(cna_w.vswitch_id)
+            if name not in dest_vlans:
+                raise _CheckFailed(
+                    _('The destination host has no vSwitch %s.') % name)
+            if (cna_w.pvid in src_vlans.get(name, []) and
+                    cna_w.pvid not in dest_vlans[name]):
+                raise _CheckFailed(
+                    _('The destination host does not bridge VLAN '
+                      '%(vlan)d on vSwitch %(vswitch)s.') %
+                    {'vlan': cna_w.pvid, 'vswitch': name})
+
+    def _check_vios_mappings(self):
+        """Checks the instance's VIOS mappings can move with it.
+
+        Only physical volumes and shared storage pool LUs can be mapped on
+        the destination's VIOSes.  The disks of a local volume group can
+        not.  The media of a config drive is removed by live_migration and
+        built again on the destination.
+        """
+        adapter, host_uuid = self.drvr.adapter, self.drvr.host_uuid
+        lpar_id = int(vm.get_vm_id(adapter, self.lpar_w.uuid))
+        vios_feed = vios.get_vios_feed(
+            adapter, host_uuid, xag=[pvm_vios.VIOS.xags.SCSI_MAPPING])
+        for vio_wrap in vios_feed:
+            for smap in vio_wrap.scsi_mappings:
+                stg = smap.backing_storage
+                if (smap.server_adapter.lpar_id != lpar_id or stg is None or
+                        isinstance(stg, (pvm_stor.PV, pvm_stor.LU,
+                                         pvm_stor.VOptMedia))):
+                    continue
+                raise _CheckFailed(
+                    _('Storage %(stg)s of Virtual I/O Server %(vios)s can '
+                      'not be moved to the destination host.') %
+                    {'stg': stg.name, 'vios': vio_wrap.name})
+
+    def _check_shared_storage(self, context):
+        # An instance booted from a volume has no disk of the disk driver.
+        # Its volumes are checked with the VIOS mappings.
+        if not self.instance.image_ref:
+            return
+        data = self.dest_data.get('dest_shared_storage')
+        if not data or not self.drvr.check_instance_shared_storage_remote(
+                context, data):
+            raise _CheckFailed(
+                _('The storage of the instance is not shared with '
+                  'the destination host.'))
+
+    def live_migration(self, context):
+        """Migrates the LPAR to the destination host.
+
+        The migration state of the LPAR is reported as the instance's
+        progress while the migration runs.
+
+        PowerVM can not move the media of a config drive.  It is removed
+        first, and built again by post_live_migration_at_destination, or by
+        rollback_live_migration if the migration fails.
+
+        :param context: security context
+        :raise MigrationError: If the migration failed or was aborted.
+        """
+        self.lpar_w = vm.get_instance_wrapper(
+            self.drvr.adapter, self.instance, self.drvr.host_uuid)
+        if configdrive.required_by(self.instance):
+            self._cfg_drive_removed = True
+            media.ConfigDrivePowerVM(
+                self.drvr.adapter, self.drvr.host_uuid).dlt_vopt(
+                self.lpar_w.uuid, lpar_id=self.lpar_w.id)
+        self._done.clear()
+        eventlet.spawn_n(self._report_progress)
+        try:
+            pvm_mig.migrate_lpar(self.lpar_w, self.dest_data['dest_sys_name'])
+        except Exception as e:
+            raise exception.MigrationError(
+                reason=_('Live migration of instance %(inst)s failed: '
+                         '%(error)s') %
+                {'inst': self.instance.name, 'error': e})
+        finally:
+            self._done.set()
+        LOG.info(_LI('Instance %(inst)s was migrated to host %(host)s.'),
+                 {'inst': self.instance.name,
+                  'host': self.dest_data['dest_sys_name']})
+
+    def _report_progress(self):
+        state = None
+        while not self._done.wait(_PROGRESS_INTERVAL):
+            try:
+                resp = self.drvr.adapter.read(pvm_lpar.LPAR.schema_type,
+                                              root_id=self.lpar_w.uuid)
+                new_state = pvm_lpar.LPAR.wrap(resp.entry).migration_state
+                if new_state == state:
+                    continue
+                state = new_state
+                LOG.info(_LI('Migration of instance %(inst)s: %(state)s'),
+                         {'inst': self.instance.name, 'state': state})
+                if state in _PROGRESS:
+                    self.instance.progress = _PROGRESS[state]
+                    self.instance.save()
+            except Exception as e:
+                # The progress is only informational.
+                LOG.debug('Unable to report the migration progress of '
+                          'instance %(inst)s: %(error)s' %
+                          {'inst': self.instance.name, 'error': e})
+
+    def abort(self):
+        """Aborts the running migration of the LPAR."""
+        if self.lpar_w is None or self._done.is_set():
+            return
+        LOG.info(_LI('Aborting the migration of instance %s.'),
+                 self.instance.name)
+        pvm_mig.migrate_abort(self.lpar_w)
+
+    def rollback_live_migration(self):
+        """Recovers the LPAR after a failed migration.
+
+        The config drive removed by live_migration is built again.
+        """
+        if self.lpar_w is None:
+            return
+        try:
+            pvm_mig.migrate_recover(self.lpar_w, force=True)
+        except Exception as e:
+            LOG.warn(_LW('Unable to recover the migration of instance '
+                         '%(inst)s: %(error)s'),
+                     {'inst': self.instance.name, 'error': e})
+
+        # Put back the config drive removed by live_migration.
+        if self._cfg_drive_removed:
+            try:
+                cfg_dr = media.ConfigDrivePowerVM(self.drvr.adapter,
+                                                  self.drvr.host_uuid)
+                cfg_dr.create_cfg_drv_vopt(
+                    self.instance, [], self.instance.info_cache.network_info,
+                    self.lpar_w.uuid)
+                self._cfg_drive_removed = False
+            except Exception as e:
+                LOG.warn(_LW('Unable to rebuild the config drive of '
+                             'instance %(inst)s: %(error)s'),
+                         {'inst': self.instance.name, 'error': e})
+
+    def post_live_migration_at_source(self):
+        """Forgets the LPAR of the instance, which left the host."""
+        vm.UUIDCache.get_cache().remove(self.instance.name)
+        vios.invalidate_vios_feed(self.drvr.host_uuid)
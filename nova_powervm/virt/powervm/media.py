@@ -19,20 +19,26 @@ from nova.api.metadata import base as instance_metadata
 from nova.i18n import _LE, _LI, _LW
 from nova.virt import configdrive
 import os
+import tempfile
+import threading
+import time
 
 from oslo_config import cfg
 from oslo_log import log as logging
+from oslo_utils import excutils
 
+from pypowervm import exceptions as pvm_exc
 from pypowervm.tasks import scsi_mapper as tsk_map
 from pypowervm.tasks import storage as tsk_stg
 from pypowervm import util as pvm_util
+from pypowervm.utils import retry as pvm_retry
 from pypowervm.wrappers import base_partition as pvm_bp
-from pypowervm.wrappers import managed_system as pvm_ms
 from pypowervm.wrappers import storage as pvm_stg
 from pypowervm.wrappers import virtual_io_server as pvm_vios
 
 import six
 
+from nova_powervm.virt.powervm import vios
 from nova_powervm.virt.powervm import vm
 
 LOG = logging.getLogger(__name__)
@@ -53,11 +59,95 @@ class NoMediaRepoVolumeGroupFound(AbstractMediaException):
                   'media repository.')
 
 
+# Directory, under image_meta_local_path, with an empty file named for each
+# config drive media that this host has started but not finished deleting.
+_PENDING_DLT_DIR = '.pending_deletes'
+
+
+def _pending_dlts():
+    """Returns the names of the media with unfinished deletes."""
+    try:
+        return set(os.listdir(os.path.join(CONF.image_meta_local_path,
+                                           _PENDING_DLT_DIR)))
+    except EnvironmentError:
+        return set()
+
+
+def _mark_pending_dlt(media_names):
+    """Records that the media is being deleted.
+
+    :param media_names: The names of the media.
+    """
+    pdir = os.path.join(CONF.image_meta_local_path, _PENDING_DLT_DIR)
+    try:
+        if not os.path.exists(pdir):
+            os.makedirs(pdir)
+        for name in media_names:
+            open(os.path.join(pdir, name), 'a').close()
+    except EnvironmentError as e:
+        # Only means the media is left behind if the delete does not finish.
+        LOG.warn(_LW('Unable to record the delete of virtual optical media '
+                     '%(media)s: %(error)s') %
+                 {'media': ', '.join(sorted(media_names)), 'error': e})
+
+
+def _clear_pending_dlt(media_names):
+    """Forgets the deletes of the media.
+
+    :param media_names: The names of the media.
+    """
+    pdir = os.path.join(CONF.image_meta_local_path, _PENDING_DLT_DIR)
+    for name in media_names:
+        path = os.path.join(pdir, name)
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+        except EnvironmentError:
+            pass
+
+
+class _MediaRepo(object):
+    """A virtual optical media repository on one Virtual I/O Server."""
+
+    def __init__(self, vios_uuid, vios_name, vg_uuid):
+        self.vios_uuid = vios_uuid
+        self.vios_name = vios_name
+        self.vg_uuid = vg_uuid
+
+
+class _MediaDeleteBatch(object):
+    """A set of optical media pending removal from one volume group."""
+
+    def __init__(self):
+        self.media_names = set()
+        self.done = threading.Event()
+        self.error = None
+
+
 class ConfigDrivePowerVM(object):
 
-    _cur_vios_uuid = None
-    _cur_vios_name = None
-    _cur_vg_uuid = None
+    # The media repositories, one per eligible VIOS, are shared by every
+    # instance of this class on the host.  They are guarded by _repo_lock.
+    _cur_repos = []
+    # Index of the repository the next instance will upload to.
+    _next_repo = 0
+    # When (per time.time()) the cached repositories were last validated.
+    _cur_validated = None
+    _repo_lock = threading.RLock()
+
+    # Media deletes waiting to be sent, keyed by (VIOS UUID, VG UUID).
+    # Guarded by _dlt_lock.
+    _dlt_batches = {}
+    _dlt_lock = threading.Lock()
+    # Signalled as deletes join a batch or finish, for the batch owners
+    # waiting on them.
+    _dlt_cond = threading.Condition(_dlt_lock)
+    # The number of dlt_vopt calls that have not yet queued their media (or
+    # found they have none).  Guarded by _dlt_lock.
+    _dlt_pending = 0
+    # Whether the media left behind by a prior run of the process has been
+    # cleaned up.
+    _orphans_reaped = False
 
     def __init__(self, adapter, host_uuid):
         """Creates the config drive manager for PowerVM.
@@ -67,14 +157,40 @@ class ConfigDrivePowerVM(object):
         """
         self.adapter = adapter
         self.host_uuid = host_uuid
+        # Whether this instance is counted in _dlt_pending.
+        self._dlt_counted = False
+        # The (VIOS UUID, VG UUID, media name) of the media uploaded by
+        # create_cfg_drv_vopt, for dlt_created_vopt.
+        self._created_media = None
 
         # The validate will use the cached static variables for the VIOS info.
-        # Once validate is done, set the class variables to the updated cache.
+        # Within the validity window this does not call the REST API.
         self._validate_vopt_vg()
+        self._load_cur_repo()
+
+    def _load_cur_repo(self):
+        """Picks the media repository this instance will upload to.
 
-        self.vios_uuid = ConfigDrivePowerVM._cur_vios_uuid
-        self.vios_name = ConfigDrivePowerVM._cur_vios_name
-        self.vg_uuid = ConfigDrivePowerVM._cur_vg_uuid
+        The repositories are handed out round robin so that concurrent
+        config drive uploads are spread across the Virtual I/O Servers.
+        """
+        with ConfigDrivePowerVM._repo_lock:
+            repos = ConfigDrivePowerVM._cur_repos
+            if not repos:
+                self._use_repo(_MediaRepo(None, None, None))
+                return
+            idx = ConfigDrivePowerVM._next_repo % len(repos)
+            ConfigDrivePowerVM._next_repo = idx + 1
+            self._use_repo(repos[idx])
+
+    def _use_repo(self, repo):
+        """Points this instance at a media repository.
+
+        :param repo: The _MediaRepo to work against.
+        """
+        self.vios_uuid = repo.vios_uuid
+        self.vios_name = repo.vios_name
+        self.vg_uuid = repo.vg_uuid
 
     def _create_cfg_dr_iso(self, instance, injected_files, network_info,
                            admin_pass=None):
@@ -90,21 +206,14 @@ class ConfigDrivePowerVM(object):
         :return file_name: The file name for the ISO
         """
         LOG.info(_LI("Creating config drive for instance: %s") % instance.name)
-        extra_md = {}
-        if admin_pass is not None:
-            extra_md['admin_pass'] = admin_pass
-
-        inst_md = instance_metadata.InstanceMetadata(instance,
-                                                     content=injected_files,
-                                                     extra_md=extra_md,
-                                                     network_info=network_info)
+        inst_md = self._bld_inst_md(instance, injected_files, network_info,
+                                    admin_pass)
 
         # Make sure the path exists.
         if not os.path.exists(CONF.image_meta_local_path):
             os.mkdir(CONF.image_meta_local_path)
 
-        file_name = pvm_util.sanitize_file_name_for_api(
-            instance.name, prefix='config_', suffix='.iso')
+        file_name = self._get_iso_name(instance)
         iso_path = os.path.join(CONF.image_meta_local_path, file_name)
         with configdrive.ConfigDriveBuilder(instance_md=inst_md) as cdb:
             LOG.info(_LI("Config drive ISO being built for instance %(inst)s "
@@ -113,8 +222,66 @@ class ConfigDrivePowerVM(object):
             cdb.make_drive(iso_path)
             return iso_path, file_name
 
+    def _create_cfg_dr_iso_mem(self, instance, injected_files, network_info,
+                               admin_pass=None):
+        """Builds the config drive ISO in memory.
+
+        The ISO is built into an anonymous (already unlinked) file on the
+        memory backed image_meta_memory_path.  Nothing is written to disk and
+        no file name is claimed in a shared directory.  The builder writes to
+        the file through its /proc file descriptor link.
+
+        :param instance: The VM instance from OpenStack.
+        :param injected_files: A list of file paths that will be injected into
+                               the ISO.
+        :param network_info: The network_info from the nova spawn method.
+        :param admin_password: Optional password to inject for the VM.
+        :return iso_stream: An open file object, positioned at the start of
+                            the ISO.  The caller must close it, which releases
+                            the memory.
+        :return file_name: The file name for the ISO
+        :return file_size: The size of the ISO in bytes.
+        """
+        LOG.info(_LI("Creating in memory config drive for instance: %s") %
+                 instance.name)
+        inst_md = self._bld_inst_md(instance, injected_files, network_info,
+                                    admin_pass)
+        file_name = self._get_iso_name(instance)
+
+        iso_stream = tempfile.TemporaryFile(dir=CONF.image_meta_memory_path)
+        try:
+            # The builder runs in a child process, so the descriptor has to be
+            # addressed through our own pid rather than /proc/self.
+            iso_path = '/proc/%d/fd/%d' % (os.getpid(), iso_stream.fileno())
+            with configdrive.ConfigDriveBuilder(instance_md=inst_md) as cdb:
+                cdb.make_drive(iso_path)
+            iso_stream.seek(0)
+            file_size = os.fstat(iso_stream.fileno()).st_size
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                iso_stream.close()
+        return iso_stream, file_name, file_size
+
+    @staticmethod
+    def _bld_inst_md(instance, injected_files, network_info, admin_pass):
+        """Builds the instance metadata for the config drive."""
+        extra_md = {}
+        if admin_pass is not None:
+            extra_md['admin_pass'] = admin_pass
+
+        return instance_metadata.InstanceMetadata(instance,
+                                                  content=injected_files,
+                                                  extra_md=extra_md,
+                                                  network_info=network_info)
+
+    @staticmethod
+    def _get_iso_name(instance):
+        """Returns the name of the config drive ISO for the instance."""
+        return pvm_util.sanitize_file_name_for_api(
+            instance.name, prefix='config_', suffix='.iso')
+
     def create_cfg_drv_vopt(self, instance, injected_files, network_info,
-                            lpar_uuid, admin_pass=None):
+                            lpar_uuid, admin_pass=None, mapping_acc=None):
         """Creates the config drive virtual optical and attach to VM.
 
         :param instance: The VM instance from OpenStack.
@@ -123,82 +290,157 @@ class ConfigDrivePowerVM(object):
         :param network_info: The network_info from the nova spawn method.
         :param lpar_uuid: The UUID of the client LPAR
         :param admin_pass: Optional password to inject for the VM.
+        :param mapping_acc: Optional VscsiMappingAccumulator to queue the
+                            mapping on, rather than adding it right away.
         """
-        iso_path, file_name = self._create_cfg_dr_iso(instance, injected_files,
-                                                      network_info, admin_pass)
-
-        # Upload the media
-        file_size = os.path.getsize(iso_path)
-        vopt, f_uuid = self._upload_vopt(iso_path, file_name, file_size)
-
-        # Delete the media
-        os.remove(iso_path)
-
-        # Add the mapping to the virtual machine
+        if CONF.image_meta_in_memory:
+            # Build in memory and stream straight up to the VIOS.
+            iso_stream, file_name, file_size = self._create_cfg_dr_iso_mem(
+                instance, injected_files, network_info, admin_pass)
+            with iso_stream:
+                vopt, f_uuid = self._upload_vopt_stream(iso_stream, file_name,
+                                                        file_size)
+        else:
+            iso_path, file_name = self._create_cfg_dr_iso(
+                instance, injected_files, network_info, admin_pass)
+
+            # Upload the media
+            file_size = os.path.getsize(iso_path)
+            vopt, f_uuid = self._upload_vopt(iso_path, file_name, file_size)
+
+            # Delete the media
+            os.remove(iso_path)
+
+        # A delete of older media of the same name that never finished must
+        # not take this media with it after a restart.
+        _clear_pending_dlt([file_name])
+        self._created_media = (self.vios_uuid, self.vg_uuid, file_name)
+
+        # Add the mapping to the virtual machine.  It must be on the VIOS
+        # that hosts the media.
+        if mapping_acc is not None:
+            mapping_acc.add_storage_mapping(self.vios_uuid, lpar_uuid, vopt)
+            return
         tsk_map.add_vscsi_mapping(self.host_uuid, self.vios_uuid, lpar_uuid,
                                   vopt)
+        vios.invalidate_vios_feed(self.host_uuid, self.vios_uuid)
 
     def _upload_vopt(self, iso_path, file_name, file_size):
         with open(iso_path, 'rb') as d_stream:
+            return self._upload_vopt_stream(d_stream, file_name, file_size)
+
+    def _upload_vopt_stream(self, d_stream, file_name, file_size):
+        def _upload():
+            # Rewind in case this is a retry against a rediscovered repository
+            d_stream.seek(0)
             return tsk_stg.upload_vopt(self.adapter, self.vios_uuid, d_stream,
                                        file_name, file_size)
+        return self._run_on_repo(_upload)
+
+    def _run_on_repo(self, func):
+        """Runs an operation against the media repository.
+
+        The repository location is cached, so it is only rediscovered when an
+        actual operation against it fails.  In that case the repository is
+        revalidated and the operation is retried once.
+
+        :param func: The operation to run.  Takes no parameters and works
+                     against self.vios_uuid/self.vg_uuid.
+        :return: The return value of func.
+        """
+        try:
+            return func()
+        except pvm_exc.Error as e:
+            LOG.warn(_LW('Operation against the virtual optical media '
+                         'repository on Virtual I/O Server %(vios)s failed.  '
+                         'Revalidating the repository.  Error: %(error)s') %
+                     {'vios': self.vios_name, 'error': e})
+
+        self._validate_vopt_vg(stale_vg_uuid=self.vg_uuid)
+        self._load_cur_repo()
+        return func()
 
-    def _validate_vopt_vg(self):
-        """Will ensure that the virtual optical media repository exists.
+    def _validate_vopt_vg(self, stale_vg_uuid=None):
+        """Will ensure that the virtual optical media repositories exist.
 
-        This method will connect to one of the Virtual I/O Servers on the
-        system and ensure that there is a root_vg that the optical media (which
-        is temporary) exists.
+        This method will connect to the Virtual I/O Servers on the system and
+        ensure that each of them with a root_vg has a repository that the
+        optical media (which is temporary) can be placed in.
 
         If the volume group on an I/O Server goes down (perhaps due to
-        maintenance), the system will rescan to determine if there is another
-        I/O Server that can host the request.
+        maintenance), the system will rescan to determine which I/O Servers
+        can host the request.
 
         The very first invocation may be expensive.  It may also be expensive
         to call if a Virtual I/O Server unexpectantly goes down.
 
         If there are no Virtual I/O Servers that can support the media, then
         an exception will be thrown.
-        """
 
-        # TODO(IBM) Add thread safety here in case two calls into this are
-        # done at once.
+        The result is cached for the host.  Within vopt_media_rep_cache_time
+        seconds of the last validation no REST calls are made.
 
-        # If our static variables were set, then we should validate that the
-        # repo is still running.  Otherwise, we need to reset the variables
-        # (as it could be down for maintenance).
-        if ConfigDrivePowerVM._cur_vg_uuid is not None:
-            vio_uuid = ConfigDrivePowerVM._cur_vios_uuid
-            vg_uuid = ConfigDrivePowerVM._cur_vg_uuid
+        :param stale_vg_uuid: If set, an operation against this volume group
+                              failed.  Unless another caller has already moved
+                              the cache off of it, the repositories are
+                              rediscovered without trusting the cache.
+        """
+        with ConfigDrivePowerVM._repo_lock:
+            self._validate_vopt_vg_locked(stale_vg_uuid)
+
+    def _validate_vopt_vg_locked(self, stale_vg_uuid):
+        """Body of _validate_vopt_vg.  Must hold the repository lock."""
+        cur_repos = ConfigDrivePowerVM._cur_repos
+        if stale_vg_uuid is not None:
+            if cur_repos and stale_vg_uuid not in [repo.vg_uuid
+                                                   for repo in cur_repos]:
+                # Another caller already revalidated past the failure.
+                return
+        elif cur_repos:
+            # Within the validity window we trust the cache outright.
+            validated = ConfigDrivePowerVM._cur_validated
+            if (validated is not None and
+                    time.time() - validated < CONF.vopt_media_rep_cache_time):
+                return
+
+            # Otherwise validate that the repos are still running.  If not, we
+            # need to reset the variables (as one could be down for
+            # maintenance).
             try:
-                vg_resp = self.adapter.read(pvm_vios.VIOS.schema_type,
-                                            vio_uuid, pvm_stg.VG.schema_type,
-                                            vg_uuid)
-                if vg_resp is not None:
+                for repo in cur_repos:
+                    vg_resp = self.adapter.read(pvm_vios.VIOS.schema_type,
+                                                repo.vios_uuid,
+                                                pvm_stg.VG.schema_type,
+                                                repo.vg_uuid)
+                    if vg_resp is None:
+                        break
+                else:
+                    ConfigDrivePowerVM._cur_validated = time.time()
                     return
             except Exception:
                 pass
 
-            LOG.log(_LI("An error occurred querying the virtual optical media "
-                        "repository.  Attempting to re-establish connection "
-                        "with a virtual optical media repository"))
+            LOG.warn(_LW("An error occurred querying the virtual optical "
+                         "media repositories.  Attempting to re-establish "
+                         "connection with the virtual optical media "
+                         "repositories"))
+
+        # Drop the cache until a repository is found again.
+        ConfigDrivePowerVM._cur_validated = None
 
-        # If we're hitting this, either it's our first time booting up, or the
+        # If we're hitting this, either it's our first time booting up, or a
         # previously used Volume Group went offline (ex. VIOS went down for
         # maintenance).
         #
-        # Since it doesn't matter which VIOS we use for the media repo, we
-        # should query all Virtual I/O Servers and see if an appropriate
-        # media repository exists.
-        vios_resp = self.adapter.read(pvm_ms.System.schema_type,
-                                      root_id=self.host_uuid,
-                                      child_type=pvm_vios.VIOS.schema_type)
-        vio_wraps = pvm_vios.VIOS.wrap(vios_resp)
-
-        # First loop through the VIOSes to see if any have the right VG
-        found_vg = None
-        found_vios = None
-
+        # Query all Virtual I/O Servers and use every one that has an
+        # appropriate volume group.  The media is spread across them.
+        if stale_vg_uuid is not None:
+            # Don't trust a cached feed to tell which VIOSes are up.
+            vios.invalidate_vios_feed(self.host_uuid)
+        vio_wraps = vios.get_vios_feed(self.adapter, self.host_uuid)
+
+        # Loop through the VIOSes to see which have the right VG
+        found = []
         for vio_wrap in vio_wraps:
             # If the RMC state is not active, skip over to ensure we don't
             # timeout
@@ -212,8 +454,7 @@ class ConfigDrivePowerVM(object):
                 vg_wraps = pvm_stg.VG.wrap(vg_resp)
                 for vg_wrap in vg_wraps:
                     if vg_wrap.name == CONF.vopt_media_volume_group:
-                        found_vg = vg_wrap
-                        found_vios = vio_wrap
+                        found.append((vio_wrap, vg_wrap))
                         break
             except Exception:
                 LOG.warn(_LW('Unable to read volume groups for Virtual '
@@ -224,42 +465,310 @@ class ConfigDrivePowerVM(object):
         # default to being the rootvg, which all VIOSes will have.  Otherwise,
         # this is user specified, and if it was not found is a proper
         # exception path.
-        if found_vg is None:
+        repos = []
+        for found_vios, found_vg in found:
+            # Ensure that there is a virtual optical media repository within
+            # it.  A VIOS we can not set one up on is just left out.
+            if len(found_vg.vmedia_repos) == 0:
+                try:
+                    vopt_repo = pvm_stg.VMediaRepos.bld(
+                        self.adapter, 'vopt', str(CONF.vopt_media_rep_size))
+                    found_vg.vmedia_repos = [vopt_repo]
+                    found_vg = found_vg.update()
+                except Exception:
+                    LOG.warn(_LW('Unable to create the virtual optical media '
+                                 'repository on Virtual I/O Server %s') %
+                             found_vios.name)
+                    continue
+            repos.append(_MediaRepo(found_vios.uuid, found_vios.name,
+                                    found_vg.uuid))
+
+        if not repos:
             raise NoMediaRepoVolumeGroupFound(
                 vol_grp=CONF.vopt_media_volume_group)
 
-        # Ensure that there is a virtual optical media repository within it.
-        if len(found_vg.vmedia_repos) == 0:
-            vopt_repo = pvm_stg.VMediaRepos.bld(self.adapter, 'vopt',
-                                                str(CONF.vopt_media_rep_size))
-            found_vg.vmedia_repos = [vopt_repo]
-            found_vg = found_vg.update()
-
         # At this point, we know that we've successfully set up the volume
-        # group.  Save to the static class variables.
-        ConfigDrivePowerVM._cur_vg_uuid = found_vg.uuid
-        ConfigDrivePowerVM._cur_vios_uuid = found_vios.uuid
-        ConfigDrivePowerVM._cur_vios_name = found_vios.name
-
-    def dlt_vopt(self, lpar_uuid):
-        """Deletes the virtual optical and scsi mappings for a VM."""
-        partition_id = vm.get_vm_id(self.adapter, lpar_uuid)
-
-        # Remove the SCSI mappings to all vOpt Media.  This returns the media
-        # devices that were removed from the bus.
-        media_elems = tsk_map.remove_vopt_mapping(self.adapter, self.vios_uuid,
-                                                  partition_id)
-
-        # Next delete the media from the volume group.  To do so, remove the
-        # media from the volume group, which triggers a delete.
-        vg_rsp = self.adapter.read(pvm_vios.VIOS.schema_type,
-                                   root_id=self.vios_uuid,
-                                   child_type=pvm_stg.VG.schema_type,
-                                   child_id=self.vg_uuid)
-        volgrp = pvm_stg.VG.wrap(vg_rsp)
-        optical_medias = volgrp.vmedia_repos[0].optical_media
-        for media_elem in media_elems:
-            optical_medias.remove(media_elem)
-
-        # Now we can do an update...and be done with it.
-        volgrp.update()
+        # groups.  Save to the static class variables.
+        ConfigDrivePowerVM._cur_repos = repos
+        ConfigDrivePowerVM._cur_validated = time.time()
+
+        # Deletes that were under way when the process went down never made
+        # it to the repository.  Nothing can be uploading yet on the very
+        # first discovery, so clean those up now.
+        if not ConfigDrivePowerVM._orphans_reaped:
+            ConfigDrivePowerVM._orphans_reaped = True
+            pending = _pending_dlts()
+            if pending:
+                for repo in repos:
+                    self._rm_orphaned_media(repo.vios_uuid, repo.vg_uuid,
+                                            pending)
+
+    def _rm_orphaned_media(self, vios_uuid, vg_uuid, pending):
+        """Removes the media of unfinished deletes from a repository.
+
+        Only media that this host had started to delete, and that is not
+        mapped to any partition, is removed.  The repository may hold media
+        that is not ours.
+
+        :param vios_uuid: The UUID of the VIOS hosting the media repository.
+        :param vg_uuid: The UUID of the volume group holding the repository.
+        :param pending: Set of the names of the media with unfinished
+                        deletes.
+        """
+        try:
+            vios_resp = self.adapter.read(
+                pvm_vios.VIOS.schema_type, root_id=vios_uuid,
+                xag=[pvm_vios.VIOS.xags.SCSI_MAPPING])
+            vios_w = pvm_vios.VIOS.wrap(vios_resp)
+            mapped = set(smap.backing_storage.media_name
+                         for smap in vios_w.scsi_mappings
+                         if isinstance(smap.backing_storage,
+                                       pvm_stg.VOptMedia))
+
+            vg_rsp = self.adapter.read(pvm_vios.VIOS.schema_type,
+                                       root_id=vios_uuid,
+                                       child_type=pvm_stg.VG.schema_type,
+                                       child_id=vg_uuid)
+            volgrp = pvm_stg.VG.wrap(vg_rsp)
+            orphans = set(media.media_name
+                          for media in volgrp.vmedia_repos[0].optical_media
+                          if media.media_name in pending and
+                          media.media_name not in mapped)
+
+            if orphans:
+                LOG.info(_LI("Removing %(num)d config drive media left "
+                             "behind by unfinished deletes from the virtual "
+                             "optical media repository.") %
+                         {'num': len(orphans)})
+                self._rm_media(vios_uuid, vg_uuid, orphans)
+                _clear_pending_dlt(orphans)
+        except Exception as e:
+            # Leftover media only takes up space in the repository.  It must
+            # not stop the driver from using it.
+            LOG.warn(_LW("Unable to clean up unmapped media in the virtual "
+                         "optical media repository: %s") % e)
+
+    def dlt_vopt(self, lpar_uuid, lpar_id=None):
+        """Deletes the virtual optical and scsi mappings for a VM.
+
+        Only the Virtual I/O Servers that map media to the VM are updated.
+        They are found from the SCSI mappings in the (cached) VIOS feed, so
+        media on a VIOS that no longer hosts a current repository is still
+        removed.
+
+        :param lpar_uuid: The pypowervm UUID of the VM.
+        :param lpar_id: (Optional) The partition ID of the VM.  If not set,
+                        it is looked up from the lpar_uuid.
+        """
+        error = None
+        self._dlt_start()
+        try:
+            partition_id = lpar_id
+            if partition_id is None:
+                partition_id = vm.get_vm_id(self.adapter, lpar_uuid)
+            partition_id = int(partition_id)
+
+            vio_wraps = vios.get_vios_feed(
+                self.adapter, self.host_uuid,
+                xag=[pvm_vios.VIOS.xags.SCSI_MAPPING])
+            for vio_wrap in vio_wraps:
+                media_names = set(
+                    smap.backing_storage.media_name
+                    for smap in vio_wrap.scsi_mappings
+                    if isinstance(smap.backing_storage, pvm_stg.VOptMedia) and
+                    smap.server_adapter.lpar_id == partition_id)
+                if not media_names:
+                    continue
+                try:
+                    self._dlt_vopt(vio_wrap.uuid, partition_id, media_names)
+                except pvm_exc.Error as e:
+                    LOG.warn(_LW('Unable to delete the virtual optical media '
+                                 'on Virtual I/O Server %(vios)s.  Error: '
+                                 '%(error)s') %
+                             {'vios': vio_wrap.name, 'error': e})
+                    error = error or e
+        finally:
+            self._dlt_joined()
+
+        # Let the caller know if any media could not be cleaned up.
+        if error is not None:
+            raise error
+
+    def dlt_created_vopt(self):
+        """Deletes the media uploaded by create_cfg_drv_vopt, if any.
+
+        Unlike dlt_vopt, the media is found even if it was never mapped to
+        the VM, or its mapping has already been rolled back.  Any mapping
+        must be removed first.
+        """
+        if self._created_media is None:
+            return
+        vios_uuid, vg_uuid, media_name = self._created_media
+
+        # Recorded first, so the media is found again after a restart.
+        _mark_pending_dlt([media_name])
+        self._rm_media(vios_uuid, vg_uuid, {media_name})
+        _clear_pending_dlt([media_name])
+        self._created_media = None
+
+    def _dlt_vopt(self, vios_uuid, partition_id, media_names):
+        """Unmaps and deletes a VM's media on one Virtual I/O Server.
+
+        :param vios_uuid: The UUID of the VIOS that maps the media.
+        :param partition_id: The short partition ID of the VM.
+        :param media_names: Set of the names of the media mapped to the VM.
+        """
+        # Recorded first, so the media is found again after a restart.
+        _mark_pending_dlt(media_names)
+        tsk_map.remove_vopt_mapping(self.adapter, vios_uuid, partition_id)
+        vios.invalidate_vios_feed(self.host_uuid, vios_uuid)
+
+        # Next delete the media from the volume group.  This is batched with
+        # the deletes from other destroys running alongside this one.
+        vg_uuid = self._media_vg_uuid(vios_uuid)
+        try:
+            self._dlt_media(vios_uuid, vg_uuid, media_names)
+        except pvm_exc.Error as e:
+            # The mappings are gone, so only the media removal is retried,
+            # against the volume group read fresh from the VIOS.
+            LOG.warn(_LW('Unable to remove the virtual optical media from '
+                         'the repository on Virtual I/O Server %(vios)s.  '
+                         'Retrying.  Error: %(error)s') %
+                     {'vios': vios_uuid, 'error': e})
+            self._rm_media(vios_uuid,
+                           self._media_vg_uuid(vios_uuid, cached=False),
+                           media_names)
+        _clear_pending_dlt(media_names)
+
+    def _media_vg_uuid(self, vios_uuid, cached=True):
+        """Returns the UUID of the volume group with a VIOS's media repository.
+
+        :param vios_uuid: The UUID of the VIOS.
+        :param cached: If True, a current repository on the VIOS is used
+                       without reading the VIOS.
+        """
+        if cached:
+            with ConfigDrivePowerVM._repo_lock:
+                for repo in ConfigDrivePowerVM._cur_repos:
+                    if repo.vios_uuid == vios_uuid:
+                        return repo.vg_uuid
+
+        # A VIOS has at most one media repository.
+        vg_resp = self.adapter.read(pvm_vios.VIOS.schema_type,
+                                    root_id=vios_uuid,
+                                    child_type=pvm_stg.VG.schema_type)
+        for vg_wrap in pvm_stg.VG.wrap(vg_resp):
+            if vg_wrap.vmedia_repos:
+                return vg_wrap.uuid
+        raise NoMediaRepoVolumeGroupFound(
+            vol_grp=CONF.vopt_media_volume_group)
+
+    def _dlt_start(self):
+        """Counts this instance's delete as pending."""
+        with ConfigDrivePowerVM._dlt_lock:
+            if not self._dlt_counted:
+                self._dlt_counted = True
+                ConfigDrivePowerVM._dlt_pending += 1
+
+    def _dlt_joined(self):
+        """Stops counting this instance's delete as pending.
+
+        Must be called once the delete has queued its media, or found it has
+        none.  Wakes the batch owners waiting on it.
+        """
+        with ConfigDrivePowerVM._dlt_lock:
+            self._dlt_joined_locked()
+
+    def _dlt_joined_locked(self):
+        if self._dlt_counted:
+            self._dlt_counted = False
+            ConfigDrivePowerVM._dlt_pending -= 1
+            ConfigDrivePowerVM._dlt_cond.notify_all()
+
+    def _dlt_media(self, vios_uuid, vg_uuid, media_names):
+        """Removes media from the repository, batched with other deletes.
+
+        The first caller for a volume group waits for the other deletes in
+        progress to join it, for up to vopt_media_delete_window seconds, and
+        then sends a single update for all of them.  With no other delete in
+        progress it does not wait at all.  Every caller returns once that
+        update is done, and raises if it failed.
+
+        :param vios_uuid: The UUID of the VIOS hosting the media repository.
+        :param vg_uuid: The UUID of the volume group holding the repository.
+        :param media_names: Set of the names of the media to remove.
+        """
+        key = (vios_uuid, vg_uuid)
+        with ConfigDrivePowerVM._dlt_lock:
+            self._dlt_joined_locked()
+            batch = ConfigDrivePowerVM._dlt_batches.get(key)
+            leader = batch is None
+            if leader:
+                batch = _MediaDeleteBatch()
+                ConfigDrivePowerVM._dlt_batches[key] = batch
+            batch.media_names.update(media_names)
+
+        if not leader:
+            batch.done.wait()
+            if batch.error is not None:
+                raise batch.error
+            return
+
+        try:
+            self._wait_for_dlts()
+        finally:
+            # Close the batch.  Later deletes start a new one.
+            with ConfigDrivePowerVM._dlt_lock:
+                del ConfigDrivePowerVM._dlt_batches[key]
+
+        try:
+            self._rm_media(vios_uuid, vg_uuid, batch.media_names)
+        except Exception as e:
+            batch.error = e
+            raise
+        finally:
+            batch.done.set()
+
+    @staticmethod
+    def _wait_for_dlts():
+        """Waits for the deletes in progress to queue their media.
+
+        Gives up after vopt_media_delete_window seconds.
+        """
+        deadline = time.time() + CONF.vopt_media_delete_window
+        with ConfigDrivePowerVM._dlt_lock:
+            while ConfigDrivePowerVM._dlt_pending > 0:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                ConfigDrivePowerVM._dlt_cond.wait(remaining)
+
+    def _rm_media(self, vios_uuid, vg_uuid, media_names):
+        """Removes the named media from the media repository.
+
+        :param vios_uuid: The UUID of the VIOS hosting the media repository.
+        :param vg_uuid: The UUID of the volume group holding the repository.
+        :param media_names: Set of the names of the media to remove.
+        """
+        @pvm_retry.retry()
+        def _rm():
+            # To delete the media, remove it from the volume group, which
+            # triggers a delete.  On an etag mismatch this is rerun against a
+            # fresh read of the volume group.
+            vg_rsp = self.adapter.read(pvm_vios.VIOS.schema_type,
+                                       root_id=vios_uuid,
+                                       child_type=pvm_stg.VG.schema_type,
+                                       child_id=vg_uuid)
+            volgrp = pvm_stg.VG.wrap(vg_rsp)
+            optical_medias = volgrp.vmedia_repos[0].optical_media
+            to_rm = [media for media in optical_medias
+                     if media.media_name in media_names]
+            if not to_rm:
+                return
+            for media in to_rm:
+                optical_medias.remove(media)
+
+            # Now we can do an update...and be done with it.
+            volgrp.update()
+
+        _rm()
@@ -29,7 +29,8 @@ LOG = logging.getLogger(__name__)
 class ConnectVolume(task.Task):
     """The task to connect a volume to an instance."""
 
-    def __init__(self, adapter, vol_drv, instance, connection_info, host_uuid):
+    def __init__(self, adapter, vol_drv, instance, connection_info, host_uuid,
+                 mapping_acc=None):
         """Create the task.
 
         Requires LPAR info through requirement of lpar_wrap.
@@ -41,6 +42,9 @@ class ConnectVolume(task.Task):
         :param connection_info: The connection info from the block device
                                 mapping.
         :param host_uuid: The pypowervm UUID of the host.
+        :param mapping_acc: Optional VscsiMappingAccumulator to queue the
+                            mappings on.  An ApplyVolumeMappings task must
+                            follow in the flow.
         """
         self.adapter = adapter
         self.vol_drv = vol_drv
@@ -48,6 +52,7 @@ class ConnectVolume(task.Task):
         self.connection_info = connection_info
         self.vol_id = self.connection_info['data']['volume_id']
         self.host_uuid = host_uuid
+        self.mapping_acc = mapping_acc
 
         super(ConnectVolume, self).__init__(name='connect_vol_%s' %
                                             self.vol_id,
@@ -58,7 +63,9 @@ class ConnectVolume(task.Task):
                  {'vol': self.vol_id, 'inst': self.instance.name})
         return self.vol_drv.connect_volume(self.adapter, self.host_uuid,
                                            lpar_wrap.uuid, self.instance,
-                                           self.connection_info)
+                                           self.connection_info,
+                                           mapping_acc=self.mapping_acc,
+                                           lpar_id=lpar_wrap.id)
 
     def revert(self, lpar_wrap, result, flow_failures):
         # The parameters have to match the execute method, plus the response +
@@ -73,17 +80,18 @@ class ConnectVolume(task.Task):
 
         return self.vol_drv.disconnect_volume(self.adapter, self.host_uuid,
                                               lpar_wrap.uuid, self.instance,
-                                              self.connection_info)
+                                              self.connection_info,
+                                              lpar_id=lpar_wrap.id)
 
 
 class DisconnectVolume(task.Task):
     """The task to disconnect a volume from an instance."""
 
     def __init__(self, adapter, vol_drv, instance, connection_info,
-                 host_uuid, vm_uuid):
+                 host_uuid, vm_uuid, mapping_acc=None):
         """Create the task.
 
-        Requires LPAR info through requirement of lpar_wrap.
+        Requires the partition ID of the VM through requirement of lpar_id.
 
         :param adapter: The pypowervm adapter.
         :param vol_drv: The volume driver (see volume folder).  Ties the
@@ -93,6 +101,9 @@ class DisconnectVolume(task.Task):
                                 mapping.
         :param host_uuid: The pypowervm UUID of the host.
         :param vm_uuid: The pypowervm UUID of the VM.
+        :param mapping_acc: Optional VscsiMappingAccumulator to queue the
+                            mapping removals on.  An ApplyVolumeMappings task
+                            must follow in the flow.
         """
         self.adapter = adapter
         self.vol_drv = vol_drv
@@ -101,18 +112,22 @@ class DisconnectVolume(task.Task):
         self.vol_id = self.connection_info['data']['volume_id']
         self.host_uuid = host_uuid
         self.vm_uuid = vm_uuid
+        self.mapping_acc = mapping_acc
 
         super(DisconnectVolume, self).__init__(name='disconnect_vol_%s' %
-                                               self.vol_id)
+                                               self.vol_id,
+                                               requires=['lpar_id'])
 
-    def execute(self):
+    def execute(self, lpar_id):
         LOG.info(_LI('Disconnecting volume %(vol)s from instance %(inst)s') %
                  {'vol': self.vol_id, 'inst': self.instance.name})
         return self.vol_drv.disconnect_volume(self.adapter, self.host_uuid,
                                               self.vm_uuid, self.instance,
-                                              self.connection_info)
+                                              self.connection_info,
+                                              mapping_acc=self.mapping_acc,
+                                              lpar_id=lpar_id)
 
-    def revert(self, result, flow_failures):
+    def revert(self, lpar_id, result, flow_failures):
         # The parameters have to match the execute method, plus the response +
         # failures even if only a subset are used.
         if result is None or isinstance(result, task_fail.Failure):
@@ -124,7 +139,44 @@ class DisconnectVolume(task.Task):
                  {'vol': self.vol_id, 'inst': self.instance.name})
         return self.vol_drv.connect_volume(self.adapter, self.host_uuid,
                                            self.vm_uuid, self.instance,
-                                           self.connection_info)
+                                           self.connection_info,
+                                           lpar_id=lpar_id)
+
+
+class ApplyVolumeMappings(task.Task):
+    """The task to send the volume mappings queued for an instance."""
+
+    def __init__(self, mapping_acc, instance, batch=False):
+        """Create the task.
+
+        Follows the ConnectVolume, DisconnectVolume, ConnectDisk or
+        CreateAndConnectCfgDrive tasks that queued their mappings on the
+        accumulator.
+
+        :param mapping_acc: The VscsiMappingAccumulator holding the mappings.
+        :param instance: The nova instance.
+        :param batch: If True, the mappings are sent along with those of the
+                      other instances being spawned at the same time.
+        """
+        self.mapping_acc = mapping_acc
+        self.instance = instance
+        self.batch = batch
+        super(ApplyVolumeMappings, self).__init__(name='apply_vol_mappings')
+
+    def execute(self):
+        LOG.info(_LI('Updating the volume mappings for instance %s') %
+                 self.instance.name)
+        if self.batch:
+            self.mapping_acc.apply_batched()
+        else:
+            self.mapping_acc.apply()
+
+    def revert(self, result, flow_failures):
+        # Also called if apply itself failed part way through.  The rollback
+        # only undoes the VIOSes that were updated.
+        LOG.warn(_LW('Rolling back the volume mappings for instance %s') %
+                 self.instance.name)
+        self.mapping_acc.rollback()
 
 
 class CreateDiskForImg(task.Task):
@@ -174,10 +226,38 @@ class CreateDiskForImg(task.Task):
         self.disk_dvr.delete_disks(self.context, self.instance, [result])
 
 
+class FindDisk(task.Task):
+    """The Task to find an existing disk of the instance in the storage."""
+
+    def __init__(self, disk_dvr, context, instance,
+                 disk_type=disk_dvr.DiskType.BOOT):
+        """Create the Task.
+
+        Provides the 'disk_dev_info' for other tasks.  Comes from the disk_dvr
+        get_disk method.
+
+        :param disk_dvr: The storage driver.
+        :param context: The context passed into the driver method.
+        :param instance: The nova instance.
+        :param disk_type: The disk type. See disk/driver.py
+        """
+        super(FindDisk, self).__init__(name='find_disk',
+                                       provides='disk_dev_info')
+        self.disk_dvr = disk_dvr
+        self.context = context
+        self.instance = instance
+        self.disk_type = disk_type
+
+    def execute(self):
+        LOG.info(_LI('Finding disk for instance: %s') % self.instance.name)
+        return self.disk_dvr.get_disk(self.context, self.instance,
+                                      disk_type=self.disk_type)
+
+
 class ConnectDisk(task.Task):
     """The task to connect the disk to the instance."""
 
-    def __init__(self, disk_dvr, context, instance):
+    def __init__(self, disk_dvr, context, instance, mapping_acc=None):
         """Create the Task for the connect disk to instance method.
 
         Requires LPAR info through requirement of lpar_wrap.
@@ -188,6 +268,9 @@ class ConnectDisk(task.Task):
         :param disk_dvr: The disk driver.
         :param context: The context passed into the spawn method.
         :param instance: The nova instance.
+        :param mapping_acc: Optional VscsiMappingAccumulator to queue the
+                            mappings on.  An ApplyVolumeMappings task must
+                            follow in the flow.
         """
         super(ConnectDisk, self).__init__(name='connect_disk',
                                           requires=['lpar_wrap',
@@ -195,24 +278,29 @@ class ConnectDisk(task.Task):
         self.disk_dvr = disk_dvr
         self.context = context
         self.instance = instance
+        self.mapping_acc = mapping_acc
 
     def execute(self, lpar_wrap, disk_dev_info):
         LOG.info(_LI('Connecting disk to instance: %s') % self.instance.name)
+        if self.mapping_acc is not None:
+            self.mapping_acc.set_lpar_id(lpar_wrap.uuid, lpar_wrap.id)
         self.disk_dvr.connect_disk(self.context, self.instance, disk_dev_info,
-                                   lpar_wrap.uuid)
+                                   lpar_wrap.uuid,
+                                   mapping_acc=self.mapping_acc)
 
     def revert(self, lpar_wrap, disk_dev_info, result, flow_failures):
         LOG.warn(_LW('Disk image being disconnected from instance %s') %
                  self.instance.name)
         self.disk_dvr.disconnect_image_disk(self.context, self.instance,
-                                            lpar_wrap.uuid)
+                                            lpar_wrap.uuid,
+                                            lpar_id=lpar_wrap.id)
 
 
 class CreateAndConnectCfgDrive(task.Task):
     """The task to create the configuration drive."""
 
     def __init__(self, adapter, host_uuid, instance, injected_files,
-                 network_info, admin_pass):
+                 network_info, admin_pass, mapping_acc=None):
         """Create the Task that create and connect the config drive.
 
         Requires the 'lpar_wrap'.
@@ -226,6 +314,9 @@ class CreateAndConnectCfgDrive(task.Task):
                                the ISO.
         :param network_info: The network_info from the nova spawn method.
         :param admin_pass: Optional password to inject for the VM.
+        :param mapping_acc: Optional VscsiMappingAccumulator to queue the
+                            mapping on.  An ApplyVolumeMappings task must
+                            follow in the flow.
         """
         super(CreateAndConnectCfgDrive, self).__init__(name='cfg_drive',
                                                        requires=['lpar_wrap'])
@@ -235,15 +326,19 @@ class CreateAndConnectCfgDrive(task.Task):
         self.injected_files = injected_files
         self.network_info = network_info
         self.ad_pass = admin_pass
+        self.mapping_acc = mapping_acc
         self.mb = None
 
     def execute(self, lpar_wrap):
         LOG.info(_LI('Creating Config Drive for instance: %s') %
                  self.instance.name)
         self.mb = media.ConfigDrivePowerVM(self.adapter, self.host_uuid)
+        if self.mapping_acc is not None:
+            self.mapping_acc.set_lpar_id(lpar_wrap.uuid, lpar_wrap.id)
         self.mb.create_cfg_drv_vopt(self.instance, self.injected_files,
                                     self.network_info, lpar_wrap.uuid,
-                                    admin_pass=self.ad_pass)
+                                    admin_pass=self.ad_pass,
+                                    mapping_acc=self.mapping_acc)
 
     def revert(self, lpar_wrap, result, flow_failures):
         # The parameters have to match the execute method, plus the response +
@@ -253,8 +348,13 @@ class CreateAndConnectCfgDrive(task.Task):
         if self.mb is None:
             return
 
-        # Delete the virtual optical media
-        self.mb.dlt_vopt(lpar_wrap.uuid)
+        # Delete the virtual optical media, with its mapping if there is one
+        self.mb.dlt_vopt(lpar_wrap.uuid, lpar_id=lpar_wrap.id)
+
+        # A mapping queued on the accumulator may never have been added, or
+        # already been rolled back by ApplyVolumeMappings.  The media is then
+        # not found from the mappings, so it is deleted by name.
+        self.mb.dlt_created_vopt()
 
 
 class DeleteVOpt(task.Task):
@@ -263,22 +363,51 @@ class DeleteVOpt(task.Task):
     def __init__(self, adapter, host_uuid, instance, lpar_uuid):
         """Creates the Task to delete the instances virtual optical media.
 
+        Requires the partition ID of the VM through requirement of lpar_id.
+
         :param adapter: The adapter for the pypowervm API
         :param host_uuid: The host UUID of the system.
         :param instance: The nova instance.
         :param lpar_uuid: The UUID of the lpar that has media.
         """
-        super(DeleteVOpt, self).__init__(name='vopt_delete')
+        super(DeleteVOpt, self).__init__(name='vopt_delete',
+                                         requires=['lpar_id'])
         self.adapter = adapter
         self.host_uuid = host_uuid
         self.instance = instance
         self.lpar_uuid = lpar_uuid
 
-    def execute(self):
+    def execute(self, lpar_id):
         LOG.info(_LI('Deleting Virtual Optical Media for instance %s')
                  % self.instance.name)
         media_builder = media.ConfigDrivePowerVM(self.adapter, self.host_uuid)
-        media_builder.dlt_vopt(self.lpar_uuid)
+        media_builder.dlt_vopt(self.lpar_uuid, lpar_id=lpar_id)
+
+
+class ExtendDisk(task.Task):
+    """The task to extend a disk of the instance."""
+
+    def __init__(self, disk_dvr, context, instance, disk_info, size):
+        """Creates the Task to extend a disk.
+
+        :param disk_dvr: The DiskAdapter for the VM.
+        :param context: The nova context.
+        :param instance: The nova instance.
+        :param disk_info: Dictionary with the type of the disk to extend.
+        :param size: The new size in GB.
+        """
+        super(ExtendDisk, self).__init__(name='extend_disk')
+        self.disk_dvr = disk_dvr
+        self.context = context
+        self.instance = instance
+        self.disk_info = disk_info
+        self.size = size
+
+    def execute(self):
+        LOG.info(_LI('Extending disk of instance %(inst)s to %(size)d GB.') %
+                 {'inst': self.instance.name, 'size': self.size})
+        self.disk_dvr.extend_disk(self.context, self.instance, self.disk_info,
+                                  self.size)
 
 
 class DetachDisk(task.Task):
@@ -291,6 +420,8 @@ class DetachDisk(task.Task):
         Provides the stor_adpt_mappings.  A list of pypowervm
         VSCSIMappings or VFCMappings (depending on the storage adapter).
 
+        Requires the partition ID of the VM through requirement of lpar_id.
+
         :param disk_dvr: The DiskAdapter for the VM.
         :param context: The nova context.
         :param instance: The nova instance.
@@ -298,19 +429,21 @@ class DetachDisk(task.Task):
         :param disk_type: List of disk types to detach. None means detach all.
         """
         super(DetachDisk, self).__init__(name='detach_storage',
-                                         provides='stor_adpt_mappings')
+                                         provides='stor_adpt_mappings',
+                                         requires=['lpar_id'])
         self.disk_dvr = disk_dvr
         self.context = context
         self.instance = instance
         self.lpar_uuid = lpar_uuid
         self.disk_type = disk_type
 
-    def execute(self):
+    def execute(self, lpar_id):
         LOG.info(_LI('Detaching disk storage adapters for instance %s')
                  % self.instance.name)
         return self.disk_dvr.disconnect_image_disk(self.context, self.instance,
                                                    self.lpar_uuid,
-                                                   disk_type=self.disk_type)
+                                                   disk_type=self.disk_type,
+                                                   lpar_id=lpar_id)
 
 
 class DeleteDisk(task.Task):
@@ -16,7 +16,6 @@
 
 from nova.i18n import _LI
 from nova.i18n import _LW
-from pypowervm.tasks import power
 
 from oslo_log import log as logging
 from taskflow import task
@@ -49,10 +48,34 @@ class Get(task.Task):
                                        self.host_uuid)
 
 
+class GetPartitionID(task.Task):
+    """The task for getting the short partition ID of a VM."""
+
+    def __init__(self, adapter, lpar_uuid, instance):
+        """Creates the Task for getting the partition ID of a VM.
+
+        Provides the 'lpar_id' for other tasks, so that the storage tasks of
+        a flow do not each have to look it up.
+
+        :param adapter: The adapter for the pypowervm API
+        :param lpar_uuid: The VM's PowerVM UUID.
+        :param instance: The nova instance.
+        """
+        super(GetPartitionID, self).__init__(name='get_lpar_id',
+                                             provides='lpar_id')
+        self.adapter = adapter
+        self.lpar_uuid = lpar_uuid
+        self.instance = instance
+
+    def execute(self):
+        return vm.get_vm_id(self.adapter, self.lpar_uuid)
+
+
 class Create(task.Task):
     """The task for creating a VM."""
 
-    def __init__(self, adapter, host_wrapper, instance, flavor):
+    def __init__(self, adapter, host_wrapper, instance, flavor,
+                 warm_pool=None):
         """Creates the Task for creating a VM.
 
         Provides the 'lpar_wrap' for other tasks.
@@ -61,6 +84,9 @@ class Create(task.Task):
         :param host_wrapper: The managed system wrapper
         :param instance: The nova instance.
         :param flavor: The nova flavor.
+        :param warm_pool: (Optional) The WarmPool to take the LPAR from.  A
+                          new LPAR is only created if the pool has none for
+                          the flavor.
         """
         super(Create, self).__init__(name='crt_lpar',
                                      provides='lpar_wrap')
@@ -68,9 +94,14 @@ class Create(task.Task):
         self.host_wrapper = host_wrapper
         self.instance = instance
         self.flavor = flavor
+        self.warm_pool = warm_pool
 
     def execute(self):
         LOG.info(_LI('Creating instance: %s') % self.instance.name)
+        if self.warm_pool is not None:
+            wrap = self.warm_pool.claim(self.instance, self.flavor)
+            if wrap is not None:
+                return wrap
         wrap = vm.crt_lpar(self.adapter, self.host_wrapper, self.instance,
                            self.flavor)
         return wrap
@@ -121,7 +152,8 @@ class PowerOn(task.Task):
 
     def execute(self, lpar_wrap):
         LOG.info(_LI('Powering on instance: %s') % self.instance.name)
-        power.power_on(lpar_wrap, self.host_uuid, add_parms=self.pwr_opts)
+        vm.start_lpar(self.adapter, lpar_wrap, self.host_uuid,
+                      add_parms=self.pwr_opts)
 
     def revert(self, lpar_wrap, result, flow_failures):
         LOG.info(_LI('Powering off instance: %s') % self.instance.name)
@@ -131,7 +163,7 @@ class PowerOn(task.Task):
             LOG.debug('Power on failed.  Not performing power off.')
             return
 
-        power.power_off(lpar_wrap, self.host_uuid, force_immediate=True)
+        vm.stop_lpar_immediate(self.adapter, lpar_wrap, self.host_uuid)
 
 
 class PowerOff(task.Task):
@@ -155,7 +187,7 @@ class PowerOff(task.Task):
         LOG.info(_LI('Powering off instance %s.')
                  % self.instance.name)
         vm.power_off(self.adapter, self.instance, self.host_uuid,
-                     add_parms=dict(immediate='true'))
+                     force_immediate=True)
 
 
 class Delete(task.Task):
@@ -14,6 +14,9 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import threading
+import time
+
 from oslo_config import cfg
 from oslo_log import log as logging
 
@@ -33,6 +36,152 @@ VALID_RMC_STATES = [pvm_bp.RMCState.ACTIVE, pvm_bp.RMCState.BUSY]
 # Only a running state is OK for now.
 VALID_VM_STATES = [pvm_bp.LPARState.RUNNING]
 
+_HTTP_NOT_MODIFIED = 304
+
+# The VIOS feeds read through get_vios_feed.  Keyed by the host UUID and the
+# extended attribute groups of the read.  The dict and the invalidation state
+# of its entries are guarded by _feed_lock, which is never held across a read.
+_feed_cache = {}
+_feed_lock = threading.Lock()
+
+
+class _CachedFeed(object):
+    """A VIOS feed for one host and set of extended attribute groups."""
+
+    def __init__(self, etag, vioses):
+        # The etag of the feed.  None if it no longer matches the wrappers.
+        self.etag = etag
+        self.vioses = vioses
+        self.read_time = time.time()
+
+
+class _FeedEntry(object):
+    """The cached feed for a key and the state of its reads."""
+
+    def __init__(self):
+        # Serializes the reads of this key only, so that callers waiting on
+        # the same feed share one read while other feeds are read at the
+        # same time.
+        self.read_lock = threading.Lock()
+        self.feed = None
+        # The UUIDs of the VIOSes changed since they were read.
+        self.stale_uuids = set()
+        # Counts the invalidations, so a read can tell whether the feed
+        # changed while it ran.
+        self.generation = 0
+
+
+def get_vios_feed(adapter, host_uuid, xag=None):
+    """Returns the Virtual I/O Server wrappers for a host.
+
+    The feed is cached per host and per set of extended attribute groups.  It
+    is reused for up to vios_feed_cache_time seconds.  After that it is
+    reread, which is cheap if the feed's etag shows it has not changed.  A
+    VIOS passed to invalidate_vios_feed is reread on its own on the next
+    call.
+
+    The wrappers are shared with other callers and must not be modified.  To
+    change a VIOS, read it fresh.  None of the driver's callers update these
+    wrappers; the mapping changes all work on a VIOS read for the update.
+
+    :param adapter: The pypowervm adapter for the query.
+    :param host_uuid: The host servers UUID.
+    :param xag: Optional list of extended attributes to use.  If not passed
+                in defaults to None.
+    :return: List of VIOS wrappers.
+    """
+    key = (host_uuid, tuple(sorted(xag)) if xag else ())
+    with _feed_lock:
+        entry = _feed_cache.get(key)
+        if entry is None:
+            entry = _FeedEntry()
+            if CONF.vios_feed_cache_time > 0:
+                _feed_cache[key] = entry
+
+    with entry.read_lock:
+        with _feed_lock:
+            feed = entry.feed
+            stale_uuids = set(entry.stale_uuids)
+            generation = entry.generation
+
+        if (feed is None or
+                time.time() - feed.read_time >= CONF.vios_feed_cache_time):
+            feed = _read_feed(adapter, host_uuid, xag, feed, stale_uuids)
+        elif stale_uuids:
+            feed = _refresh_vioses(adapter, host_uuid, xag, feed,
+                                   stale_uuids)
+
+        with _feed_lock:
+            if entry.generation == generation:
+                entry.feed = feed
+                entry.stale_uuids.clear()
+            elif entry.feed is not None:
+                # Only some VIOSes were invalidated during the read.  Keep
+                # the result, but leave them to be reread next time.
+                entry.feed = feed
+        return list(feed.vioses)
+
+
+def _read_feed(adapter, host_uuid, xag, feed, stale_uuids):
+    """Reads the VIOS feed, reusing the cached feed if it has not changed."""
+    if feed is not None and feed.etag is not None and not stale_uuids:
+        resp = adapter.read(pvm_ms.System.schema_type, root_id=host_uuid,
+                            child_type=pvm_vios.VIOS.schema_type,
+                            xag=xag, etag=feed.etag)
+        if resp.status == _HTTP_NOT_MODIFIED:
+            return _CachedFeed(feed.etag, feed.vioses)
+    else:
+        resp = adapter.read(pvm_ms.System.schema_type, root_id=host_uuid,
+                            child_type=pvm_vios.VIOS.schema_type, xag=xag)
+    return _CachedFeed(resp.etag, pvm_vios.VIOS.wrap(resp))
+
+
+def _refresh_vioses(adapter, host_uuid, xag, feed, stale_uuids):
+    """Rereads only the VIOSes in the feed that were invalidated."""
+    vioses = list(feed.vioses)
+    try:
+        for idx, vio in enumerate(vioses):
+            if vio.uuid not in stale_uuids:
+                continue
+            resp = adapter.read(pvm_vios.VIOS.schema_type, root_id=vio.uuid,
+                                xag=xag, etag=vio.etag)
+            if resp.status != _HTTP_NOT_MODIFIED:
+                vioses[idx] = pvm_vios.VIOS.wrap(resp)
+    except Exception as e:
+        # The VIOS may have gone away.  Start over with the whole feed.
+        LOG.debug('Unable to refresh a Virtual I/O Server in the feed, '
+                  'rereading the feed: %s' % e)
+        return _read_feed(adapter, host_uuid, xag, None, stale_uuids)
+
+    # The feed's etag does not cover the reread VIOSes.
+    refreshed = _CachedFeed(None, vioses)
+    refreshed.read_time = feed.read_time
+    return refreshed
+
+
+def invalidate_vios_feed(host_uuid=None, vios_uuid=None):
+    """Marks cached VIOS feeds as out of date.
+
+    Must be called after the driver changes a VIOS (for example its
+    mappings), so later reads of the feed see the change.  A read of the feed
+    that is running at the time does not cache what it read over the change.
+
+    :param host_uuid: The host whose feeds are out of date.  If None, the
+                      feeds for all hosts.
+    :param vios_uuid: The VIOS that changed.  If None, the whole feed is
+                      dropped.  Otherwise only that VIOS is reread.
+    """
+    with _feed_lock:
+        for key, entry in _feed_cache.items():
+            if host_uuid is not None and key[0] != host_uuid:
+                continue
+            entry.generation += 1
+            if vios_uuid is None:
+                entry.feed = None
+                entry.stale_uuids.clear()
+            else:
+                entry.stale_uuids.add(vios_uuid)
+
 
 def get_active_vioses(adapter, host_uuid, xag=None):
     """Returns a list of active Virtual I/O Server Wrappers for a host.
@@ -45,10 +194,7 @@ def get_active_vioses(adapter, host_uuid, xag=None):
                 in defaults to None.
     :return: List of VIOS wrappers.
     """
-    vio_feed_resp = adapter.read(pvm_ms.System.schema_type, root_id=host_uuid,
-                                 child_type=pvm_vios.VIOS.schema_type,
-                                 xag=xag)
-    wrappers = pvm_vios.VIOS.wrap(vio_feed_resp)
+    wrappers = get_vios_feed(adapter, host_uuid, xag=xag)
     return [vio for vio in wrappers if is_vios_active(vio)]
 
 
@@ -65,10 +211,8 @@ def is_vios_active(vios):
 
 def get_physical_wwpns(adapter, ms_uuid):
     """Returns the active WWPNs of the FC ports across all VIOSes on system."""
-    resp = adapter.read(pvm_ms.System.schema_type, root_id=ms_uuid,
-                        child_type=pvm_vios.VIOS.schema_type,
-                        xag=[pvm_vios.VIOS.xags.STORAGE])
-    vios_feed = pvm_vios.VIOS.wrap(resp)
+    vios_feed = get_vios_feed(adapter, ms_uuid,
+                              xag=[pvm_vios.VIOS.xags.STORAGE])
     wwpn_list = []
     for vios in vios_feed:
         wwpn_list.extend(vios.get_active_pfc_wwpns())
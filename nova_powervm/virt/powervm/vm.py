@@ -14,6 +14,8 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+from eventlet import greenpool
+import functools
 import json
 
 from oslo_config import cfg
@@ -21,18 +23,23 @@ from oslo_log import log as logging
 
 from nova.compute import power_state
 from nova import exception
-from nova.i18n import _LI, _LE
+from nova.i18n import _LI, _LE, _LW
 from nova.virt import hardware
+from pypowervm import const as pvm_const
 from pypowervm import exceptions as pvm_exc
 from pypowervm.tasks import cna
-from pypowervm.tasks import power
 from pypowervm.tasks import vterm
 from pypowervm.utils import lpar_builder as lpar_bldr
 from pypowervm.wrappers import base_partition as pvm_bp
+from pypowervm.wrappers import job as pvm_job
 from pypowervm.wrappers import logical_partition as pvm_lpar
 from pypowervm.wrappers import managed_system as pvm_ms
 from pypowervm.wrappers import network as pvm_net
 
+import six
+
+from nova_powervm.virt.powervm import jobs
+
 LOG = logging.getLogger(__name__)
 CONF = cfg.CONF
 
@@ -93,11 +100,37 @@ ATTRS_MAP = {
     'powervm:availability_priority': 'avail_priority'
 }
 
+# Job error codes for a VM that is already in the requested power state.
+_ALREADY_POWERED_ON_ERRS = ['HSCL3681']
+_ALREADY_POWERED_OFF_ERRS = ['HSCL1558']
+
+# Error codes of an LPAR delete that failed because its console is open.
+_VTERM_OPEN_ERRS = ['HSCL151B']
+# The UUIDs of the LPARs whose console this driver has opened.
+_open_vterms = set()
+
+# The validated LPAR builder attributes of each flavor (or an _InvalidFlavor),
+# by flavor and extra specs.  Flavors are few and rarely change, so they are
+# only validated on first use.
+_flavor_attrs = {}
+
+
+class _InvalidFlavor(object):
+    """A flavor that failed validation, by the attribute that failed."""
+
+    def __init__(self, attr):
+        self.attr = attr
+
+
 # Attributes for secure RMC
 # TODO(thorst) The name of the secure RMC vswitch will change.
 SECURE_RMC_VSWITCH = 'MGMT'
 SECURE_RMC_VLAN = 4094
 
+# The secure RMC vSwitch of each host, by host UUID.  Only a vSwitch that was
+# found is kept, so a host without one is read again on the next lookup.
+_secure_rmc_vswitches = {}
+
 
 def _translate_vm_state(pvm_state):
     """Find the current state of the lpar and convert it to
@@ -235,15 +268,63 @@ def _build_attrs(instance, flavor):
     """Builds LPAR attributes that are used by the LPAR builder.
 
     This method translates instance and flavor values to those
-    that can be used by the LPAR builder.
+    that can be used by the LPAR builder.  The flavor values are only
+    validated the first time the flavor is used.
 
     :param instance: the VM instance
     :param flavor: the instance flavor
     :returns: a dict that can be used by the LPAR builder
     """
+    return _build_named_attrs(instance.name, flavor)
+
+
+def _build_named_attrs(name, flavor):
+    """Builds the LPAR builder attributes for an LPAR name and flavor.
+
+    :param name: the LPAR name
+    :param flavor: the instance flavor
+    :returns: a dict that can be used by the LPAR builder
+    """
+    key = (flavor.flavorid, frozenset(six.iteritems(flavor.extra_specs)),
+           flavor.memory_mb, flavor.vcpus)
+    flavor_attrs = _flavor_attrs.get(key)
+    if flavor_attrs is None:
+        try:
+            flavor_attrs = _build_flavor_attrs(flavor)
+        except exception.InvalidAttribute as e:
+            flavor_attrs = _InvalidFlavor(e.kwargs['attr'])
+        _flavor_attrs[key] = flavor_attrs
+
+    # A flavor that failed validation fails every use, but was only logged
+    # the first time.  Each use gets its own exception.
+    if isinstance(flavor_attrs, _InvalidFlavor):
+        raise exception.InvalidAttribute(attr=flavor_attrs.attr)
+
+    attrs = dict(flavor_attrs)
+    attrs[lpar_bldr.NAME] = name
+    return attrs
+
+
+def get_flavor_attrs(flavor):
+    """Returns the LPAR builder attributes of a flavor, without the name.
+
+    :param flavor: the instance flavor
+    :returns: a dict of the attributes
+    :raises InvalidAttribute: If the flavor is not valid.
+    """
+    attrs = _build_named_attrs(None, flavor)
+    del attrs[lpar_bldr.NAME]
+    return attrs
+
+
+def _build_flavor_attrs(flavor):
+    """Builds the LPAR builder attributes of a flavor.
+
+    :param flavor: the instance flavor
+    :returns: a dict that can be used by the LPAR builder, without the name
+    """
     attrs = {}
 
-    attrs[lpar_bldr.NAME] = instance.name
     attrs[lpar_bldr.MEM] = flavor.memory_mb
     attrs[lpar_bldr.VCPU] = flavor.vcpus
 
@@ -337,11 +418,23 @@ def _crt_lpar_builder(adapter, host_wrapper, instance, flavor):
     """
 
     attrs = _build_attrs(instance, flavor)
-    stdz = lpar_bldr.DefaultStandardize(
-        host_wrapper, proc_units_factor=CONF.proc_units_factor)
+    stdz = _get_standardize(host_wrapper)
     return lpar_bldr.LPARBuilder(adapter, attrs, stdz)
 
 
+def _get_standardize(host_wrapper):
+    """Returns a new LPAR builder standardizer for a host.
+
+    A standardizer holds the attributes of the builder it is given to, so
+    each builder gets its own.  They are cheap to build.
+
+    :param host_wrapper: The host wrapper
+    :returns: The DefaultStandardize of the host.
+    """
+    return lpar_bldr.DefaultStandardize(
+        host_wrapper, proc_units_factor=CONF.proc_units_factor)
+
+
 def crt_lpar(adapter, host_wrapper, instance, flavor):
     """Create an LPAR based on the host based on the instance
 
@@ -361,6 +454,42 @@ def crt_lpar(adapter, host_wrapper, instance, flavor):
     return lpar_w
 
 
+def crt_lpar_shell(adapter, host_wrapper, name, flavor):
+    """Create an LPAR for a flavor that is not yet tied to an instance.
+
+    :param adapter: The adapter for the pypowervm API
+    :param host_wrapper: The host wrapper
+    :param name: The name of the LPAR.
+    :param flavor: The nova flavor.
+    :returns: The LPAR wrapper.
+    """
+    attrs = _build_named_attrs(name, flavor)
+    bldr = lpar_bldr.LPARBuilder(adapter, attrs,
+                                 _get_standardize(host_wrapper))
+    return bldr.build().create(parent_type=pvm_ms.System,
+                               parent_uuid=host_wrapper.uuid)
+
+
+def rename(adapter, host_uuid, instance, lpar_uuid):
+    """Renames an LPAR after an instance and makes it that instance's LPAR.
+
+    :param adapter: The adapter for the pypowervm API
+    :param host_uuid: The host UUID
+    :param instance: The nova instance.
+    :param lpar_uuid: The UUID of the LPAR.
+    :returns: The updated LPAR wrapper.
+    """
+    resp = adapter.read(pvm_ms.System.schema_type, root_id=host_uuid,
+                        child_type=pvm_lpar.LPAR.schema_type,
+                        child_id=lpar_uuid)
+    lpar_w = pvm_lpar.LPAR.wrap(resp)
+    lpar_w.name = instance.name
+    lpar_w = lpar_w.update()
+    # Add the uuid to the cache.
+    UUIDCache.get_cache().add(instance.name, lpar_w.uuid)
+    return lpar_w
+
+
 def update(adapter, host_wrapper, instance, flavor, entry=None):
     """Update an LPAR based on the host based on the instance
 
@@ -381,29 +510,156 @@ def update(adapter, host_wrapper, instance, flavor, entry=None):
     entry.update()
 
 
+def resize(adapter, host_wrapper, instance, flavor):
+    """Changes an LPAR to match a new flavor.
+
+    The LPAR is only powered off if the change can not be made while it
+    runs.  A running LPAR keeps running if only its desired processors,
+    processor units or memory change, within its current minimums and
+    maximums, and it can take the change through DLPAR.
+
+    :param adapter: The adapter for the pypowervm API
+    :param host_wrapper: The host wrapper
+    :param instance: The nova instance.
+    :param flavor: The new nova flavor.
+    :returns: True if the LPAR was powered off for the change.
+    """
+    entry = get_instance_wrapper(adapter, instance, host_wrapper.uuid)
+    old = _resize_profile(entry)
+    _crt_lpar_builder(adapter, host_wrapper, instance, flavor).rebuild(entry)
+    new = _resize_profile(entry)
+    if old == new:
+        LOG.info(_LI('Instance %s already matches the flavor.'),
+                 instance.name, instance=instance)
+        return False
+
+    pwrd = False
+    if not _dlpar_capable(entry, old, new):
+        pwrd = power_off(adapter, instance, host_wrapper.uuid, entry=entry)
+        # The power off changed the etag, so the change goes on a new read.
+        if pwrd:
+            entry = get_instance_wrapper(adapter, instance, host_wrapper.uuid)
+            _crt_lpar_builder(adapter, host_wrapper, instance,
+                              flavor).rebuild(entry)
+
+    # Write out the new specs
+    entry.update()
+    return pwrd
+
+
+def _resize_profile(lpar_w):
+    """Returns the settings of an LPAR that a resize can change.
+
+    :param lpar_w: The LPAR wrapper.
+    :returns: A dict of the settings.  The memory, processors and processor
+              units are (min, desired, max) tuples.
+    """
+    mem_cfg = lpar_w.mem_config
+    proc_cfg = lpar_w.proc_config
+    profile = {'mem': (mem_cfg.min, mem_cfg.desired, mem_cfg.max),
+               'dedicated': proc_cfg.has_dedicated,
+               'sharing_mode': proc_cfg.sharing_mode}
+    if proc_cfg.has_dedicated:
+        ded_cfg = proc_cfg.dedicated_proc_cfg
+        profile['procs'] = (ded_cfg.min, ded_cfg.desired, ded_cfg.max)
+    else:
+        shr_cfg = proc_cfg.shared_proc_cfg
+        profile['procs'] = (shr_cfg.min_virtual, shr_cfg.desired_virtual,
+                            shr_cfg.max_virtual)
+        profile['proc_units'] = (shr_cfg.min_units, shr_cfg.desired_units,
+                                 shr_cfg.max_units)
+        profile['uncapped_weight'] = shr_cfg.uncapped_weight
+    return profile
+
+
+def _dlpar_capable(lpar_w, old, new):
+    """Returns whether a resize can be made without powering off the LPAR.
+
+    :param lpar_w: The LPAR wrapper, as it was before the resize.
+    :param old: The _resize_profile of the LPAR before the resize.
+    :param new: The _resize_profile of the LPAR after the resize.
+    """
+    for key in set(old) | set(new):
+        if old.get(key) == new.get(key):
+            continue
+        if key not in ('mem', 'procs', 'proc_units'):
+            return False
+
+        # Only the desired value may change, within the current range.
+        old_min, old_des, old_max = old[key]
+        new_min, new_des, new_max = new[key]
+        if (old_min, old_max) != (new_min, new_max):
+            return False
+        if not old_min <= new_des <= old_max:
+            return False
+
+        capable, reason = (lpar_w.can_modify_mem() if key == 'mem' else
+                           lpar_w.can_modify_proc())
+        if not capable:
+            LOG.debug('LPAR %(lpar)s must be powered off for the resize: '
+                      '%(reason)s', {'lpar': lpar_w.name, 'reason': reason})
+            return False
+    return True
+
+
 def dlt_lpar(adapter, lpar_uuid):
     """Delete an LPAR
 
+    The console of the LPAR is only closed first if this driver opened it.
+    A console opened some other way fails the delete, which is then retried
+    once the console is closed.
+
     :param adapter: The adapter for the pypowervm API
     :param lpar_uuid: The lpar to delete
     """
-    # Attempt to delete the VM. If delete fails because of vterm
-    # we will close the vterm and try the delete again
-    try:
-        LOG.info(_LI('Deleting virtual machine. LPARID: %s'), lpar_uuid)
-        # Ensure any vterms are closed.  Will no-op otherwise.
+    LOG.info(_LI('Deleting virtual machine. LPARID: %s'), lpar_uuid)
+    if lpar_uuid in _open_vterms:
         vterm.close_vterm(adapter, lpar_uuid)
 
-        # Run the LPAR delete
-        resp = adapter.delete(pvm_lpar.LPAR.schema_type, root_id=lpar_uuid)
-        LOG.info(_LI('Virtual machine delete status: %d'), resp.status)
-        return resp
+    try:
+        try:
+            # Run the LPAR delete
+            resp = adapter.delete(pvm_lpar.LPAR.schema_type,
+                                  root_id=lpar_uuid)
+        except pvm_exc.Error as e:
+            if not _vterm_open(e):
+                raise
+            LOG.info(_LI('Virtual machine %s has an open console.  Closing '
+                         'it and deleting again.'), lpar_uuid)
+            vterm.close_vterm(adapter, lpar_uuid)
+            resp = adapter.delete(pvm_lpar.LPAR.schema_type,
+                                  root_id=lpar_uuid)
     except pvm_exc.Error:
-        # Attempting to close vterm did not help so raise exception
         LOG.error(_LE('Virtual machine delete failed: LPARID=%s'),
                   lpar_uuid)
         raise
 
+    _open_vterms.discard(lpar_uuid)
+    LOG.info(_LI('Virtual machine delete status: %d'), resp.status)
+    return resp
+
+
+def _vterm_open(error):
+    """Returns whether a failed LPAR delete was due to an open console."""
+    resp = getattr(error, 'response', None)
+    body = getattr(resp, 'body', None) or ''
+    return any(code in body for code in _VTERM_OPEN_ERRS)
+
+
+def open_vnc_vterm(adapter, lpar_uuid, bind_ip):
+    """Opens the VNC console of an LPAR.
+
+    The console is recorded as open, so that it is closed before the LPAR
+    is deleted.
+
+    :param adapter: The adapter for the pypowervm API
+    :param lpar_uuid: The UUID of the LPAR.
+    :param bind_ip: The IP address the VNC server listens on.
+    :returns: The VNC port of the console.
+    """
+    _open_vterms.add(lpar_uuid)
+    return vterm.open_vnc_vterm(adapter, lpar_uuid, bind_ip=bind_ip)
+
 
 def power_on(adapter, instance, host_uuid, entry=None):
     if entry is None:
@@ -412,25 +668,201 @@ def power_on(adapter, instance, host_uuid, entry=None):
     # Get the current state and see if we can start the VM
     if entry.state in POWERVM_STARTABLE_STATE:
         # Now start the lpar
-        power.power_on(entry, host_uuid)
+        start_lpar(adapter, entry, host_uuid)
         return True
 
     return False
 
 
-def power_off(adapter, instance, host_uuid, entry=None, add_parms=None):
+def power_off(adapter, instance, host_uuid, entry=None,
+              force_immediate=False):
+    """Powers off a VM, if it is in a state that can be stopped.
+
+    See stop_lpar.
+
+    :param adapter: The pypowervm adapter.
+    :param instance: The nova instance.
+    :param host_uuid: The host UUID.
+    :param entry: Optional LPAR wrapper of the VM.  Read if not passed.
+    :param force_immediate: If True, the operating system is not asked to
+                            shut down first.
+    :return: True if the VM was powered off, False if it was not in a state
+             that can be stopped.
+    """
     if entry is None:
         entry = get_instance_wrapper(adapter, instance, host_uuid)
 
     # Get the current state and see if we can stop the VM
     if entry.state in POWERVM_STOPABLE_STATE:
         # Now stop the lpar
-        power.power_off(entry, host_uuid, add_parms=add_parms)
+        stop_lpar(adapter, entry, host_uuid, force_immediate=force_immediate)
         return True
 
     return False
 
 
+def start_lpar(adapter, lpar_w, host_uuid, add_parms=None):
+    """Runs the power on job of a VM.
+
+    The job is waited on through the job monitor of the host.
+
+    :param adapter: The pypowervm adapter.
+    :param lpar_w: The LPAR wrapper of the VM.
+    :param host_uuid: The host UUID.
+    :param add_parms: Optional dict of additional job parameters (ex.
+                      bootmode).
+    :raise VMPowerOnFailure: If the VM could not be powered on.
+    """
+    job_parms = [pvm_job.Job.create_job_parameter(key, str(value))
+                 for key, value in (add_parms or {}).items()]
+    try:
+        _run_power_job(adapter, lpar_w, host_uuid, 'PowerOn', job_parms)
+    except pvm_exc.JobRequestFailed as e:
+        emsg = six.text_type(e)
+        if any(code in emsg for code in _ALREADY_POWERED_ON_ERRS):
+            LOG.info(_LI('VM %s is already powered on.'), lpar_w.name)
+            return
+        raise pvm_exc.VMPowerOnFailure(lpar_nm=lpar_w.name, reason=emsg)
+
+
+def stop_lpar(adapter, lpar_w, host_uuid, force_immediate=False):
+    """Runs the power off jobs of a VM.
+
+    Unless force_immediate is set, the operating system is first asked to
+    shut down, through RMC if it is active and otherwise through the virtual
+    service processor.  If that fails, or does not finish in time, the VM is
+    powered off immediately.  The jobs are waited on through the job monitor
+    of the host.
+
+    :param adapter: The pypowervm adapter.
+    :param lpar_w: The LPAR wrapper of the VM.
+    :param host_uuid: The host UUID.
+    :param force_immediate: If True, only the immediate power off is run.
+    :raise VMPowerOffFailure: If the VM could not be powered off.
+    """
+    if not force_immediate:
+        operation = ('osshutdown'
+                     if lpar_w.rmc_state == pvm_bp.RMCState.ACTIVE
+                     else 'shutdown')
+        job_parms = [pvm_job.Job.create_job_parameter('operation',
+                                                      operation)]
+        try:
+            _run_power_job(adapter, lpar_w, host_uuid, 'PowerOff',
+                           job_parms)
+            return
+        except (pvm_exc.JobRequestFailed, pvm_exc.JobRequestTimedOut) as e:
+            emsg = six.text_type(e)
+            if any(code in emsg for code in _ALREADY_POWERED_OFF_ERRS):
+                LOG.info(_LI('VM %s is already powered off.'), lpar_w.name)
+                return
+            LOG.warn(_LW('Normal power off of VM %(lpar)s failed.  Powering '
+                         'it off immediately.  Error: %(error)s'),
+                     {'lpar': lpar_w.name, 'error': emsg})
+
+    stop_lpar_immediate(adapter, lpar_w, host_uuid)
+
+
+def stop_lpar_immediate(adapter, lpar_w, host_uuid):
+    """Runs an immediate power off job of a VM.
+
+    The operating system is not asked to shut down first.  The job is waited
+    on through the job monitor of the host.
+
+    :param adapter: The pypowervm adapter.
+    :param lpar_w: The LPAR wrapper of the VM.
+    :param host_uuid: The host UUID.
+    :raise VMPowerOffFailure: If the VM could not be powered off.
+    """
+    job_parms = [pvm_job.Job.create_job_parameter('operation', 'shutdown'),
+                 pvm_job.Job.create_job_parameter('immediate', 'true')]
+    try:
+        _run_power_job(adapter, lpar_w, host_uuid, 'PowerOff', job_parms)
+    except pvm_exc.JobRequestFailed as e:
+        emsg = six.text_type(e)
+        if any(code in emsg for code in _ALREADY_POWERED_OFF_ERRS):
+            LOG.info(_LI('VM %s is already powered off.'), lpar_w.name)
+            return
+        raise pvm_exc.VMPowerOffFailure(lpar_nm=lpar_w.name, reason=emsg)
+
+
+def _run_power_job(adapter, lpar_w, host_uuid, suffix, job_parms):
+    resp = adapter.read(pvm_lpar.LPAR.schema_type, root_id=lpar_w.uuid,
+                        suffix_type=pvm_const.SUFFIX_TYPE_DO,
+                        suffix_parm=suffix)
+    jobs.JobMonitor.get(adapter, host_uuid).run_job(
+        pvm_job.Job.wrap(resp.entry), lpar_w.uuid, pvm_lpar.LPAR.schema_type,
+        suffix, job_parms=job_parms)
+
+
+def power_on_many(adapter, instances, host_uuid):
+    """Powers on many VMs at once.
+
+    :param adapter: The pypowervm adapter.
+    :param instances: The nova instances to power on.
+    :param host_uuid: The host UUID.
+    :return: A list of (instance, exception) tuples in the order of
+             instances.  The exception is None for each VM that was powered
+             on or was already running.
+    """
+    return _power_many(adapter, instances, host_uuid, power_on)
+
+
+def power_off_many(adapter, instances, host_uuid, force_immediate=False):
+    """Powers off many VMs at once.
+
+    :param adapter: The pypowervm adapter.
+    :param instances: The nova instances to power off.
+    :param host_uuid: The host UUID.
+    :param force_immediate: If True, the operating systems are not asked to
+                            shut down first.
+    :return: A list of (instance, exception) tuples in the order of
+             instances.  The exception is None for each VM that was powered
+             off or was already stopped.
+    """
+    return _power_many(adapter, instances, host_uuid,
+                       functools.partial(power_off,
+                                         force_immediate=force_immediate))
+
+
+def _power_many(adapter, instances, host_uuid, power_func):
+    """Runs a power operation on many VMs, a limited number at a time.
+
+    :param adapter: The pypowervm adapter.
+    :param instances: The nova instances.
+    :param host_uuid: The host UUID.
+    :param power_func: power_on or power_off.
+    :return: A list of (instance, exception) tuples, see power_on_many.
+    """
+    # One LPAR feed has the state of every VM.  If it cannot be read, each
+    # VM is read on its own instead.
+    feed = get_lpar_feed(adapter, host_uuid)
+    lpar_wraps = None
+    if feed is not None:
+        lpar_wraps = {}
+        for entry in feed.entries:
+            lpar_w = pvm_lpar.LPAR.wrap(entry)
+            lpar_wraps[lpar_w.name] = lpar_w
+
+    def _run(instance):
+        entry = None
+        if lpar_wraps is not None:
+            entry = lpar_wraps.get(instance.name)
+            if entry is None:
+                return (instance,
+                        exception.InstanceNotFound(instance_id=instance.name))
+        try:
+            power_func(adapter, instance, host_uuid, entry=entry)
+            return (instance, None)
+        except Exception as e:
+            LOG.exception(_LE('Power operation failed for instance %(inst)s: '
+                              '%(error)s'),
+                          {'inst': instance.name, 'error': e})
+            return (instance, e)
+
+    pool = greenpool.GreenPool(size=max(CONF.power_op_concurrency, 1))
+    return list(pool.imap(_run, instances))
+
+
 def get_pvm_uuid(instance):
     """Get the corresponding PowerVM VM uuid of an instance uuid
 
@@ -484,7 +916,16 @@ def crt_secure_rmc_vif(adapter, instance, host_uuid):
     :param instance: The nova instance to create the VIF against.
     :param host_uuid: The host system UUID.
     """
-    lpar_uuid = get_pvm_uuid(instance)
+    crt_secure_rmc_cna(adapter, host_uuid, get_pvm_uuid(instance))
+
+
+def crt_secure_rmc_cna(adapter, host_uuid, lpar_uuid):
+    """Creates the Secure RMC Network Adapter on an LPAR.
+
+    :param adapter: The pypowervm adapter API interface.
+    :param host_uuid: The host system UUID.
+    :param lpar_uuid: The UUID of the LPAR.
+    """
     cna.crt_cna(adapter, host_uuid, lpar_uuid, SECURE_RMC_VLAN,
                 vswitch=SECURE_RMC_VSWITCH, crt_vswitch=True)
 
@@ -495,13 +936,19 @@ def get_secure_rmc_vswitch(adapter, host_uuid):
     :param adapter: The pypowervm adapter API interface.
     :param host_uuid: The host system UUID.
     :return: The wrapper for the secure RMC vSwitch.  If it does not exist
-             on the system, None is returned.
+             on the system, None is returned.  Once found, the vSwitch is
+             not read again.
     """
+    vswitch_w = _secure_rmc_vswitches.get(host_uuid)
+    if vswitch_w is not None:
+        return vswitch_w
+
     resp = adapter.read(pvm_ms.System.schema_type, root_id=host_uuid,
                         child_type=pvm_net.VSwitch.schema_type)
     vswitches = pvm_net.VSwitch.wrap(resp)
     for vswitch in vswitches:
         if vswitch.name == SECURE_RMC_VSWITCH:
+            _secure_rmc_vswitches[host_uuid] = vswitch
             return vswitch
     return None
 
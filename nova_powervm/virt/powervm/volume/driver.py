@@ -26,8 +26,24 @@ class PowerVMVolumeAdapter(object):
     This is built similarly to the LibvirtBaseVolumeDriver.
     """
 
+    # Whether connect_volume and disconnect_volume queue their mappings on
+    # the mapping_acc.  The volumes of adapters that do not are connected and
+    # disconnected one at a time.
+    queues_mappings = False
+
+    def init_host(self, adapter, host_uuid):
+        """Prepares the adapter for use when the compute driver starts.
+
+        Must not block on the REST API.  Anything slow is started in the
+        background.
+
+        :param adapter: The pypowervm adapter.
+        :param host_uuid: The pypowervm UUID of the host.
+        """
+        pass
+
     def connect_volume(self, adapter, host_uuid, vm_uuid, instance,
-                       connection_info):
+                       connection_info, mapping_acc=None, lpar_id=None):
         """Connects the volume.
 
         :param adapter: The pypowervm adapter.
@@ -52,11 +68,16 @@ class PowerVMVolumeAdapter(object):
                    'access_mode':'rw',
                    'target_wwn':'500507680210E522'
                 }
+        :param mapping_acc: Optional VscsiMappingAccumulator.  Adapters that
+                            map through vSCSI queue their mappings on it
+                            rather than sending them to the VIOSes.
+        :param lpar_id: (Optional) The partition ID of the VM.  If not set,
+                        adapters that need it look it up from the vm_uuid.
         """
         raise NotImplementedError()
 
     def disconnect_volume(self, adapter, host_uuid, vm_uuid, instance,
-                          connection_info):
+                          connection_info, mapping_acc=None, lpar_id=None):
         """Disconnect the volume.
 
         :param adapter: The pypowervm adapter.
@@ -82,9 +103,52 @@ class PowerVMVolumeAdapter(object):
                    'access_mode':'rw',
                    'target_wwn':'500507680210E522'
                 }
+        :param mapping_acc: Optional VscsiMappingAccumulator.  Adapters that
+                            map through vSCSI queue their mapping removals
+                            on it rather than sending them to the VIOSes.
+        :param lpar_id: (Optional) The partition ID of the VM.  If not set,
+                        adapters that need it look it up from the vm_uuid.
         """
         raise NotImplementedError()
 
+    def pre_live_migration_on_destination(self, adapter, host_uuid,
+                                          instance, connection_info):
+        """Prepares this host to take the volume of a migrating instance.
+
+        Runs on the destination host before the migration.  Adapters whose
+        mappings the migration carries over as they are do nothing.
+
+        :param adapter: The pypowervm adapter.
+        :param host_uuid: The pypowervm UUID of the host.
+        :param instance: The nova instance being migrated.
+        :param connection_info: The connection_info of the volume.
+        """
+        pass
+
+    def post_live_migration_at_destination(self, adapter, host_uuid,
+                                           instance, connection_info,
+                                           lpar_id):
+        """Finishes taking the volume of an instance migrated to this host.
+
+        :param adapter: The pypowervm adapter.
+        :param host_uuid: The pypowervm UUID of the host.
+        :param instance: The nova instance that was migrated.
+        :param connection_info: The connection_info of the volume.
+        :param lpar_id: The partition ID of the LPAR on this host.
+        """
+        pass
+
+    def rollback_live_migration_at_destination(self, adapter, host_uuid,
+                                               instance, connection_info):
+        """Undoes pre_live_migration_on_destination after a failure.
+
+        :param adapter: The pypowervm adapter.
+        :param host_uuid: The pypowervm UUID of the host.
+        :param instance: The nova instance that was being migrated.
+        :param connection_info: The connection_info of the volume.
+        """
+        pass
+
 
 class FibreChannelVolumeAdapter(PowerVMVolumeAdapter):
     """Defines a Fibre Channel specific volume adapter.
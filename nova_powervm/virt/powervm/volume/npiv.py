@@ -14,15 +14,21 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import eventlet
+import threading
+import time
+
 from oslo_config import cfg
 from oslo_log import log as logging
 
 from nova.compute import task_states
-from nova.i18n import _LI
+from nova.i18n import _LI, _LW
 from pypowervm.tasks import wwpn as pvm_wwpn
 from pypowervm.wrappers import virtual_io_server as pvm_vios
 
 from nova_powervm.virt import powervm
+from nova_powervm.virt.powervm import vios
 from nova_powervm.virt.powervm.volume import driver as v_driver
 
 LOG = logging.getLogger(__name__)
@@ -32,6 +38,234 @@ WWPN_SYSTEM_METADATA_KEY = 'npiv_adpt_wwpns'
 
 TASK_STATES_FOR_DISCONNECT = [task_states.DELETING, task_states.SPAWNING]
 
+_XAGS = [pvm_vios.VIOS.xags.FC_MAPPING, pvm_vios.VIOS.xags.STORAGE]
+
+# Seconds after which a port assignment that never showed up as a VFC
+# mapping (for example that of a failed spawn) stops counting towards the
+# load of its physical port.
+_ASSIGNMENT_TIMEOUT = 3600
+
+
+def _norm_wwpn(wwpn):
+    return wwpn.upper().replace(':', '')
+
+
+def _balanced_npiv_map(vios_wraps, p_port_wwpns, v_port_wwpns, pending,
+                       used_vioses):
+    """Maps virtual ports to the least loaded physical ports of a fabric.
+
+    The load of a physical port is the number of VFC mappings it backs (plus
+    the ones handed out but not mapped yet) relative to the number of NPIV
+    ports it supports.  Ports on a VIOS that the instance is not using yet
+    are preferred, so that the fabrics are spread across the VIOSes.
+
+    :param vios_wraps: The VIOS wrappers, with the FC_MAPPING xag.
+    :param p_port_wwpns: The WWPNs of the fabric's physical ports.
+    :param v_port_wwpns: The virtual port WWPNs.  Each pair needs a port.
+    :param pending: Dictionary of physical port WWPN to the number of
+                    virtual ports assigned to it that are not mapped yet.
+                    Updated with the new assignments.
+    :param used_vioses: Set of the UUIDs of the VIOSes the instance already
+                        has ports on.  Updated with the VIOSes used.
+    :return: A list of (physical port WWPN, 'v_wwpn1 v_wwpn2') tuples, as
+             derive_npiv_map would return.
+    """
+    fabric_wwpns = set(_norm_wwpn(wwpn) for wwpn in p_port_wwpns)
+    ports = []
+    for vio_w in vios_wraps:
+        mapped = collections.Counter(
+            _norm_wwpn(vfc_map.backing_port.wwpn)
+            for vfc_map in vio_w.vfc_mappings
+            if vfc_map.backing_port is not None)
+        for port in vio_w.pfc_ports:
+            wwpn = _norm_wwpn(port.wwpn)
+            if wwpn in fabric_wwpns:
+                ports.append((vio_w.uuid, port, mapped[wwpn]))
+
+    def _free(port):
+        # Ports that do not report their NPIV capacity have none.
+        return (port.npiv_available_ports or 0) - pending.get(port.wwpn, 0)
+
+    def _load(entry):
+        vios_uuid, port, mapped = entry
+        total = max(port.npiv_total_ports or 0, 1)
+        return (vios_uuid in used_vioses,
+                float(mapped + pending.get(port.wwpn, 0)) / total,
+                -_free(port))
+
+    port_map = []
+    for v_wwpn1, v_wwpn2 in zip(v_port_wwpns[::2], v_port_wwpns[1::2]):
+        candidates = [entry for entry in ports if _free(entry[1]) > 0]
+        if not candidates:
+            # No free NPIV ports left, leave it to pypowervm to decide.
+            return pvm_wwpn.derive_npiv_map(vios_wraps, p_port_wwpns,
+                                            v_port_wwpns)
+
+        vios_uuid, port, mapped = min(candidates, key=_load)
+        pending[port.wwpn] = pending.get(port.wwpn, 0) + 1
+        used_vioses.add(vios_uuid)
+        port_map.append((port.wwpn, ' '.join([v_wwpn1, v_wwpn2])))
+    return port_map
+
+
+class _NPIVHostCache(object):
+    """The NPIV port topology and a pool of virtual WWPNs for a host.
+
+    The VIOS wrappers, with their physical FC ports and VFC mappings, are
+    kept in memory.  They are refreshed in the background once they are
+    CONF.npiv.topology_refresh_interval old, and after this driver changes
+    the VFC mappings.  Virtual WWPN pairs are generated ahead of time and
+    the pool is refilled in the background as it is drawn on.  Building a
+    volume connector then needs no REST calls in the common case.
+    """
+
+    _caches = {}
+    _caches_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, adapter, host_uuid):
+        """Returns the cache for a host.
+
+        :param adapter: The pypowervm adapter.
+        :param host_uuid: The pypowervm UUID of the host.
+        :return: The _NPIVHostCache of the host.
+        """
+        with cls._caches_lock:
+            cache = cls._caches.get(host_uuid)
+            if cache is None:
+                cache = cls(adapter, host_uuid)
+                cls._caches[host_uuid] = cache
+            return cache
+
+    def __init__(self, adapter, host_uuid):
+        self.adapter = adapter
+        self.host_uuid = host_uuid
+        self._lock = threading.Lock()
+        self._vios_wraps = None
+        self._read_time = 0
+        # The (physical port WWPN, virtual port WWPN, time) of the virtual
+        # ports handed out that were not mapped when the topology was read.
+        self._assigned = []
+        # WWPN pairs, each a list of two WWPNs.
+        self._pairs = collections.deque()
+        # The names of the background tasks that are running.
+        self._running = set()
+
+    def warm(self):
+        """Reads the topology and fills the WWPN pool in the background."""
+        self._start('topology', self._load_topology)
+        self.fill()
+
+    def vios_wraps(self):
+        """Returns the host's VIOS wrappers with the FC mapping data.
+
+        :return: A new list of the wrappers, which the caller may reorder.
+        """
+        with self._lock:
+            wraps = self._vios_wraps
+            stale = (time.time() - self._read_time >
+                     CONF.npiv.topology_refresh_interval)
+        if wraps is None:
+            return list(self._load_topology())
+        if stale:
+            self._start('topology', self._load_topology)
+        return list(wraps)
+
+    def topology_changed(self):
+        """Refreshes the topology after the VFC mappings have changed."""
+        vios.invalidate_vios_feed(self.host_uuid)
+        with self._lock:
+            self._read_time = 0
+            if self._vios_wraps is None:
+                return
+        self._start('topology', self._load_topology)
+
+    def assign_ports(self, vios_wraps, p_port_wwpns, v_port_wwpns,
+                     used_vioses):
+        """Assigns virtual ports to the fabric's least loaded physical ports.
+
+        See _balanced_npiv_map.  The assignments count towards the load of
+        the ports until a topology read finds their VFC mappings.
+        """
+        with self._lock:
+            pending = collections.Counter(
+                p_wwpn for p_wwpn, v_wwpn, assign_time in self._assigned)
+            port_map = _balanced_npiv_map(vios_wraps, p_port_wwpns,
+                                          v_port_wwpns, pending, used_vioses)
+            now = time.time()
+            for p_wwpn, v_wwpns in port_map:
+                self._assigned.append((p_wwpn, v_wwpns.split()[0], now))
+            return port_map
+
+    def take_wwpns(self, pair_count):
+        """Takes virtual WWPN pairs from the pool.
+
+        Pairs that the pool does not have are generated on the spot.
+
+        :param pair_count: The number of pairs needed.
+        :return: A list of pair_count * 2 WWPNs.
+        """
+        wwpns = []
+        with self._lock:
+            while self._pairs and len(wwpns) < pair_count * 2:
+                wwpns.extend(self._pairs.popleft())
+        while len(wwpns) < pair_count * 2:
+            wwpns.extend(pvm_wwpn.build_wwpn_pair(self.adapter,
+                                                  self.host_uuid))
+        self.fill()
+        return wwpns
+
+    def fill(self):
+        """Refills the WWPN pool in the background."""
+        if CONF.npiv.wwpn_pool_size > 0:
+            self._start('pool', self._fill)
+
+    def _load_topology(self):
+        wraps = vios.get_vios_feed(self.adapter, self.host_uuid, xag=_XAGS)
+        mapped = set()
+        for vio_w in wraps:
+            for vfc_map in vio_w.vfc_mappings:
+                if vfc_map.client_adapter is not None:
+                    mapped.update(_norm_wwpn(wwpn) for wwpn
+                                  in vfc_map.client_adapter.wwpns)
+        with self._lock:
+            self._vios_wraps = wraps
+            self._read_time = time.time()
+            # The assignments made since the read began are not mapped in it
+            # either, so they are kept.
+            self._assigned = [
+                entry for entry in self._assigned
+                if _norm_wwpn(entry[1]) not in mapped and
+                self._read_time - entry[2] < _ASSIGNMENT_TIMEOUT]
+        return wraps
+
+    def _fill(self):
+        while True:
+            with self._lock:
+                if len(self._pairs) >= CONF.npiv.wwpn_pool_size:
+                    return
+            pair = pvm_wwpn.build_wwpn_pair(self.adapter, self.host_uuid)
+            with self._lock:
+                self._pairs.append(pair)
+
+    def _start(self, name, func):
+        """Runs func in a green thread, unless it is already running."""
+        with self._lock:
+            if name in self._running:
+                return
+            self._running.add(name)
+
+        def _run():
+            try:
+                func()
+            except Exception as e:
+                LOG.warn(_LW('Background NPIV %(name)s refresh failed: '
+                             '%(error)s'), {'name': name, 'error': e})
+            finally:
+                with self._lock:
+                    self._running.discard(name)
+        eventlet.spawn_n(_run)
+
 
 class NPIVVolumeAdapter(v_driver.PowerVMVolumeAdapter):
     """The NPIV implementation of the Volume Adapter.
@@ -45,8 +279,16 @@ class NPIVVolumeAdapter(v_driver.PowerVMVolumeAdapter):
     Server only passes through communication directly to the VM itself.
     """
 
+    def init_host(self, adapter, host_uuid):
+        """Prepares the adapter for use when the compute driver starts.
+
+        :param adapter: The pypowervm adapter.
+        :param host_uuid: The pypowervm UUID of the host.
+        """
+        _NPIVHostCache.get(adapter, host_uuid).warm()
+
     def connect_volume(self, adapter, host_uuid, vm_uuid, instance,
-                       connection_info):
+                       connection_info, mapping_acc=None, lpar_id=None):
         """Connects the volume.
 
         :param adapter: The pypowervm adapter.
@@ -72,6 +314,9 @@ class NPIVVolumeAdapter(v_driver.PowerVMVolumeAdapter):
                    'access_mode':'rw',
                    'target_wwn':'500507680210E522'
                 }
+        :param mapping_acc: Not used.  The NPIV mappings for the instance are
+                            already added in a single call.
+        :param lpar_id: Not used.  The NPIV mappings are added by VM UUID.
         """
         # We need to gather each fabric's port mappings
         npiv_port_mappings = []
@@ -88,9 +333,10 @@ class NPIVVolumeAdapter(v_driver.PowerVMVolumeAdapter):
         LOG.info(_LI("Adding NPIV mapping for instance %s") % instance.name)
         pvm_wwpn.add_npiv_port_mappings(adapter, host_uuid, vm_uuid,
                                         npiv_port_mappings)
+        _NPIVHostCache.get(adapter, host_uuid).topology_changed()
 
     def disconnect_volume(self, adapter, host_uuid, vm_uuid, instance,
-                          connection_info):
+                          connection_info, mapping_acc=None, lpar_id=None):
         """Disconnect the volume.
 
         :param adapter: The pypowervm adapter.
@@ -116,6 +362,9 @@ class NPIVVolumeAdapter(v_driver.PowerVMVolumeAdapter):
                    'access_mode':'rw',
                    'target_wwn':'500507680210E522'
                 }
+        :param mapping_acc: Not used.  The NPIV mappings for the instance are
+                            already removed in a single call.
+        :param lpar_id: Not used.  The NPIV mappings are removed by VM UUID.
         """
         # We should only delete the NPIV mappings if we are running through a
         # VM deletion.  VM deletion occurs when the task state is deleting.
@@ -137,6 +386,7 @@ class NPIVVolumeAdapter(v_driver.PowerVMVolumeAdapter):
         LOG.info(_LI("Removing NPIV mapping for instance %s") % instance.name)
         pvm_wwpn.remove_npiv_port_mappings(adapter, host_uuid,
                                            npiv_port_mappings)
+        _NPIVHostCache.get(adapter, host_uuid).topology_changed()
 
     def wwpns(self, adapter, host_uuid, instance):
         """Builds the WWPNs of the adapters that will connect the ports.
@@ -169,30 +419,25 @@ class NPIVVolumeAdapter(v_driver.PowerVMVolumeAdapter):
         # before that can be done, the mapping needs to be derived between
         # the logical ports and the physical ports.
         #
-        # This should be done on a per-fabric basis.
-        vios_resp = adapter.read(pvm_vios.VIOS.schema_type,
-                                 xag=[pvm_vios.VIOS.xags.FC_MAPPING,
-                                      pvm_vios.VIOS.xags.STORAGE])
-        vios_wraps = pvm_vios.VIOS.wrap(vios_resp)
+        # This should be done on a per-fabric basis.  Each fabric goes on
+        # the least loaded of its physical ports, preferring the VIOSes that
+        # the earlier fabrics did not use as a form of multi pathing (so that
+        # the paths are not restricted to a single VIOS).
+        host_cache = _NPIVHostCache.get(adapter, host_uuid)
+        vios_wraps = host_cache.vios_wraps()
+        used_vioses = set()
         resp_wwpns = []
         for fabric in self._fabric_names():
-            v_port_wwpns = self._build_wwpns_for_fabric(adapter, host_uuid)
+            v_port_wwpns = host_cache.take_wwpns(self._ports_per_fabric())
             resp_wwpns.extend(v_port_wwpns)
 
             # Derive the virtual to physical port mapping
-            port_map = pvm_wwpn.derive_npiv_map(vios_wraps,
-                                                self._fabric_ports(fabric),
-                                                v_port_wwpns)
+            port_map = host_cache.assign_ports(vios_wraps,
+                                               self._fabric_ports(fabric),
+                                               v_port_wwpns, used_vioses)
 
             self._set_fabric_meta(instance, fabric, port_map)
 
-            # Every loop through, we reverse the vios wrappers.  This is done
-            # so that if Fabric A only has 1 port, it goes on the first VIOS.
-            # Then Fabric B would put its port on a different VIOS.  As a form
-            # of multi pathing (so that your paths were not restricted to a
-            # single VIOS).
-            vios_wraps.reverse()
-
             # TODO(IBM) Need to log the WWPNs in temporarily here.
 
         # The return object needs to be a list for the volume connector.
@@ -260,15 +505,6 @@ class NPIVVolumeAdapter(v_driver.PowerVMVolumeAdapter):
         """Returns the nova system metadata key for a given fabric."""
         return WWPN_SYSTEM_METADATA_KEY + '_' + fabric
 
-    def _build_wwpns_for_fabric(self, adapter, host_uuid):
-        """Builds all of the WWPNs that are needed for a given fabric."""
-        wwpns = []
-        i = 0
-        while i < self._ports_per_fabric():
-            wwpns.extend(pvm_wwpn.build_wwpn_pair(adapter, host_uuid))
-            i += 1
-        return wwpns
-
     def _fabric_names(self):
         """Returns a list of the fabric names."""
         return powervm.NPIV_FABRIC_WWPNS.keys()
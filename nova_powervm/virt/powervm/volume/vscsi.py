@@ -14,10 +14,18 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import contextlib
+import eventlet
+from eventlet import greenpool
+import functools
+import threading
+import time
 from nova.i18n import _LI, _LW, _LE
 
 from oslo_config import cfg
 from oslo_log import log as logging
+from oslo_utils import excutils
 
 from nova_powervm.virt.powervm import vios
 from nova_powervm.virt.powervm import vm
@@ -26,6 +34,7 @@ from nova_powervm.virt.powervm.volume import driver as v_driver
 import pypowervm.exceptions as pexc
 from pypowervm.tasks import hdisk
 from pypowervm.tasks import scsi_mapper as tsk_map
+from pypowervm.utils import retry as pvm_retry
 from pypowervm.wrappers import storage as pvm_stor
 from pypowervm.wrappers import virtual_io_server as pvm_vios
 
@@ -34,7 +43,681 @@ import six
 CONF = cfg.CONF
 LOG = logging.getLogger(__name__)
 
-_XAGS = [pvm_vios.VIOS.xags.STORAGE]
+
+def _run_on_vioses(func, items):
+    """Runs a function against each item concurrently.
+
+    :param func: The function to run.  Takes a single item.
+    :param items: The items (typically VIOS wrappers) to run func against.
+    :return: A list of (item, result, exception) tuples in the order of
+             items.  Exactly one of result or exception is meaningful.
+    """
+    def _run(item):
+        try:
+            return item, func(item), None
+        except Exception as e:
+            return item, None, e
+    return list(greenpool.GreenPool().imap(_run, items))
+
+
+_GOOD_DISCOVERY = [hdisk.LUAStatus.DEVICE_AVAILABLE,
+                   hdisk.LUAStatus.FOUND_ITL_ERR]
+
+
+class _DiscoveryCache(object):
+    """Bounded cache of successful hdisk discoveries.
+
+    Keyed on the VIOS and the initiators, targets and LUN that the hdisk was
+    discovered with.  The least recently used entry is dropped first once
+    CONF.vscsi_discovery_cache_size is reached.
+    """
+
+    def __init__(self):
+        # key -> (status, device_name, udid)
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(vios_uuid, i_wwpns, t_wwpns, lun):
+        return vios_uuid, frozenset(i_wwpns), frozenset(t_wwpns), str(lun)
+
+    def get(self, key):
+        """Returns the cached discovery result for a key, or None."""
+        with self._lock:
+            result = self._entries.pop(key, None)
+            if result is not None:
+                self._entries[key] = result
+            return result
+
+    def put(self, key, result):
+        """Caches a discovery result.
+
+        :param key: The key, from the key method.
+        :param result: The (status, device_name, udid) of the discovery.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            if CONF.vscsi_discovery_cache_size <= 0:
+                return
+            self._entries[key] = result
+            while len(self._entries) > CONF.vscsi_discovery_cache_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate(self, vios_uuid, device_name):
+        """Drops the entries for an hdisk that has been removed."""
+        with self._lock:
+            for key, result in list(self._entries.items()):
+                if key[0] == vios_uuid and result[1] == device_name:
+                    del self._entries[key]
+
+
+_discovery_cache = _DiscoveryCache()
+
+
+def _hdisk_reusable(adapter, host_uuid, vios_uuid, device_name, udid):
+    """Whether an hdisk with the given name and UDID is on a VIOS, unmapped.
+
+    An hdisk that is mapped to a partition is in use, which only a discovery
+    reports.  Uses the cached storage and mapping feed, so is normally only
+    an etag check.
+    """
+    vios_feed = vios.get_vios_feed(
+        adapter, host_uuid,
+        xag=[pvm_vios.VIOS.xags.STORAGE, pvm_vios.VIOS.xags.SCSI_MAPPING])
+    for vio_wrap in vios_feed:
+        if vio_wrap.uuid != vios_uuid:
+            continue
+        if not any(pv.name == device_name and pv.udid == udid
+                   for pv in vio_wrap.phys_vols):
+            return False
+        return not any(isinstance(smap.backing_storage, pvm_stor.PV) and
+                       smap.backing_storage.name == device_name
+                       for smap in vio_wrap.scsi_mappings)
+    return False
+
+
+class _PhysicalWWPNs(object):
+    """The WWPNs of the active physical FC ports of a host's VIOSes.
+
+    The WWPNs are served from memory.  Once they are
+    CONF.pfc_wwpn_refresh_interval old they are refreshed in the background
+    with a conditional read of the VIOS feed, and only worked out again if
+    the etag of a VIOS has changed.
+    """
+
+    def __init__(self, adapter, host_uuid):
+        self.adapter = adapter
+        self.host_uuid = host_uuid
+        self._lock = threading.Lock()
+        self._wwpns = None
+        self._etags = None
+        self._read_time = 0
+        self._refreshing = False
+
+    def get(self):
+        """Returns the list of physical WWPNs."""
+        with self._lock:
+            wwpns = self._wwpns
+            stale = (time.time() - self._read_time >
+                     CONF.pfc_wwpn_refresh_interval)
+        if wwpns is None:
+            self._refresh()
+            with self._lock:
+                return list(self._wwpns)
+        if stale:
+            self.refresh_async()
+        return list(wwpns)
+
+    def refresh_async(self):
+        """Refreshes the WWPNs in the background, unless already running."""
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def _run():
+            try:
+                self._refresh()
+            except Exception as e:
+                LOG.warn(_LW('Unable to refresh the physical FC port WWPNs: '
+                             '%s'), e)
+            finally:
+                with self._lock:
+                    self._refreshing = False
+        eventlet.spawn_n(_run)
+
+    def _refresh(self):
+        vios_feed = vios.get_vios_feed(self.adapter, self.host_uuid,
+                                       xag=[pvm_vios.VIOS.xags.STORAGE])
+        etags = [vio_wrap.etag for vio_wrap in vios_feed]
+        with self._lock:
+            if self._wwpns is None or etags != self._etags:
+                wwpns = []
+                for vio_wrap in vios_feed:
+                    wwpns.extend(vio_wrap.get_active_pfc_wwpns())
+                self._wwpns = wwpns
+                self._etags = etags
+            self._read_time = time.time()
+
+
+class UDIDIndex(object):
+    """Where each hdisk UDID is mapped on a host's Virtual I/O Servers.
+
+    Indexes the UDID of every vSCSI mapped hdisk to the (VIOS UUID, hdisk
+    name, client LPAR ID) of each of its mappings.  The index is read from
+    the storage of the host's VIOSes once and then kept current as this
+    driver maps and unmaps hdisks, so a detach finds its devices without
+    reading the storage of every VIOS.  A lookup that finds nothing rereads
+    the VIOSes first, which picks up mappings changed outside of the driver.
+    """
+
+    _indexes = {}
+    _lock = threading.RLock()
+
+    @classmethod
+    def get(cls, adapter, host_uuid):
+        """Returns the index for a host.
+
+        :param adapter: The pypowervm adapter.
+        :param host_uuid: The pypowervm UUID of the host.
+        :return: The UDIDIndex of the host.
+        """
+        with cls._lock:
+            index = cls._indexes.get(host_uuid)
+            if index is None:
+                index = cls(adapter, host_uuid)
+                cls._indexes[host_uuid] = index
+            return index
+
+    def __init__(self, adapter, host_uuid):
+        self.adapter = adapter
+        self.host_uuid = host_uuid
+        # UDID -> set of (vios_uuid, device_name, lpar_id).  Loaded on first
+        # use.
+        self._udids = None
+        # Volume ID -> UDID of the volumes connected since the driver
+        # started.
+        self._volumes = {}
+        # The changes made while each running load reads the VIOSes, as
+        # (function, args) to replay on what it read.
+        self._journals = []
+
+    def _read(self):
+        """Reads the UDID mappings from the VIOS storage and mappings."""
+        udids = {}
+        vios_feed = vios.get_vios_feed(
+            self.adapter, self.host_uuid,
+            xag=[pvm_vios.VIOS.xags.STORAGE, pvm_vios.VIOS.xags.SCSI_MAPPING])
+        for vio_wrap in vios_feed:
+            # The mappings only carry the hdisk name.
+            pv_udids = dict((pv.name, pv.udid) for pv in vio_wrap.phys_vols)
+            for smap in vio_wrap.scsi_mappings:
+                stg = smap.backing_storage
+                if not isinstance(stg, pvm_stor.PV):
+                    continue
+                udid = pv_udids.get(stg.name)
+                if udid is None:
+                    continue
+                udids.setdefault(udid, set()).add(
+                    (vio_wrap.uuid, stg.name, smap.server_adapter.lpar_id))
+        return udids
+
+    def _load(self):
+        """(Re)builds the index from the VIOS storage and mappings.
+
+        The VIOSes are read without holding the lock.  The adds and removes
+        made while they are read are replayed on the result, as the read may
+        have missed them.
+        """
+        journal = []
+        with self._lock:
+            self._journals.append(journal)
+        try:
+            udids = self._read()
+        finally:
+            with self._lock:
+                self._journals.remove(journal)
+        with self._lock:
+            for func, args in journal:
+                func(udids, *args)
+            self._udids = udids
+
+    def _find(self, udid, lpar_id):
+        return sorted((vios_uuid, device_name) for vios_uuid, device_name, lid
+                      in self._udids.get(udid, ()) if lid == lpar_id)
+
+    def lookup(self, udid, lpar_id):
+        """Finds the hdisks for a UDID that are mapped to an LPAR.
+
+        :param udid: The UDID of the hdisk.
+        :param lpar_id: The short ID of the client LPAR.
+        :return: A list of (vios_uuid, device_name) tuples.  Empty if the
+                 hdisk is not mapped to the LPAR on any VIOS.
+        """
+        lpar_id = int(lpar_id)
+        with self._lock:
+            loaded = self._udids is not None
+            if loaded:
+                found = self._find(udid, lpar_id)
+                if found:
+                    return found
+        if loaded:
+            # Might have been mapped outside of the driver, so make sure the
+            # reread is not served from the feed cache.
+            vios.invalidate_vios_feed(self.host_uuid)
+        self._load()
+        with self._lock:
+            return self._find(udid, lpar_id)
+
+    @staticmethod
+    def _add(udids, udid, vios_uuid, device_name, lpar_id):
+        udids.setdefault(udid, set()).add((vios_uuid, device_name, lpar_id))
+
+    @staticmethod
+    def _remove(udids, udid, vios_uuid, lpar_id):
+        if udid not in udids:
+            return
+        udids[udid] = set(loc for loc in udids[udid]
+                          if loc[0] != vios_uuid or loc[2] != lpar_id)
+        if not udids[udid]:
+            del udids[udid]
+
+    def _change(self, func, *args):
+        """Applies a change to the index and to the loads in progress."""
+        if self._udids is not None:
+            func(self._udids, *args)
+        for journal in self._journals:
+            journal.append((func, args))
+
+    def add(self, udid, vios_uuid, device_name, lpar_id, volume_id=None):
+        """Records a new mapping of an hdisk.
+
+        :param udid: The UDID of the hdisk.
+        :param vios_uuid: The UUID of the VIOS the hdisk is on.
+        :param device_name: The hdisk device name.
+        :param lpar_id: The short ID of the LPAR the hdisk is mapped to.
+        :param volume_id: Optional ID of the volume the hdisk is for.
+        """
+        with self._lock:
+            if volume_id is not None:
+                self._volumes[volume_id] = udid
+            # Mappings made before the index is loaded are read with it.
+            self._change(self._add, udid, vios_uuid, device_name,
+                         int(lpar_id))
+
+    def remove(self, udid, vios_uuid, lpar_id):
+        """Removes the mappings of an hdisk from an LPAR on a VIOS.
+
+        :param udid: The UDID of the hdisk.
+        :param vios_uuid: The UUID of the VIOS the hdisk is on.
+        :param lpar_id: The short ID of the LPAR the hdisk was mapped to.
+        """
+        with self._lock:
+            self._change(self._remove, udid, vios_uuid, int(lpar_id))
+            if self._udids is None or udid in self._udids:
+                return
+            for volume_id, v_udid in list(self._volumes.items()):
+                if v_udid == udid:
+                    del self._volumes[volume_id]
+
+    def volume_udid(self, volume_id):
+        """Returns the UDID of a volume connected by this driver, or None."""
+        with self._lock:
+            return self._volumes.get(volume_id)
+
+
+class _MappingBatch(object):
+    """Mapping accumulators whose changes are sent together."""
+
+    def __init__(self):
+        self.accs = []
+        self.done = threading.Event()
+        # Per accumulator, the exception raised while sending its changes.
+        self.errors = {}
+        self.error = None
+
+
+class VscsiMappingAccumulator(object):
+    """Collects the vSCSI mapping changes for a VM.
+
+    Rather than a read and an update of a VIOS for each volume, the mappings
+    for all of a VM's volumes, boot disk and config drive are queued up and
+    sent with one update per VIOS by apply.  rollback undoes whatever apply
+    managed to send.
+
+    apply_batched also sends the changes of other VMs being spawned on the
+    host at the same time in the same update.
+    """
+    # The open batch of each host, by host UUID, and the number of spawns in
+    # flight on each host that have not sent their mappings yet.  Guarded by
+    # _batch_lock.
+    _batches = {}
+    _spawns = collections.Counter()
+    _batch_lock = threading.Lock()
+    # Notified as accumulators join a batch and as spawns end.
+    _batch_changed = threading.Condition(_batch_lock)
+
+    def __init__(self, adapter, host_uuid):
+        """Creates the accumulator.
+
+        :param adapter: The pypowervm adapter.
+        :param host_uuid: The pypowervm UUID of the host.
+        """
+        self.adapter = adapter
+        self.host_uuid = host_uuid
+        # Per VIOS UUID, the (vm_uuid, storage element) mappings to add and
+        # to remove.
+        self._adds = {}
+        self._removes = {}
+        self._post_apply = []
+        # Per VIOS UUID, the functions to run once rollback has made sure the
+        # added mappings are not there.
+        self._post_rollback = {}
+        # The VIOSes that apply has updated.
+        self._applied = []
+        self._post_applied = False
+        self._lpar_ids = {}
+        # Whether the spawn of this accumulator is counted in _spawns.
+        self._spawning = False
+
+    def set_lpar_id(self, vm_uuid, lpar_id):
+        """Records the partition ID of a VM, so apply need not look it up.
+
+        :param vm_uuid: The pypowervm UUID of the VM.
+        :param lpar_id: The short partition ID of the VM.  Ignored if None.
+        """
+        if lpar_id is not None:
+            self._lpar_ids[vm_uuid] = int(lpar_id)
+
+    @contextlib.contextmanager
+    def spawning(self):
+        """Counts the spawn of this accumulator as in flight in the context.
+
+        apply_batched only waits for the spawns in flight that have not sent
+        their mappings yet.
+        """
+        with VscsiMappingAccumulator._batch_lock:
+            VscsiMappingAccumulator._spawns[self.host_uuid] += 1
+            self._spawning = True
+        try:
+            yield
+        finally:
+            with VscsiMappingAccumulator._batch_lock:
+                self._end_spawn()
+
+    def _end_spawn(self):
+        """Stops counting the spawn.  The caller holds _batch_lock."""
+        if not self._spawning:
+            return
+        self._spawning = False
+        spawns = VscsiMappingAccumulator._spawns
+        spawns[self.host_uuid] -= 1
+        if spawns[self.host_uuid] <= 0:
+            del spawns[self.host_uuid]
+        VscsiMappingAccumulator._batch_changed.notify_all()
+
+    def add_mapping(self, vios_uuid, vm_uuid, device_name, post_apply=None,
+                    post_rollback=None):
+        """Queues the mapping of an hdisk to a VM.
+
+        :param vios_uuid: The UUID of the VIOS the hdisk is on.
+        :param vm_uuid: The pypowervm UUID of the VM.
+        :param device_name: The hdisk device name.
+        :param post_apply: Optional function (no parameters) to run once the
+                           mapping has been added.
+        :param post_rollback: Optional function (no parameters) to run on
+                              rollback once the mapping is known not to be
+                              there, because it was never sent or has been
+                              removed again.  Undoes the work done for the
+                              mapping, including what post_apply recorded.
+        """
+        self.add_storage_mapping(vios_uuid, vm_uuid,
+                                 pvm_stor.PV.bld(self.adapter, device_name),
+                                 post_apply=post_apply,
+                                 post_rollback=post_rollback)
+
+    def add_storage_mapping(self, vios_uuid, vm_uuid, stg_elem,
+                            post_apply=None, post_rollback=None):
+        """Queues the mapping of a storage element to a VM.
+
+        :param vios_uuid: The UUID of the VIOS to add the mapping on.
+        :param vm_uuid: The pypowervm UUID of the VM.
+        :param stg_elem: The pypowervm storage element to map.  Ex. PV, LU,
+                         VDisk or VOptMedia.
+        :param post_apply: See add_mapping.
+        :param post_rollback: See add_mapping.
+        """
+        self._adds.setdefault(vios_uuid, []).append((vm_uuid, stg_elem))
+        if post_apply is not None:
+            self._post_apply.append(post_apply)
+        if post_rollback is not None:
+            self._post_rollback.setdefault(vios_uuid, []).append(
+                post_rollback)
+
+    def remove_mapping(self, vios_uuid, vm_uuid, device_name,
+                       post_apply=None):
+        """Queues the removal of the mapping of an hdisk from a VM.
+
+        :param vios_uuid: The UUID of the VIOS the hdisk is on.
+        :param vm_uuid: The pypowervm UUID of the VM.
+        :param device_name: The hdisk device name.
+        :param post_apply: Optional function (no parameters) to run once the
+                           mapping has been removed.
+        """
+        pv = pvm_stor.PV.bld(self.adapter, device_name)
+        self._removes.setdefault(vios_uuid, []).append((vm_uuid, pv))
+        if post_apply is not None:
+            self._post_apply.append(post_apply)
+
+    def apply(self):
+        """Sends the queued mapping changes, one update per VIOS."""
+        for vios_uuid in set(self._adds) | set(self._removes):
+            self._update(vios_uuid, self._adds.get(vios_uuid, []),
+                         self._removes.get(vios_uuid, []))
+            self._applied.append(vios_uuid)
+
+        self._run_post_apply()
+
+    def apply_batched(self):
+        """Sends the queued mapping changes along with those of other VMs.
+
+        The first caller for a host waits up to spawn_batch_window seconds
+        for the accumulators of the other spawns in flight (see spawning) to
+        join, then sends one update per VIOS for all of them.  It does not
+        wait if no other spawn is in flight.  Every caller returns once that
+        is done, and raises if its own changes could not be sent.  Each
+        accumulator is still rolled back on its own.
+        """
+        if CONF.spawn_batch_window <= 0:
+            self.apply()
+            return
+
+        key = self.host_uuid
+        with VscsiMappingAccumulator._batch_lock:
+            batch = VscsiMappingAccumulator._batches.get(key)
+            leader = batch is None
+            if leader:
+                batch = _MappingBatch()
+                VscsiMappingAccumulator._batches[key] = batch
+            batch.accs.append(self)
+            self._end_spawn()
+
+        if leader:
+            deadline = time.time() + CONF.spawn_batch_window
+            with VscsiMappingAccumulator._batch_lock:
+                try:
+                    # Spawns that end without joining stop being counted.
+                    while VscsiMappingAccumulator._spawns[key] > 0:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        VscsiMappingAccumulator._batch_changed.wait(
+                            remaining)
+                finally:
+                    # Close the batch.  Later callers start a new one.
+                    del VscsiMappingAccumulator._batches[key]
+
+            try:
+                batch.errors = _apply_together(batch.accs)
+            except Exception as e:
+                batch.error = e
+                raise
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+            if batch.error is not None:
+                raise batch.error
+
+        error = batch.errors.get(self)
+        if error is not None:
+            raise error
+
+    def rollback(self):
+        """Undoes the changes made by apply, one update per VIOS.
+
+        Removed mappings are only put back if their hdisks have not been
+        removed yet.  Otherwise the volume has to be connected again.
+        """
+        failed = set()
+        for vios_uuid in self._applied:
+            readds = ([] if self._post_applied else
+                      self._removes.get(vios_uuid, []))
+            try:
+                self._update(vios_uuid, readds, self._adds.get(vios_uuid, []))
+            except Exception as e:
+                LOG.error(_LE('Unable to roll back the mappings on Virtual '
+                              'I/O Server %(vios)s.  Error: %(error)s') %
+                          {'vios': vios_uuid, 'error': e})
+                failed.add(vios_uuid)
+        self._applied = []
+
+        # The added mappings that are still there keep their hdisks.
+        for vios_uuid, funcs in self._post_rollback.items():
+            if vios_uuid in failed:
+                continue
+            for func in funcs:
+                try:
+                    func()
+                except Exception as e:
+                    LOG.warn(_LW('Unable to clean up after rolling back the '
+                                 'mappings on Virtual I/O Server %(vios)s.  '
+                                 'Error: %(error)s'),
+                             {'vios': vios_uuid, 'error': e})
+        self._post_rollback = {}
+
+    def _run_post_apply(self):
+        self._post_applied = True
+        for func in self._post_apply:
+            func()
+
+    def _lpar_id(self, vm_uuid):
+        if vm_uuid not in self._lpar_ids:
+            self._lpar_ids[vm_uuid] = int(vm.get_vm_id(self.adapter,
+                                                       vm_uuid))
+        return self._lpar_ids[vm_uuid]
+
+    def _find_maps(self, vios_w, vm_uuid, stg_elem):
+        lpar_id = self._lpar_id(vm_uuid)
+        return [smap for smap in vios_w.scsi_mappings
+                if smap.server_adapter.lpar_id == lpar_id and
+                isinstance(smap.backing_storage, type(stg_elem)) and
+                smap.backing_storage.name == stg_elem.name]
+
+    def _update(self, vios_uuid, adds, removes):
+        """Adds and removes vSCSI mappings in a single VIOS update.
+
+        :param vios_uuid: The UUID of the VIOS to update.
+        :param adds: List of (vm_uuid, storage element) mappings to add.
+        :param removes: List of (vm_uuid, storage element) mappings to
+                        remove.
+        """
+        @pvm_retry.retry()
+        def _do_update():
+            vios_w = pvm_vios.VIOS.wrap(self.adapter.read(
+                pvm_vios.VIOS.schema_type, root_id=vios_uuid,
+                xag=[pvm_vios.VIOS.xags.SCSI_MAPPING]))
+
+            changed = False
+            for vm_uuid, stg_elem in removes:
+                for smap in self._find_maps(vios_w, vm_uuid, stg_elem):
+                    vios_w.scsi_mappings.remove(smap)
+                    changed = True
+
+            for vm_uuid, stg_elem in adds:
+                # Skip mappings that are already there.
+                if self._find_maps(vios_w, vm_uuid, stg_elem):
+                    continue
+                vios_w.scsi_mappings.append(pvm_vios.VSCSIMapping.bld(
+                    self.adapter, self.host_uuid, vm_uuid, stg_elem))
+                changed = True
+
+            if changed:
+                vios_w.update()
+
+        _do_update()
+        vios.invalidate_vios_feed(self.host_uuid, vios_uuid)
+
+
+def _apply_together(accs):
+    """Sends the queued changes of many accumulators, one update per VIOS.
+
+    If the combined update of a VIOS fails, each accumulator's changes for
+    that VIOS are sent on their own, so that one bad mapping only fails its
+    own VM.
+
+    :param accs: The VscsiMappingAccumulators.
+    :return: Dict of the accumulators whose changes could not all be sent,
+             to the exception raised.
+    """
+    errors = {}
+    merged = VscsiMappingAccumulator(accs[0].adapter, accs[0].host_uuid)
+    vios_uuids = set()
+    for acc in accs:
+        merged._lpar_ids.update(acc._lpar_ids)
+        vios_uuids.update(acc._adds)
+        vios_uuids.update(acc._removes)
+
+    for vios_uuid in vios_uuids:
+        members = [acc for acc in accs if acc not in errors and
+                   (vios_uuid in acc._adds or vios_uuid in acc._removes)]
+        if not members:
+            continue
+        adds, removes = [], []
+        for acc in members:
+            adds.extend(acc._adds.get(vios_uuid, []))
+            removes.extend(acc._removes.get(vios_uuid, []))
+        try:
+            merged._update(vios_uuid, adds, removes)
+            for acc in members:
+                acc._applied.append(vios_uuid)
+            continue
+        except Exception as e:
+            LOG.warn(_LW('Unable to update the mappings of %(count)d VMs '
+                         'together on Virtual I/O Server %(vios)s, updating '
+                         'them one at a time: %(error)s'),
+                     {'count': len(members), 'vios': vios_uuid, 'error': e})
+
+        for acc in members:
+            try:
+                acc._update(vios_uuid, acc._adds.get(vios_uuid, []),
+                            acc._removes.get(vios_uuid, []))
+                acc._applied.append(vios_uuid)
+            except Exception as e:
+                errors[acc] = e
+
+    for acc in accs:
+        if acc in errors:
+            continue
+        try:
+            acc._run_post_apply()
+        except Exception as e:
+            errors[acc] = e
+    return errors
 
 
 class VscsiVolumeAdapter(v_driver.FibreChannelVolumeAdapter):
@@ -45,12 +728,34 @@ class VscsiVolumeAdapter(v_driver.FibreChannelVolumeAdapter):
     information from the driver and link it to a given virtual machine.
     """
 
+    queues_mappings = True
+
     def __init__(self):
         super(VscsiVolumeAdapter, self).__init__()
         self._pfc_wwpns = None
+        # The hdisks discovered for instances live migrating to this host,
+        # by (instance UUID, volume ID).  Each is a list of (vios_uuid,
+        # device_name, udid).
+        self._migrating = {}
+
+    def _physical_wwpns(self, adapter, host_uuid):
+        if self._pfc_wwpns is None:
+            self._pfc_wwpns = _PhysicalWWPNs(adapter, host_uuid)
+        return self._pfc_wwpns
+
+    def init_host(self, adapter, host_uuid):
+        """Prepares the adapter for use when the compute driver starts.
+
+        Reads the physical WWPNs in the background, so that the first volume
+        connector does not wait for them.
+
+        :param adapter: The pypowervm adapter.
+        :param host_uuid: The pypowervm UUID of the host.
+        """
+        self._physical_wwpns(adapter, host_uuid).refresh_async()
 
     def connect_volume(self, adapter, host_uuid, vm_uuid, instance,
-                       connection_info):
+                       connection_info, mapping_acc=None, lpar_id=None):
         """Connects the volume.
 
         :param adapter: The pypowervm adapter.
@@ -75,13 +780,85 @@ class VscsiVolumeAdapter(v_driver.FibreChannelVolumeAdapter):
                    'access_mode':'rw',
                    'target_wwn':'500507680210E522'
                 }
+        :param mapping_acc: Optional VscsiMappingAccumulator.  If set, the
+                            mappings are queued on it rather than sent to the
+                            VIOSes.
+        :param lpar_id: (Optional) The partition ID of the VM.  If not set,
+                        it is looked up from the vm_uuid.
         """
+        volume_id = connection_info['data']['volume_id']
+        hdisk_found = False
+        found, device_name = self._discover_volume(adapter, host_uuid,
+                                                   connection_info)
 
+        index = UDIDIndex.get(adapter, host_uuid)
+        partition_id = lpar_id
+        if partition_id is None and found:
+            partition_id = vm.get_vm_id(adapter, vm_uuid)
+
+        if mapping_acc is not None:
+            if partition_id is not None:
+                mapping_acc.set_lpar_id(vm_uuid, partition_id)
+            # The mappings are sent along with those of the instance's other
+            # volumes, once they have all been discovered.
+            # The UDID is only recorded once the mapping is in place.  If the
+            # mapping is rolled back, the discovered hdisk is removed again.
+            for vio_wrap, device_name, udid in found:
+                mapping_acc.add_mapping(
+                    vio_wrap.uuid, vm_uuid, device_name,
+                    post_apply=functools.partial(
+                        self._record_udid, instance, index, connection_info,
+                        udid, vio_wrap.uuid, device_name, partition_id),
+                    post_rollback=functools.partial(
+                        self._rm_hdisk, adapter, instance, index, udid,
+                        partition_id, vio_wrap.uuid, volume_id, device_name))
+                hdisk_found = True
+            found = []
+
+        # Map the hdisk on each VIOS that found it, again all at once.
+        def _map(found_disk):
+            vio_wrap, device_name, udid = found_disk
+            self._add_mapping(adapter, host_uuid, vm_uuid, vio_wrap.uuid,
+                              device_name)
+
+        map_error = None
+        for found_disk, result, error in _run_on_vioses(_map, found):
+            vio_wrap, device_name, udid = found_disk
+            if error is not None:
+                LOG.error(_LE('Failed to map %(hdisk)s on %(vios)s for '
+                              'volume %(volume)s.  Error: %(error)s'),
+                          {'hdisk': device_name, 'vios': vio_wrap.name,
+                           'volume': volume_id, 'error': error})
+                map_error = map_error or error
+                continue
+            self._record_udid(instance, index, connection_info, udid,
+                              vio_wrap.uuid, device_name, partition_id)
+            LOG.info(_LI('Device attached: %s'), device_name)
+            hdisk_found = True
+
+        # As before, a failed mapping fails the attach.  The mappings that
+        # did succeed are recorded above so a detach can clean them up.
+        if map_error is not None:
+            raise map_error
+
+        # A valid hdisk was not found so log and exit
+        if not hdisk_found:
+            raise self._no_hdisk_error(instance, volume_id, device_name)
+
+    def _discover_volume(self, adapter, host_uuid, connection_info):
+        """Discovers the hdisk of a volume on each of the host's VIOSes.
+
+        :param adapter: The pypowervm adapter.
+        :param host_uuid: The pypowervm UUID of the host.
+        :param connection_info: The connection_info of the volume.
+        :return: The list of (vio_wrap, device_name, udid) of the VIOSes that
+                 found a usable hdisk, and the last device name discovered
+                 (None if there was none).
+        """
         # Get the initiators
         it_map = connection_info['data']['initiator_target_map']
         volume_id = connection_info['data']['volume_id']
         lun = connection_info['data']['target_lun']
-        hdisk_found = False
 
         i_wwpns = it_map.keys()
         t_wwpns = []
@@ -92,48 +869,138 @@ class VscsiVolumeAdapter(v_driver.FibreChannelVolumeAdapter):
         # Get VIOS feed
         vios_feed = vios.get_active_vioses(adapter, host_uuid)
 
-        # Iterate through host vios list to find valid hdisks and map to VM.
+        # TODO(IBM): Investigate if i_wwpns passed to discover_hdisk
+        # should be intersection with VIOS pfc_wwpns
+        itls = hdisk.build_itls(i_wwpns, t_wwpns, lun)
+
+        # Discovery is a job on each VIOS that can take some time, so run it
+        # on all of the host's VIOSes at once.
         # TODO(IBM): The VIOS should only include the intersection with
         # defined SCG targets when they are available.
-        for vio_wrap in vios_feed:
-            # TODO(IBM): Investigate if i_wwpns passed to discover_hdisk
-            # should be intersection with VIOS pfc_wwpns
-            itls = hdisk.build_itls(i_wwpns, t_wwpns, lun)
-            status, device_name, udid = hdisk.discover_hdisk(
-                adapter, vio_wrap.uuid, itls)
-            if device_name is not None and status in [
-                    hdisk.LUAStatus.DEVICE_AVAILABLE,
-                    hdisk.LUAStatus.FOUND_ITL_ERR]:
+        def _discover(vio_wrap):
+            # Reattaching a volume finds the same hdisk as last time, so skip
+            # the discovery job if that hdisk is still there and not mapped.
+            key = _DiscoveryCache.key(vio_wrap.uuid, i_wwpns, t_wwpns, lun)
+            cached = _discovery_cache.get(key)
+            if cached is not None:
+                try:
+                    if _hdisk_reusable(adapter, host_uuid, vio_wrap.uuid,
+                                       cached[1], cached[2]):
+                        return cached
+                except Exception as e:
+                    LOG.warn(_LW('Unable to validate the cached hdisk '
+                                 '%(hdisk)s on %(vios)s.  Error: %(error)s'),
+                             {'hdisk': cached[1], 'vios': vio_wrap.name,
+                              'error': e})
+                _discovery_cache.discard(key)
+
+            result = hdisk.discover_hdisk(adapter, vio_wrap.uuid, itls)
+            status, device_name, udid = result
+            if device_name is not None and status in _GOOD_DISCOVERY:
+                _discovery_cache.put(key, result)
+            return result
+
+        found = []
+        device_name = None
+        for vio_wrap, result, error in _run_on_vioses(_discover, vios_feed):
+            if error is not None:
+                LOG.warn(_LW('Failed to discover the hdisk for volume '
+                             '%(volume)s on %(vios)s.  Error: %(error)s'),
+                         {'volume': volume_id, 'vios': vio_wrap.name,
+                          'error': error})
+                continue
+
+            status, device_name, udid = result
+            if device_name is not None and status in _GOOD_DISCOVERY:
                 LOG.info(_LI('Discovered %(hdisk)s on vios %(vios)s for '
                          'volume %(volume_id)s. Status code: %(status)s.') %
                          {'hdisk': device_name, 'vios': vio_wrap.name,
                           'volume_id': volume_id, 'status': str(status)})
-                self._add_mapping(adapter, host_uuid, vm_uuid, vio_wrap.uuid,
-                                  device_name)
-                connection_info['data']['target_UDID'] = udid
-                self._set_udid(instance, vio_wrap.uuid, volume_id, udid)
-                LOG.info(_LI('Device attached: %s'), device_name)
-                hdisk_found = True
+                found.append((vio_wrap, device_name, udid))
             elif status == hdisk.LUAStatus.DEVICE_IN_USE:
                 LOG.warn(_LW('Discovered device %(dev)s for volume %(volume)s '
                              'on %(vios)s is in use Errorcode: %(status)s.'),
                          {'dev': device_name, 'volume': volume_id,
                           'vios': vio_wrap.name, 'status': str(status)})
-        # A valid hdisk was not found so log and exit
-        if not hdisk_found:
-            msg = (_LE('Failed to discover valid hdisk on any Virtual I/O '
-                       'Server for volume %(volume_id)s.') %
-                   {'volume_id': volume_id})
-            LOG.error(msg)
-            if device_name is None:
-                device_name = 'None'
-            ex_args = {'backing_dev': device_name,
-                       'instance_name': instance.name,
-                       'reason': six.text_type(msg)}
-            raise pexc.VolumeAttachFailed(**ex_args)
+
+        return found, device_name
+
+    @staticmethod
+    def _no_hdisk_error(instance, volume_id, device_name):
+        """Logs and builds the error for a volume no VIOS found an hdisk for.
+
+        :param instance: The nova instance.
+        :param volume_id: The lun volume id.
+        :param device_name: The last device name discovered, or None.
+        :return: The VolumeAttachFailed to raise.
+        """
+        msg = (_LE('Failed to discover valid hdisk on any Virtual I/O '
+                   'Server for volume %(volume_id)s.') %
+               {'volume_id': volume_id})
+        LOG.error(msg)
+        if device_name is None:
+            device_name = 'None'
+        ex_args = {'backing_dev': device_name,
+                   'instance_name': instance.name,
+                   'reason': six.text_type(msg)}
+        return pexc.VolumeAttachFailed(**ex_args)
+
+    def pre_live_migration_on_destination(self, adapter, host_uuid,
+                                          instance, connection_info):
+        """Discovers the hdisk of the volume for a migrating instance.
+
+        The migration maps the hdisks on this host's VIOSes, so they must
+        have been discovered here first.  The UDIDs are recorded by
+        post_live_migration_at_destination, once the LPAR is on the host.
+
+        :param adapter: The pypowervm adapter.
+        :param host_uuid: The pypowervm UUID of the host.
+        :param instance: The nova instance being migrated.
+        :param connection_info: The connection_info of the volume.
+        """
+        volume_id = connection_info['data']['volume_id']
+        found, device_name = self._discover_volume(adapter, host_uuid,
+                                                   connection_info)
+        if not found:
+            raise self._no_hdisk_error(instance, volume_id, device_name)
+        self._migrating[(instance.uuid, volume_id)] = [
+            (vio_wrap.uuid, device_name, udid)
+            for vio_wrap, device_name, udid in found]
+
+    def post_live_migration_at_destination(self, adapter, host_uuid,
+                                           instance, connection_info,
+                                           lpar_id):
+        """Records the UDIDs of the hdisks of a migrated instance's volume.
+
+        :param adapter: The pypowervm adapter.
+        :param host_uuid: The pypowervm UUID of the host.
+        :param instance: The nova instance that was migrated.
+        :param connection_info: The connection_info of the volume.
+        :param lpar_id: The partition ID of the LPAR on this host.
+        """
+        volume_id = connection_info['data']['volume_id']
+        index = UDIDIndex.get(adapter, host_uuid)
+        for vios_uuid, device_name, udid in self._migrating.pop(
+                (instance.uuid, volume_id), []):
+            self._record_udid(instance, index, connection_info, udid,
+                              vios_uuid, device_name, lpar_id)
+
+    def rollback_live_migration_at_destination(self, adapter, host_uuid,
+                                               instance, connection_info):
+        """Removes the hdisks discovered for a failed migration.
+
+        :param adapter: The pypowervm adapter.
+        :param host_uuid: The pypowervm UUID of the host.
+        :param instance: The nova instance that was being migrated.
+        :param connection_info: The connection_info of the volume.
+        """
+        volume_id = connection_info['data']['volume_id']
+        for vios_uuid, device_name, udid in self._migrating.pop(
+                (instance.uuid, volume_id), []):
+            self._remove_hdisk(adapter, vios_uuid, device_name)
 
     def disconnect_volume(self, adapter, host_uuid, vm_uuid, instance,
-                          connection_info):
+                          connection_info, mapping_acc=None, lpar_id=None):
         """Disconnect the volume.
 
         :param adapter: The pypowervm adapter.
@@ -159,67 +1026,69 @@ class VscsiVolumeAdapter(v_driver.FibreChannelVolumeAdapter):
                    'access_mode':'rw',
                    'target_wwn':'500507680210E522'
                 }
+        :param mapping_acc: Optional VscsiMappingAccumulator.  If set, the
+                            mapping removals are queued on it.  The hdisks
+                            are removed once it has been applied.
+        :param lpar_id: (Optional) The partition ID of the VM.  If not set,
+                        it is looked up from the vm_uuid.
         """
 
         volume_id = connection_info['data']['volume_id']
+        device_name = None
 
         try:
-            # Get VIOS feed
-            vios_feed = vios.get_active_vioses(adapter, host_uuid,
-                                               xag=_XAGS)
+            index = UDIDIndex.get(adapter, host_uuid)
+            udids = self._get_udids(index, instance, connection_info)
+            if not udids:
+                LOG.warn(_LW(u"Disconnect Volume: No hdisk UDID was found "
+                             "for volume %(volume_id)s on instance "
+                             "%(instance)s.")
+                         % {'volume_id': volume_id,
+                            'instance': instance.name})
+                return
 
-            # Iterate through host vios list to find hdisks to disconnect.
-            for vio_wrap in vios_feed:
-                LOG.debug("vios uuid %s" % vio_wrap.uuid)
-                try:
-                    volume_udid = self._get_udid(instance, vio_wrap.uuid,
-                                                 volume_id)
-                    device_name = vio_wrap.hdisk_from_uuid(volume_udid)
-
-                    if not device_name:
-                        LOG.info(_LI(u"Disconnect Volume: No mapped device "
-                                     "found on vios %(vios)s for volume "
-                                     "%(volume_id)s. volume_uid: "
-                                     "%(volume_uid)s ")
-                                 % {'volume_uid': volume_udid,
-                                    'volume_id': volume_id,
-                                    'vios': vio_wrap.name})
-                        continue
+            partition_id = lpar_id
+            if partition_id is None:
+                partition_id = vm.get_vm_id(adapter, vm_uuid)
 
-                except Exception as e:
-                    LOG.error(_LE(u"Disconnect Volume: Failed to find disk "
-                                  "on vios %(vios_name)s for volume "
-                                  "%(volume_id)s. volume_uid: %(volume_uid)s."
-                                  "Error: %(error)s")
-                              % {'error': e, 'volume_uid': volume_udid,
-                                 'volume_id': volume_id,
-                                 'vios_name': vio_wrap.name})
+            # Without an accumulator from the caller, the removals are still
+            # gathered so that each VIOS is read and updated only once.
+            own_acc = mapping_acc is None
+            if own_acc:
+                mapping_acc = VscsiMappingAccumulator(adapter, host_uuid)
+            mapping_acc.set_lpar_id(vm_uuid, partition_id)
+
+            for volume_udid in udids:
+                locations = index.lookup(volume_udid, partition_id)
+                if not locations:
+                    LOG.info(_LI(u"Disconnect Volume: No mapped device "
+                                 "found for volume %(volume_id)s. "
+                                 "volume_uid: %(volume_uid)s ")
+                             % {'volume_uid': volume_udid,
+                                'volume_id': volume_id})
                     continue
 
-                # We have found the device name
-                LOG.info(_LI(u"Disconnect Volume: Discovered the device "
-                             "%(hdisk)s on vios %(vios_name)s for volume "
-                             "%(volume_id)s. volume_uid: %(volume_uid)s.")
-                         % {'volume_uid': volume_udid, 'volume_id': volume_id,
-                            'vios_name': vio_wrap.name, 'hdisk': device_name})
-                partition_id = vm.get_vm_id(adapter, vm_uuid)
-                tsk_map.remove_pv_mapping(adapter, vio_wrap.uuid,
-                                          partition_id, device_name)
+                for vios_uuid, device_name in locations:
+                    LOG.info(_LI(u"Disconnect Volume: Discovered the device "
+                                 "%(hdisk)s on vios %(vios)s for volume "
+                                 "%(volume_id)s. volume_uid: "
+                                 "%(volume_uid)s.")
+                             % {'volume_uid': volume_udid,
+                                'volume_id': volume_id, 'vios': vios_uuid,
+                                'hdisk': device_name})
+                    rm_hdisk = functools.partial(
+                        self._rm_hdisk, adapter, instance, index, volume_udid,
+                        partition_id, vios_uuid, volume_id, device_name)
+                    mapping_acc.remove_mapping(vios_uuid, vm_uuid,
+                                               device_name,
+                                               post_apply=rm_hdisk)
 
+            if own_acc:
                 try:
-                    # Attempt to remove the hDisk
-                    hdisk.remove_hdisk(adapter, CONF.host, device_name,
-                                       vio_wrap.uuid)
-                except Exception as e:
-                    # If there is a failure, log it, but don't stop the process
-                    msg = (_LW("There was an error removing the hdisk "
-                               "%(disk)s from the Virtual I/O Server.") %
-                           {'disk': device_name})
-                    LOG.warn(msg)
-                    LOG.warn(e)
-
-                # Disconnect volume complete, now remove key
-                self._delete_udid_key(instance, vio_wrap.uuid, volume_id)
+                    mapping_acc.apply()
+                except Exception:
+                    with excutils.save_and_reraise_exception():
+                        mapping_acc.rollback()
 
         except Exception as e:
             LOG.error(_LE('Cannot detach volumes from virtual machine: %s') %
@@ -230,6 +1099,77 @@ class VscsiVolumeAdapter(v_driver.FibreChannelVolumeAdapter):
                        'reason': six.text_type(e)}
             raise pexc.VolumeDetachFailed(**ex_args)
 
+    def _rm_hdisk(self, adapter, instance, index, udid, partition_id,
+                  vios_uuid, volume_id, device_name):
+        """Removes an unmapped hdisk and the records of its UDID.
+
+        :param adapter: The pypowervm API adapter.
+        :param instance: The nova instance.
+        :param index: The UDIDIndex of the host.
+        :param udid: The UDID of the hdisk.
+        :param partition_id: The short ID of the LPAR it was mapped to.
+        :param vios_uuid: The UUID of the vios for the pypowervm adapter.
+        :param volume_id: The lun volume id
+        :param device_name: The hdisk device name
+        """
+        self._remove_hdisk(adapter, vios_uuid, device_name)
+
+        # Disconnect volume complete, now remove key
+        self._forget_udid(instance, index, udid, vios_uuid, partition_id,
+                          volume_id)
+
+    @staticmethod
+    def _remove_hdisk(adapter, vios_uuid, device_name):
+        """Removes an unmapped hdisk from a VIOS.  Failures are logged.
+
+        :param adapter: The pypowervm API adapter.
+        :param vios_uuid: The UUID of the vios for the pypowervm adapter.
+        :param device_name: The hdisk device name
+        """
+        try:
+            # Attempt to remove the hDisk
+            hdisk.remove_hdisk(adapter, CONF.host, device_name, vios_uuid)
+        except Exception as e:
+            # If there is a failure, log it, but don't stop the process
+            msg = (_LW("There was an error removing the hdisk "
+                       "%(disk)s from the Virtual I/O Server.") %
+                   {'disk': device_name})
+            LOG.warn(msg)
+            LOG.warn(e)
+        _discovery_cache.invalidate(vios_uuid, device_name)
+
+    def _record_udid(self, instance, index, connection_info, udid,
+                     vios_uuid, device_name, partition_id):
+        """Records the UDID of a newly mapped hdisk for the detach.
+
+        :param instance: The nova instance.
+        :param index: The UDIDIndex of the host.
+        :param connection_info: The connection_info of the volume.
+        :param udid: The UDID of the hdisk.
+        :param vios_uuid: The UUID of the VIOS the hdisk is on.
+        :param device_name: The hdisk device name.
+        :param partition_id: The short ID of the LPAR it is mapped to.
+        """
+        volume_id = connection_info['data']['volume_id']
+        index.add(udid, vios_uuid, device_name, partition_id,
+                  volume_id=volume_id)
+        connection_info['data']['target_UDID'] = udid
+        self._set_udid(instance, vios_uuid, volume_id, udid)
+
+    def _forget_udid(self, instance, index, udid, vios_uuid, partition_id,
+                     volume_id):
+        """Removes the records of an hdisk that is no longer mapped.
+
+        :param instance: The nova instance.
+        :param index: The UDIDIndex of the host.
+        :param udid: The UDID of the hdisk.
+        :param vios_uuid: The UUID of the VIOS the hdisk is on.
+        :param partition_id: The short ID of the LPAR it was mapped to.
+        :param volume_id: The lun volume id
+        """
+        index.remove(udid, vios_uuid, partition_id)
+        self._delete_udid_key(instance, vios_uuid, volume_id)
+
     def wwpns(self, adapter, host_uuid, instance):
         """Builds the WWPNs of the adapters that will connect the ports.
 
@@ -238,9 +1178,7 @@ class VscsiVolumeAdapter(v_driver.FibreChannelVolumeAdapter):
         :param instance: The nova instance.
         :returns: The list of WWPNs that need to be included in the zone set.
         """
-        if self._pfc_wwpns is None:
-            self._pfc_wwpns = vios.get_physical_wwpns(adapter, host_uuid)
-        return self._pfc_wwpns
+        return self._physical_wwpns(adapter, host_uuid).get()
 
     def host_name(self, adapter, host_uuid, instance):
         """Derives the host name that should be used for the storage device.
@@ -265,29 +1203,77 @@ class VscsiVolumeAdapter(v_driver.FibreChannelVolumeAdapter):
         """
         pv = pvm_stor.PV.bld(adapter, device_name)
         tsk_map.add_vscsi_mapping(host_uuid, vios_uuid, vm_uuid, pv)
+        vios.invalidate_vios_feed(host_uuid, vios_uuid)
+
+    def _get_udids(self, index, instance, connection_info):
+        """Returns the hdisk UDIDs recorded for a volume.
 
-    def _get_udid(self, instance, vios_uuid, volume_id):
-        """This method will return the hdisk udid stored in system metadata.
+        The UDID is taken from the connection_info, from the volumes the
+        index has seen connected, and from the system_metadata kept for each
+        VIOS.  Any one of them is enough to find the hdisks in the index.  If
+        none of them has it, for example because the system_metadata was lost
+        and the driver restarted since the connect, the hdisk of the volume's
+        ITLs is looked up on the VIOSes instead.
 
-        TODO(IBM):Temporary method to persist udid will be replaced with
-        vios read support
+        :param index: The UDIDIndex of the host.
         :param instance: The nova instance.
-        :param vios_uuid: The UUID of the vios for the pypowervm adapter.
-        :param volume_id: The lun volume id
-        :returns: The target_udid associated with the hdisk
+        :param connection_info: The connection_info of the volume.
+        :returns: The set of UDIDs.  Empty if the hdisk could not be found.
         """
-        try:
-            udid_key = self._build_udid_key(vios_uuid, volume_id)
-            return instance.system_metadata[udid_key]
-        except (KeyError, ValueError) as e:
-            LOG.exception(_LE(u'Failed to retrieve deviceid key: %s') % e)
-            return None
+        volume_id = connection_info['data']['volume_id']
+        udids = set()
+        for udid in (connection_info['data'].get('target_UDID'),
+                     index.volume_udid(volume_id)):
+            if udid:
+                udids.add(udid)
+        for key, udid in instance.system_metadata.items():
+            # The keys are the VIOS UUID followed by the volume ID.
+            if key.endswith(volume_id) and len(key) > len(volume_id):
+                udids.add(udid)
+        if not udids:
+            udids = self._discover_udids(index.adapter, index.host_uuid,
+                                         connection_info)
+        return udids
+
+    def _discover_udids(self, adapter, host_uuid, connection_info):
+        """Finds the UDIDs of a volume's hdisk from its ITLs.
+
+        :param adapter: The pypowervm adapter.
+        :param host_uuid: The pypowervm UUID of the host.
+        :param connection_info: The connection_info of the volume.
+        :returns: The set of UDIDs the VIOSes report for the ITLs.
+        """
+        it_map = connection_info['data']['initiator_target_map']
+        t_wwpns = []
+        for it_list in it_map.values():
+            t_wwpns.extend(it_list)
+        itls = hdisk.build_itls(it_map.keys(), t_wwpns,
+                                connection_info['data']['target_lun'])
+
+        def _discover(vio_wrap):
+            return hdisk.discover_hdisk(adapter, vio_wrap.uuid, itls)
+
+        udids = set()
+        vios_feed = vios.get_active_vioses(adapter, host_uuid)
+        for vio_wrap, result, error in _run_on_vioses(_discover, vios_feed):
+            if error is not None:
+                LOG.warn(_LW('Failed to find the hdisk for volume %(volume)s '
+                             'on %(vios)s.  Error: %(error)s'),
+                         {'volume': connection_info['data']['volume_id'],
+                          'vios': vio_wrap.name, 'error': error})
+                continue
+            # The hdisk is normally still mapped, so in use is fine here.
+            status, device_name, udid = result
+            if udid:
+                udids.add(udid)
+        return udids
 
     def _set_udid(self, instance, vios_uuid, volume_id, udid):
         """This method will set the hdisk udid in the system_metadata.
 
-        TODO(IBM):Temporary method to persist udid will be replaced with
-        vios read support
+        Nova does not save changes to the connection_info made while an
+        instance is spawned, so this is where the UDID that a detach looks
+        up in the UDIDIndex is kept.
         :param instance: The nova instance.
         :param vios_uuid: The UUID of the vios for the pypowervm adapter.
         :param volume_id: The lun volume id
@@ -299,22 +1285,19 @@ class VscsiVolumeAdapter(v_driver.FibreChannelVolumeAdapter):
     def _delete_udid_key(self, instance, vios_uuid, volume_id):
         """This method will delete udid key stored in the system_metadata.
 
-        TODO(IBM):Temporary method to persist udid will be replaced with
-        vios read support
         :param instance: The nova instance.
         :param volume_id: The lun volume id
         """
         try:
             udid_key = self._build_udid_key(vios_uuid, volume_id)
-            instance.system_metadata.pop(udid_key)
+            # Not there if the system_metadata was lost.
+            instance.system_metadata.pop(udid_key, None)
         except Exception as e:
             LOG.exception(_LE(u'Failed to delete deviceid key: %s') % e)
 
     def _build_udid_key(self, vios_uuid, volume_id):
         """This method will build the udid dictionary key.
 
-        TODO(IBM):Temporary method to persist udid will be replaced with
-        vios read support
         :param vios_uuid: The UUID of the vios for the pypowervm adapter.
         :param volume_id: The lun volume id
         :returns: The udid dictionary key
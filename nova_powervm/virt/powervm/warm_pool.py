@@ -0,0 +1,270 @@
+# Copyright 2015 IBM Corp.
+#
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import eventlet
+import hashlib
+import threading
+import uuid
+
+from nova import context as ctx
+from nova import exception
+from nova.i18n import _LI, _LW
+from nova.objects import flavor as flavor_obj
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_utils import excutils
+from pypowervm.wrappers import logical_partition as pvm_lpar
+
+from nova_powervm.virt.powervm import vm
+
+LOG = logging.getLogger(__name__)
+CONF = cfg.CONF
+
+# The name of a pool LPAR is the prefix, a tag of its flavor ID, a tag of the
+# LPAR settings of the flavor and a random suffix.  The tags keep the name
+# short, whatever the flavor is.
+SHELL_PREFIX = 'pvm-warm-'
+
+
+def is_shell(name):
+    """Returns whether an LPAR name is that of a warm pool LPAR."""
+    return name.startswith(SHELL_PREFIX)
+
+
+def _flavor_tag(flavorid):
+    """Returns the tag of a flavor ID used in the pool LPAR names."""
+    return hashlib.md5(flavorid.encode('utf-8')).hexdigest()[:8]
+
+
+def _settings_tag(flavor):
+    """Returns the tag of the LPAR settings of a flavor.
+
+    The tag changes with the settings that the LPAR is built with, such as
+    the extra specs of the flavor.
+
+    :raises InvalidAttribute: If the flavor is not valid.
+    """
+    attrs = sorted(vm.get_flavor_attrs(flavor).items())
+    return hashlib.md5(repr(attrs).encode('utf-8')).hexdigest()[:8]
+
+
+def _parse_name(name):
+    """Returns the (flavor tag, settings tag) of a pool LPAR name.
+
+    The settings tag is None for a name without one.
+    """
+    parts = name[len(SHELL_PREFIX):].split('-')
+    return parts[0], (parts[1] if len(parts) > 2 else None)
+
+
+class WarmPool(object):
+    """Powered off LPARs, created ahead of time for the warm pool flavors.
+
+    Each LPAR already has the secure RMC adapter.  A spawn of one of the
+    flavors renames an LPAR of the pool instead of creating a new one, and
+    the pool is refilled in the background.
+    """
+
+    def __init__(self, adapter, host_wrapper):
+        self.adapter = adapter
+        self.host_wrapper = host_wrapper
+        self.host_uuid = host_wrapper.uuid
+        self._lock = threading.Lock()
+        # Flavor ID -> the (UUID, settings tag) of the pool LPARs for it.
+        self._shells = {}
+        self._loaded = False
+        self._filling = False
+
+    @staticmethod
+    def enabled():
+        return CONF.warm_pool_size > 0 and bool(CONF.warm_pool_flavors)
+
+    def size(self):
+        """Returns the number of LPARs in the pool."""
+        with self._lock:
+            return sum(len(shells) for shells in self._shells.values())
+
+    def claim(self, instance, flavor):
+        """Takes an LPAR of the pool and makes it the instance's LPAR.
+
+        Only an LPAR built with the current settings of the flavor is used.
+        The others are left for the fill to delete.
+
+        :param instance: The nova instance.
+        :param flavor: The nova flavor of the instance.
+        :return: The LPAR wrapper, renamed for the instance.  None if the
+                 pool had no LPAR for the flavor.
+        """
+        if not self.enabled() or (
+                flavor.flavorid not in CONF.warm_pool_flavors):
+            return None
+        try:
+            tag = _settings_tag(flavor)
+        except exception.InvalidAttribute:
+            # The create of the LPAR fails the same way.
+            return None
+
+        lpar_uuid = None
+        with self._lock:
+            shells = self._shells.get(flavor.flavorid, [])
+            for shell in reversed(shells):
+                if shell[1] == tag:
+                    shells.remove(shell)
+                    lpar_uuid = shell[0]
+                    break
+        if lpar_uuid is None:
+            self.fill()
+            return None
+
+        try:
+            lpar_w = vm.rename(self.adapter, self.host_uuid, instance,
+                               lpar_uuid)
+            LOG.info(_LI('Using warm pool LPAR %(lpar)s for instance '
+                         '%(inst)s.'), {'lpar': lpar_uuid,
+                                        'inst': instance.name})
+        except Exception as e:
+            LOG.warn(_LW('Unable to use warm pool LPAR %(lpar)s for instance '
+                         '%(inst)s, a new LPAR will be created: %(error)s'),
+                     {'lpar': lpar_uuid, 'inst': instance.name, 'error': e})
+            self._delete(lpar_uuid)
+            lpar_w = None
+        self.fill()
+        return lpar_w
+
+    def fill(self):
+        """Refills the pool in the background.
+
+        The first fill also adopts the pool LPARs of an earlier run.  It runs
+        even if the pool is disabled, so that the LPARs left behind by an
+        earlier run with the pool enabled are deleted.
+        """
+        with self._lock:
+            if self._filling or (self._loaded and not self.enabled()):
+                return
+            self._filling = True
+
+        def _run():
+            try:
+                if not self._loaded:
+                    self._load()
+                if self.enabled():
+                    self._fill()
+            except Exception as e:
+                LOG.warn(_LW('Unable to fill the warm LPAR pool: %s'), e)
+            finally:
+                with self._lock:
+                    self._filling = False
+        eventlet.spawn_n(_run)
+
+    def _load(self):
+        """Adopts the pool LPARs left on the host by an earlier run.
+
+        LPARs of flavors that are no longer in the pool, or that were built
+        with other settings than the flavor's current ones, are deleted.  So
+        are all of them if the pool is disabled.
+        """
+        feed = vm.get_lpar_feed(self.adapter, self.host_uuid)
+        if feed is None:
+            return
+        flavors = self._pool_flavors() if self.enabled() else []
+        tags = dict((_flavor_tag(flavor.flavorid), (flavor.flavorid, tag))
+                    for flavor, tag in flavors)
+        for entry in feed.entries:
+            lpar_w = pvm_lpar.LPAR.wrap(entry)
+            if not is_shell(lpar_w.name):
+                continue
+            flavor_tag, settings_tag = _parse_name(lpar_w.name)
+            flavorid, tag = tags.get(flavor_tag, (None, None))
+            if flavorid is None or settings_tag != tag:
+                self._delete(lpar_w.uuid)
+                continue
+            with self._lock:
+                self._shells.setdefault(flavorid, []).append(
+                    (lpar_w.uuid, tag))
+        self._loaded = True
+
+    def _pool_flavors(self):
+        """Returns the (flavor, settings tag) of each warm pool flavor.
+
+        Flavors that are not found or not valid are skipped.
+        """
+        admin_ctx = ctx.get_admin_context()
+        flavors = []
+        for flavorid in CONF.warm_pool_flavors:
+            try:
+                flavor = flavor_obj.Flavor.get_by_flavor_id(admin_ctx,
+                                                            flavorid)
+                flavors.append((flavor, _settings_tag(flavor)))
+            except exception.FlavorNotFound:
+                LOG.warn(_LW('Warm pool flavor %s was not found.'), flavorid)
+            except exception.InvalidAttribute:
+                LOG.warn(_LW('Warm pool flavor %s is not valid.'), flavorid)
+        return flavors
+
+    def _fill(self):
+        for flavor, tag in self._pool_flavors():
+            flavorid = flavor.flavorid
+
+            # The LPARs built with older settings of the flavor are deleted.
+            with self._lock:
+                shells = self._shells.get(flavorid, [])
+                stale = [shell for shell in shells if shell[1] != tag]
+                for shell in stale:
+                    shells.remove(shell)
+            for lpar_uuid, old_tag in stale:
+                LOG.info(_LI('Deleting warm pool LPAR %s, built with older '
+                             'settings of its flavor.'), lpar_uuid)
+                self._delete(lpar_uuid)
+
+            while True:
+                with self._lock:
+                    if (len(self._shells.get(flavorid, [])) >=
+                            CONF.warm_pool_size):
+                        break
+                lpar_uuid = self._crt_shell(flavor, tag)
+                with self._lock:
+                    self._shells.setdefault(flavorid, []).append(
+                        (lpar_uuid, tag))
+
+    def _crt_shell(self, flavor, tag):
+        """Creates a pool LPAR for a flavor.
+
+        :param flavor: The nova flavor.
+        :param tag: The settings tag of the flavor.
+        :return: The UUID of the new LPAR.
+        """
+        name = '%s%s-%s-%s' % (SHELL_PREFIX, _flavor_tag(flavor.flavorid),
+                               tag, uuid.uuid4().hex[:8])
+        lpar_w = vm.crt_lpar_shell(self.adapter, self.host_wrapper, name,
+                                   flavor)
+        try:
+            # Same as for a spawn, the secure RMC adapter is only added if
+            # the host has the vSwitch.
+            if vm.get_secure_rmc_vswitch(self.adapter,
+                                         self.host_uuid) is not None:
+                vm.crt_secure_rmc_cna(self.adapter, self.host_uuid,
+                                      lpar_w.uuid)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                self._delete(lpar_w.uuid)
+        return lpar_w.uuid
+
+    def _delete(self, lpar_uuid):
+        try:
+            vm.dlt_lpar(self.adapter, lpar_uuid)
+        except Exception as e:
+            LOG.warn(_LW('Unable to delete warm pool LPAR %(lpar)s: '
+                         '%(error)s'), {'lpar': lpar_uuid, 'error': e})